@@ -0,0 +1,140 @@
+"""
+Consolidated reporting over many portfolio databases.
+
+Each portfolio .db file is summarized in its own worker process: positions,
+net worth in its primary currency, realized gains and the tax estimate for the
+year. The
+summaries are then merged into one report, with the time each file took.
+
+Usage:
+    python aggregate.py "portfolios/*.db" [--workers N] [--year YYYY] [--output report.json]
+    python aggregate.py portfolios/                  # every .db file in the directory
+"""
+import argparse
+import datetime
+import glob
+import json
+import multiprocessing
+import os
+import time
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+
+import db
+
+
+def find_portfolios(pattern):
+    """ The .db files in a directory, or those matching a glob pattern, sorted """
+    if os.path.isdir(pattern):
+        pattern = os.path.join(pattern, "*.db")
+    return sorted(glob.glob(pattern))
+
+
+def summarize(db_file, year=None):
+    """ Summarize one portfolio. Runs in a worker process; returns plain data, timings included """
+    import lifo
+    import networth
+    import tax
+
+    year = year or datetime.date.today().year
+    summary = {"file": db_file, "timings": {}}
+    started = time.perf_counter()
+    try:
+        db.create_tables(db_file)
+
+        step = time.perf_counter()
+        summary["positions"] = [list(row) for row in db.fetch_asset_overview(db_file)]
+        summary["timings"]["positions"] = time.perf_counter() - step
+
+        step = time.perf_counter()
+        end_date = min(datetime.date(year, 12, 31), datetime.date.today())
+        series = networth.net_worth_series(db_file, end_date=end_date)
+        currency_id = networth.primary_currency_id(db_file)
+        summary["currency"] = db.get_currency_code(db_file, currency_id) if currency_id is not None else None
+        summary["net_worth"] = float(series.iloc[-1]) if len(series) else 0.0
+        summary["timings"]["net_worth"] = time.perf_counter() - step
+
+        step = time.perf_counter()
+        lifo.get_engine(db_file).sync()
+        summary["realized_gains"] = lifo.realized_gains(db_file, f"{year}-01-01", f"{year}-12-31")
+        summary["timings"]["realized_gains"] = time.perf_counter() - step
+
+        step = time.perf_counter()
+        summary["tax"] = tax.estimate(db_file, year)["tax"]
+        summary["timings"]["tax"] = time.perf_counter() - step
+    except Exception as e:
+        summary["error"] = f"{type(e).__name__}: {e}"
+    finally:
+        db.close_db(db_file)
+    summary["timings"]["total"] = time.perf_counter() - started
+    return summary
+
+
+def merge(summaries):
+    """ Merge per-file summaries into a consolidated report """
+    net_worth = defaultdict(float)
+    tax = 0.0
+    positions = defaultdict(float)
+    gains = {"harmonised": defaultdict(float), "non_harmonised": defaultdict(float)}
+    for summary in summaries:
+        if "error" in summary:
+            continue
+        net_worth[summary["currency"]] += summary["net_worth"]
+        tax += summary["tax"]
+        for asset_name, location_name, quantity in summary["positions"]:
+            positions[asset_name] += quantity
+        for bucket, totals in summary["realized_gains"].items():
+            for currency_code, gain in totals.items():
+                gains[bucket][currency_code] += gain
+    return {
+        "portfolios": len(summaries),
+        "failed": [{"file": summary["file"], "error": summary["error"]} for summary in summaries if "error" in summary],
+        "net_worth": dict(net_worth),
+        "positions": dict(sorted(positions.items())),
+        "realized_gains": {bucket: dict(totals) for bucket, totals in gains.items()},
+        "tax": tax,
+        "timings": {summary["file"]: summary["timings"] for summary in summaries},
+    }
+
+
+def aggregate(paths, max_workers=None, year=None):
+    """ Summarize every portfolio in paths on a pool of processes and merge the results.
+
+    Workers are spawned rather than forked, so none of them inherits an open
+    SQLite connection from this process.
+    """
+    started = time.perf_counter()
+    max_workers = max_workers or os.cpu_count() or 1
+    if max_workers == 1 or len(paths) <= 1:
+        summaries = [summarize(path, year) for path in paths]
+    else:
+        with ProcessPoolExecutor(max_workers=max_workers, mp_context=multiprocessing.get_context("spawn")) as pool:
+            summaries = list(pool.map(summarize, paths, [year] * len(paths)))
+    report = merge(summaries)
+    report["workers"] = max_workers
+    report["seconds"] = time.perf_counter() - started
+    return report
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Consolidated report over many portfolio databases")
+    parser.add_argument("pattern", help="a directory of .db files, or a glob pattern")
+    parser.add_argument("--workers", type=int, help="worker processes (default: one per core)")
+    parser.add_argument("--year", type=int, help="year of the realized gains (default: this year)")
+    parser.add_argument("--output", help="JSON file to write the report to (default: standard output)")
+    args = parser.parse_args(argv)
+
+    paths = find_portfolios(args.pattern)
+    if not paths:
+        parser.error(f"no portfolio found for {args.pattern}")
+    report = aggregate(paths, args.workers, args.year)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=1)
+    else:
+        print(json.dumps(report, indent=1))
+    return 1 if report["failed"] else 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,294 @@
+"""
+Performance analytics, to compare investments with each other.
+
+analyze() computes, for every asset market, every location and the whole
+portfolio at once, from the daily matrices of networth.py:
+
+- the time-weighted return (TWR), which leaves out the effect of when money
+  was put in or taken out: each day's return is the change in value net of the
+  day's trades, and the daily returns are compounded;
+- the money-weighted return (XIRR), the yearly rate at which the trades and
+  the final value discount to zero, found by Newton's method for all the
+  series together;
+- the maximum drawdown of the time-weighted growth;
+- the volatility of the weekday returns over a rolling window, annualized,
+  their rolling correlation with the whole portfolio, and the correlation
+  matrix of the last window.
+
+Values and trades are converted to one currency (the primary currency by
+default) at the rate of their day. A day with trades is split in two at the
+trade price: what was held is marked at that price, and the return before the
+trade is compounded with the return of what is held after it, so buying more
+of something does not dilute the gain made on what was held already.
+
+The arrays come from networth.get_arrays(), and the results are cached under
+db.data_version(): asking again with nothing written in between is a
+dictionary lookup.
+"""
+import datetime
+import threading
+from collections import namedtuple
+
+import numpy as np
+import pandas as pd
+
+import db
+import fx
+import models
+import networth
+
+WINDOW_DAYS = 63            # rolling window, in weekdays: about three months
+PERIODS_PER_YEAR = 252      # weekdays in a year, to annualize the volatility
+XIRR_ITERATIONS = 20
+XIRR_BISECTIONS = 40
+XIRR_TOLERANCE = 1e-9
+# Bounds of the continuous yearly rate XIRR is searched within, -99.3% to +14700% a year
+XIRR_BOUNDS = (-5.0, 5.0)
+# Brackets bisected when Newton's method fails, narrowest first: the flows of a series
+# that buys and sells a lot can have several rates, and the one closest to 0 is the telling one
+XIRR_BRACKETS = ((-0.5, 0.5), (-1.5, 1.5), XIRR_BOUNDS)
+
+Analytics = namedtuple("Analytics", [
+    "summary",              # DataFrame with a row per series, see SUMMARY_COLUMNS
+    "growth",               # DataFrame of the time-weighted growth of 1, day by day, a column per series
+    "rolling_volatility",   # DataFrame, weekday by weekday
+    "rolling_correlation",  # with the whole portfolio, weekday by weekday
+    "correlation",          # DataFrame, correlation matrix of the weekday returns of the last window
+])
+# Series are indexed by (kind, id): ("asset_market", id), ("location", id) and ("portfolio", 0)
+SUMMARY_COLUMNS = ["name", "first_date", "invested", "value", "twr", "twr_annualized", "xirr",
+                   "max_drawdown", "volatility", "correlation"]
+
+
+def series_matrices(arrays, currency_id, first_day, n_days, pivots=()):
+    """ (values, flows, marks, keys), as (n_days, n_series) matrices: the value of each series at the end of each
+    day, the net amount traded into it during the day (purchases positive), and what was held before the day's
+    trades, valued at the trade price (the value of the day before if there were none); and the (kind, id) of
+    each column
+    """
+    values, holdings, rates = networth.daily_values(arrays, currency_id, first_day, n_days, pivots)
+    # As for the net worth, what cannot be valued yet is left out, its trades too
+    values = np.nan_to_num(values)
+    flows = np.zeros_like(values)
+    inside = arrays.trade_days < first_day + n_days
+    days = np.maximum(arrays.trade_days[inside] - first_day, 0)
+    columns = arrays.trade_columns[inside]
+    amounts = arrays.trade_quantities[inside] * arrays.trade_prices[inside] * rates[days, columns]
+    np.add.at(flows, (days, columns), np.nan_to_num(amounts))
+    marks = np.vstack([np.zeros((1, values.shape[1])), values[:-1]])
+    # With several trades in a day, the last one's price is used
+    held_before = np.where(days > 0, holdings[days - 1, columns], 0.0)
+    marks[days, columns] = np.nan_to_num(held_before * arrays.trade_prices[inside] * rates[days, columns])
+
+    locations = np.unique(arrays.location_ids)
+    keys = ([("asset_market", int(asset_market_id)) for asset_market_id in arrays.asset_market_ids]
+            + [("location", int(location_id)) for location_id in locations] + [("portfolio", 0)])
+
+    membership = (arrays.location_ids[:, None] == locations[None, :]).astype(np.float64)
+
+    def grouped(matrix):
+        return np.column_stack([matrix, matrix @ membership, matrix.sum(axis=1)])
+
+    return grouped(values), grouped(flows), grouped(marks), keys
+
+
+def daily_returns(values, flows, marks):
+    """ (returns, held): the time-weighted return of each series on each day, 0 on the days nothing was held """
+    previous = np.vstack([np.zeros((1, values.shape[1])), values[:-1]])
+    after_trades = marks + flows
+    # Relative to the largest value, so that the rounding left by a closed position is not a holding
+    threshold = 1e-9 * np.maximum(np.abs(values).max(axis=0, initial=0), 1e-300)
+    # A position closed by the end of the day, or a short one, has no return after the trades
+    held_before, held_after = previous > threshold, (after_trades > threshold) & (values > threshold)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        before = np.where(held_before, marks / np.where(held_before, previous, 1), 1.0)
+        after = np.where(held_after, values / np.where(held_after, after_trades, 1), 1.0)
+    return before * after - 1, held_before | held_after
+
+
+def max_drawdown(growth):
+    """ The largest fall of each column of growth from its highest point before, as a negative fraction """
+    return (growth / np.maximum.accumulate(growth, axis=0) - 1).min(axis=0, initial=0)
+
+
+def xirr(series, years, amounts, n_series):
+    """ The yearly rate making the cash flows of each series discount to zero, NaN where there is none.
+
+    The flows are parallel arrays: the series each belongs to, when it happens
+    (in years from the first flow of its series) and its amount, positive for
+    money received. Newton's method runs on the continuous rate for every
+    series at once. The series it does not settle, or settles outside a narrower
+    bracket than need be, are bisected in the first of XIRR_BRACKETS their net
+    present value changes sign in.
+    """
+    def net_present_value(rates, series=series, years=years, amounts=amounts):
+        return np.bincount(series, amounts * np.exp(-rates[series] * years), n_series)
+
+    rates = np.full(n_series, 0.1)
+    npv = np.full(n_series, np.inf)
+    scale = np.bincount(series, np.abs(amounts), n_series)
+    for _ in range(XIRR_ITERATIONS):
+        discounted = amounts * np.exp(-rates[series] * years)
+        npv = np.bincount(series, discounted, n_series)
+        slope = -np.bincount(series, discounted * years, n_series)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            step = np.where(slope != 0, npv / slope, 0.0)
+        # Damped, so a far guess does not jump out of the bounds in one go
+        rates = np.clip(rates - np.clip(step, -1, 1), *XIRR_BOUNDS)
+        if np.all(np.abs(step) < XIRR_TOLERANCE):
+            break
+    solved = (np.abs(net_present_value(rates)) <= 1e-6 * scale) & (scale > 0)
+
+    low, high, low_npv = np.zeros(n_series), np.zeros(n_series), np.zeros(n_series)
+    bracketed = np.zeros(n_series, dtype=bool)
+    for bracket_low, bracket_high in XIRR_BRACKETS:
+        bracket_low_npv = net_present_value(np.full(n_series, bracket_low))
+        outside = ~solved | (rates < bracket_low) | (rates > bracket_high)
+        found = outside & ~bracketed & (np.sign(bracket_low_npv)
+                                         != np.sign(net_present_value(np.full(n_series, bracket_high))))
+        low[found], high[found], low_npv[found] = bracket_low, bracket_high, bracket_low_npv[found]
+        bracketed |= found
+    if bracketed.any():
+        entries = bracketed[series]
+        subset = series[entries], years[entries], amounts[entries]
+        for _ in range(XIRR_BISECTIONS):
+            middle = (low + high) / 2
+            middle_npv = net_present_value(middle, *subset)
+            lower = np.sign(middle_npv) == np.sign(low_npv)
+            low, low_npv = np.where(lower, middle, low), np.where(lower, middle_npv, low_npv)
+            high = np.where(lower, high, middle)
+        rates = np.where(bracketed, (low + high) / 2, rates)
+        solved |= bracketed
+    return np.where(solved, np.expm1(rates), np.nan)
+
+
+def money_weighted(values, flows):
+    """ The XIRR of each series: its trades as paid and received, and its value at the end as if sold """
+    n_days, n_series = values.shape
+    days, series = np.nonzero(flows)
+    amounts = -flows[days, series]
+    days = np.concatenate([days, np.full(n_series, n_days - 1)])
+    series = np.concatenate([series, np.arange(n_series)])
+    amounts = np.concatenate([amounts, values[-1]])
+    first = np.full(n_series, n_days - 1)
+    np.minimum.at(first, series, days)
+    return xirr(series, (days - first[series]) / 365.25, amounts, n_series)
+
+
+def rolling_statistics(returns, held, window):
+    """ (volatility, correlation): the annualized volatility of each column of returns, and its correlation with
+    the last column, over the window rows up to each row. Rows of a column where held is False are left out,
+    and a statistic with fewer than two rows is NaN
+    """
+    held = held.astype(np.float64)
+    x = returns * held
+    y = returns[:, -1:] * held
+
+    def window_sum(matrix):
+        totals = np.cumsum(matrix, axis=0)
+        if len(matrix) < window:
+            return totals[-1:]
+        sums = totals[window - 1:]
+        sums[1:] -= totals[:-window]
+        return sums
+
+    n, sx, sy = window_sum(held), window_sum(x), window_sum(y)
+    sxx, syy, sxy = window_sum(x * x), window_sum(y * y), window_sum(x * y)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        enough = n >= 2
+        var_x = np.where(enough, (sxx - sx * sx / n) / (n - 1), np.nan)
+        var_y = np.where(enough, (syy - sy * sy / n) / (n - 1), np.nan)
+        cov = np.where(enough, (sxy - sx * sy / n) / (n - 1), np.nan)
+        volatility = np.sqrt(np.maximum(var_x, 0) * PERIODS_PER_YEAR)
+        correlation = cov / np.sqrt(var_x * var_y)
+    return volatility, np.where(np.isfinite(correlation), np.clip(correlation, -1, 1), np.nan)
+
+
+def compute(arrays, currency_id, end_date=None, window=WINDOW_DAYS, pivots=(), names=None):
+    """ The Analytics of arrays, in currency_id, up to end_date (default today) """
+    names = names or {}
+    if not len(arrays.trade_days):
+        empty = pd.DataFrame()
+        return Analytics(pd.DataFrame(columns=SUMMARY_COLUMNS), empty, empty, empty, empty)
+    first_day, n_days = networth.day_range(arrays, end_date)
+    values, flows, marks, keys = series_matrices(arrays, currency_id, first_day, n_days, pivots)
+    columns = pd.MultiIndex.from_tuples(keys, names=["kind", "id"])
+    dates = networth.date_index(first_day, n_days)
+
+    returns, held = daily_returns(values, flows, marks)
+    growth = np.cumprod(1 + returns, axis=0)
+    held_days = held.sum(axis=0)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        twr_annualized = np.where(held_days > 0, growth[-1] ** (365.25 / held_days) - 1, np.nan)
+
+    # Weekday returns, with those of the weekend folded into Monday's: 1970-01-01, day 0, was a Thursday
+    weekdays = (np.arange(first_day, first_day + n_days) + 3) % 7 < 5
+    weekday_growth = growth[weekdays]
+    weekday_returns = weekday_growth / np.vstack([np.ones((1, len(keys))), weekday_growth[:-1]]) - 1
+    weekday_held = held[weekdays]
+    volatility, correlation = rolling_statistics(weekday_returns, weekday_held, window)
+    window_dates = dates[weekdays][-len(volatility):]
+
+    last = weekday_returns[-window:]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        matrix = np.corrcoef(last, rowvar=False) if len(last) >= 2 else np.full((len(keys), len(keys)), np.nan)
+
+    first_held = np.where(held.any(axis=0), held.argmax(axis=0), -1)
+    summary = pd.DataFrame({
+        "name": [names.get(key, "") for key in keys],
+        "first_date": [dates[day].date().isoformat() if day >= 0 else None for day in first_held],
+        "invested": np.maximum(flows, 0).sum(axis=0),
+        "value": values[-1],
+        "twr": growth[-1] - 1,
+        "twr_annualized": twr_annualized,
+        "xirr": money_weighted(values, flows),
+        "max_drawdown": max_drawdown(growth),
+        "volatility": volatility[-1],
+        "correlation": correlation[-1],
+    }, index=columns)
+    return Analytics(summary, pd.DataFrame(growth, index=dates, columns=columns),
+                     pd.DataFrame(volatility, index=window_dates, columns=columns),
+                     pd.DataFrame(correlation, index=window_dates, columns=columns),
+                     pd.DataFrame(matrix, index=columns, columns=columns))
+
+
+def series_names(db_file):
+    """ {(kind, id): name} of the series, from the reference tables """
+    identity_map = models.get_identity_map(db_file)
+    assets = {asset.id: asset for asset in identity_map.all(models.Asset)}
+    names = {("portfolio", 0): "Portfolio", ("location", -1): "No location"}
+    for location in identity_map.all(models.Location):
+        names[("location", location.id)] = location.name
+    for asset_market in identity_map.all(models.AssetMarket):
+        asset = assets.get(asset_market.asset_id)
+        symbol = asset.symbol if asset is not None and asset.symbol else asset_market.name
+        names[("asset_market", asset_market.id)] = f"{symbol} ({asset_market.name})" if symbol != asset_market.name else symbol
+    return names
+
+
+_results = {}
+_results_lock = threading.Lock()
+
+
+def analyze(db_file, currency_id=None, end_date=None, window=WINDOW_DAYS):
+    """ The Analytics of db_file, in currency_id (default: the primary currency) up to end_date (default today).
+
+    The last result of each database is kept, and handed back as long as the
+    arguments are the same and nothing was written to the tables it comes from.
+    """
+    if currency_id is None:
+        currency_id = networth.primary_currency_id(db_file)
+    arguments = (currency_id, str(end_date or datetime.date.today()), window)
+    # The version is taken before reading, so that a write made meanwhile is not hidden under it
+    version = db.data_version(db_file)
+    # Keyed as db.get_db() pools connections, so that two spellings of one file share the result
+    key = db.database_key(db_file)
+    with _results_lock:
+        cached = _results.get(key)
+    if cached is not None and cached[:2] == (arguments, version):
+        return cached[2]
+    result = compute(networth.get_arrays(db_file), currency_id, arguments[1], window, fx.pivot_ids(db_file),
+                     series_names(db_file))
+    with _results_lock:
+        _results[key] = (arguments, version, result)
+    return result
@@ -0,0 +1,1214 @@
+"""
+Benchmarks for PortfolioTracker.
+
+Usage:
+    python benchmark.py                  # run every benchmark
+    python benchmark.py connections      # run only the named ones
+    python benchmark.py suite --json baseline.json
+    python benchmark.py suite --baseline baseline.json [--tolerance 0.5]
+
+Each benchmark builds its own throw-away database in a temporary directory,
+prints its results and returns them as a dict. The "suite" benchmark times
+every read function of db.py and the computation engines on one portfolio
+made by generate_portfolio(), which is seeded, so runs are comparable. With
+--json the results are saved; with --baseline they are compared against a
+saved run and every metric that got worse by more than the tolerance is
+reported as a regression.
+"""
+import argparse
+import datetime
+import heapq
+import http.server
+import itertools
+import json
+import os
+import random
+import subprocess
+import sys
+import sqlite3
+import tempfile
+import threading
+import time
+import urllib.parse
+import tracemalloc
+
+import numpy as np
+
+import aggregate
+import analytics
+import cash
+import db
+import fx
+import importer
+import lifo
+import models
+import networth
+import paging
+import prices
+import refresh
+import snapshot
+import tax
+import worker
+from utils import EPOCH, to_day
+
+
+def _seconds(func):
+    start = time.perf_counter()
+    func()
+    return time.perf_counter() - start
+
+
+def calls_per_second(func, n):
+    """ Call func n times and return the achieved rate """
+    start = time.perf_counter()
+    for _ in range(n):
+        func()
+    return n / (time.perf_counter() - start)
+
+
+def _legacy_get_locations(db_file):
+    """ get_locations as it was before PortfolioDB: one connection per call """
+    conn = db.create_connection(db_file)
+    try:
+        return [(location[0], location[1]) for location in conn.execute("SELECT id, name FROM locations")]
+    finally:
+        conn.close()
+
+
+def bench_connections(n=5000):
+    """ Compare per-call sqlite3.connect against the pooled PortfolioDB connection """
+    with tempfile.TemporaryDirectory() as tmp:
+        db_file = os.path.join(tmp, "bench.db")
+        db.create_tables(db_file)
+        for i in range(20):
+            db.add_location(db_file, f"Location {i}", "")
+
+        results = {
+            "legacy_calls_per_s": calls_per_second(lambda: _legacy_get_locations(db_file), n),
+            "pooled_calls_per_s": calls_per_second(lambda: db.get_locations(db_file), n),
+        }
+        results["speedup"] = results["pooled_calls_per_s"] / results["legacy_calls_per_s"]
+        db.close_db(db_file)
+
+    print(f"get_locations x{n}: legacy {results['legacy_calls_per_s']:.0f}/s, "
+          f"pooled {results['pooled_calls_per_s']:.0f}/s ({results['speedup']:.1f}x)")
+    return results
+
+
+def seed_reference_data(db_file, n_locations=3, n_asset_markets=50, currencies=("EUR",)):
+    """ Fill the lookup tables and return a list of (asset_market_id, location_id) pairs """
+    currency_ids = [db.add_currency(db_file, code, code) for code in currencies]
+    market_id = db.add_market(db_file, "SYNTH", "Synthetic market")
+    location_ids = [db.add_location(db_file, f"Location {i}", "") for i in range(n_locations)]
+    pairs = []
+    for i in range(n_asset_markets):
+        asset_id = db.add_asset(db_file, f"Asset {i}", f"SYM{i}", "stock", "", i % 5 != 0)
+        location_id = location_ids[i % n_locations]
+        currency_id = currency_ids[i % len(currency_ids)]
+        pairs.append((db.add_asset_market(db_file, location_id, f"SYM{i}@SYNTH", "", asset_id, market_id, currency_id), location_id))
+    return pairs
+
+
+def seed_exchange_rates(db_file, from_code, to_code, start=datetime.date(2014, 1, 1), days=3650, seed=0):
+    """ Store a random walk of daily rates between two currencies already in the database """
+    ids = {code: currency_id for currency_id, code, name in db.get_currencies(db_file)}
+    rng = random.Random(seed)
+    rate = 1.0
+    rows = []
+    for day in range(days):
+        rate *= 1 + rng.gauss(0, 0.005)
+        rows.append(((start + datetime.timedelta(days=day)).isoformat(), ids[from_code], ids[to_code], rate))
+    with db.get_db(db_file).transaction() as conn:
+        conn.executemany("INSERT INTO exchange_rates (date, currency_from_id, currency_to_id, rate) VALUES (?, ?, ?, ?)", rows)
+
+
+def synthetic_transactions(pairs, n, seed=0, start=datetime.date(2014, 1, 1), days=3650):
+    """ Yield n random transaction tuples, in date order, in the order expected by db.add_transaction """
+    rng = random.Random(seed)
+    random_ = rng.random
+    dates = [(start + datetime.timedelta(days=day)).isoformat() for day in range(days)]
+    n_pairs = len(pairs)
+    for i in range(n):
+        asset_market_id, location_id = pairs[int(random_() * n_pairs)]
+        quantity = int(random_() * 100) + 1
+        if random_() < 0.3:
+            quantity = -quantity
+        yield (asset_market_id, quantity, round(1 + random_() * 499, 2), dates[i * days // n], location_id)
+
+
+def seed_prices(db_file, asset_market_ids, start=datetime.date(2014, 1, 1), days=3650, seed=0):
+    """ Store a random walk of weekday closes for every asset market """
+    rng = random.Random(seed)
+    dates = [start + datetime.timedelta(days=day) for day in range(days)]
+    dates = [date.isoformat() for date in dates if date.weekday() < 5]
+    with db.get_db(db_file).transaction() as conn:
+        for asset_market_id in asset_market_ids:
+            close = 1 + rng.random() * 499
+            rows = []
+            for date in dates:
+                close *= 1 + rng.gauss(0, 0.01)
+                rows.append((asset_market_id, date, round(close, 4)))
+            conn.executemany("INSERT INTO prices (asset_market_id, date, close) VALUES (?, ?, ?)", rows)
+
+
+def generate_portfolio(db_file, n_locations=3, n_assets=100, years=10, transactions_per_year=20000,
+                       currencies=("EUR", "USD"), with_prices=True, seed=0, start=datetime.date(2014, 1, 1)):
+    """ Fill a new database with a synthetic portfolio, the same for the same arguments.
+
+    Every currency after the first gets daily rates to the first one, and every
+    asset market weekday closes. Returns {"pairs", "transactions", "days"}.
+    """
+    db.create_tables(db_file)
+    days = years * 365
+    pairs = seed_reference_data(db_file, n_locations, n_assets, currencies)
+    for i, code in enumerate(currencies[1:]):
+        seed_exchange_rates(db_file, code, currencies[0], start, days, seed=seed + i)
+    if with_prices:
+        seed_prices(db_file, [asset_market_id for asset_market_id, location_id in pairs], start, days, seed)
+    n = years * transactions_per_year
+    db.add_transactions_bulk(db_file, synthetic_transactions(pairs, n, seed, start, days))
+    return {"pairs": pairs, "transactions": n, "days": days}
+
+
+def bench_bulk_insert(n=1_000_000, n_single=2000):
+    """ Compare add_transaction row by row against add_transactions_bulk """
+    with tempfile.TemporaryDirectory() as tmp:
+        db_file = os.path.join(tmp, "bench.db")
+        db.create_tables(db_file)
+        pairs = seed_reference_data(db_file)
+
+        start = time.perf_counter()
+        for row in synthetic_transactions(pairs, n_single):
+            db.add_transaction(db_file, *row)
+        single_rate = n_single / (time.perf_counter() - start)
+
+        start = time.perf_counter()
+        ids = db.add_transactions_bulk(db_file, synthetic_transactions(pairs, n, seed=1))
+        bulk_seconds = time.perf_counter() - start
+        db.close_db(db_file)
+
+    results = {
+        "single_rows_per_s": single_rate,
+        "bulk_rows": len(ids),
+        "bulk_seconds": bulk_seconds,
+        "bulk_rows_per_s": len(ids) / bulk_seconds,
+    }
+    print(f"add_transaction: {single_rate:.0f} rows/s; add_transactions_bulk: {len(ids)} rows in "
+          f"{bulk_seconds:.2f}s ({results['bulk_rows_per_s']:.0f} rows/s)")
+    return results
+
+
+def write_flex_csv(path, n, n_symbols=200, seed=0):
+    """ Write a synthetic Flex Query trades CSV with n rows """
+    rng = random.Random(seed)
+    start = datetime.date(2014, 1, 1)
+    with open(path, "w", newline="") as f:
+        f.write("ClientAccountID,AssetClass,Symbol,Description,CurrencyPrimary,ListingExchange,DateTime,Quantity,TradePrice,TransactionID\n")
+        for i in range(n):
+            symbol = rng.randrange(n_symbols)
+            date = start + datetime.timedelta(days=i * 3650 // n)
+            f.write(f"U1234567,STK,SYM{symbol},Synthetic {symbol},{'USD' if symbol % 3 else 'EUR'},NASDAQ,"
+                    f"{date:%Y%m%d};101500,{rng.randint(-50, 100) or 1},{rng.uniform(1, 500):.2f},{1000000 + i}\n")
+
+
+def bench_import(n=500_000):
+    """ Import a synthetic Flex statement, then import it again (a no-op thanks to the fingerprints) """
+    with tempfile.TemporaryDirectory() as tmp:
+        db_file = os.path.join(tmp, "bench.db")
+        statement = os.path.join(tmp, "statement.csv")
+        db.create_tables(db_file)
+        write_flex_csv(statement, n)
+
+        start = time.perf_counter()
+        first = importer.import_statement(db_file, statement)
+        first_seconds = time.perf_counter() - start
+        start = time.perf_counter()
+        repeat = importer.import_statement(db_file, statement)
+        repeat_seconds = time.perf_counter() - start
+
+        # Peak memory must not depend on the size of the statement
+        peaks = {}
+        for rows in (n // 10, n):
+            write_flex_csv(statement, rows, seed=1)
+            tracemalloc.start()
+            importer.import_statement(db_file, statement)
+            peaks[rows] = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+        db.close_db(db_file)
+
+    results = {
+        "first_import_seconds": first_seconds,
+        "first_import_inserted": first["inserted"],
+        "repeat_import_seconds": repeat_seconds,
+        "repeat_import_inserted": repeat["inserted"],
+        "peak_memory_bytes": peaks,
+    }
+    print(f"import {n} rows: {first_seconds:.2f}s ({first['inserted']} inserted), repeat "
+          f"{repeat_seconds:.2f}s ({repeat['inserted']} inserted); peak memory "
+          + ", ".join(f"{rows} rows {peak / 2**20:.1f}MB" for rows, peak in peaks.items()))
+    return results
+
+
+def bench_query_plans(n=20000):
+    """ Fail if a hot query falls back to a table scan (see db.HOT_QUERIES).
+
+    The app never runs ANALYZE, so the plans are checked without statistics,
+    as they are on real user databases.
+    """
+    with tempfile.TemporaryDirectory() as tmp:
+        db_file = os.path.join(tmp, "bench.db")
+        db.create_tables(db_file)
+        pairs = seed_reference_data(db_file)
+        db.add_transactions_bulk(db_file, synthetic_transactions(pairs, n))
+        scans = db.find_table_scans(db_file)
+        db.close_db(db_file)
+
+    for name, details in scans.items():
+        print(f"{name} scans: {'; '.join(details)}")
+    if scans:
+        raise SystemExit("query plan regression: a hot query does a table scan")
+    print(f"query plans: no table scans in {len(db.HOT_QUERIES)} hot queries")
+    return scans
+
+
+def lifo_mismatches(db_file):
+    """ The rows of lots and lot_matches that differ from what rebuild() makes of the same transactions, counted
+    on a copy of db_file so that the engines matching it keep their stacks
+    """
+    with tempfile.TemporaryDirectory() as tmp:
+        copy = os.path.join(tmp, "rebuilt.db")
+        target = sqlite3.connect(copy)
+        db.get_db(db_file).connection.backup(target)
+        target.close()
+        lifo.LifoEngine(copy).rebuild()
+        conn = db.get_db(copy).connection
+        conn.execute("ATTACH DATABASE ? AS incremental", (db_file,))
+        mismatches = 0
+        for table in ("lots", "lot_matches"):
+            for first, second in (("main", "incremental"), ("incremental", "main")):
+                mismatches += conn.execute(f"SELECT COUNT(*) FROM (SELECT * FROM {first}.{table} "
+                                           f"EXCEPT SELECT * FROM {second}.{table})").fetchone()[0]
+        conn.execute("DETACH DATABASE incremental")
+        db.close_db(copy)
+    return mismatches
+
+
+def bench_lifo(n=1_000_000, n_new=100):
+    """ Full LIFO matching of n transactions, then incremental updates against full recomputation """
+    with tempfile.TemporaryDirectory() as tmp:
+        db_file = os.path.join(tmp, "bench.db")
+        db.create_tables(db_file)
+        pairs = seed_reference_data(db_file)
+        db.add_transactions_bulk(db_file, synthetic_transactions(pairs, n))
+        engine = lifo.LifoEngine(db_file)
+
+        start = time.perf_counter()
+        engine.rebuild()
+        rebuild_seconds = time.perf_counter() - start
+
+        # New trades dated after everything else, one sync each as the wizard would do
+        start = time.perf_counter()
+        for row in synthetic_transactions(pairs, n_new, seed=2, start=datetime.date(2025, 1, 1), days=30):
+            db.add_transaction(db_file, *row)
+            engine.sync()
+        append_seconds = (time.perf_counter() - start) / n_new
+        append_mismatches = lifo_mismatches(db_file)
+
+        # A trade back-dated by a year
+        asset_market_id, location_id = pairs[0]
+        db.add_transaction(db_file, asset_market_id, 10, 100.0, "2023-06-01", location_id)
+        start = time.perf_counter()
+        engine.sync()
+        backdated_seconds = time.perf_counter() - start
+        backdated_mismatches = lifo_mismatches(db_file)
+        db.close_db(db_file)
+
+    results = {
+        "rebuild_seconds": rebuild_seconds,
+        "append_sync_seconds": append_seconds,
+        "backdated_sync_seconds": backdated_seconds,
+        "naive_speedup_append": rebuild_seconds / append_seconds,
+        "naive_speedup_backdated": rebuild_seconds / backdated_seconds,
+        "append_mismatches": append_mismatches,
+        "backdated_mismatches": backdated_mismatches,
+    }
+    print(f"LIFO {n} transactions: full rebuild {rebuild_seconds:.2f}s; incremental append "
+          f"{append_seconds * 1000:.2f}ms ({results['naive_speedup_append']:.0f}x faster than rebuilding); "
+          f"back-dated insert {backdated_seconds * 1000:.1f}ms ({results['naive_speedup_backdated']:.0f}x); "
+          f"rows differing from a rebuild: {append_mismatches} after the appends, {backdated_mismatches} after the "
+          f"back-dated insert")
+    if append_mismatches or backdated_mismatches:
+        raise SystemExit("LIFO regression: the incremental lots differ from a full rebuild")
+    return results
+
+
+def bench_edits(n=1_000_000, n_edits=50, seed=0):
+    """ Editing, deleting and undoing transactions, and bringing the lots and the net worth arrays up to date
+    after each from the change journal, against computing them again from scratch
+    """
+    with tempfile.TemporaryDirectory() as tmp:
+        db_file = os.path.join(tmp, "bench.db")
+        db.create_tables(db_file)
+        pairs = seed_reference_data(db_file, n_asset_markets=500)
+        db.add_transactions_bulk(db_file, synthetic_transactions(pairs, n))
+        engine = lifo.LifoEngine(db_file)
+        rebuild_seconds = _seconds(engine.rebuild)
+        load_seconds = _seconds(lambda: networth.get_arrays(db_file))
+
+        # The recent trades are the ones edited the most: pick among the last year's
+        rng = random.Random(seed)
+        recent = [row[0] for row in db.get_db(db_file).fetchall("SELECT id FROM transactions WHERE date >= '2023-01-01'")]
+        timings = {"edit": [], "delete": [], "undo": [], "lifo_sync": [], "arrays": []}
+        for _ in range(n_edits):
+            for action, write in (("edit", lambda: db.update_transaction(db_file, rng.choice(recent), price=round(1 + rng.random() * 499, 2))),
+                                  ("delete", lambda: db.delete_transactions(db_file, [recent.pop(rng.randrange(len(recent)))])),
+                                  ("undo", lambda: db.undo(db_file))):
+                timings[action].append(_seconds(write))
+                timings["lifo_sync"].append(_seconds(engine.sync))
+                timings["arrays"].append(_seconds(lambda: networth.get_arrays(db_file)))
+        same_arrays = all(np.array_equal(a, b) for a, b in zip(networth.get_arrays(db_file), networth.load_arrays(db_file)))
+        db.close_db(db_file)
+
+    results = {f"{action}_seconds": sum(values) / len(values) for action, values in timings.items()}
+    results.update({"rebuild_seconds": rebuild_seconds, "load_seconds": load_seconds, "same_arrays": same_arrays,
+                    "lifo_speedup": rebuild_seconds / results["lifo_sync_seconds"],
+                    "arrays_speedup": load_seconds / results["arrays_seconds"]})
+    print(f"changes to {n} transactions: edit {results['edit_seconds'] * 1000:.2f}ms, delete "
+          f"{results['delete_seconds'] * 1000:.2f}ms, undo {results['undo_seconds'] * 1000:.2f}ms; then lots "
+          f"{results['lifo_sync_seconds'] * 1000:.1f}ms ({results['lifo_speedup']:.0f}x faster than rebuilding) and "
+          f"net worth arrays {results['arrays_seconds'] * 1000:.0f}ms ({results['arrays_speedup']:.0f}x faster than "
+          f"reading them again), same arrays: {same_arrays}")
+    return results
+
+
+def bench_net_worth(n_asset_markets=500, n=200_000):
+    """ Daily net worth over ten years of n transactions on n_asset_markets instruments in two currencies """
+    with tempfile.TemporaryDirectory() as tmp:
+        db_file = os.path.join(tmp, "bench.db")
+        db.create_tables(db_file)
+        pairs = seed_reference_data(db_file, n_asset_markets=n_asset_markets, currencies=("EUR", "USD"))
+        seed_exchange_rates(db_file, "USD", "EUR")
+        db.add_transactions_bulk(db_file, synthetic_transactions(pairs, n))
+
+        start = time.perf_counter()
+        arrays = networth.load_arrays(db_file)
+        load_seconds = time.perf_counter() - start
+        start = time.perf_counter()
+        series = networth.compute_series(arrays, networth.primary_currency_id(db_file), end_date="2023-12-31")
+        compute_seconds = time.perf_counter() - start
+        db.close_db(db_file)
+
+    results = {"days": len(series), "load_seconds": load_seconds, "compute_seconds": compute_seconds}
+    print(f"net worth {len(series)} days x {n_asset_markets} instruments: load {load_seconds:.2f}s, "
+          f"compute {compute_seconds:.3f}s")
+    return results
+
+
+# fetch_asset_overview as it was before the positions table
+LEGACY_ASSET_OVERVIEW_SQL = '''SELECT a.name, l.name, SUM(t.quantity) as quantity_owned
+                                FROM transactions t
+                                JOIN asset_markets am ON t.asset_market_id = am.id
+                                JOIN assets a ON am.asset_id = a.id
+                                JOIN locations l ON am.location_id = l.id
+                                GROUP BY a.id, l.id'''
+
+
+def bench_positions(n=1_000_000, repeat=20):
+    """ Asset overview from the full aggregation against the materialized positions, and their agreement """
+    with tempfile.TemporaryDirectory() as tmp:
+        db_file = os.path.join(tmp, "bench.db")
+        db.create_tables(db_file)
+        pairs = seed_reference_data(db_file, n_asset_markets=500)
+        db.add_transactions_bulk(db_file, synthetic_transactions(pairs, n))
+        database = db.get_db(db_file)
+
+        legacy = calls_per_second(lambda: database.fetchall(LEGACY_ASSET_OVERVIEW_SQL), repeat)
+        positions = calls_per_second(lambda: db.fetch_asset_overview(db_file), repeat)
+        same = sorted(database.fetchall(LEGACY_ASSET_OVERVIEW_SQL)) == sorted(db.fetch_asset_overview(db_file))
+        start = time.perf_counter()
+        mismatches = db.verify_positions(db_file)
+        verify_seconds = time.perf_counter() - start
+        start = time.perf_counter()
+        db.rebuild_positions(db_file)
+        rebuild_seconds = time.perf_counter() - start
+        db.close_db(db_file)
+
+    results = {"legacy_per_s": legacy, "positions_per_s": positions, "speedup": positions / legacy,
+               "same_overview": same, "mismatches": len(mismatches),
+               "verify_seconds": verify_seconds, "rebuild_seconds": rebuild_seconds}
+    print(f"asset overview over {n} transactions: {legacy:.1f}/s aggregated, {positions:.0f}/s from positions "
+          f"({results['speedup']:.0f}x), same result: {same}; verify {verify_seconds:.2f}s, "
+          f"{len(mismatches)} mismatches; rebuild {rebuild_seconds:.2f}s")
+    return results
+
+
+# The balance at a date without checkpoints: every movement of the account up to it
+FULL_SCAN_BALANCE_SQL = '''SELECT TOTAL(amount) FROM cash_movements
+                            WHERE account_id = (SELECT id FROM accounts WHERE location_id = ?) AND currency_id = ? AND date <= ?'''
+
+
+def bench_cash(n=1_000_000, n_single=2000, repeat=200, seed=0):
+    """ Cash balance at random dates from the checkpoints against a scan of the movements, and what booking
+    the cash legs costs add_transaction
+    """
+    with tempfile.TemporaryDirectory() as tmp:
+        db_file = os.path.join(tmp, "bench.db")
+        db.create_tables(db_file)
+        pairs = seed_reference_data(db_file, n_asset_markets=500)
+        start = time.perf_counter()
+        db.add_transactions_bulk(db_file, synthetic_transactions(pairs, n))
+        bulk_seconds = time.perf_counter() - start
+        start = time.perf_counter()
+        checkpoints = cash.checkpoint(db_file)
+        checkpoint_seconds = time.perf_counter() - start
+        database = db.get_db(db_file)
+        currency_id = db.get_currencies(db_file)[0][0]
+        rng = random.Random(seed)
+        queries = [(rng.choice(pairs)[1], (datetime.date(2014, 1, 1) + datetime.timedelta(days=rng.randrange(3650))).isoformat())
+                   for _ in range(repeat)]
+        same = all(abs(cash.balance_at(db_file, location_id, currency_id, date)
+                       - database.fetchone(FULL_SCAN_BALANCE_SQL, (location_id, currency_id, date))[0]) < 1e-3
+                   for location_id, date in queries[:20])
+        scan_seconds = _seconds(lambda: [database.fetchone(FULL_SCAN_BALANCE_SQL, (location_id, currency_id, date))
+                                         for location_id, date in queries]) / repeat
+        checkpoint_query_seconds = _seconds(lambda: [cash.balance_at(db_file, location_id, currency_id, date)
+                                                     for location_id, date in queries]) / repeat
+
+        # New trades come after the history, so they leave the checkpoints alone
+        rows = list(synthetic_transactions(pairs, n_single, seed=1, start=datetime.date(2024, 1, 1), days=30))
+        add_per_s = calls_per_second(lambda: db.add_transaction(db_file, *rows.pop()), n_single)
+        start = time.perf_counter()
+        mismatches = cash.verify(db_file)
+        verify_seconds = time.perf_counter() - start
+        db.close_db(db_file)
+
+    results = {"bulk_seconds": bulk_seconds, "checkpoints": checkpoints, "checkpoint_seconds": checkpoint_seconds,
+               "scan_balance_seconds": scan_seconds, "balance_at_seconds": checkpoint_query_seconds,
+               "speedup": scan_seconds / checkpoint_query_seconds, "same_balance": same,
+               "add_transaction_per_s": add_per_s, "verify_seconds": verify_seconds, "mismatches": len(mismatches)}
+    print(f"cash over {n} transactions: booked in bulk in {bulk_seconds:.2f}s, {checkpoints} checkpoints in "
+          f"{checkpoint_seconds:.2f}s; balance at a date {scan_seconds * 1000:.2f} ms scanning, "
+          f"{checkpoint_query_seconds * 1000:.3f} ms from a checkpoint ({results['speedup']:.0f}x), same: {same}; "
+          f"add_transaction {add_per_s:.0f}/s; verify {verify_seconds:.2f}s, {len(mismatches)} mismatches")
+    return results
+
+
+def _retained_mb(func):
+    """ (result, MB still allocated by func() once it returns) """
+    tracemalloc.start()
+    result = func()
+    current = tracemalloc.get_traced_memory()[0] / 1e6
+    tracemalloc.stop()
+    return result, current
+
+
+def bench_models(n=1_000_000):
+    """ Memory of n transactions held as tuples, as Transaction objects and as a TransactionBatch """
+    with tempfile.TemporaryDirectory() as tmp:
+        db_file = os.path.join(tmp, "bench.db")
+        db.create_tables(db_file)
+        pairs = seed_reference_data(db_file)
+        db.add_transactions_bulk(db_file, synthetic_transactions(pairs, n))
+        database = db.get_db(db_file)
+
+        results = {}
+        rows, results["tuples_mb"] = _retained_mb(lambda: database.fetchall(models.TRANSACTIONS_SQL))
+        del rows
+        objects, results["objects_mb"] = _retained_mb(
+            lambda: [models.Transaction(*row) for row in database.execute(models.TRANSACTIONS_SQL)])
+        del objects
+        batch, results["batch_mb"] = _retained_mb(lambda: models.load_transactions(db_file))
+        del batch
+        start = time.perf_counter()
+        models.load_transactions(db_file)
+        results["batch_load_seconds"] = time.perf_counter() - start
+
+        identity_map = models.get_identity_map(db_file)
+        asset_markets = identity_map.all(models.AssetMarket)
+        results["shared_records"] = all(identity_map.get(models.AssetMarket, record.id) is record for record in asset_markets)
+        db.close_db(db_file)
+
+    per_million = 1_000_000 / n
+    print(f"{n} transactions: tuples {results['tuples_mb'] * per_million:.0f} MB/1M, "
+          f"Transaction objects {results['objects_mb'] * per_million:.0f} MB/1M, "
+          f"TransactionBatch {results['batch_mb'] * per_million:.0f} MB/1M (loaded in {results['batch_load_seconds']:.2f}s); "
+          f"identity map shares records: {results['shared_records']}")
+    return results
+
+
+def bench_reference_cache(n=20000):
+    """ Point lookups and wizard lists from the database against the reference-data cache """
+    with tempfile.TemporaryDirectory() as tmp:
+        db_file = os.path.join(tmp, "bench.db")
+        db.create_tables(db_file)
+        pairs = seed_reference_data(db_file, n_asset_markets=500, currencies=("EUR", "USD"))
+        asset_market_ids = [asset_market_id for asset_market_id, location_id in pairs]
+        identity_map = models.get_identity_map(db_file)
+
+        def lookups(asset_market_currency, currency_code):
+            for i in range(n):
+                currency_code(db_file, asset_market_currency(db_file, asset_market_ids[i % len(asset_market_ids)]))
+
+        results = {
+            "db_lookups_per_s": n / _seconds(lambda: lookups(db.get_asset_market_currency, db.get_currency_code)),
+            "cached_lookups_per_s": n / _seconds(lambda: lookups(models.asset_market_currency, models.currency_code)),
+            "db_lists_per_s": calls_per_second(lambda: db.get_assets(db_file), 1000),
+            "cached_lists_per_s": calls_per_second(lambda: identity_map.all(models.Asset), 1000),
+        }
+        # A write moves the generation on: the next lookup reads the table again and sees it
+        currency_id = db.add_currency(db_file, "CHF", "Swiss franc")
+        results["sees_new_rows"] = models.currency_code(db_file, currency_id) == "CHF"
+        results.update(identity_map.stats())
+        db.close_db(db_file)
+
+    print(f"reference data: point lookups {results['db_lookups_per_s']:.0f}/s from the database, "
+          f"{results['cached_lookups_per_s']:.0f}/s cached; asset lists {results['db_lists_per_s']:.0f}/s against "
+          f"{results['cached_lists_per_s']:.0f}/s; hit rate {results['hit_rate']:.4f}, sees new rows: {results['sees_new_rows']}")
+    return results
+
+
+def bench_snapshot(n=1_000_000, n_new=1000):
+    """ Full and incremental Arrow snapshots of n transactions, and loading them back against reading SQL into pandas """
+    try:
+        snapshot._pyarrow()
+    except ImportError as e:
+        print(f"snapshot: skipped, {e}")
+        return {}
+    import pandas as pd
+    with tempfile.TemporaryDirectory() as tmp:
+        db_file = os.path.join(tmp, "bench.db")
+        snapshot_dir = os.path.join(tmp, "snapshot")
+        db.create_tables(db_file)
+        pairs = seed_reference_data(db_file)
+        db.add_transactions_bulk(db_file, synthetic_transactions(pairs, n))
+
+        results = {"full_seconds": _seconds(lambda: snapshot.snapshot(db_file, snapshot_dir, tables=["transactions"]))}
+        db.add_transactions_bulk(db_file, synthetic_transactions(pairs, n_new, seed=1, start=datetime.date(2024, 1, 1), days=30))
+        results["append_seconds"] = _seconds(lambda: snapshot.snapshot(db_file, snapshot_dir, tables=["transactions"]))
+        results["load_mmap_seconds"] = _seconds(lambda: snapshot.load_table(snapshot_dir, "transactions"))
+        results["load_frame_seconds"] = _seconds(lambda: snapshot.load_frame(snapshot_dir, "transactions"))
+        conn = db.get_db(db_file).connection
+        results["read_sql_seconds"] = _seconds(lambda: pd.read_sql_query(models.TRANSACTIONS_SQL, conn))
+        results["rows"] = snapshot.load_table(snapshot_dir, "transactions").num_rows
+        db.close_db(db_file)
+
+    print(f"snapshot {results['rows']} transactions: full {results['full_seconds']:.2f}s, append {n_new} rows "
+          f"{results['append_seconds']:.2f}s; load memory-mapped {results['load_mmap_seconds'] * 1000:.1f} ms, "
+          f"as DataFrame {results['load_frame_seconds'] * 1000:.0f} ms, against read_sql {results['read_sql_seconds']:.2f}s")
+    return results
+
+
+def bench_aggregate(n_files=8, n=50000, workers=None):
+    """ Consolidated report over n_files portfolios of n transactions, in one process and on a process pool """
+    workers = workers or sorted({1, os.cpu_count() or 1, 4})
+    with tempfile.TemporaryDirectory() as tmp:
+        for i in range(n_files):
+            db_file = os.path.join(tmp, f"user{i}.db")
+            db.create_tables(db_file)
+            pairs = seed_reference_data(db_file, n_asset_markets=100)
+            db.add_transactions_bulk(db_file, synthetic_transactions(pairs, n, seed=i))
+            db.close_db(db_file)
+        paths = aggregate.find_portfolios(tmp)
+        # The first pass matches every lot; time the passes after it, which all do the same work
+        aggregate.aggregate(paths, 1, year=2023)
+
+        results = {}
+        for max_workers in workers:
+            report = aggregate.aggregate(paths, max_workers, year=2023)
+            results[f"workers_{max_workers}_seconds"] = report["seconds"]
+            slowest = max(timings["total"] for timings in report["timings"].values())
+            print(f"aggregate {len(paths)} portfolios x {n} transactions, {max_workers} worker(s): "
+                  f"{report['seconds']:.2f}s (slowest file {slowest:.2f}s), {len(report['failed'])} failed")
+    print(f"    {os.cpu_count()} core(s) available")
+    return results
+
+
+def _treeview_paint_seconds(rows):
+    """ Seconds to insert rows into a Treeview and draw it, or None without a display """
+    try:
+        import tkinter as tk
+        from tkinter import ttk
+        root = tk.Tk()
+    except Exception:
+        return None
+    try:
+        tree = ttk.Treeview(root, columns=tuple(range(9)), show="headings")
+        tree.pack()
+        start = time.perf_counter()
+        for row in rows:
+            tree.insert("", "end", iid=row[0], values=row[1:])
+        root.update()
+        return time.perf_counter() - start
+    finally:
+        root.destroy()
+
+
+def _measure(func):
+    """ (result, seconds, peak traced memory in MB) of func() """
+    tracemalloc.start()
+    start = time.perf_counter()
+    result = func()
+    seconds = time.perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1] / 1e6
+    tracemalloc.stop()
+    return result, seconds, peak
+
+
+def bench_transactions_page(sizes=(10_000, 100_000, 1_000_000), paint_limit=100_000):
+    """ Time to first paint and memory of the transactions list: everything at once, against the paged window """
+    results = {}
+    for n in sizes:
+        with tempfile.TemporaryDirectory() as tmp:
+            db_file = os.path.join(tmp, "bench.db")
+            db.create_tables(db_file)
+            pairs = seed_reference_data(db_file)
+            db.add_transactions_bulk(db_file, synthetic_transactions(pairs, n))
+
+            rows, full_seconds, full_mb = _measure(lambda: db.get_db(db_file).fetchall(db.TRANSACTIONS_PAGE_SQL))
+            full_paint = _treeview_paint_seconds(rows) if n <= paint_limit else None
+            del rows
+            window = paging.TransactionWindow(db_file)
+            rows, paged_seconds, paged_mb = _measure(window.load)
+            paged_paint = _treeview_paint_seconds(rows)
+            _, forward_seconds, _ = _measure(window.forward)
+            db.close_db(db_file)
+
+        results[n] = {"full_seconds": full_seconds, "full_mb": full_mb, "full_paint_seconds": full_paint,
+                      "paged_seconds": paged_seconds, "paged_mb": paged_mb, "paged_paint_seconds": paged_paint,
+                      "next_page_seconds": forward_seconds}
+        paint = "" if paged_paint is None else f", treeview {full_paint or float('nan'):.2f}s vs {paged_paint:.3f}s"
+        print(f"transactions list {n} rows: load all {full_seconds:.2f}s / {full_mb:.0f} MB, "
+              f"first page {paged_seconds * 1000:.1f} ms / {paged_mb:.2f} MB, "
+              f"next page {forward_seconds * 1000:.1f} ms{paint}")
+    return results
+
+
+def bench_fx(n=1_000_000):
+    """ Convert n (amount, currency, date) tuples into EUR, with GBP quoted only against USD """
+    with tempfile.TemporaryDirectory() as tmp:
+        db_file = os.path.join(tmp, "bench.db")
+        db.create_tables(db_file)
+        for code in ("EUR", "USD", "GBP", "CHF"):
+            db.add_currency(db_file, code, code)
+        seed_exchange_rates(db_file, "USD", "EUR", seed=1)
+        seed_exchange_rates(db_file, "GBP", "USD", seed=2)
+        seed_exchange_rates(db_file, "EUR", "CHF", seed=3)
+        ids = {code: currency_id for currency_id, code, name in db.get_currencies(db_file)}
+
+        start = time.perf_counter()
+        service = fx.FxService.load(db_file)
+        load_seconds = time.perf_counter() - start
+        db.close_db(db_file)
+
+    rng = np.random.default_rng(0)
+    amounts = rng.uniform(-1000, 1000, n)
+    currency_ids = rng.choice(list(ids.values()), n)
+    days = rng.integers(int(to_day("2014-01-01")), int(to_day("2023-12-31")), n)
+    start = time.perf_counter()
+    converted = service.convert(amounts, currency_ids, days, ids["EUR"])
+    convert_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for day in days[:10000]:
+        service.rate(ids["GBP"], ids["EUR"], EPOCH + np.timedelta64(int(day), "D"))
+    lookups_per_s = 10000 / (time.perf_counter() - start)
+
+    results = {"load_seconds": load_seconds, "convert_seconds": convert_seconds, "lookups_per_s": lookups_per_s,
+               "unconverted": int(np.isnan(converted).sum())}
+    print(f"fx: load {load_seconds:.3f}s, convert {n} amounts {convert_seconds:.3f}s, "
+          f"{lookups_per_s:.0f} triangulated lookups/s")
+    return results
+
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+def _startup_seconds(args, repeat):
+    """ Best wall time of repeat runs of a fresh interpreter with args, or None if it fails """
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        completed = subprocess.run([sys.executable, *args], cwd=HERE, capture_output=True)
+        seconds = time.perf_counter() - start
+        if completed.returncode != 0:
+            return None
+        best = seconds if best is None else min(best, seconds)
+    return best
+
+
+# Cold start budget for importing the GUI (the window itself needs a display)
+STARTUP_BUDGET_SECONDS = 0.3
+
+
+def import_report(statement, top=10):
+    """ The modules that statement imports, as reported by python -X importtime: [(cumulative seconds, module)],
+    slowest first, top of them
+    """
+    completed = subprocess.run([sys.executable, "-X", "importtime", "-c", statement], cwd=HERE, capture_output=True, text=True)
+    modules = []
+    for line in completed.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split("|")
+        modules.append((int(cumulative_us) / 1e6, name.rstrip()))
+    return sorted(modules, reverse=True)[:top]
+
+
+def bench_startup(n=10000, repeat=5):
+    """ Cold start of the command line (overview, net worth) and of the GUI modules, each in a new interpreter """
+    with tempfile.TemporaryDirectory() as tmp:
+        db_file = os.path.join(tmp, "bench.db")
+        db.create_tables(db_file)
+        pairs = seed_reference_data(db_file)
+        db.add_transactions_bulk(db_file, synthetic_transactions(pairs, n))
+        db.close_db(db_file)
+
+        results = {
+            "interpreter_seconds": _startup_seconds(["-c", "pass"], repeat),
+            "cli_overview_seconds": _startup_seconds(["cli.py", db_file, "overview"], repeat),
+            "cli_net_worth_seconds": _startup_seconds(["cli.py", db_file, "net-worth", "--output", os.devnull], repeat),
+            # Without a display the GUI cannot open a window: this is the cost of importing it
+            "gui_import_seconds": _startup_seconds(["-c", "import main"], repeat),
+        }
+        check = "import sys, cli; cli.main([sys.argv[1], 'overview']); sys.exit('tkinter' in sys.modules)"
+        results["cli_imports_tkinter"] = _startup_seconds(["-c", check, db_file], 1) is None
+        check = "import sys, main; sys.exit(any(name in sys.modules for name in ('numpy', 'pandas', 'tkcalendar')))"
+        results["gui_imports_heavy_modules"] = _startup_seconds(["-c", check], 1) is None
+        results["gui_import_report"] = import_report("import main")
+        results["within_budget"] = results["gui_import_seconds"] is not None and results["gui_import_seconds"] <= STARTUP_BUDGET_SECONDS
+
+    def show(seconds):
+        return "unavailable" if seconds is None else f"{seconds * 1000:.0f} ms"
+    print(f"startup: interpreter {show(results['interpreter_seconds'])}, cli overview {show(results['cli_overview_seconds'])}, "
+          f"cli net-worth {show(results['cli_net_worth_seconds'])}, gui import {show(results['gui_import_seconds'])}; "
+          f"cli imports tkinter: {results['cli_imports_tkinter']}")
+    print(f"gui import within {STARTUP_BUDGET_SECONDS * 1000:.0f} ms budget: {results['within_budget']}; "
+          f"imports numpy/pandas/tkcalendar: {results['gui_imports_heavy_modules']}; slowest imports:")
+    for seconds, module in results["gui_import_report"]:
+        print(f"    {seconds * 1000:8.1f} ms  {module}")
+    return results
+
+
+class StubQuoteHandler(http.server.BaseHTTPRequestHandler):
+    """ Answers /<symbol>?start=...&end=... with a constant close for every day, after a fixed latency """
+
+    latency = 0.05
+
+    def do_GET(self):
+        url = urllib.parse.urlparse(self.path)
+        query = urllib.parse.parse_qs(url.query)
+        start, end = (datetime.date.fromisoformat(query[name][0]) for name in ("start", "end"))
+        closes = [[(start + datetime.timedelta(days=day)).isoformat(), 100.0] for day in range((end - start).days + 1)]
+        time.sleep(self.latency)
+        body = json.dumps(closes).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def bench_refresh(n_asset_markets=100, workers=(1, 8)):
+    """ Refresh prices from a local stub HTTP server, with one worker and with a pool """
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), StubQuoteHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    prices.register_fetcher("stub", prices.HttpJsonFetcher(f"http://127.0.0.1:{server.server_address[1]}"))
+    results = {}
+    try:
+        for max_workers in workers:
+            with tempfile.TemporaryDirectory() as tmp:
+                db_file = os.path.join(tmp, "bench.db")
+                db.create_tables(db_file)
+                pairs = seed_reference_data(db_file, n_asset_markets=n_asset_markets)
+                for asset_market_id, location_id in pairs:
+                    db.get_db(db_file).write("UPDATE asset_markets SET data_source_id = 'stub' WHERE id = ?", (asset_market_id,))
+                db.add_transactions_bulk(db_file, synthetic_transactions(pairs, 10 * n_asset_markets,
+                                                                         start=datetime.date(2024, 1, 1), days=365))
+                summary = refresh.RefreshScheduler(db_file, max_workers=max_workers, rate_limits={}).refresh()
+                db.close_db(db_file)
+            results[f"workers_{max_workers}_seconds"] = summary["seconds"]
+            print(f"refresh {n_asset_markets} instruments, {max_workers} worker(s): {summary['seconds']:.2f}s, "
+                  f"{summary['prices']} prices, {len(summary['errors'])} errors")
+    finally:
+        server.shutdown()
+        del prices.FETCHERS["stub"]
+    return results
+
+
+def bench_tax(n=500_000):
+    """ Tax estimates over n transactions: cold, from the per-year cache, after a new trade, and a what-if sale """
+    with tempfile.TemporaryDirectory() as tmp:
+        db_file = os.path.join(tmp, "bench.db")
+        db.create_tables(db_file)
+        pairs = seed_reference_data(db_file, currencies=("EUR", "USD"))
+        seed_exchange_rates(db_file, "USD", "EUR")
+        db.add_transactions_bulk(db_file, synthetic_transactions(pairs, n))
+        lifo.get_engine(db_file).sync()
+
+        results = {
+            "cold_seconds": _seconds(lambda: tax.estimate(db_file, 2023)),
+            "cached_seconds": _seconds(lambda: tax.estimate(db_file, 2023)),
+        }
+        asset_market_id, location_id = pairs[0]
+        db.add_transaction(db_file, asset_market_id, -1, 100.0, "2023-06-01", location_id)
+        results["one_new_trade_seconds"] = _seconds(lambda: tax.estimate(db_file, 2023))
+        before = db.count_transactions(db_file)
+        results["what_if_seconds"] = _seconds(lambda: tax.what_if_sell(db_file, asset_market_id, 10, 100.0, "2023-12-01"))
+        results["what_if_wrote"] = db.count_transactions(db_file) != before
+        db.close_db(db_file)
+
+    print(f"tax estimate over {n} transactions: cold {results['cold_seconds']:.2f}s, "
+          f"cached {results['cached_seconds'] * 1000:.1f} ms, after one new trade {results['one_new_trade_seconds'] * 1000:.0f} ms; "
+          f"what-if sale {results['what_if_seconds'] * 1000:.0f} ms (wrote to the database: {results['what_if_wrote']})")
+    return results
+
+
+def bench_profiling(n=20000):
+    """ Cost of the instrumentation: calls per second of a cheap read, with profiling off and on """
+    import profiling
+    with tempfile.TemporaryDirectory() as tmp:
+        db_file = os.path.join(tmp, "bench.db")
+        db.create_tables(db_file)
+        seed_reference_data(db_file)
+        results = {"off_per_s": calls_per_second(lambda: db.get_asset_name(db_file, 1), n)}
+        profiling.enable(slow_ms=float("inf"))
+        try:
+            results["on_per_s"] = calls_per_second(lambda: db.get_asset_name(db_file, 1), n)
+            report = profiling.get_profiler().report()
+        finally:
+            profiling.disable()
+        results["off_again_per_s"] = calls_per_second(lambda: db.get_asset_name(db_file, 1), n)
+        results["recorded_calls"] = report["functions"]["get_asset_name"]["calls"]
+        db.close_db(db_file)
+
+    print(f"get_asset_name x{n}: {results['off_per_s']:.0f}/s unprofiled, {results['on_per_s']:.0f}/s profiled "
+          f"({results['recorded_calls']} calls recorded), {results['off_again_per_s']:.0f}/s once disabled")
+    return results
+
+
+def bench_search(n=1_000_000, n_asset_markets=200, repeat=5):
+    """ Latency of the Transactions filter bar over n transactions: first page and count per kind of filter,
+    and typing a symbol one keystroke at a time through a SearchWorker
+    """
+    import search
+    filters = {
+        "no_filter": search.TransactionFilter(),
+        "symbol": search.TransactionFilter("SYM123"),
+        "name_prefix": search.TransactionFilter("Asset 1"),
+        "broad_text": search.TransactionFilter("Asset"),
+        "no_match": search.TransactionFilter("nothing"),
+        "location": search.TransactionFilter(location_id=2),
+        "month": search.TransactionFilter(date_from="2022-03-01", date_to="2022-03-31"),
+        "price_range": search.TransactionFilter(price_min=100, price_max=110),
+        "symbol_and_year": search.TransactionFilter("SYM7", date_from="2021-01-01", date_to="2021-12-31"),
+    }
+    with tempfile.TemporaryDirectory() as tmp:
+        db_file = os.path.join(tmp, "bench.db")
+        db.create_tables(db_file)
+        pairs = seed_reference_data(db_file, n_asset_markets=n_asset_markets)
+        db.add_transactions_bulk(db_file, synthetic_transactions(pairs, n))
+
+        results = {}
+        for name, transaction_filter in filters.items():
+            results[f"{name}_seconds"] = _best_seconds(lambda: search.search(db_file, transaction_filter), repeat)
+            results[f"{name}_matches"] = search.search(db_file, transaction_filter).total
+
+        # No debounce: every keystroke is submitted, and supersedes the search before it
+        worker = search.SearchWorker(db_file)
+        start = time.perf_counter()
+        for length in range(1, len("SYM123") + 1):
+            generation = worker.submit(search.TransactionFilter("SYM123"[:length]))
+        while True:
+            result = worker.results.get()
+            if result[0] == generation:
+                break
+        results["typing_seconds"] = time.perf_counter() - start
+        db.close_db(db_file)
+
+    print(f"search over {n} transactions, {n_asset_markets} asset markets (first page and count, best of {repeat}):")
+    for name in filters:
+        print(f"    {name:<16} {results[name + '_seconds'] * 1000:8.2f} ms  {results[name + '_matches']:>8} matches")
+    print(f"    typing 'SYM123' key by key: last result after {results['typing_seconds'] * 1000:.1f} ms")
+    return results
+
+
+def bench_analytics(n_assets=500, years=10, transactions_per_year=20000, repeat=3):
+    """ Returns, drawdown and volatility of every asset market and location: cold, computed again on the cached
+    arrays, from the result cache, and after a new transaction
+    """
+    with tempfile.TemporaryDirectory() as tmp:
+        db_file = os.path.join(tmp, "bench.db")
+        generated = generate_portfolio(db_file, n_assets=n_assets, years=years, transactions_per_year=transactions_per_year)
+        end_date = f"{2014 + years - 1}-12-31"
+        currency_id, pivots = networth.primary_currency_id(db_file), fx.pivot_ids(db_file)
+
+        results = {"cold_seconds": _seconds(lambda: analytics.analyze(db_file, end_date=end_date))}
+        arrays = networth.get_arrays(db_file)
+        results["compute_seconds"] = _best_seconds(lambda: analytics.compute(arrays, currency_id, end_date, pivots=pivots), repeat)
+        results["cached_seconds"] = _best_seconds(lambda: analytics.analyze(db_file, end_date=end_date), repeat)
+        asset_market_id, location_id = generated["pairs"][0]
+        db.add_transaction(db_file, asset_market_id, 1, 100.0, end_date, location_id)
+        results["after_new_trade_seconds"] = _seconds(lambda: analytics.analyze(db_file, end_date=end_date))
+        summary = analytics.analyze(db_file, end_date=end_date).summary
+        results["series"] = len(summary)
+        results["xirr_unsolved"] = int(summary["xirr"].isna().sum())
+        db.close_db(db_file)
+
+    print(f"analytics of {results['series']} series over {generated['transactions']} transactions, {years} years: "
+          f"cold {results['cold_seconds']:.2f}s, compute {results['compute_seconds'] * 1000:.0f} ms, "
+          f"cached {results['cached_seconds'] * 1000:.2f} ms, after a new trade {results['after_new_trade_seconds']:.2f}s "
+          f"({results['xirr_unsolved']} without an XIRR)")
+    return results
+
+
+class _MainLoop:
+    """ A stand-in for the Tk main loop where there is no display: runs the after() callbacks when they are due,
+    and draws a frame every frame_ms, recording the time between frames
+    """
+
+    def __init__(self, frame_ms=16):
+        self.frame_seconds = frame_ms / 1000
+        self.timers = []
+        self.order = itertools.count()
+
+    def after(self, ms, func, *args):
+        heapq.heappush(self.timers, (time.perf_counter() + ms / 1000, next(self.order), func, args))
+
+    def run(self, until):
+        """ Run until until() is true. Returns the seconds between consecutive frames """
+        frames, last = [], time.perf_counter()
+        while not until():
+            now = time.perf_counter()
+            while self.timers and self.timers[0][0] <= now:
+                _, _, func, args = heapq.heappop(self.timers)
+                func(*args)
+            if now - last >= self.frame_seconds:
+                frames.append(now - last)
+                last = now
+            wake = min(last + self.frame_seconds, self.timers[0][0] if self.timers else float("inf"))
+            time.sleep(max(wake - time.perf_counter(), 0))
+        return frames
+
+
+def bench_worker(n=1_000_000, cancel_after_ms=100):
+    """ Frame times of the main loop while multi-second work runs on the database worker, against the stall of
+    running it on the main loop, and how soon a cancelled query lets go
+    """
+    with tempfile.TemporaryDirectory() as tmp:
+        db_file = os.path.join(tmp, "bench.db")
+        db.create_tables(db_file)
+        pairs = seed_reference_data(db_file, n_asset_markets=500)
+        db.add_transactions_bulk(db_file, synthetic_transactions(pairs, n))
+        database = db.get_db(db_file)
+        jobs = {"query": lambda: database.fetchall(LEGACY_ASSET_OVERVIEW_SQL),
+                # As net_worth_series() computes it the first time, without the cache
+                "net_worth": lambda: networth.compute_series(networth.load_arrays(db_file), networth.primary_currency_id(db_file))}
+
+        results = {}
+        loop = _MainLoop()
+        db_worker = worker.DBWorker(loop, db_file)
+        for name, job in jobs.items():
+            # On the main loop, nothing is drawn until the job is over
+            results[f"{name}_blocking_seconds"] = _seconds(job)
+            done = []
+            db_worker.then(db_worker.submit_query(job), done.append)
+            frames = loop.run(lambda: done)
+            results[f"{name}_max_frame_ms"] = max(frames) * 1000
+            results[f"{name}_p95_frame_ms"] = float(np.percentile(frames, 95)) * 1000
+
+        # A query given up on a little after it started
+        cancelled = []
+        future = db_worker.then(db_worker.submit_query(jobs["query"]), cancelled.append, cancelled.append)
+        loop.after(cancel_after_ms, db_worker.cancel)
+        start = time.perf_counter()
+        loop.run(lambda: cancelled)
+        results["cancel_seconds"] = time.perf_counter() - start - cancel_after_ms / 1000
+        results["cancelled"] = future.cancelled() or isinstance(future.exception(), worker.CancelledError)
+        db_worker.close()
+        db.close_db(db_file)
+
+    print(f"main loop frames while working on {n} transactions, the 60 fps target being 16.7 ms:")
+    for name in jobs:
+        print(f"    {name}: {results[f'{name}_blocking_seconds']:.2f}s stall on the main loop; on the worker "
+              f"frames of {results[f'{name}_p95_frame_ms']:.1f} ms (p95), {results[f'{name}_max_frame_ms']:.1f} ms at most")
+    print(f"    cancelled query: gone {results['cancel_seconds'] * 1000:.1f} ms after cancel(), cancelled: {results['cancelled']}")
+    return results
+
+
+# The read functions of db.py, each with arguments for a portfolio of generate_portfolio.
+# bench_suite lists any read function missing from here, so that new ones get timed too.
+READ_CALLS = {
+    "get_schema_version": lambda db_file: db.get_schema_version(db_file),
+    "get_setting": lambda db_file: db.get_setting(db_file, networth.PRIMARY_CURRENCY_SETTING),
+    "get_data_sources_from_asset": lambda db_file: db.get_data_sources_from_asset(db_file, 1),
+    "get_data_sources_from_asset_market": lambda db_file: db.get_data_sources_from_asset_market(db_file, 1),
+    "get_locations": lambda db_file: db.get_locations(db_file),
+    "get_assets": lambda db_file: db.get_assets(db_file),
+    "get_asset_name": lambda db_file: db.get_asset_name(db_file, 1),
+    "get_currencies": lambda db_file: db.get_currencies(db_file),
+    "get_currency_code": lambda db_file: db.get_currency_code(db_file, 1),
+    "get_currency_by_location": lambda db_file: db.get_currency_by_location(db_file, 1),
+    "get_markets": lambda db_file: db.get_markets(db_file),
+    "get_asset_markets": lambda db_file: db.get_asset_markets(db_file, 1),
+    "get_all_asset_markets": lambda db_file: db.get_all_asset_markets(db_file),
+    "get_asset_market_currency": lambda db_file: db.get_asset_market_currency(db_file, 1),
+    "fetch_all_transactions": lambda db_file: db.fetch_all_transactions(db_file),
+    "fetch_transactions_page": lambda db_file: db.fetch_transactions_page(db_file),
+    "fetch_transactions_since": lambda db_file: db.fetch_transactions_since(db_file, db.get_last_transaction_id(db_file) - 100),
+    "get_last_transaction_id": lambda db_file: db.get_last_transaction_id(db_file),
+    "count_transactions": lambda db_file: db.count_transactions(db_file),
+    "fetch_asset_overview": lambda db_file: db.fetch_asset_overview(db_file),
+    "fetch_positions": lambda db_file: db.fetch_positions(db_file),
+    "verify_positions": lambda db_file: db.verify_positions(db_file),
+    "find_table_scans": lambda db_file: db.find_table_scans(db_file),
+}
+READ_PREFIXES = ("get_", "fetch_", "count_", "find_", "verify_")
+
+
+def _best_seconds(func, repeat):
+    """ The fastest of repeat calls of func, the least disturbed by the rest of the machine """
+    return min(_seconds(func) for _ in range(repeat))
+
+
+def _page_population_seconds(db_file):
+    """ Seconds to fill the transactions window from the end and scroll back a few pages, as TransactionsPage does """
+    def populate():
+        window = paging.TransactionWindow(db_file)
+        window.load(from_end=True)
+        for _ in range(5):
+            window.backward()
+    return _seconds(populate)
+
+
+def bench_suite(n_assets=100, years=10, transactions_per_year=20000, repeat=5, seed=0):
+    """ Every db.py read function, the page population and the computation engines, on one generated portfolio """
+    with tempfile.TemporaryDirectory() as tmp:
+        db_file = os.path.join(tmp, "bench.db")
+        generated = generate_portfolio(db_file, n_assets=n_assets, years=years,
+                                       transactions_per_year=transactions_per_year, seed=seed)
+        results = {"transactions": generated["transactions"]}
+
+        untimed = sorted(name for name in dir(db) if name.startswith(READ_PREFIXES) and name != "get_db"
+                         and callable(getattr(db, name)) and name not in READ_CALLS)
+        for name, call in READ_CALLS.items():
+            results[f"read_{name}_seconds"] = _best_seconds(lambda: call(db_file), repeat)
+
+        results["page_population_seconds"] = min(_page_population_seconds(db_file) for _ in range(repeat))
+        results["overview_seconds"] = results["read_fetch_asset_overview_seconds"]
+        results["load_transactions_seconds"] = _best_seconds(lambda: models.load_transactions(db_file), repeat)
+        results["lifo_rebuild_seconds"] = _seconds(lambda: lifo.get_engine(db_file).rebuild())
+        results["lifo_sync_seconds"] = _best_seconds(lambda: lifo.get_engine(db_file).sync(), repeat)
+        results["positions_rebuild_seconds"] = _seconds(lambda: db.rebuild_positions(db_file))
+        results["fx_load_seconds"] = _best_seconds(lambda: fx.FxService.load(db_file), repeat)
+        end_date = f"{2014 + years - 1}-12-31"
+        results["net_worth_seconds"] = _best_seconds(lambda: networth.net_worth_series(db_file, end_date=end_date), repeat)
+        results["tax_cold_seconds"] = _seconds(lambda: tax.estimate(db_file, 2014 + years - 1))
+        results["tax_cached_seconds"] = _best_seconds(lambda: tax.estimate(db_file, 2014 + years - 1), repeat)
+        results["analytics_seconds"] = _seconds(lambda: analytics.analyze(db_file, end_date=end_date))
+        db.close_db(db_file)
+
+    width = max(len(key) for key in results)
+    print(f"suite over {results['transactions']} transactions, {n_assets} assets, {years} years (best of {repeat}):")
+    for key, value in results.items():
+        if key.endswith("_seconds"):
+            print(f"    {key[:-len('_seconds')]:<{width}} {value * 1000:10.2f} ms")
+    if untimed:
+        print("    not timed, add them to READ_CALLS: " + ", ".join(untimed))
+    return results
+
+
+BENCHMARKS = {
+    "connections": bench_connections,
+    "bulk_insert": bench_bulk_insert,
+    "import": bench_import,
+    "query_plans": bench_query_plans,
+    "lifo": bench_lifo,
+    "edits": bench_edits,
+    "net_worth": bench_net_worth,
+    "fx": bench_fx,
+    "transactions_page": bench_transactions_page,
+    "positions": bench_positions,
+    "cash": bench_cash,
+    "startup": bench_startup,
+    "models": bench_models,
+    "reference_cache": bench_reference_cache,
+    "snapshot": bench_snapshot,
+    "aggregate": bench_aggregate,
+    "tax": bench_tax,
+    "suite": bench_suite,
+    "profiling": bench_profiling,
+    "search": bench_search,
+    "analytics": bench_analytics,
+    "refresh": bench_refresh,
+    "worker": bench_worker,
+}
+
+
+# A metric counts as a regression when it is worse than its baseline by more than the tolerance
+# and by more than this much (in seconds), so that sub-millisecond noise is not flagged
+REGRESSION_MIN_SECONDS = 0.002
+
+
+def _direction(key):
+    """ 1 if a higher value of metric key is worse, -1 if a lower one is, 0 if it is not a performance metric """
+    if key.endswith(("_seconds", "_mb")):
+        return 1
+    if key.endswith("_per_s"):
+        return -1
+    return 0
+
+
+def compare(results, baseline, tolerance=0.5):
+    """ [(benchmark, metric, baseline value, value)] for every metric of results worse than baseline by tolerance """
+    regressions = []
+    for name, metrics in results.items():
+        for key, value in (metrics or {}).items():
+            before = (baseline.get(name) or {}).get(key)
+            direction = _direction(key)
+            if not direction or not isinstance(value, (int, float)) or not isinstance(before, (int, float)) or not before:
+                continue
+            worse = (value - before) * direction
+            if worse > tolerance * abs(before) and (not key.endswith("_seconds") or worse > REGRESSION_MIN_SECONDS):
+                regressions.append((name, key, before, value))
+    return regressions
+
+
+def _environment():
+    import platform
+    import sqlite3
+    return {"python": platform.python_version(), "sqlite": sqlite3.sqlite_version, "machine": platform.machine(),
+            "cpu_count": os.cpu_count(), "date": datetime.datetime.now().isoformat(timespec="seconds")}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Run PortfolioTracker benchmarks")
+    parser.add_argument("names", nargs="*", help="benchmarks to run, among: " + ", ".join(BENCHMARKS) + " (default: all)")
+    parser.add_argument("--json", help="write the results to this JSON file")
+    parser.add_argument("--baseline", help="JSON file of an earlier run to compare against; regressions exit with status 1")
+    parser.add_argument("--tolerance", type=float, default=0.5,
+                        help="how much worse than the baseline a metric may get, as a fraction (default: 0.5)")
+    args = parser.parse_args(argv)
+    unknown = [name for name in args.names if name not in BENCHMARKS]
+    if unknown:
+        parser.error("unknown benchmark(s): " + ", ".join(unknown))
+    results = {name: BENCHMARKS[name]() for name in (args.names or BENCHMARKS)}
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"environment": _environment(), "results": results}, f, indent=1, default=str)
+    if not args.baseline:
+        return 0
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    regressions = compare(results, baseline["results"], args.tolerance)
+    for name, key, before, value in regressions:
+        print(f"REGRESSION {name}.{key}: {before:.4g} -> {value:.4g} ({value / before - 1:+.0%})")
+    print(f"{len(regressions)} regression(s) against {args.baseline} (tolerance {args.tolerance:.0%})")
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,181 @@
+"""
+Cash ledger.
+
+Every location has a cash account (a row of accounts, opened on first use)
+with one balance per currency. Each transaction books its cash leg in
+cash_movements, by trigger, in the currency of its asset market: a purchase
+takes quantity * price out, a sale puts it in. add_movement() records the
+rest: deposits, withdrawals, dividends and fees. account_balances holds the
+current balance of every account and currency, kept up to date by trigger
+too, so balances() reads no movement at all.
+
+A balance at an earlier date starts from a checkpoint: cash_snapshots holds
+the balance at the end of a day every CHECKPOINT_EVERY movements, and
+balance_at() adds to the last checkpoint on or before the date the few
+movements after it, rather than adding up the whole history. A movement
+back-dated before a checkpoint corrects it (by trigger), and balance_at()
+writes new checkpoints once it finds too many movements after the last one.
+"""
+import datetime
+import sqlite3
+
+import db
+
+CHECKPOINT_EVERY = 500
+CASH_ACCOUNT_TYPE = "cash"
+
+LAST_CHECKPOINT_SQL = '''SELECT date, balance FROM cash_snapshots
+                         WHERE account_id = ? AND currency_id = ? AND date <= ?
+                         ORDER BY date DESC LIMIT 1'''
+MOVEMENTS_SINCE_SQL = '''SELECT COUNT(*), TOTAL(amount) FROM cash_movements
+                         WHERE account_id = ? AND currency_id = ? AND date > ? AND date <= ?'''
+
+
+def _day(date):
+    return date.isoformat() if isinstance(date, datetime.date) else str(date)
+
+
+def get_account(db_file, location_id):
+    """ The id of the cash account of location_id, opened if need be. None if there is no such location """
+    database = db.get_db(db_file)
+    database.write(f"INSERT OR IGNORE INTO accounts (name, type, location_id) "
+                   f"SELECT name, '{CASH_ACCOUNT_TYPE}', id FROM locations WHERE id = ?", (location_id,))
+    row = database.fetchone("SELECT id FROM accounts WHERE location_id = ?", (location_id,))
+    return row[0] if row else None
+
+
+def add_movement(db_file, location_id, currency_id, amount, date, description=None):
+    """ Record a movement of cash that is not a trade, such as a deposit (positive amount), a withdrawal or a fee
+    (negative). Returns its id, or -1 on error
+    """
+    account_id = get_account(db_file, location_id)
+    if account_id is None:
+        print(f"Unknown location_id: {location_id}")
+        return -1
+    return db.get_db(db_file).write("INSERT INTO cash_movements (account_id, currency_id, date, amount, description) "
+                                    "VALUES (?, ?, ?, ?, ?)", (account_id, currency_id, _day(date), amount, description))
+
+
+def get_movements(db_file, location_id, currency_id, date_from="", date_to="9999-12-31"):
+    """ The movements of a location's cash in a currency between two dates, as (id, date, amount, transaction_id,
+    description), in date order
+    """
+    return db.get_db(db_file).fetchall(
+        '''SELECT m.id, m.date, m.amount, m.transaction_id, m.description
+           FROM cash_movements m JOIN accounts ac ON m.account_id = ac.id
+           WHERE ac.location_id = ? AND m.currency_id = ? AND m.date >= ? AND m.date <= ?
+           ORDER BY m.date, m.id''', (location_id, currency_id, _day(date_from), _day(date_to)))
+
+
+def balances(db_file):
+    """ The current cash of every location, as (location_id, location name, currency_id, currency code, amount) """
+    return db.get_db(db_file).fetchall(
+        '''SELECT ac.location_id, l.name, b.currency_id, cu.code, b.amount
+           FROM account_balances b
+           JOIN accounts ac ON b.account_id = ac.id
+           JOIN locations l ON ac.location_id = l.id
+           JOIN currencies cu ON b.currency_id = cu.id
+           ORDER BY l.name, cu.code''')
+
+
+def balance_at(db_file, location_id, currency_id, date):
+    """ The cash of location_id in currency_id at the end of date: the last checkpoint plus the movements after it """
+    database = db.get_db(db_file)
+    row = database.fetchone("SELECT id FROM accounts WHERE location_id = ?", (location_id,))
+    if row is None:
+        return 0.0
+    account_id, date = row[0], _day(date)
+    checkpoint_date, balance = database.fetchone(LAST_CHECKPOINT_SQL, (account_id, currency_id, date)) or ("", 0.0)
+    count, delta = database.fetchone(MOVEMENTS_SINCE_SQL, (account_id, currency_id, checkpoint_date, date)) or (0, 0.0)
+    if count > 2 * CHECKPOINT_EVERY:
+        # Too long a replay: the checkpoints are behind, and the next call will be short again
+        checkpoint(db_file, account_id, currency_id)
+    return balance + delta
+
+
+def balances_at(db_file, date):
+    """ The cash of every location at the end of date, as (location_id, location name, currency_id, currency code,
+    amount), for every account and currency with a current balance
+    """
+    return [(location_id, name, currency_id, code, balance_at(db_file, location_id, currency_id, date))
+            for location_id, name, currency_id, code, amount in balances(db_file)]
+
+
+def checkpoint(db_file, account_id=None, currency_id=None):
+    """ Write the missing checkpoints of one account and currency (default: all of them), going on from the last
+    one. Returns the number written, or -1 on error
+    """
+    database = db.get_db(db_file)
+    if account_id is None:
+        pairs = database.fetchall("SELECT account_id, currency_id FROM account_balances")
+    else:
+        pairs = [(account_id, currency_id)]
+    written = 0
+    try:
+        with database.transaction() as conn:
+            # Holding the write lock, so that no movement comes in between reading them and writing the checkpoints
+            conn.execute("BEGIN IMMEDIATE")
+            for account_id, currency_id in pairs:
+                last = conn.execute("SELECT date, balance FROM cash_snapshots WHERE account_id = ? AND currency_id = ? "
+                                    "ORDER BY date DESC LIMIT 1", (account_id, currency_id)).fetchone()
+                after, balance = last or ("", 0.0)
+                days = conn.execute('''SELECT date, TOTAL(amount), COUNT(*) FROM cash_movements
+                                       WHERE account_id = ? AND currency_id = ? AND date > ?
+                                       GROUP BY date ORDER BY date''', (account_id, currency_id, after))
+                checkpoints, count = [], 0
+                for date, amount, movements in days:
+                    balance += amount
+                    count += movements
+                    if count >= CHECKPOINT_EVERY:
+                        checkpoints.append((account_id, currency_id, date, balance))
+                        count = 0
+                conn.executemany("INSERT INTO cash_snapshots (account_id, currency_id, date, balance) VALUES (?, ?, ?, ?)",
+                                 checkpoints)
+                written += len(checkpoints)
+    except sqlite3.Error as e:
+        print(e)
+        return -1
+    return written
+
+
+def verify(db_file, tolerance=1e-9):
+    """ Compare account_balances and the checkpoints with the sums of the movements.
+
+    Returns [(account_id, currency_id, date, stored, expected)] for every balance (date None) and checkpoint
+    that differs by more than tolerance, relative to the expected amount
+    """
+    def differ(stored, expected):
+        return stored is None or abs(stored - expected) > tolerance * max(1.0, abs(expected))
+
+    database = db.get_db(db_file)
+    expected = {(account_id, currency_id): amount for account_id, currency_id, amount in database.fetchall(
+        "SELECT account_id, currency_id, SUM(amount) FROM cash_movements GROUP BY account_id, currency_id")}
+    stored = {(account_id, currency_id): amount for account_id, currency_id, amount in database.fetchall(
+        "SELECT account_id, currency_id, amount FROM account_balances")}
+    mismatches = []
+    for account_id, currency_id in sorted(stored.keys() | expected.keys()):
+        have, want = stored.get((account_id, currency_id)), expected.get((account_id, currency_id), 0.0)
+        if differ(have, want):
+            mismatches.append((account_id, currency_id, None, have, want))
+    # The running balance at the end of every day with movements, in one pass, matched to the checkpoints
+    for account_id, currency_id, date, balance, total in database.fetchall(
+            '''WITH days AS (SELECT account_id, currency_id, date,
+                                   SUM(TOTAL(amount)) OVER (PARTITION BY account_id, currency_id ORDER BY date) AS total
+                            FROM cash_movements GROUP BY account_id, currency_id, date)
+               SELECT s.account_id, s.currency_id, s.date, s.balance,
+                      COALESCE((SELECT d.total FROM days d
+                                WHERE d.account_id = s.account_id AND d.currency_id = s.currency_id AND d.date <= s.date
+                                ORDER BY d.date DESC LIMIT 1), 0.0)
+               FROM cash_snapshots s ORDER BY s.account_id, s.currency_id, s.date'''):
+        if differ(balance, total):
+            mismatches.append((account_id, currency_id, date, balance, total))
+    return mismatches
+
+
+def rebuild(db_file):
+    """ Book the cash legs of every transaction again, recompute the balances and write the checkpoints again.
+    Deposits and the other movements added by hand are kept. Returns the number of checkpoints, -1 on error
+    """
+    if db.rebuild_cash_ledger(db_file) < 0:
+        return -1
+    return checkpoint(db_file)
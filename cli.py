@@ -0,0 +1,332 @@
+"""
+Command line interface, for scripts and headless servers.
+
+Usage:
+    python cli.py portfolio.db import statement.csv [--location NAME]
+    python cli.py portfolio.db refresh [--workers N]
+    python cli.py portfolio.db lots [--rebuild]
+    python cli.py portfolio.db net-worth [--currency CODE] [--end YYYY-MM-DD] [--output FILE.csv]
+    python cli.py portfolio.db analytics [--currency CODE] [--end YYYY-MM-DD] [--sort COLUMN] [--output FILE.csv]
+    python cli.py portfolio.db overview
+    python cli.py portfolio.db cash [--date YYYY-MM-DD] [--verify | --rebuild]
+    python cli.py portfolio.db cash --add LOCATION CURRENCY AMOUNT [--date YYYY-MM-DD] [--description TEXT]
+    python cli.py portfolio.db positions [--rebuild]
+    python cli.py portfolio.db edit TRANSACTION_ID [--quantity Q] [--price P] [--date YYYY-MM-DD]
+    python cli.py portfolio.db delete TRANSACTION_ID [TRANSACTION_ID ...]
+    python cli.py portfolio.db undo
+    python cli.py portfolio.db redo
+    python cli.py portfolio.db snapshot DIRECTORY [--format arrow|parquet] [--full]
+    python cli.py portfolio.db tax [--year YYYY] [--sell ASSET_MARKET_ID QUANTITY PRICE [--date YYYY-MM-DD]]
+
+With --profile (before the command) every query is timed, and the profile is
+printed once the command is over, or written as JSON with --profile-output:
+    python cli.py --profile --slow-ms 50 portfolio.db overview
+
+Nothing here imports tkinter. Each command imports only the modules it needs,
+so that the quick ones (overview, positions) start without loading pandas.
+"""
+import argparse
+import datetime
+import sys
+
+import db
+
+
+def cmd_import(args):
+    import importer
+    result = importer.import_statement(args.db_file, args.statement, args.location or importer.DEFAULT_LOCATION)
+    print(f"{result['read']} trades read, {result['inserted']} imported, {result['duplicates']} already there")
+    return 0
+
+
+def cmd_refresh(args):
+    import refresh
+    summary = refresh.RefreshScheduler(args.db_file, max_workers=args.workers).refresh()
+    print(f"{summary['prices']} prices and {summary['rates']} exchange rates downloaded in {summary['seconds']:.1f}s")
+    for error in summary["errors"]:
+        print(f"error: {error}", file=sys.stderr)
+    return 1 if summary["errors"] else 0
+
+
+def cmd_lots(args):
+    import lifo
+    engine = lifo.get_engine(args.db_file)
+    if args.rebuild:
+        engine.rebuild()
+        print("Lots recomputed from the whole history")
+    else:
+        print(f"{engine.sync()} new transactions matched")
+    for bucket, gains in lifo.realized_gains(args.db_file).items():
+        for currency_code, gain in sorted(gains.items(), key=lambda item: str(item[0])):
+            print(f"realized gains, {bucket}: {gain:,.2f} {currency_code}")
+    return 0
+
+
+def _currency_id(db_file, code):
+    """ The id of the currency with code, None (after saying so) if there is none """
+    currency_id = next((currency[0] for currency in db.get_currencies(db_file) if currency[1] == code), None)
+    if currency_id is None:
+        print(f"Unknown currency: {code}", file=sys.stderr)
+    return currency_id
+
+
+def cmd_net_worth(args):
+    import networth
+    currency_id = None
+    if args.currency:
+        currency_id = _currency_id(args.db_file, args.currency)
+        if currency_id is None:
+            return 1
+    series = networth.net_worth_series(args.db_file, currency_id, args.end)
+    series.to_csv(args.output or sys.stdout, index_label="date", float_format="%.2f")
+    return 0
+
+
+def cmd_analytics(args):
+    import analytics
+    currency_id = None
+    if args.currency:
+        currency_id = _currency_id(args.db_file, args.currency)
+        if currency_id is None:
+            return 1
+    summary = analytics.analyze(args.db_file, currency_id, args.end).summary
+    summary = summary.sort_values(args.sort, ascending=False, kind="stable") if args.sort else summary
+    if args.output:
+        summary.to_csv(args.output, float_format="%.6f")
+        return 0
+    print(f"{'Kind':<12}  {'Name':<30}  {'Value':>14}  {'TWR':>8}  {'TWR/yr':>8}  {'XIRR':>8}  "
+          f"{'Drawdown':>8}  {'Vol':>7}  {'Corr':>5}")
+    for (kind, series_id), row in summary.iterrows():
+        print(f"{kind:<12}  {row['name'][:30]:<30}  {row['value']:>14,.2f}  {row['twr']:>8.1%}  "
+              f"{row['twr_annualized']:>8.1%}  {row['xirr']:>8.1%}  {row['max_drawdown']:>8.1%}  "
+              f"{row['volatility']:>7.1%}  {row['correlation']:>5.2f}")
+    return 0
+
+
+def cmd_overview(args):
+    rows = db.fetch_asset_overview(args.db_file)
+    width = max([len(str(name)) for name, location, quantity in rows] + [5])
+    print(f"{'Asset':<{width}}  {'Location':<30}  {'Quantity':>14}")
+    for name, location, quantity in rows:
+        print(f"{name:<{width}}  {location:<30}  {quantity:>14,.4f}")
+    return 0
+
+
+def cmd_cash(args):
+    import cash
+    if args.rebuild:
+        count = cash.rebuild(args.db_file)
+        print(f"cash ledger rebuilt, {count} checkpoints written")
+        return 0 if count >= 0 else 1
+    if args.verify:
+        mismatches = cash.verify(args.db_file)
+        for account_id, currency_id, date, stored, expected in mismatches:
+            print(f"account {account_id}, currency {currency_id}, {date or 'now'}: stored {stored}, expected {expected}")
+        print(f"{len(mismatches)} balances differ from the movements" if mismatches else "cash balances are up to date")
+        return 1 if mismatches else 0
+    if args.add:
+        location, code, amount = args.add
+        location_id = next((row[0] for row in db.get_locations(args.db_file) if row[1] == location), None)
+        if location_id is None:
+            print(f"Unknown location: {location}", file=sys.stderr)
+            return 1
+        currency_id = _currency_id(args.db_file, code)
+        if currency_id is None:
+            return 1
+        movement_id = cash.add_movement(args.db_file, location_id, currency_id, float(amount),
+                                        args.date or datetime.date.today().isoformat(), args.description)
+        return 0 if movement_id != -1 else 1
+    rows = cash.balances_at(args.db_file, args.date) if args.date else cash.balances(args.db_file)
+    print(f"{'Location':<30}  {'Currency':<8}  {'Cash':>16}")
+    for location_id, location, currency_id, code, amount in rows:
+        print(f"{location:<30}  {code:<8}  {amount:>16,.2f}")
+    return 0
+
+
+def cmd_positions(args):
+    if args.rebuild:
+        count = db.rebuild_positions(args.db_file)
+        print(f"{count} positions rebuilt")
+        return 0 if count >= 0 else 1
+    mismatches = db.verify_positions(args.db_file)
+    for asset_market_id, stored, expected in mismatches:
+        print(f"asset market {asset_market_id}: stored {stored}, expected {expected}")
+    print(f"{len(mismatches)} positions differ from the transactions" if mismatches else "positions are up to date")
+    return 1 if mismatches else 0
+
+
+def _print_change(change, done):
+    """ Say what a db.Change did; 1 if there was none """
+    if change is None:
+        return 1
+    for asset_market_id, date in sorted(change.dirty.items()):
+        print(f"asset market {asset_market_id}: changed from {date}")
+    print(f"{done}: {len(change.transaction_ids)} transactions" if change.id is not None else "nothing changed")
+    return 0
+
+
+def cmd_edit(args):
+    try:
+        change = db.update_transaction(args.db_file, args.transaction_id, quantity=args.quantity, price=args.price,
+                                       date=args.date)
+    except ValueError as e:
+        print(e, file=sys.stderr)
+        return 1
+    return _print_change(change, "edited")
+
+
+def cmd_delete(args):
+    return _print_change(db.delete_transactions(args.db_file, args.transaction_ids), "deleted")
+
+
+def cmd_undo(args):
+    description = db.undo_redo_state(args.db_file)[0 if args.command == "undo" else 1]
+    if description is None:
+        print(f"nothing to {args.command}")
+        return 1
+    change = db.undo(args.db_file) if args.command == "undo" else db.redo(args.db_file)
+    return _print_change(change, f"{args.command} {description}")
+
+
+def cmd_snapshot(args):
+    import snapshot
+    written = snapshot.snapshot(args.db_file, args.directory, args.format, args.full)
+    for table, count in written.items():
+        print(f"{table}: {count} rows written")
+    return 0
+
+
+def cmd_tax(args):
+    import tax
+    if args.sell:
+        asset_market_id, quantity, price = args.sell
+        try:
+            result = tax.what_if_sell(args.db_file, int(asset_market_id), float(quantity), float(price),
+                                      args.date or datetime.date.today().isoformat())
+        except ValueError as e:
+            print(e, file=sys.stderr)
+            return 1
+        print(f"gain on the sale: {result['gain']:,.2f} ({db.get_currency_code(args.db_file, result['currency_id'])})")
+        for year in result["years"]:
+            if year["delta"]:
+                print(f"{year['year']}: tax {year['tax_before']:,.2f} -> {year['tax_after']:,.2f} {tax.TAX_CURRENCY}")
+        print(f"additional tax: {result['tax_delta']:,.2f} {tax.TAX_CURRENCY}")
+        return 0
+    result = tax.estimate(args.db_file, args.year)
+    print(f"{result['year']} tax estimate: {result['tax']:,.2f} {tax.TAX_CURRENCY}")
+    print(f"    redditi diversi {result['redditi_diversi']:,.2f}, of which offset by past losses {result['losses_used']:,.2f}")
+    print(f"    redditi di capitale {result['redditi_di_capitale']:,.2f}")
+    for origin, amount in sorted(result["carry_out"].items()):
+        print(f"    loss of {origin} carried forward: {amount:,.2f}")
+    if result["unconverted_gains"]:
+        print(f"gains without an exchange rate to {tax.TAX_CURRENCY} left out: {result['unconverted_gains']:,.2f}",
+              file=sys.stderr)
+    return 0
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description="PortfolioTracker without the GUI")
+    parser.add_argument("--profile", action="store_true", help="time every query and print the profile at the end")
+    parser.add_argument("--slow-ms", type=float, help="with --profile, log the queries slower than this")
+    parser.add_argument("--profile-output", help="with --profile, write the profile to this JSON file instead")
+    parser.add_argument("db_file", help="the portfolio database; created if it does not exist")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    command = commands.add_parser("import", help="import an Interactive Brokers statement (CSV or Flex XML)")
+    command.add_argument("statement")
+    command.add_argument("--location",
+                         help="location the trades are booked at, when the statement names no account")
+    command.set_defaults(func=cmd_import)
+
+    command = commands.add_parser("refresh", help="download the missing prices and exchange rates")
+    command.add_argument("--workers", type=int, default=8)
+    command.set_defaults(func=cmd_refresh)
+
+    command = commands.add_parser("lots", help="match new transactions into LIFO lots and print realized gains")
+    command.add_argument("--rebuild", action="store_true", help="recompute every lot from scratch")
+    command.set_defaults(func=cmd_lots)
+
+    command = commands.add_parser("net-worth", help="write the daily net worth as CSV")
+    command.add_argument("--currency", help="currency code (default: the primary currency)")
+    command.add_argument("--end", help="last day, YYYY-MM-DD (default: today)")
+    command.add_argument("--output", help="CSV file to write (default: standard output)")
+    command.set_defaults(func=cmd_net_worth)
+
+    command = commands.add_parser("analytics", help="compare the returns, drawdown and volatility of every asset market and location")
+    command.add_argument("--currency", help="currency code (default: the primary currency)")
+    command.add_argument("--end", help="last day, YYYY-MM-DD (default: today)")
+    command.add_argument("--sort", choices=("value", "twr", "twr_annualized", "xirr", "max_drawdown", "volatility"),
+                         help="order by this column, highest first")
+    command.add_argument("--output", help="write the table to this CSV file instead")
+    command.set_defaults(func=cmd_analytics)
+
+    command = commands.add_parser("overview", help="print the quantity of each asset held at each location")
+    command.set_defaults(func=cmd_overview)
+
+    command = commands.add_parser("cash", help="print the cash of every location, or record a deposit or withdrawal")
+    command.add_argument("--date", help="the balances at the end of this day, YYYY-MM-DD, or the date of --add (default: today)")
+    command.add_argument("--add", nargs=3, metavar=("LOCATION", "CURRENCY", "AMOUNT"),
+                         help="record a movement of cash: positive for a deposit, negative for a withdrawal")
+    command.add_argument("--description", help="with --add, what the movement is")
+    check = command.add_mutually_exclusive_group()
+    check.add_argument("--verify", action="store_true", help="check the balances and checkpoints against the movements")
+    check.add_argument("--rebuild", action="store_true", help="book the cash of every transaction again")
+    command.set_defaults(func=cmd_cash)
+
+    command = commands.add_parser("positions", help="check the materialized positions against the transactions")
+    command.add_argument("--rebuild", action="store_true", help="recompute them instead")
+    command.set_defaults(func=cmd_positions)
+
+    command = commands.add_parser("edit", help="change the quantity, price or date of a transaction")
+    command.add_argument("transaction_id", type=int)
+    command.add_argument("--quantity", type=float)
+    command.add_argument("--price", type=float)
+    command.add_argument("--date", help="YYYY-MM-DD")
+    command.set_defaults(func=cmd_edit)
+
+    command = commands.add_parser("delete", help="delete transactions")
+    command.add_argument("transaction_ids", type=int, nargs="+", metavar="transaction_id")
+    command.set_defaults(func=cmd_delete)
+
+    command = commands.add_parser("undo", help="undo the last add, edit or deletion of transactions")
+    command.set_defaults(func=cmd_undo)
+
+    command = commands.add_parser("redo", help="redo the last change undone")
+    command.set_defaults(func=cmd_undo)
+
+    command = commands.add_parser("snapshot", help="export the tables to Arrow or Parquet files, appending only what is new")
+    command.add_argument("directory")
+    command.add_argument("--format", choices=("arrow", "parquet"), default="arrow")
+    command.add_argument("--full", action="store_true", help="write every table again from scratch")
+    command.set_defaults(func=cmd_snapshot)
+
+    command = commands.add_parser("tax", help="estimate the capital gains tax of a year, or of a sale")
+    command.add_argument("--year", type=int, help="fiscal year (default: this year)")
+    command.add_argument("--sell", nargs=3, metavar=("ASSET_MARKET_ID", "QUANTITY", "PRICE"),
+                         help="estimate the tax of this sale instead, without recording it")
+    command.add_argument("--date", help="date of the sale, YYYY-MM-DD (default: today)")
+    command.set_defaults(func=cmd_tax)
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    profiler = None
+    if args.profile or args.profile_output:
+        import profiling
+        profiler = profiling.enable(args.slow_ms or profiling.DEFAULT_SLOW_MS)
+    db.create_tables(args.db_file)
+    try:
+        return args.func(args)
+    finally:
+        db.close_db(args.db_file)
+        if profiler is not None:
+            report = profiling.disable()
+            if args.profile_output:
+                profiling.dump(args.profile_output, report)
+            else:
+                print(profiling.format_report(report), file=sys.stderr)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,22 @@
+"""
+Dates as whole days since 1970-01-01, the form the array code and
+models.TransactionBatch keep them in.
+
+Only the standard library is imported, so that modules the GUI loads at
+startup can use it without pulling in NumPy (utils.py builds on it for arrays).
+"""
+import datetime
+
+EPOCH_ORDINAL = datetime.date(1970, 1, 1).toordinal()
+
+
+def to_day(date):
+    """ Convert one YYYY-MM-DD string or date to days since 1970-01-01 """
+    if isinstance(date, str):
+        date = datetime.date.fromisoformat(date)
+    return date.toordinal() - EPOCH_ORDINAL
+
+
+def from_day(day):
+    """ Convert days since 1970-01-01 back to a YYYY-MM-DD string """
+    return datetime.date.fromordinal(day + EPOCH_ORDINAL).isoformat()
@@ -1,4 +1,11 @@
+import itertools
+import os
 import sqlite3
+import sys
+import threading
+import time
+from collections import namedtuple
+from contextlib import contextmanager
 
 
 def create_connection(db_file):
@@ -11,9 +18,202 @@ def create_connection(db_file):
     return conn
 
 
+_generation_counter = itertools.count(1)
+
+
+class PortfolioDB:
+    """ Long-lived connection manager for one portfolio database file.
+
+    Each thread gets its own connection, opened on first use and then reused,
+    so the module-level functions below no longer pay for a connect/close on
+    every call. Prepared statements are kept in sqlite3's statement cache.
+    """
+
+    STATEMENT_CACHE_SIZE = 256
+    PRAGMAS = (
+        ("journal_mode", "WAL"),      # readers do not block the writer
+        ("synchronous", "NORMAL"),    # safe with WAL, avoids an fsync per commit
+        ("temp_store", "MEMORY"),
+        ("cache_size", -16000),       # negative means KiB, so ~16MB of page cache
+        ("mmap_size", 268435456),
+    )
+
+    def __init__(self, db_file):
+        self.db_file = db_file
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._connections = []
+        self.closed = False
+        # Generation of each table written through this process, see generation()
+        self._generations = {}
+        self._base_generation = next(_generation_counter)
+        # What check_external_writes() saw last: (PRAGMA data_version, total_changes of this process), and when
+        self._monitor = None
+        self._seen = None
+        self._checked_at = None
+
+    def generation(self, table):
+        """ A number that changes every time table is written to through bump_generation().
+
+        Numbers are never reused, not even after close_db(), so a cache remembering
+        one can always tell whether what it holds is still current. Call check_external_writes()
+        first to have writes made by other processes move it on too.
+        """
+        return self._generations.get(table, self._base_generation)
+
+    def check_external_writes(self, max_age=0):
+        """ Invalidate every generation if another process has committed to the file since the last look.
+        The first look only takes note. Returns True if it invalidated.
+
+        With max_age, in seconds, no look is taken sooner than that after the last one.
+        """
+        if self.db_file == ":memory:":
+            return False
+        now = time.monotonic()
+        if max_age and self._checked_at is not None and now - self._checked_at < max_age:
+            return False
+        with self._lock:
+            self._checked_at = now
+            try:
+                if self._monitor is None:
+                    self._monitor = sqlite3.connect(self.db_file, check_same_thread=False)
+                # Moves on with every commit of any other connection: those of this process as well as the others'
+                version = self._monitor.execute("PRAGMA data_version").fetchone()[0]
+            except sqlite3.Error as e:
+                print(e)
+                return False
+            # The rows written by the connections of this process, whose writes move the generations themselves
+            changes = sum(conn.total_changes for conn in self._connections)
+            seen, self._seen = self._seen, (version, changes)
+        # Between two looks that saw this process write, a commit of another process cannot be told apart from
+        # this process' own: it is only seen once another process commits again
+        if seen is None or seen[0] == version or seen[1] != changes:
+            return False
+        self.invalidate()
+        return True
+
+    def bump_generation(self, *tables):
+        for table in tables:
+            self._generations[table] = next(_generation_counter)
+
+    def invalidate(self):
+        """ Move the generation of every table on, so that whatever was cached under them is read again """
+        self._generations.clear()
+        self._base_generation = next(_generation_counter)
+
+    @property
+    def connection(self):
+        """ The connection owned by the calling thread, opened on first use """
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_file, cached_statements=self.STATEMENT_CACHE_SIZE,
+                                   check_same_thread=False)
+            for pragma, value in self.PRAGMAS:
+                conn.execute(f"PRAGMA {pragma} = {value}")
+            self._local.conn = conn
+            with self._lock:
+                self._connections.append(conn)
+                self.closed = False
+        return conn
+
+    def execute(self, sql, params=()):
+        """ Execute a statement on the thread's connection and return the cursor """
+        return self.connection.execute(sql, params)
+
+    def fetchall(self, sql, params=()):
+        """ Run a query and return all rows, or an empty list on error """
+        try:
+            return self.execute(sql, params).fetchall()
+        except sqlite3.Error as e:
+            print(e)
+            return []
+
+    def fetchone(self, sql, params=()):
+        """ Run a query and return the first row, or None on error """
+        try:
+            return self.execute(sql, params).fetchone()
+        except sqlite3.Error as e:
+            print(e)
+            return None
+
+    def write(self, sql, params=()):
+        """ Execute a single write and commit it. Returns the lastrowid, or -1 on error """
+        try:
+            conn = self.connection
+            try:
+                c = conn.execute(sql, params)
+                conn.commit()
+            except sqlite3.Error:
+                conn.rollback()
+                raise
+            return c.lastrowid
+        except sqlite3.Error as e:
+            print(e)
+            return -1
+
+    @contextmanager
+    def transaction(self):
+        """ Group several writes in one transaction, committed on success and rolled back on error """
+        conn = self.connection
+        try:
+            yield conn
+            conn.commit()
+        except BaseException:
+            conn.rollback()
+            raise
+
+    def close(self):
+        """ Close every connection opened by this manager, from any thread """
+        with self._lock:
+            connections, self._connections = self._connections, []
+            if self._monitor is not None:
+                connections.append(self._monitor)
+            self._monitor = self._seen = None
+            self.closed = True
+        for conn in connections:
+            conn.close()
+        self._local = threading.local()
+
+
+_databases = {}
+_databases_lock = threading.Lock()
+
+
+def database_key(db_file):
+    """ The key db_file is pooled under: its absolute path, so that two spellings of one file share it """
+    return db_file if db_file == ":memory:" else os.path.abspath(db_file)
+
+
+def get_db(db_file):
+    """ Return the shared PortfolioDB for db_file, creating it on first use """
+    key = database_key(db_file)
+    with _databases_lock:
+        database = _databases.get(key)
+        if database is None:
+            database = _databases[key] = PortfolioDB(db_file)
+    return database
+
+
+def close_db(db_file=None):
+    """ Close the pooled connections for db_file, or for every database if db_file is None """
+    with _databases_lock:
+        if db_file is None:
+            databases = list(_databases.values())
+            _databases.clear()
+        else:
+            database = _databases.pop(database_key(db_file), None)
+            databases = [database] if database is not None else []
+    for database in databases:
+        database.close()
+
+
 def create_tables(db_file):
     """ Create tables in the database """
-    conn = create_connection(db_file)
+    try:
+        conn = get_db(db_file).connection
+    except sqlite3.Error as e:
+        print(e)
+        conn = None
     if conn is not None:
         try:
             c = conn.cursor()
@@ -127,348 +327,1057 @@ def create_tables(db_file):
             conn.commit()
         except sqlite3.Error as e:
             print(e)
-        finally:
-            conn.close()
+            return
+        # The tables above are the original schema, the migrations bring it up to date
+        migrate(db_file)
     else:
         print("Error! Cannot create the database connection.")
 
 
+# Schema migrations
+# Each migration takes a cursor and upgrades the schema by one version. The
+# version a database is at is stored in PRAGMA user_version, so existing user
+# files are upgraded in place the next time they are opened.
+def _migration_transaction_fingerprint(c):
+    """ Imported transactions carry a hash of their natural key, so the same action is never stored twice """
+    if "fingerprint" not in [column[1] for column in c.execute("PRAGMA table_info(transactions)")]:
+        c.execute("ALTER TABLE transactions ADD COLUMN fingerprint BLOB")
+    c.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_transactions_fingerprint ON transactions (fingerprint)")
+
+def _migration_join_indexes(c):
+    """ Indexes for the join paths of fetch_all_transactions, fetch_asset_overview and get_asset_markets """
+    c.execute("CREATE INDEX IF NOT EXISTS idx_transactions_asset_market_date ON transactions (asset_market_id, date, quantity, price)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_asset_markets_location ON asset_markets (location_id, name)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_asset_markets_asset ON asset_markets (asset_id)")
+
+def _migration_unique_constraints(c):
+    """ Remove duplicate rows, keeping the latest one, then forbid them with UNIQUE indexes """
+    for table, columns in (("location_currencies", "location_id, currency_id"),
+                           ("exchange_rates", "currency_from_id, currency_to_id, date"),
+                           ("account_balances", "account_id, currency_id"),
+                           ("user_settings", "setting_key")):
+        c.execute(f"DELETE FROM {table} WHERE rowid NOT IN (SELECT MAX(rowid) FROM {table} GROUP BY {columns})")
+        c.execute(f"CREATE UNIQUE INDEX IF NOT EXISTS idx_{table}_unique ON {table} ({columns})")
+
+def _migration_lifo_tables(c):
+    """ Lots opened by each transaction and the LIFO matches that closed them, see lifo.py """
+    c.execute('''CREATE TABLE IF NOT EXISTS lots (
+                 transaction_id INTEGER PRIMARY KEY,
+                 asset_id INTEGER NOT NULL,
+                 location_id INTEGER,
+                 date TEXT NOT NULL,
+                 quantity REAL NOT NULL,
+                 remaining REAL NOT NULL,
+                 price REAL NOT NULL,
+                 FOREIGN KEY (transaction_id) REFERENCES transactions (id),
+                 FOREIGN KEY (asset_id) REFERENCES assets (id),
+                 FOREIGN KEY (location_id) REFERENCES locations (id)
+                 )''')
+    c.execute("CREATE INDEX IF NOT EXISTS idx_lots_stack ON lots (asset_id, location_id, date)")
+    c.execute('''CREATE TABLE IF NOT EXISTS lot_matches (
+                 lot_transaction_id INTEGER NOT NULL,
+                 transaction_id INTEGER NOT NULL,
+                 asset_id INTEGER NOT NULL,
+                 location_id INTEGER,
+                 currency_id INTEGER,
+                 date TEXT NOT NULL,
+                 quantity REAL NOT NULL,
+                 open_price REAL NOT NULL,
+                 close_price REAL NOT NULL,
+                 gain REAL NOT NULL,
+                 FOREIGN KEY (lot_transaction_id) REFERENCES lots (transaction_id),
+                 FOREIGN KEY (transaction_id) REFERENCES transactions (id),
+                 FOREIGN KEY (currency_id) REFERENCES currencies (id)
+                 )''')
+    c.execute("CREATE INDEX IF NOT EXISTS idx_lot_matches_stack ON lot_matches (asset_id, location_id, date)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_lot_matches_date ON lot_matches (date)")
+
+def _migration_price_cache(c):
+    """ Daily closes downloaded from the data sources, and the date spans already downloaded, see prices.py """
+    c.execute('''CREATE TABLE IF NOT EXISTS prices (
+                 asset_market_id INTEGER NOT NULL,
+                 date TEXT NOT NULL,
+                 close REAL NOT NULL,
+                 PRIMARY KEY (asset_market_id, date),
+                 FOREIGN KEY (asset_market_id) REFERENCES asset_markets (id)
+                 ) WITHOUT ROWID''')
+    c.execute('''CREATE TABLE IF NOT EXISTS price_ranges (
+                 asset_market_id INTEGER NOT NULL,
+                 start_date TEXT NOT NULL,
+                 end_date TEXT NOT NULL,
+                 PRIMARY KEY (asset_market_id, start_date),
+                 FOREIGN KEY (asset_market_id) REFERENCES asset_markets (id)
+                 ) WITHOUT ROWID''')
+
+def _migration_transactions_date_index(c):
+    """ Index for the keyset pagination of the transactions list: (date, id) order, id being the implicit rowid """
+    c.execute("CREATE INDEX IF NOT EXISTS idx_transactions_date ON transactions (date)")
+
+# positions holds, per asset market, the running totals of its transactions: the
+# quantity held and the cost basis (the net amount paid, SUM(quantity * price)).
+# The triggers below keep it in step with every insert, update and delete.
+POSITIONS_AGGREGATE_SQL = '''SELECT t.asset_market_id, am.asset_id, am.location_id,
+                                    SUM(t.quantity), SUM(t.quantity * t.price), COUNT(*)
+                             FROM transactions t
+                             JOIN asset_markets am ON t.asset_market_id = am.id
+                             GROUP BY t.asset_market_id'''
+
+_ADD_TO_POSITION = '''INSERT INTO positions (asset_market_id, asset_id, location_id, quantity, cost_basis, transaction_count)
+                       SELECT NEW.asset_market_id, am.asset_id, am.location_id, NEW.quantity, NEW.quantity * NEW.price, 1
+                       FROM asset_markets am WHERE am.id = NEW.asset_market_id
+                       ON CONFLICT (asset_market_id) DO UPDATE SET
+                           quantity = quantity + excluded.quantity,
+                           cost_basis = cost_basis + excluded.cost_basis,
+                           transaction_count = transaction_count + 1;'''
+
+_REMOVE_FROM_POSITION = '''UPDATE positions SET quantity = quantity - OLD.quantity,
+                                              cost_basis = cost_basis - OLD.quantity * OLD.price,
+                                              transaction_count = transaction_count - 1
+                           WHERE asset_market_id = OLD.asset_market_id;
+                           DELETE FROM positions WHERE asset_market_id = OLD.asset_market_id AND transaction_count <= 0;'''
+
+POSITIONS_INSERT_TRIGGER_SQL = f"CREATE TRIGGER IF NOT EXISTS trg_positions_insert AFTER INSERT ON transactions BEGIN {_ADD_TO_POSITION} END"
+
+# Adds to positions the transactions from a given id on, in one aggregated statement
+ADD_TO_POSITIONS_SINCE_SQL = POSITIONS_AGGREGATE_SQL.replace("GROUP BY", "WHERE t.id >= ? GROUP BY") + '''
+                             ON CONFLICT (asset_market_id) DO UPDATE SET
+                                 quantity = quantity + excluded.quantity,
+                                 cost_basis = cost_basis + excluded.cost_basis,
+                                 transaction_count = transaction_count + excluded.transaction_count'''
+
+def _migration_positions(c):
+    """ Materialized positions for the asset overview, kept up to date by triggers on transactions """
+    c.execute('''CREATE TABLE IF NOT EXISTS positions (
+                 asset_market_id INTEGER PRIMARY KEY,
+                 asset_id INTEGER NOT NULL,
+                 location_id INTEGER,
+                 quantity REAL NOT NULL,
+                 cost_basis REAL NOT NULL,
+                 transaction_count INTEGER NOT NULL,
+                 FOREIGN KEY (asset_market_id) REFERENCES asset_markets (id)
+                 )''')
+    c.execute("CREATE INDEX IF NOT EXISTS idx_positions_asset_location ON positions (asset_id, location_id, quantity)")
+    c.execute(POSITIONS_INSERT_TRIGGER_SQL)
+    c.execute(f"CREATE TRIGGER IF NOT EXISTS trg_positions_delete AFTER DELETE ON transactions BEGIN {_REMOVE_FROM_POSITION} END")
+    c.execute(f'''CREATE TRIGGER IF NOT EXISTS trg_positions_update
+                  AFTER UPDATE OF asset_market_id, quantity, price ON transactions
+                  BEGIN {_REMOVE_FROM_POSITION} {_ADD_TO_POSITION} END''')
+    c.execute('''CREATE TRIGGER IF NOT EXISTS trg_positions_asset_market
+                 AFTER UPDATE OF asset_id, location_id ON asset_markets
+                 BEGIN
+                     UPDATE positions SET asset_id = NEW.asset_id, location_id = NEW.location_id WHERE asset_market_id = NEW.id;
+                 END''')
+    c.execute("DELETE FROM positions")
+    c.execute("INSERT INTO positions (asset_market_id, asset_id, location_id, quantity, cost_basis, transaction_count) "
+              + POSITIONS_AGGREGATE_SQL)
+
+def _migration_tax_cache(c):
+    """ The tax estimate of each fiscal year, with the checksum of what it was computed from, see tax.py """
+    c.execute('''CREATE TABLE IF NOT EXISTS tax_years (
+                 year INTEGER PRIMARY KEY,
+                 checksum TEXT NOT NULL,
+                 result TEXT NOT NULL
+                 )''')
+
+# Keeps asset_market_search in step with asset_markets and assets: one row per asset market, with the same id
+_INDEX_ASSET_MARKETS = '''INSERT INTO asset_market_search (rowid, symbol, asset_name, asset_market_name)
+                          SELECT am.id, a.symbol, a.name, am.name
+                          FROM asset_markets am LEFT JOIN assets a ON am.asset_id = a.id'''
+
+def _migration_search_index(c):
+    """ Full-text index of the asset markets, by symbol, asset name and name, and an index for price ranges, see search.py """
+    c.execute('''CREATE VIRTUAL TABLE IF NOT EXISTS asset_market_search
+                 USING fts5 (symbol, asset_name, asset_market_name, tokenize = "unicode61", prefix = "1 2")''')
+    c.execute(f'''CREATE TRIGGER IF NOT EXISTS trg_search_asset_market_insert AFTER INSERT ON asset_markets
+                  BEGIN {_INDEX_ASSET_MARKETS} WHERE am.id = NEW.id; END''')
+    c.execute(f'''CREATE TRIGGER IF NOT EXISTS trg_search_asset_market_update AFTER UPDATE OF name, asset_id ON asset_markets
+                  BEGIN
+                      DELETE FROM asset_market_search WHERE rowid = OLD.id;
+                      {_INDEX_ASSET_MARKETS} WHERE am.id = NEW.id;
+                  END''')
+    c.execute('''CREATE TRIGGER IF NOT EXISTS trg_search_asset_market_delete AFTER DELETE ON asset_markets
+                 BEGIN DELETE FROM asset_market_search WHERE rowid = OLD.id; END''')
+    c.execute(f'''CREATE TRIGGER IF NOT EXISTS trg_search_asset_update AFTER UPDATE OF name, symbol ON assets
+                  BEGIN
+                      DELETE FROM asset_market_search WHERE rowid IN (SELECT id FROM asset_markets WHERE asset_id = NEW.id);
+                      {_INDEX_ASSET_MARKETS} WHERE am.asset_id = NEW.id;
+                  END''')
+    c.execute("DELETE FROM asset_market_search")
+    c.execute(_INDEX_ASSET_MARKETS)
+    c.execute("CREATE INDEX IF NOT EXISTS idx_transactions_price ON transactions (price)")
+
+# cash_movements holds every movement of cash in an account: the cash leg of each transaction, booked by
+# the triggers below in the currency of its asset market, and the deposits, withdrawals, dividends and fees
+# of cash.add_movement(). Each location has one cash account, created on first use. The triggers on
+# cash_movements keep account_balances (the current balance of each account and currency) and
+# cash_snapshots (the balance at the end of some days, see cash.py) in step.
+_OPEN_CASH_ACCOUNT = '''INSERT OR IGNORE INTO accounts (name, type, location_id)
+                         SELECT name, 'cash', id FROM locations WHERE id = NEW.location_id;'''
+
+_BOOK_TRADE = '''INSERT INTO cash_movements (account_id, currency_id, date, amount, transaction_id)
+                  SELECT ac.id, am.currency_id, NEW.date, -NEW.quantity * NEW.price, NEW.id
+                  FROM asset_markets am JOIN accounts ac ON ac.location_id = NEW.location_id
+                  WHERE am.id = NEW.asset_market_id AND am.currency_id IS NOT NULL;'''
+
+_UNBOOK_TRADE = "DELETE FROM cash_movements WHERE transaction_id = OLD.id;"
+
+_ADD_MOVEMENT = '''INSERT INTO account_balances (account_id, currency_id, amount) VALUES (NEW.account_id, NEW.currency_id, NEW.amount)
+                    ON CONFLICT (account_id, currency_id) DO UPDATE SET amount = amount + excluded.amount;
+                    UPDATE cash_snapshots SET balance = balance + NEW.amount
+                    WHERE account_id = NEW.account_id AND currency_id = NEW.currency_id AND date >= NEW.date;'''
+
+_REMOVE_MOVEMENT = '''UPDATE account_balances SET amount = amount - OLD.amount
+                       WHERE account_id = OLD.account_id AND currency_id = OLD.currency_id;
+                       UPDATE cash_snapshots SET balance = balance - OLD.amount
+                       WHERE account_id = OLD.account_id AND currency_id = OLD.currency_id AND date >= OLD.date;'''
+
+CASH_TRADE_INSERT_TRIGGER_SQL = f"CREATE TRIGGER IF NOT EXISTS trg_cash_trade_insert AFTER INSERT ON transactions BEGIN {_OPEN_CASH_ACCOUNT} {_BOOK_TRADE} END"
+CASH_MOVEMENT_INSERT_TRIGGER_SQL = f"CREATE TRIGGER IF NOT EXISTS trg_cash_movement_insert AFTER INSERT ON cash_movements BEGIN {_ADD_MOVEMENT} END"
+
+# Books the cash legs of the transactions from a given id on, in one statement
+BOOK_TRADES_SINCE_SQL = '''INSERT INTO cash_movements (account_id, currency_id, date, amount, transaction_id)
+                           SELECT ac.id, am.currency_id, t.date, -t.quantity * t.price, t.id
+                           FROM transactions t
+                           JOIN asset_markets am ON t.asset_market_id = am.id
+                           JOIN accounts ac ON ac.location_id = t.location_id
+                           WHERE t.id >= ? AND am.currency_id IS NOT NULL'''
+
+# Adds the movements from a given id on to account_balances, in one aggregated statement
+ADD_TO_BALANCES_SINCE_SQL = '''INSERT INTO account_balances (account_id, currency_id, amount)
+                               SELECT account_id, currency_id, SUM(amount) FROM cash_movements WHERE id >= ?
+                               GROUP BY account_id, currency_id
+                               ON CONFLICT (account_id, currency_id) DO UPDATE SET amount = amount + excluded.amount'''
+
+def _open_cash_accounts(c):
+    c.execute("INSERT OR IGNORE INTO accounts (name, type, location_id) SELECT name, 'cash', id FROM locations")
+
+def _book_trades_since(c, first_id):
+    """ Book the cash legs of the transactions from first_id on, for add_transactions_bulk with the cash triggers dropped.
+    The checkpoints from the first new date on are dropped, to be written again by cash.checkpoint()
+    """
+    _open_cash_accounts(c)
+    first_movement_id = c.execute("SELECT COALESCE(MAX(id), 0) + 1 FROM cash_movements").fetchone()[0]
+    c.execute(BOOK_TRADES_SINCE_SQL, (first_id,))
+    c.execute(ADD_TO_BALANCES_SINCE_SQL, (first_movement_id,))
+    c.execute("DELETE FROM cash_snapshots WHERE date >= (SELECT MIN(date) FROM cash_movements WHERE id >= ?)",
+              (first_movement_id,))
+
+def _migration_cash_ledger(c):
+    """ Cash movements booked by every transaction, running balances and balance checkpoints, see cash.py """
+    if "location_id" not in [column[1] for column in c.execute("PRAGMA table_info(accounts)")]:
+        c.execute("ALTER TABLE accounts ADD COLUMN location_id INTEGER REFERENCES locations (id)")
+    c.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_accounts_location ON accounts (location_id)")
+    c.execute('''CREATE TABLE IF NOT EXISTS cash_movements (
+                 id INTEGER PRIMARY KEY,
+                 account_id INTEGER NOT NULL,
+                 currency_id INTEGER NOT NULL,
+                 date TEXT NOT NULL,
+                 amount REAL NOT NULL,
+                 transaction_id INTEGER,
+                 description TEXT,
+                 FOREIGN KEY (account_id) REFERENCES accounts (id),
+                 FOREIGN KEY (currency_id) REFERENCES currencies (id),
+                 FOREIGN KEY (transaction_id) REFERENCES transactions (id)
+                 )''')
+    c.execute("CREATE INDEX IF NOT EXISTS idx_cash_movements_account ON cash_movements (account_id, currency_id, date, amount)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_cash_movements_transaction ON cash_movements (transaction_id)")
+    c.execute('''CREATE TABLE IF NOT EXISTS cash_snapshots (
+                 account_id INTEGER NOT NULL,
+                 currency_id INTEGER NOT NULL,
+                 date TEXT NOT NULL,
+                 balance REAL NOT NULL,
+                 PRIMARY KEY (account_id, currency_id, date),
+                 FOREIGN KEY (account_id) REFERENCES accounts (id),
+                 FOREIGN KEY (currency_id) REFERENCES currencies (id)
+                 ) WITHOUT ROWID''')
+
+    # The balances entered before the ledger are kept, as opening movements dated before the first trade,
+    # then come the cash legs of the transactions already there, and the balances they all add up to
+    _open_cash_accounts(c)
+    c.execute('''INSERT INTO cash_movements (account_id, currency_id, date, amount, description)
+                 SELECT account_id, currency_id, COALESCE((SELECT MIN(date) FROM transactions), date('now')), amount,
+                        'Opening balance'
+                 FROM account_balances
+                 WHERE account_id IS NOT NULL AND currency_id IS NOT NULL AND amount IS NOT NULL AND amount != 0
+                 ORDER BY account_id, currency_id''')
+    c.execute(BOOK_TRADES_SINCE_SQL, (0,))
+    c.execute("DELETE FROM account_balances")
+    c.execute(ADD_TO_BALANCES_SINCE_SQL, (0,))
+
+    c.execute(CASH_TRADE_INSERT_TRIGGER_SQL)
+    c.execute(f"CREATE TRIGGER IF NOT EXISTS trg_cash_trade_delete AFTER DELETE ON transactions BEGIN {_UNBOOK_TRADE} END")
+    c.execute(f'''CREATE TRIGGER IF NOT EXISTS trg_cash_trade_update
+                  AFTER UPDATE OF asset_market_id, quantity, price, date, location_id ON transactions
+                  BEGIN {_UNBOOK_TRADE} {_OPEN_CASH_ACCOUNT} {_BOOK_TRADE} END''')
+    c.execute(CASH_MOVEMENT_INSERT_TRIGGER_SQL)
+    c.execute(f"CREATE TRIGGER IF NOT EXISTS trg_cash_movement_delete AFTER DELETE ON cash_movements BEGIN {_REMOVE_MOVEMENT} END")
+    c.execute(f'''CREATE TRIGGER IF NOT EXISTS trg_cash_movement_update
+                  AFTER UPDATE OF account_id, currency_id, date, amount ON cash_movements
+                  BEGIN {_REMOVE_MOVEMENT} {_ADD_MOVEMENT} END''')
+
+# The columns of transactions the journal copies, see _migration_change_journal
+JOURNAL_COLUMNS = ("asset_market_id", "quantity", "price", "date", "location_id", "fingerprint")
+JOURNAL_COLUMN_TYPES = ("INTEGER", "REAL", "REAL", "TEXT", "INTEGER", "BLOB")
+
+def _migration_change_journal(c):
+    """ The journal of the changes made to the transactions, for undo and redo and to tell the caches what changed.
+    transactions is rebuilt with AUTOINCREMENT, so that the id of a deleted transaction is never handed out again:
+    what remembers the last id it has seen (lifo.py, paging.py, dirty_since) would miss the new transaction
+    """
+    c.execute('''CREATE TABLE IF NOT EXISTS changes (
+                 id INTEGER PRIMARY KEY,
+                 action TEXT NOT NULL,
+                 target_id INTEGER,
+                 description TEXT,
+                 created TEXT NOT NULL DEFAULT CURRENT_TIMESTAMP,
+                 FOREIGN KEY (target_id) REFERENCES changes (id)
+                 )''')
+    images = ",\n".join(f"{side}_{column} {kind}" for side in ("before", "after")
+                        for column, kind in zip(JOURNAL_COLUMNS, JOURNAL_COLUMN_TYPES))
+    c.execute(f'''CREATE TABLE IF NOT EXISTS change_rows (
+                  change_id INTEGER NOT NULL,
+                  transaction_id INTEGER NOT NULL,
+                  {images},
+                  PRIMARY KEY (change_id, transaction_id),
+                  FOREIGN KEY (change_id) REFERENCES changes (id)
+                  ) WITHOUT ROWID''')
+
+    if "AUTOINCREMENT" not in c.execute("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = 'transactions'").fetchone()[0].upper():
+        # The indexes and triggers go with the old table, and are created again on the new one
+        dependents = [row[0] for row in c.execute("SELECT sql FROM sqlite_master WHERE tbl_name = 'transactions' "
+                                                  "AND type IN ('index', 'trigger') AND sql IS NOT NULL")]
+        c.execute('''CREATE TABLE transactions_autoincrement (
+                     id INTEGER PRIMARY KEY AUTOINCREMENT,
+                     asset_market_id INTEGER,
+                     quantity REAL NOT NULL,
+                     price REAL NOT NULL,
+                     date TEXT NOT NULL,
+                     location_id INTEGER,
+                     fingerprint BLOB,
+                     FOREIGN KEY (asset_market_id) REFERENCES asset_markets (id),
+                     FOREIGN KEY (location_id) REFERENCES locations (id)
+                     )''')
+        c.execute("INSERT INTO transactions_autoincrement (id, asset_market_id, quantity, price, date, location_id, fingerprint) "
+                  "SELECT id, asset_market_id, quantity, price, date, location_id, fingerprint FROM transactions")
+        c.execute("DROP TABLE transactions")
+        c.execute("ALTER TABLE transactions_autoincrement RENAME TO transactions")
+        for sql in dependents:
+            c.execute(sql)
+
+def _migration_lot_currency(c):
+    """ The currency each lot was opened in, so that it is converted when closed in another one (see lifo.py).
+    The lots and matches made before mixed currencies: they are dropped, and the next sync matches everything again
+    """
+    if "currency_id" not in [row[1] for row in c.execute("PRAGMA table_info(lots)")]:
+        c.execute("ALTER TABLE lots ADD COLUMN currency_id INTEGER REFERENCES currencies (id)")
+    c.execute("DELETE FROM lot_matches")
+    c.execute("DELETE FROM lots")
+    # lifo.SYNCED_SETTING and lifo.JOURNAL_SETTING, and lifo.LOTS_VERSION_SETTING moved on for the engines running
+    c.execute("DELETE FROM user_settings WHERE setting_key IN ('lifo_synced_transaction_id', 'lifo_synced_change_id')")
+    c.execute("UPDATE user_settings SET setting_value = CAST(setting_value AS INTEGER) + 1 "
+              "WHERE setting_key = 'lifo_lots_version'")
+
+MIGRATIONS = [
+    _migration_transaction_fingerprint,
+    _migration_join_indexes,
+    _migration_unique_constraints,
+    _migration_lifo_tables,
+    _migration_price_cache,
+    _migration_transactions_date_index,
+    _migration_positions,
+    _migration_tax_cache,
+    _migration_search_index,
+    _migration_cash_ledger,
+    _migration_change_journal,
+    _migration_lot_currency,
+]
+SCHEMA_VERSION = len(MIGRATIONS)
+
+
+def get_schema_version(db_file):
+    row = get_db(db_file).fetchone("PRAGMA user_version")
+    return row[0] if row else None
+
+def migrate(db_file):
+    """ Apply the pending migrations, each one in its own transaction. Returns the resulting schema version """
+    database = get_db(db_file)
+    version = get_schema_version(db_file)
+    if version is None:
+        return None
+    for target in range(version + 1, SCHEMA_VERSION + 1):
+        try:
+            with database.transaction() as conn:
+                # DDL does not open a transaction implicitly, so do it by hand to keep each step atomic
+                conn.execute("BEGIN IMMEDIATE")
+                MIGRATIONS[target - 1](conn.cursor())
+                conn.execute(f"PRAGMA user_version = {target}")
+        except sqlite3.Error as e:
+            print(f"Migration to schema version {target} failed: {e}")
+            break
+        version = target
+    return version
+
+
+# User Settings Functions
+def get_setting(db_file, key, default=None):
+    row = get_db(db_file).fetchone("SELECT setting_value FROM user_settings WHERE setting_key = ?", (key,))
+    return row[0] if row else default
+
+def set_setting(db_file, key, value):
+    get_db(db_file).write("INSERT INTO user_settings (setting_key, setting_value) VALUES (?, ?) "
+                          "ON CONFLICT (setting_key) DO UPDATE SET setting_value = excluded.setting_value", (key, value))
+
+
 # Data Source Functions
 # checks if an asset has a linked data source, or if it is equal to -1.
 # if it is equal to -1, then the data source might be linked to the asset_market
 def has_data_source(db_file, asset_id):
     """ Check if an asset has a linked data source """
-    conn = create_connection(db_file)
-    has_data_source = False
-    if conn is not None:
-        try:
-            c = conn.cursor()
-            c.execute("SELECT id FROM data_sources WHERE id = (SELECT data_source_id FROM assets WHERE id = ?)", (asset_id,))
-            #  If the query returns a result and the asset has a linked data source different from -1 then the asset has a linked data source
-            if c.fetchone() and c.fetchone()[0] != -1:
-                has_data_source = True
-        except sqlite3.Error as e:
-            print(e)
-        finally:
-            conn.close()
-    return has_data_source
+    row = get_db(db_file).fetchone("SELECT id FROM data_sources WHERE id = (SELECT data_source_id FROM assets WHERE id = ?)", (asset_id,))
+    #  If the query returns a result and the asset has a linked data source different from -1 then the asset has a linked data source
+    return row is not None and row[0] != -1
 
 def get_data_sources_from_asset(db_file, asset_id):
     """ Fetch all data sources for an asset """
-    conn = create_connection(db_file)
-    data_sources = []
-    if conn is not None:
-        try:
-            c = conn.cursor()
-            c.execute("SELECT id, name FROM data_sources WHERE id = (SELECT data_source_id FROM assets WHERE id = ?)", (asset_id,))
-            data_sources = [(data_source[0], data_source[1]) for data_source in c.fetchall()]
-        except sqlite3.Error as e:
-            print(e)
-        finally:
-            conn.close()
-    return data_sources
+    rows = get_db(db_file).fetchall("SELECT id, source FROM data_sources WHERE id = (SELECT data_source_id FROM assets WHERE id = ?)", (asset_id,))
+    return [(data_source[0], data_source[1]) for data_source in rows]
 
 def get_data_sources_from_asset_market(db_file, asset_market_id):
     """ Fetch all data sources for an asset market """
-    conn = create_connection(db_file)
-    data_sources = []
-    if conn is not None:
-        try:
-            c = conn.cursor()
-            c.execute("SELECT id, name FROM data_sources WHERE id = (SELECT data_source_id FROM asset_markets WHERE id = ?)", (asset_market_id,))
-            data_sources = [(data_source[0], data_source[1]) for data_source in c.fetchall()]
-        except sqlite3.Error as e:
-            print(e)
-        finally:
-            conn.close()
-    return data_sources
+    rows = get_db(db_file).fetchall("SELECT id, source FROM data_sources WHERE id = (SELECT data_source_id FROM asset_markets WHERE id = ?)", (asset_market_id,))
+    return [(data_source[0], data_source[1]) for data_source in rows]
 
 def add_data_source_to_asset(db_file, asset_id, asset_market_id, data_source_id, who_to_add_it_to):
-    conn = create_connection(db_file)
-    if conn is not None:
-        try:
-            c = conn.cursor()
+    try:
+        with get_db(db_file).transaction() as conn:
             if who_to_add_it_to == "asset":
-                c.execute("UPDATE assets        SET data_source_id = ? WHERE id = ?", (data_source_id,        asset_id))
-                c.execute("UPDATE asset_markets SET data_source_id = ? WHERE id = ?", (            -1, asset_market_id))
-            elif who_to_add_it_to == "asset market":
-                c.execute("UPDATE asset_markets SET data_source_id = ? WHERE id = ?", (data_source_id, asset_market_id))
-            conn.commit()
-        except sqlite3.Error as e:
-            print(e)
-        finally:
-            conn.close()
+                conn.execute("UPDATE assets        SET data_source_id = ? WHERE id = ?", (data_source_id,        asset_id))
+                conn.execute("UPDATE asset_markets SET data_source_id = ? WHERE id = ?", (            -1, asset_market_id))
+            elif who_to_add_it_to in ("asset market", "asset_market"):
+                conn.execute("UPDATE asset_markets SET data_source_id = ? WHERE id = ?", (data_source_id, asset_market_id))
+    except sqlite3.Error as e:
+        print(e)
+    get_db(db_file).bump_generation("assets", "asset_markets")
+
+# The reference tables: small, read often, cached by models.IdentityMap
+REFERENCE_TABLES = ("locations", "markets", "assets", "currencies", "asset_markets")
+
+def _write_reference(db_file, table, sql, params):
+    """ Write to a reference table and move its generation on, so that caches reload it """
+    database = get_db(db_file)
+    try:
+        return database.write(sql, params)
+    finally:
+        database.bump_generation(table)
+
+# The tables of market data: written to often, their generations tell the computed series whether they are stale
+DATA_TABLES = ("transactions", "prices", "exchange_rates")
+
+def data_version(db_file, tables=DATA_TABLES + REFERENCE_TABLES):
+    """ The generations of tables, as a tuple. It changes with every write through db.py or prices.py to
+    any of them, and with every write another process has made to the file, so a result computed from
+    those tables can be cached under it
+    """
+    database = get_db(db_file)
+    database.check_external_writes()
+    return tuple(database.generation(table) for table in tables)
 
 def get_locations(db_file):
     """ Fetch all locations from the database """
-    conn = create_connection(db_file)
-    locations = []
-    if conn is not None:
-        try:
-            c = conn.cursor()
-            c.execute("SELECT id, name FROM locations")
-            locations = [(location[0], location[1]) for location in c.fetchall()]
-        except sqlite3.Error as e:
-            print(e)
-        finally:
-            conn.close()
-    return locations
+    rows = get_db(db_file).fetchall("SELECT id, name FROM locations")
+    return [(location[0], location[1]) for location in rows]
 def add_location(db_file, name, description):
     """ Add a new location to the database """
-    conn = create_connection(db_file)
-    location_id = -1
-    if conn is not None:
-        try:
-            c = conn.cursor()
-            c.execute("INSERT INTO locations (name, description) VALUES (?, ?)", (name, description))
-            conn.commit()
-            location_id = c.lastrowid # Get the ID of the newly inserted location
-        except sqlite3.Error as e:
-            print(e)
-        finally:
-            conn.close()
-            return location_id
+    # Returns the ID of the newly inserted location
+    return _write_reference(db_file, "locations", "INSERT INTO locations (name, description) VALUES (?, ?)", (name, description))
 
 def get_assets(db_file):
     """ Fetch all assets from the database """
-    conn = create_connection(db_file)
-    assets = []
-    if conn is not None:
-        try:
-            c = conn.cursor()
-            c.execute("SELECT id, symbol, name, description, is_harmonised FROM assets")
-            assets = [(asset[0], asset[1], asset[2], asset[3], asset[4]) for asset in c.fetchall()]
-        except sqlite3.Error as e:
-            print(e)
-        finally:
-            conn.close()
-    return assets
+    rows = get_db(db_file).fetchall("SELECT id, symbol, name, description, is_harmonised FROM assets")
+    return [(asset[0], asset[1], asset[2], asset[3], asset[4]) for asset in rows]
 def add_asset(db_file, name, symbol, type, description, is_harmonised):
-    conn = create_connection(db_file)
-    asset_id=-1
-    try:
-        c = conn.cursor()
-        c.execute("INSERT INTO assets (name, symbol, type, description, is_harmonised) VALUES (?, ?, ?, ?, ?)",
-                  (name, symbol, type, description, is_harmonised))        
-        conn.commit()
-        asset_id = c.lastrowid  # Get the ID of the newly inserted asset
-    except sqlite3.Error as e:
-        print(e)
-    finally:
-        conn.close()
-        return asset_id
+    # Returns the ID of the newly inserted asset
+    return _write_reference(db_file, "assets", "INSERT INTO assets (name, symbol, type, description, is_harmonised) VALUES (?, ?, ?, ?, ?)",
+                            (name, symbol, type, description, is_harmonised))
 
 def get_asset_name(db_file, asset_id):
-    conn = create_connection(db_file)
-    asset_name=None
-    if conn is not None:
-        try:
-            c = conn.cursor()
-            c.execute("SELECT name FROM assets WHERE id = ?", (asset_id,))
-            asset_name = c.fetchone()[0]
-        except sqlite3.Error as e:
-            print(e)
-        finally:
-            conn.close()
-    return asset_name
+    row = get_db(db_file).fetchone("SELECT name FROM assets WHERE id = ?", (asset_id,))
+    return row[0] if row else None
 
 
 
 
 def get_currencies(db_file):
     """ Fetch all currencies from the database """
-    conn = create_connection(db_file)
-    currencies = []
-    if conn is not None:
-        try:
-            c = conn.cursor()
-            c.execute("SELECT id, code, name FROM currencies")
-            currencies = [(currency[0], currency[1], currency[2]) for currency in c.fetchall()]
-        except sqlite3.Error as e:
-            print(e)
-        finally:
-            conn.close()
-    return currencies
+    rows = get_db(db_file).fetchall("SELECT id, code, name FROM currencies")
+    return [(currency[0], currency[1], currency[2]) for currency in rows]
 def add_currency(db_file, code, name):
-    conn = create_connection(db_file)
-    currency_id = -1
+    # Returns the ID of the newly inserted currency
+    return _write_reference(db_file, "currencies", "INSERT INTO currencies (code, name) VALUES (?, ?)", (code, name))
+def get_currency_code(db_file, currency_id):
+    row = get_db(db_file).fetchone("SELECT code FROM currencies WHERE id = ?", (currency_id,))
+    return row[0] if row else None
+
+def add_exchange_rates(db_file, rows):
+    """ Store (date, currency_from_id, currency_to_id, rate) rows, replacing the rate already stored for the same pair and day """
+    database = get_db(db_file)
     try:
-        c = conn.cursor()
-        c.execute("INSERT INTO currencies (code, name) VALUES (?, ?)", (code, name))
-        conn.commit()
-        currency_id = c.lastrowid  # Get the ID of the newly inserted currency
+        with database.transaction() as conn:
+            conn.executemany("INSERT OR REPLACE INTO exchange_rates (date, currency_from_id, currency_to_id, rate) VALUES (?, ?, ?, ?)", rows)
     except sqlite3.Error as e:
         print(e)
     finally:
-        conn.close()
-        return currency_id
-def get_currency_code(db_file, currency_id):
-    conn = create_connection(db_file)
-    currency_code=None
-    if conn is not None:
-        try:
-            c = conn.cursor()
-            c.execute("SELECT code FROM currencies WHERE id = ?", (currency_id,))
-            result = c.fetchone()
-            currency_code = result[0] if result else None
-        except sqlite3.Error as e:
-            print(e)
-        finally:
-            conn.close()
-    return currency_code
+        database.bump_generation("exchange_rates")
 
 def get_currency_by_location(db_file, location_id):
-    conn = create_connection(db_file)
-    if conn is not None:
-        try:
-            c = conn.cursor()
-            c.execute("SELECT currency_id FROM location_currencies WHERE location_id = ?", (location_id,))
-            result = c.fetchone()
-            return result[0] if result else None
-        except sqlite3.Error as e:
-            print(e)
-        finally:
-            conn.close()
+    row = get_db(db_file).fetchone("SELECT currency_id FROM location_currencies WHERE location_id = ?", (location_id,))
+    return row[0] if row else None
 def add_location_currency(db_file, location_id, currency_id):
     "add a currency to a location but also check if it already exists"
-    conn = create_connection(db_file)
+    get_db(db_file).write("INSERT OR IGNORE INTO location_currencies (location_id, currency_id) VALUES (?, ?)", (location_id, currency_id))
+
+def get_markets(db_file):
+    """ Fetch all markets from the database """
+    rows = get_db(db_file).fetchall("SELECT id, name, description FROM markets")
+    return [(market[0], market[1], market[2]) for market in rows]
+def add_market(db_file, name, description=""):
+    # Returns the ID of the newly inserted market
+    return _write_reference(db_file, "markets", "INSERT INTO markets (name, description) VALUES (?, ?)", (name, description))
+
+ASSET_MARKETS_BY_LOCATION_SQL = "SELECT id, name FROM asset_markets WHERE location_id = ?"
+
+def get_asset_markets(db_file, location_id):
+    """ Fetch all unique asset markets for a given location from the database """
+    rows = get_db(db_file).fetchall(ASSET_MARKETS_BY_LOCATION_SQL, (location_id,))
+    return [(market[0], market[1]) for market in rows]
+def add_asset_market(db_file, location_id, name, description, asset_id, market_id, currency_id):
+    # Returns the ID of the newly inserted asset_market
+    return _write_reference(db_file, "asset_markets", "INSERT INTO asset_markets (location_id, name, description, asset_id, market_id, currency_id) VALUES (?, ?, ?, ?, ?, ?)",
+                            (location_id, name, description, asset_id, market_id, currency_id))
+def get_all_asset_markets(db_file):
+    """ Fetch every asset market as (id, asset_id, market_id, location_id, currency_id) """
+    return get_db(db_file).fetchall("SELECT id, asset_id, market_id, location_id, currency_id FROM asset_markets")
+def get_asset_market_currency(db_file, asset_market_id):
+    """ Fetch the currency of an asset market from the database """
+    row = get_db(db_file).fetchone("SELECT currency_id FROM asset_markets WHERE id = ?", (asset_market_id,))
+    return row[0] if row else None
+
+def add_transaction(db_file, asset_market_id, quantity, price, date, location_id):
+    ''' Add a new transaction to the transactions table, as a change of the journal that can be undone.
+    Returns its id, or -1 on error'''
+    def insert(conn):
+        return [conn.execute("INSERT INTO transactions (asset_market_id, quantity, price, date, location_id) VALUES (?, ?, ?, ?, ?)",
+                             (asset_market_id, quantity, price, date, location_id)).lastrowid]
+
+    change = _journaled(db_file, "add a transaction", (), insert)
+    return change.transaction_ids[0] if change else -1
+
+BULK_CHUNK_SIZE = 50000
+# The id of the next transaction: AUTOINCREMENT goes on from the largest id ever used, even if it was deleted
+NEXT_TRANSACTION_ID_SQL = '''SELECT MAX((SELECT COALESCE(MAX(id), 0) FROM transactions),
+                                       COALESCE((SELECT seq FROM sqlite_sequence WHERE name = 'transactions'), 0)) + 1'''
+
+
+def _missing_ids(conn, table, ids):
+    """ Return the ids that do not exist in table, checking them in one query """
+    ids = list(ids)
+    found = set()
+    # stay well below SQLITE_MAX_VARIABLE_NUMBER
+    for start in range(0, len(ids), 900):
+        batch = ids[start:start + 900]
+        placeholders = ",".join("?" * len(batch))
+        found.update(row[0] for row in conn.execute(f"SELECT id FROM {table} WHERE id IN ({placeholders})", batch))
+    return set(ids) - found
+
+
+def add_transactions_bulk(db_file, rows, chunk_size=BULK_CHUNK_SIZE):
+    """ Insert many transactions at once, inside a single transaction.
+
+    rows is any iterable (a generator is fine) of
+    (asset_market_id, quantity, price, date, location_id) tuples, in the same
+    order as the arguments of add_transaction. The rows are consumed in chunks
+    of chunk_size, their foreign keys are checked once per chunk and each chunk
+    is written with executemany. Nothing is committed unless every row is valid.
+
+    Returns the range of the new transaction ids, or an empty list on a database
+    error. Raises ValueError if a row references an unknown asset market or location.
+    """
+    database = get_db(db_file)
+    known_asset_markets = set()
+    known_locations = set()
     try:
-        c = conn.cursor()
-        c.execute("INSERT OR IGNORE INTO location_currencies (location_id, currency_id) VALUES (?, ?)", (location_id, currency_id))
-        conn.commit()
+        with database.transaction() as conn:
+            # Take the write lock now, so no other writer can interleave ids with ours
+            conn.execute("BEGIN IMMEDIATE")
+            first_id = next_id = conn.execute(NEXT_TRANSACTION_ID_SQL).fetchone()[0]
+            # Positions are updated once for the whole batch rather than by the per-row trigger;
+            # dropping the trigger is part of this transaction, so no other writer ever sees it missing
+            has_trigger = conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'trigger' AND name = 'trg_positions_insert'").fetchone()
+            if has_trigger:
+                conn.execute("DROP TRIGGER trg_positions_insert")
+            # The same goes for the cash legs and the balances they move
+            has_cash_triggers = conn.execute("SELECT COUNT(*) FROM sqlite_master WHERE type = 'trigger' AND name IN "
+                                             "('trg_cash_trade_insert', 'trg_cash_movement_insert')").fetchone()[0] == 2
+            if has_cash_triggers:
+                conn.execute("DROP TRIGGER trg_cash_trade_insert")
+                conn.execute("DROP TRIGGER trg_cash_movement_insert")
+            rows = iter(rows)
+            while True:
+                chunk = list(itertools.islice(rows, chunk_size))
+                if not chunk:
+                    break
+
+                new_asset_markets = {row[0] for row in chunk} - known_asset_markets
+                new_locations = {row[4] for row in chunk if row[4] is not None} - known_locations
+                missing = _missing_ids(conn, "asset_markets", new_asset_markets)
+                if missing:
+                    raise ValueError(f"Unknown asset_market_id(s): {sorted(missing)}")
+                missing = _missing_ids(conn, "locations", new_locations)
+                if missing:
+                    raise ValueError(f"Unknown location_id(s): {sorted(missing)}")
+                known_asset_markets |= new_asset_markets
+                known_locations |= new_locations
+
+                # With the write lock held, rowids are handed out one after the other, so the ids are contiguous
+                conn.executemany("INSERT INTO transactions (asset_market_id, quantity, price, date, location_id) VALUES (?, ?, ?, ?, ?)", chunk)
+                next_id += len(chunk)
+            if has_trigger:
+                conn.execute("INSERT INTO positions (asset_market_id, asset_id, location_id, quantity, cost_basis, transaction_count) "
+                             + ADD_TO_POSITIONS_SINCE_SQL, (first_id,))
+                conn.execute(POSITIONS_INSERT_TRIGGER_SQL)
+            if has_cash_triggers:
+                _book_trades_since(conn, first_id)
+                conn.execute(CASH_TRADE_INSERT_TRIGGER_SQL)
+                conn.execute(CASH_MOVEMENT_INSERT_TRIGGER_SQL)
+        return range(first_id, next_id)
     except sqlite3.Error as e:
         print(e)
+        return []
     finally:
-        conn.close()
+        database.bump_generation("transactions")
 
-def get_markets(db_file):
-    """ Fetch all markets from the database """
-    conn = create_connection(db_file)
-    markets = []
-    if conn is not None:
-        try:
-            c = conn.cursor()
-            c.execute("SELECT id, name, description FROM markets")
-            markets = [(market[0], market[1], market[2]) for market in c.fetchall()]
-        except sqlite3.Error as e:
-            print(e)
-        finally:
-            conn.close()
-    return markets
-def add_market(db_file, name, description=""):
-    conn = create_connection(db_file)
-    market_id = -1
+
+def add_imported_transactions(db_file, rows):
+    """ Insert (asset_market_id, quantity, price, date, location_id, fingerprint) rows in one transaction.
+
+    Rows whose fingerprint is already stored are skipped. Returns the number of rows inserted.
+    """
+    database = get_db(db_file)
     try:
-        c = conn.cursor()
-        c.execute("INSERT INTO markets (name, description) VALUES (?, ?)", (name, description))
-        conn.commit()
-        market_id = c.lastrowid  # Get the ID of the newly inserted market
+        with database.transaction() as conn:
+            # rowcount, unlike total_changes, leaves out the rows written by the positions trigger
+            return conn.executemany("INSERT OR IGNORE INTO transactions (asset_market_id, quantity, price, date, location_id, fingerprint) VALUES (?, ?, ?, ?, ?, ?)", rows).rowcount
     except sqlite3.Error as e:
         print(e)
+        return 0
     finally:
-        conn.close()
-        return market_id
+        database.bump_generation("transactions")
 
-def get_asset_markets(db_file, location_id):
-    """ Fetch all unique asset markets for a given location from the database """
-    conn = create_connection(db_file)
-    asset_markets = []
-    if conn is not None:
-        try:
-            c = conn.cursor()
-            c.execute("SELECT id, name FROM asset_markets WHERE location_id = ?", (location_id,))
-            asset_markets = [(market[0], market[1]) for market in c.fetchall()]
-        except sqlite3.Error as e:
-            print(e)
-        finally:
-            conn.close()
-    return asset_markets
-def add_asset_market(db_file, location_id, name, description, asset_id, market_id, currency_id):
-    conn = create_connection(db_file)
-    asset_market_id = -1
+
+# Change journal
+# Adding, editing and deleting transactions through the functions below is a change of the journal: the
+# rows it touches are copied before the write and after it. Undoing a change writes the copies from before
+# back, redoing it those from after, and both are entries of the journal too, pointing at the change, so
+# the journal is only ever appended to. dirty_since() reads it to tell what is computed from the
+# transactions (the LIFO lots, the net worth arrays) which asset markets changed, and from which date on,
+# so that only that is computed again; positions and the cash ledger follow the changes by trigger.
+# add_transactions_bulk and add_imported_transactions are not journaled, and cannot be undone.
+
+# A change: the id of its journal entry, the ids of the transactions it touched and {asset_market_id: first date}
+# of what it touched, the old rows and the new ones
+Change = namedtuple("Change", ["id", "transaction_ids", "dirty"])
+# What dirty_since() found, {asset_market_id: first date} of the transactions changed and of those added,
+# and the ids to ask from next time
+DirtyRanges = namedtuple("DirtyRanges", ["journal_id", "transaction_id", "changed", "added"])
+
+_NO_ROW = (None,) * len(JOURNAL_COLUMNS)
+INSERT_CHANGE_ROW_SQL = (f"INSERT INTO change_rows (change_id, transaction_id, "
+                         f"{', '.join('before_' + column for column in JOURNAL_COLUMNS)}, "
+                         f"{', '.join('after_' + column for column in JOURNAL_COLUMNS)}) "
+                         f"VALUES ({', '.join('?' * (2 + 2 * len(JOURNAL_COLUMNS)))})")
+CHANGE_ROWS_SQL = (f"SELECT transaction_id, {', '.join('before_' + column for column in JOURNAL_COLUMNS)}, "
+                   f"{', '.join('after_' + column for column in JOURNAL_COLUMNS)} FROM change_rows WHERE change_id = ?")
+# Not an upsert: its conflict clause would override the INSERT OR IGNORE of the cash triggers
+RESTORE_ROW_SQL = (f"INSERT INTO transactions ({', '.join(JOURNAL_COLUMNS)}, id) "
+                   f"VALUES ({', '.join('?' * (1 + len(JOURNAL_COLUMNS)))})")
+REWRITE_ROW_SQL = f"UPDATE transactions SET {', '.join(column + ' = ?' for column in JOURNAL_COLUMNS)} WHERE id = ?"
+
+# {asset_market_id: first date} of the rows touched by the journal entries in a range of ids (for an undo
+# or a redo, the rows of the change it points at), among the transactions up to an id
+DIRTY_SINCE_SQL = '''SELECT asset_market_id, MIN(date) FROM (
+                         SELECT r.before_asset_market_id AS asset_market_id, r.before_date AS date
+                         FROM changes j JOIN change_rows r ON r.change_id = COALESCE(j.target_id, j.id)
+                         WHERE j.id > :after AND j.id <= :last AND r.transaction_id <= :transaction_id
+                         UNION ALL
+                         SELECT r.after_asset_market_id, r.after_date
+                         FROM changes j JOIN change_rows r ON r.change_id = COALESCE(j.target_id, j.id)
+                         WHERE j.id > :after AND j.id <= :last AND r.transaction_id <= :transaction_id)
+                     WHERE date IS NOT NULL
+                     GROUP BY asset_market_id'''
+
+def _row_images(conn, transaction_ids):
+    """ {transaction_id: row} of the transactions among transaction_ids, with the columns of JOURNAL_COLUMNS """
+    ids = list(transaction_ids)
+    images = {}
+    for start in range(0, len(ids), 900):
+        batch = ids[start:start + 900]
+        placeholders = ",".join("?" * len(batch))
+        images.update((row[0], row[1:]) for row in conn.execute(
+            f"SELECT id, {', '.join(JOURNAL_COLUMNS)} FROM transactions WHERE id IN ({placeholders})", batch))
+    return images
+
+def _dirty(*images):
+    """ {asset_market_id: first date} of the rows of the {transaction_id: row} images """
+    dirty = {}
+    for rows in images:
+        for asset_market_id, quantity, price, date, *rest in rows.values():
+            dirty[asset_market_id] = min(date, dirty.get(asset_market_id, date))
+    return dirty
+
+def _delete_ids(conn, transaction_ids):
+    for start in range(0, len(transaction_ids), 900):
+        batch = transaction_ids[start:start + 900]
+        conn.execute(f"DELETE FROM transactions WHERE id IN ({','.join('?' * len(batch))})", batch)
+
+def _journaled(db_file, description, transaction_ids, write):
+    """ Run write(conn), which returns the ids of the transactions it added, in one transaction, copying the
+    rows of transaction_ids (those it may change or delete) before and the rows touched after.
+    Returns the Change, with id None if nothing changed, or None on error
+    """
+    database = get_db(db_file)
     try:
-        c = conn.cursor()
-        c.execute("INSERT INTO asset_markets (location_id, name, description, asset_id, market_id, currency_id) VALUES (?, ?, ?, ?, ?, ?)", (location_id, name, description, asset_id, market_id, currency_id))
-        conn.commit()
-        asset_market_id = c.lastrowid  # Get the ID of the newly inserted asset_market
+        with database.transaction() as conn:
+            # Take the write lock now, so that the copies from before are those the write starts from
+            conn.execute("BEGIN IMMEDIATE")
+            before = _row_images(conn, transaction_ids)
+            touched = sorted(set(write(conn)) | before.keys())
+            after = _row_images(conn, touched)
+            rows = [(transaction_id, *before.get(transaction_id, _NO_ROW), *after.get(transaction_id, _NO_ROW))
+                    for transaction_id in touched if before.get(transaction_id) != after.get(transaction_id)]
+            if not rows:
+                return Change(None, [], {})
+            change_id = conn.execute("INSERT INTO changes (action, description) VALUES ('change', ?)", (description,)).lastrowid
+            conn.executemany(INSERT_CHANGE_ROW_SQL, [(change_id, *row) for row in rows])
+            return Change(change_id, [row[0] for row in rows], _dirty(before, after))
     except sqlite3.Error as e:
         print(e)
+        return None
     finally:
-        conn.close()
-        return asset_market_id
-def get_asset_market_currency(db_file, asset_market_id):
-    """ Fetch the currency of an asset market from the database """
-    conn = create_connection(db_file)
-    result = None
-    if conn is not None:
-        try:
-            c = conn.cursor()
-            c.execute("SELECT currency_id FROM asset_markets WHERE id = ?", (asset_market_id,))
-            result = c.fetchone()
-        except sqlite3.Error as e:
-            print(e)
-        finally:
-            conn.close()
-    return result[0] if result else None
+        database.bump_generation("transactions")
 
-def add_transaction(db_file, asset_market_id, quantity, price, date, location_id):
-    ''' Add a new transaction to the transactions table unless it already exists.'''
-    conn = create_connection(db_file)
-    transaction_id = -1
+def update_transaction(db_file, transaction_id, asset_market_id=None, quantity=None, price=None, date=None, location_id=None):
+    """ Change the fields of a transaction given (those left None stay as they are), as a change of the journal.
+
+    Returns the Change, or None on a database error. Raises ValueError if the transaction, the asset market
+    or the location does not exist.
+    """
+    fields = {column: value for column, value in (("asset_market_id", asset_market_id), ("quantity", quantity),
+                                                   ("price", price), ("date", date), ("location_id", location_id))
+              if value is not None}
+
+    def update(conn):
+        for table, name, value in (("transactions", "transaction_id", transaction_id),
+                                   ("asset_markets", "asset_market_id", asset_market_id),
+                                   ("locations", "location_id", location_id)):
+            if value is not None and _missing_ids(conn, table, [value]):
+                raise ValueError(f"Unknown {name}: {value}")
+        if fields:
+            conn.execute(f"UPDATE transactions SET {', '.join(column + ' = ?' for column in fields)} WHERE id = ?",
+                         (*fields.values(), transaction_id))
+        return []
+
+    return _journaled(db_file, f"edit transaction {transaction_id}", [transaction_id], update)
+
+def delete_transactions(db_file, transaction_ids):
+    """ Delete the transactions with the ids given, as one change of the journal. Ids that do not exist are
+    left out. Returns the Change, or None on error
+    """
+    transaction_ids = list(transaction_ids)
+    description = (f"delete transaction {transaction_ids[0]}" if len(transaction_ids) == 1
+                   else f"delete {len(transaction_ids)} transactions")
+
+    def delete(conn):
+        _delete_ids(conn, transaction_ids)
+        return []
+
+    return _journaled(db_file, description, transaction_ids, delete)
+
+def _undo_stacks(conn):
+    """ ([ids of the changes that can be undone], [ids of those that can be redone]), the next one last """
+    undoable, redoable = [], []
+    for change_id, action in conn.execute("SELECT id, action FROM changes ORDER BY id"):
+        if action == "undo":
+            redoable.append(undoable.pop())
+        elif action == "redo":
+            undoable.append(redoable.pop())
+        else:
+            # A change made after an undo takes the place of what was undone, which cannot be redone any more
+            undoable.append(change_id)
+            redoable.clear()
+    return undoable, redoable
+
+def _step(db_file, action):
+    """ Undo the last change (action "undo") or redo the last one undone ("redo"), see undo() """
+    database = get_db(db_file)
     try:
-        c = conn.cursor()
-        c.execute("INSERT INTO transactions (asset_market_id, quantity, price, date, location_id) VALUES (?, ?, ?, ?, ?)", (asset_market_id, quantity, price, date, location_id))
-        conn.commit()
-        transaction_id = c.lastrowid
+        with database.transaction() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            undoable, redoable = _undo_stacks(conn)
+            stack = undoable if action == "undo" else redoable
+            if not stack:
+                return None
+            target_id = stack[-1]
+            width = len(JOURNAL_COLUMNS)
+            before, after = {}, {}
+            for transaction_id, *images in conn.execute(CHANGE_ROWS_SQL, (target_id,)):
+                # The date is NOT NULL: without one, there was no row on that side
+                for side, image in ((before, images[:width]), (after, images[width:])):
+                    if image[3] is not None:
+                        side[transaction_id] = tuple(image)
+            wanted = before if action == "undo" else after
+            _delete_ids(conn, [transaction_id for transaction_id in before.keys() | after.keys() if transaction_id not in wanted])
+            present = _row_images(conn, wanted)
+            conn.executemany(REWRITE_ROW_SQL, [(*row, transaction_id) for transaction_id, row in wanted.items()
+                                               if transaction_id in present])
+            conn.executemany(RESTORE_ROW_SQL, [(*row, transaction_id) for transaction_id, row in wanted.items()
+                                               if transaction_id not in present])
+            change_id = conn.execute("INSERT INTO changes (action, target_id) VALUES (?, ?)", (action, target_id)).lastrowid
+            return Change(change_id, sorted(before.keys() | after.keys()), _dirty(before, after))
     except sqlite3.Error as e:
         print(e)
+        return None
     finally:
-        conn.close()
-        return transaction_id
+        database.bump_generation("transactions")
 
+def undo(db_file):
+    """ Undo the last change of the transactions not undone yet. Returns the Change undoing it, None if there
+    is nothing to undo or on error
+    """
+    return _step(db_file, "undo")
 
-def fetch_all_transactions(db_file):
-    """ Fetch all transactions from the database and return them """
-    conn = create_connection(db_file)
-    transactions = []
-    if conn is not None:
-        try:
-            c = conn.cursor()
-            # Adjust the SELECT statement as needed to fetch all necessary data
-            c.execute('''SELECT t.date, a.symbol, a.name, am.name, t.price, t.quantity, (t.price * t.quantity) as total, l.name, cu.code 
+def redo(db_file):
+    """ Redo the last change undone, unless another change came after it. Returns the Change, None if there
+    is nothing to redo or on error
+    """
+    return _step(db_file, "redo")
+
+def undo_redo_state(db_file):
+    """ (description of the change undo() would undo, of the one redo() would redo), None where there is none """
+    database = get_db(db_file)
+    undoable, redoable = _undo_stacks(database.connection)
+    descriptions = []
+    for stack in (undoable, redoable):
+        row = database.fetchone("SELECT description FROM changes WHERE id = ?", (stack[-1],)) if stack else None
+        descriptions.append(row[0] if row else None)
+    return tuple(descriptions)
+
+def last_change_id(db_file):
+    """ The id of the last entry of the journal, 0 if there is none: dirty_since() goes on from there """
+    row = get_db(db_file).fetchone("SELECT COALESCE(MAX(id), 0) FROM changes")
+    return row[0] if row else 0
+
+def dirty_since(db_file, journal_id=0, transaction_id=None):
+    """ Where the transactions changed after the journal entry journal_id, as DirtyRanges.
+
+    changed holds {asset_market_id: first date} of the rows edited, deleted or brought back since. With
+    transaction_id, that is only among the transactions up to that id, and added holds the same for the
+    transactions with a larger id: those are read as they are now anyway, journaled or not (see
+    add_transactions_bulk). Pass the journal_id and transaction_id returned to the next call.
+    """
+    database = get_db(db_file)
+    # The last ids are read first: whatever is written meanwhile is seen, at worst, twice
+    last_journal_id = last_change_id(db_file)
+    last_transaction_id = None if transaction_id is None else get_last_transaction_id(db_file)
+    changed = dict(database.fetchall(DIRTY_SINCE_SQL, {"after": journal_id, "last": last_journal_id,
+                                                       "transaction_id": (1 << 63) - 1 if transaction_id is None else transaction_id}))
+    added = {}
+    if transaction_id is not None:
+        added = dict(database.fetchall("SELECT asset_market_id, MIN(date) FROM transactions WHERE id > ? AND id <= ? "
+                                       "GROUP BY asset_market_id", (transaction_id, last_transaction_id)))
+    return DirtyRanges(last_journal_id, last_transaction_id, changed, added)
+
+
+# Adjust the SELECT statement as needed to fetch all necessary data
+ALL_TRANSACTIONS_SQL = '''SELECT t.date, a.symbol, a.name, am.name, t.price, t.quantity, (t.price * t.quantity) as total, l.name, cu.code 
                          FROM transactions t
                          JOIN asset_markets am ON t.asset_market_id = am.id
                          JOIN assets a ON am.asset_id = a.id
                          JOIN locations l ON t.location_id = l.id
-                         JOIN currencies cu ON am.currency_id = cu.id''')
-            transactions = c.fetchall()
-        except sqlite3.Error as e:
-            print(e)
-        finally:
-            conn.close()
-    return transactions
+                         JOIN currencies cu ON am.currency_id = cu.id'''
 
+def fetch_all_transactions(db_file):
+    """ Fetch all transactions from the database and return them """
+    return get_db(db_file).fetchall(ALL_TRANSACTIONS_SQL)
 
-if __name__ == "__main__":
-    create_tables()
 
+# The transactions list, a page at a time in (date, id) order. The rows are those of
+# ALL_TRANSACTIONS_SQL with the transaction id in front, as the key of each row.
+TRANSACTIONS_PAGE_SQL = '''SELECT t.id, t.date, a.symbol, a.name, am.name, t.price, t.quantity, (t.price * t.quantity) as total, l.name, cu.code
+                          FROM transactions t
+                          JOIN asset_markets am ON t.asset_market_id = am.id
+                          JOIN assets a ON am.asset_id = a.id
+                          JOIN locations l ON t.location_id = l.id
+                          JOIN currencies cu ON am.currency_id = cu.id'''
+TRANSACTIONS_AFTER_SQL = TRANSACTIONS_PAGE_SQL + " WHERE (t.date, t.id) > (?, ?) ORDER BY t.date, t.id LIMIT ?"
+TRANSACTIONS_BEFORE_SQL = TRANSACTIONS_PAGE_SQL + " WHERE (t.date, t.id) < (?, ?) ORDER BY t.date DESC, t.id DESC LIMIT ?"
+TRANSACTIONS_PAGE_SIZE = 200
+
+def transactions_page_query(after=None, before=None, limit=TRANSACTIONS_PAGE_SIZE, where=None):
+    """ The (sql, params) of fetch_transactions_page. where, if given, is a (condition, params) pair on
+    the columns of t (transactions) that the rows must also meet, see search.TransactionFilter
+    """
+    if where is None:
+        if before is not None:
+            return TRANSACTIONS_BEFORE_SQL, (*before, limit)
+        return TRANSACTIONS_AFTER_SQL, (*(after or ("", 0)), limit)
+    condition, params = where
+    if before is not None:
+        return (TRANSACTIONS_PAGE_SQL + f" WHERE (t.date, t.id) < (?, ?) AND ({condition}) ORDER BY t.date DESC, t.id DESC LIMIT ?",
+                (*before, *params, limit))
+    return (TRANSACTIONS_PAGE_SQL + f" WHERE (t.date, t.id) > (?, ?) AND ({condition}) ORDER BY t.date, t.id LIMIT ?",
+            (*(after or ("", 0)), *params, limit))
+
+def fetch_transactions_page(db_file, after=None, before=None, limit=TRANSACTIONS_PAGE_SIZE, where=None):
+    """ Fetch up to limit transactions following the (date, id) key after, or preceding the key before.
+
+    With neither, the first page is returned; with before=(MAX_DATE, 0) the last one.
+    Rows are always in (date, id) order. where restricts them, see transactions_page_query.
+    """
+    rows = get_db(db_file).fetchall(*transactions_page_query(after, before, limit, where))
+    return rows[::-1] if before is not None else rows
+
+def fetch_transactions_since(db_file, transaction_id, where=None):
+    """ Fetch the transactions with an id above transaction_id, in the rows of fetch_transactions_page """
+    condition, params = where or ("1", ())
+    return get_db(db_file).fetchall(TRANSACTIONS_PAGE_SQL + f" WHERE t.id > ? AND ({condition}) ORDER BY t.date, t.id",
+                                    (transaction_id, *params))
+
+def fetch_transactions_by_id(db_file, transaction_ids, where=None):
+    """ Fetch the transactions among transaction_ids (meeting where), in the rows of fetch_transactions_page """
+    condition, params = where or ("1", ())
+    ids = list(transaction_ids)
+    rows = []
+    for start in range(0, len(ids), 900):
+        batch = ids[start:start + 900]
+        rows += get_db(db_file).fetchall(TRANSACTIONS_PAGE_SQL + f" WHERE t.id IN ({','.join('?' * len(batch))}) AND ({condition})",
+                                         (*batch, *params))
+    return sorted(rows, key=lambda row: (row[1], row[0]))
+
+def get_last_transaction_id(db_file):
+    row = get_db(db_file).fetchone("SELECT MAX(id) FROM transactions")
+    return row[0] if row and row[0] else 0
+
+def count_transactions_query(where=None, limit=None):
+    """ The (sql, params) of count_transactions """
+    if where is None and limit is None:
+        return "SELECT COUNT(*) FROM transactions", ()
+    condition, params = where or ("1", ())
+    return (f"SELECT COUNT(*) FROM (SELECT 1 FROM transactions t WHERE {condition} LIMIT ?)",
+            (*params, -1 if limit is None else limit))
+
+def count_transactions(db_file, where=None, limit=None):
+    """ The number of transactions (meeting where, see transactions_page_query), counting no further than limit """
+    row = get_db(db_file).fetchone(*count_transactions_query(where, limit))
+    return row[0] if row else 0
+
+ASSET_OVERVIEW_SQL = '''SELECT a.name, l.name, SUM(p.quantity) as quantity_owned
+                         FROM positions p
+                         JOIN assets a ON p.asset_id = a.id
+                         JOIN locations l ON p.location_id = l.id
+                         GROUP BY p.asset_id, p.location_id'''
 
 def fetch_asset_overview(db_file):
-    """ Fetch the quantity of each asset owned at each location """
-    conn = create_connection(db_file)
-    asset_overview = []
-    if conn is not None:
-        try:
-            c = conn.cursor()
-            c.execute('''SELECT a.name, l.name, SUM(t.quantity) as quantity_owned
-                         FROM transactions t
-                         JOIN asset_markets am ON t.asset_market_id = am.id
-                         JOIN assets a ON am.asset_id = a.id
-                         JOIN locations l ON am.location_id = l.id
-                         GROUP BY a.id, l.id''')
-            asset_overview = c.fetchall()
-        except sqlite3.Error as e:
-            print(e)
-        finally:
-            conn.close()
-    return asset_overview
+    """ Fetch the quantity of each asset owned at each location, from the materialized positions """
+    return get_db(db_file).fetchall(ASSET_OVERVIEW_SQL)
+
+def fetch_positions(db_file):
+    """ (asset_market_id, asset_id, location_id, quantity, cost_basis, transaction_count) of every position """
+    return get_db(db_file).fetchall("SELECT asset_market_id, asset_id, location_id, quantity, cost_basis, transaction_count "
+                                    "FROM positions ORDER BY asset_market_id")
+
+def verify_positions(db_file, tolerance=1e-6):
+    """ Compare the positions table with a full aggregation of the transactions.
+
+    Returns [(asset_market_id, stored row, expected row)] for every position that differs;
+    a missing row is None. Quantities and amounts within tolerance are equal.
+    """
+    stored = {row[0]: row for row in fetch_positions(db_file)}
+    expected = {row[0]: row for row in get_db(db_file).fetchall(POSITIONS_AGGREGATE_SQL)}
+    mismatches = []
+    for asset_market_id in sorted(stored.keys() | expected.keys()):
+        have, want = stored.get(asset_market_id), expected.get(asset_market_id)
+        if have is None or want is None or have[1:3] != want[1:3] or have[5] != want[5] \
+                or abs(have[3] - want[3]) > tolerance or abs(have[4] - want[4]) > tolerance:
+            mismatches.append((asset_market_id, have, want))
+    return mismatches
+
+def rebuild_positions(db_file):
+    """ Recompute the positions table from the transactions. Returns the number of positions """
+    try:
+        with get_db(db_file).transaction() as conn:
+            conn.execute("DELETE FROM positions")
+            conn.execute("INSERT INTO positions (asset_market_id, asset_id, location_id, quantity, cost_basis, transaction_count) "
+                         + POSITIONS_AGGREGATE_SQL)
+            return conn.execute("SELECT COUNT(*) FROM positions").fetchone()[0]
+    except sqlite3.Error as e:
+        print(e)
+        return -1
+
+
+def rebuild_cash_ledger(db_file):
+    """ Book the cash legs of the transactions again and recompute account_balances from the movements.
+    The checkpoints are dropped, see cash.rebuild. Returns the number of movements, -1 on error
+    """
+    try:
+        with get_db(db_file).transaction() as conn:
+            # Emptied first, so that the triggers of the movements deleted and booked below have nothing to update
+            conn.execute("DELETE FROM account_balances")
+            conn.execute("DELETE FROM cash_snapshots")
+            conn.execute("DELETE FROM cash_movements WHERE transaction_id IS NOT NULL")
+            conn.execute("DROP TRIGGER IF EXISTS trg_cash_movement_insert")
+            _open_cash_accounts(conn)
+            conn.execute(BOOK_TRADES_SINCE_SQL, (0,))
+            conn.execute(ADD_TO_BALANCES_SINCE_SQL, (0,))
+            conn.execute(CASH_MOVEMENT_INSERT_TRIGGER_SQL)
+            return conn.execute("SELECT COUNT(*) FROM cash_movements").fetchone()[0]
+    except sqlite3.Error as e:
+        print(e)
+        return -1
+
+
+EXCHANGE_RATE_AS_OF_SQL = '''SELECT rate FROM exchange_rates
+                         WHERE currency_from_id = ? AND currency_to_id = ? AND date <= ?
+                         ORDER BY date DESC LIMIT 1'''
+
+# The queries run on every page load, with the only full scans they are allowed to do.
+# Any other "SCAN" in their plan means an index is missing or is not being used.
+HOT_QUERIES = {
+    "fetch_all_transactions": (ALL_TRANSACTIONS_SQL, (), ("SCAN t",)),
+    "fetch_transactions_page": (TRANSACTIONS_AFTER_SQL, ("2024-01-01", 1, TRANSACTIONS_PAGE_SIZE), ()),
+    "fetch_transactions_page_before": (TRANSACTIONS_BEFORE_SQL, ("2024-01-01", 1, TRANSACTIONS_PAGE_SIZE), ()),
+    "fetch_asset_overview": (ASSET_OVERVIEW_SQL, (), ("SCAN p USING COVERING INDEX idx_positions_asset_location",)),
+    "get_asset_markets": (ASSET_MARKETS_BY_LOCATION_SQL, (1,), ()),
+    "exchange_rate_as_of": (EXCHANGE_RATE_AS_OF_SQL, (1, 2, "2024-01-01"), ()),
+}
+
+
+def explain_query_plan(db_file, sql, params=()):
+    """ Return the detail lines of EXPLAIN QUERY PLAN for sql """
+    return [row[3] for row in get_db(db_file).fetchall("EXPLAIN QUERY PLAN " + sql, params)]
+
+def find_table_scans(db_file):
+    """ Return {query name: unexpected SCAN lines} for every hot query that falls back to a table scan """
+    scans = {}
+    for name, (sql, params, allowed) in HOT_QUERIES.items():
+        unexpected = [detail for detail in explain_query_plan(db_file, sql, params)
+                      if detail.startswith("SCAN") and detail not in allowed]
+        if unexpected:
+            scans[name] = unexpected
+    return scans
+
+
+if __name__ == "__main__":
+    # python db.py portfolio.db: create the tables of a new database, or bring an existing one up to date
+    if len(sys.argv) != 2:
+        sys.exit("usage: python db.py portfolio.db")
+    create_tables(sys.argv[1])
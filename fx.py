@@ -0,0 +1,113 @@
+"""
+Exchange rates.
+
+FxService keeps the exchange_rates table as one sorted array of days and one
+of rates per currency pair, and answers as-of lookups (the last rate known on
+or before a day) with a binary search. A pair with no quotes is answered with
+the inverse quotes if there are any, or else through a pivot currency, as
+from -> pivot -> to. Derived series are memoized, with LRU eviction.
+"""
+import functools
+from collections import defaultdict
+
+import numpy as np
+
+import db
+from utils import to_day, to_days
+
+DEFAULT_PIVOTS = ("EUR", "USD")
+DERIVED_CACHE_SIZE = 128
+
+EMPTY_SERIES = (np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float64))
+
+
+def as_of(series, days):
+    """ The values of a (days, values) series on each of days, NaN before its first day """
+    series_days, values = series
+    positions = np.searchsorted(series_days, days, side="right") - 1
+    found = positions >= 0
+    result = np.full(np.shape(days), np.nan)
+    result[found] = values[positions[found]]
+    return result
+
+
+def pivot_ids(db_file, pivot_codes=DEFAULT_PIVOTS):
+    """ The ids of the pivot currencies that exist in db_file, in order of preference """
+    ids = {code: currency_id for currency_id, code, name in db.get_currencies(db_file)}
+    return [ids[code] for code in pivot_codes if code in ids]
+
+
+class FxService:
+    """ As-of exchange rates between any two currencies, from the quotes loaded at construction """
+
+    def __init__(self, rate_from, rate_to, rate_days, rate_values, pivots=(), cache_size=DERIVED_CACHE_SIZE):
+        """ Build the per-pair arrays from parallel arrays of quotes. pivots are currency ids, in order of preference """
+        self.pivots = tuple(pivots)
+        rate_from, rate_to = np.asarray(rate_from, dtype=np.int64), np.asarray(rate_to, dtype=np.int64)
+        rate_days, rate_values = np.asarray(rate_days, dtype=np.int64), np.asarray(rate_values, dtype=np.float64)
+        order = np.lexsort((rate_days, rate_to, rate_from))
+        rate_from, rate_to, rate_days, rate_values = rate_from[order], rate_to[order], rate_days[order], rate_values[order]
+        self.quotes = {}
+        starts = np.flatnonzero(np.r_[True, (rate_from[1:] != rate_from[:-1]) | (rate_to[1:] != rate_to[:-1])]) if len(order) else []
+        for start, end in zip(starts, list(starts[1:]) + [len(order)]):
+            self.quotes[(int(rate_from[start]), int(rate_to[start]))] = (rate_days[start:end], rate_values[start:end])
+        self.neighbours = defaultdict(set)
+        for from_id, to_id in self.quotes:
+            self.neighbours[from_id].add(to_id)
+            self.neighbours[to_id].add(from_id)
+        self.series = functools.lru_cache(maxsize=cache_size)(self._series)
+
+    @classmethod
+    def load(cls, db_file, pivot_codes=DEFAULT_PIVOTS):
+        """ An FxService over every rate stored in db_file """
+        rows = db.get_db(db_file).fetchall("SELECT currency_from_id, currency_to_id, date, rate FROM exchange_rates")
+        rate_from, rate_to, dates, rates = zip(*rows) if rows else ((), (), (), ())
+        return cls(rate_from, rate_to, to_days(dates), rates, pivot_ids(db_file, pivot_codes))
+
+    def _direct(self, from_id, to_id):
+        if (from_id, to_id) in self.quotes:
+            return self.quotes[(from_id, to_id)]
+        if (to_id, from_id) in self.quotes:
+            days, rates = self.quotes[(to_id, from_id)]
+            with np.errstate(divide="ignore"):
+                return days, 1.0 / rates
+        return None
+
+    def _series(self, from_id, to_id):
+        """ The (days, rates) series from one currency to another: quoted, inverted or crossed through a pivot """
+        if from_id == to_id:
+            return np.array([np.iinfo(np.int64).min]), np.ones(1)
+        direct = self._direct(from_id, to_id)
+        if direct is not None:
+            return direct
+        for pivot in self.pivots:
+            if pivot in (from_id, to_id) or pivot not in self.neighbours[from_id] or pivot not in self.neighbours[to_id]:
+                continue
+            first, second = self._direct(from_id, pivot), self._direct(pivot, to_id)
+            days = np.union1d(first[0], second[0])
+            rates = as_of(first, days) * as_of(second, days)
+            known = ~np.isnan(rates)
+            return days[known], rates[known]
+        return EMPTY_SERIES
+
+    def rate(self, from_id, to_id, date):
+        """ The rate from one currency to another on date (YYYY-MM-DD or a date), or None if unknown """
+        value = as_of(self.series(from_id, to_id), np.array([to_day(date)]))[0]
+        return None if np.isnan(value) else float(value)
+
+    def convert(self, amounts, currency_ids, days, to_id):
+        """ Convert arrays of amounts, each in its own currency and on its own day (days since EPOCH), into to_id.
+
+        Amounts whose rate is unknown come out as NaN.
+        """
+        amounts = np.asarray(amounts, dtype=np.float64)
+        currency_ids = np.asarray(currency_ids, dtype=np.int64)
+        days = np.asarray(days, dtype=np.int64)
+        rates = np.full(amounts.shape, np.nan)
+        currencies, inverse = np.unique(currency_ids, return_inverse=True)
+        order = np.argsort(inverse, kind="stable")
+        bounds = np.searchsorted(inverse[order], np.arange(len(currencies) + 1))
+        for i, currency_id in enumerate(currencies):
+            rows = order[bounds[i]:bounds[i + 1]]
+            rates[rows] = as_of(self.series(int(currency_id), to_id), days[rows])
+        return amounts * rates
@@ -0,0 +1,264 @@
+"""
+Interactive Brokers statement importer.
+
+Reads Activity statements exported as CSV, Flex Query CSV files and Flex Query
+XML files. Statements are streamed: the file is parsed one trade at a time and
+written in chunks, so memory use does not grow with the size of the file.
+
+Every imported trade is stored with a fingerprint, a hash of its natural key
+(the IB trade id when there is one), and the transactions table has a UNIQUE
+index on it. Importing the same statement twice therefore stores nothing new.
+"""
+import csv
+import hashlib
+import itertools
+import operator
+import xml.etree.ElementTree as ET
+from collections import namedtuple
+
+import db
+
+IMPORT_CHUNK_SIZE = 20000
+DEFAULT_LOCATION = "Interactive Brokers"
+
+# A trade as read from any of the statement formats
+IBTrade = namedtuple("IBTrade", "account symbol description asset_category currency exchange timestamp quantity price trade_id")
+
+# IB asset categories, as used in Activity statements and in Flex queries, and the asset type we store
+ASSET_TYPES = {
+    "stocks": "stock", "stk": "stock",
+    "etf": "etf",
+    "equity and index options": "option", "opt": "option",
+    "futures": "future", "fut": "future",
+    "options on futures": "option", "fop": "option",
+    "crypto": "crypto", "crypto currency": "crypto",
+    "bonds": "bond", "bond": "bond",
+}
+# Currency conversions are cash movements, not assets
+SKIPPED_CATEGORIES = {"forex", "cash"}
+
+
+def _number(text):
+    """ Parse an IB number, which may contain thousands separators """
+    return float(text.replace(",", "")) if text else 0.0
+
+
+def _iso_date(timestamp):
+    """ Return the YYYY-MM-DD part of any of the IB date/time formats """
+    date = timestamp.strip().replace("-", "")[:8]
+    return f"{date[:4]}-{date[4:6]}-{date[6:8]}"
+
+
+def fingerprint(trade):
+    """ Hash the natural key of a trade into 16 bytes """
+    if trade.trade_id:
+        key = f"ib|{trade.account}|{trade.trade_id}"
+    else:
+        key = (f"ib|{trade.account}|{trade.symbol}|{trade.exchange}|{trade.currency}|"
+               f"{trade.timestamp}|{trade.quantity!r}|{trade.price!r}")
+    return hashlib.blake2b(key.encode(), digest_size=16).digest()
+
+
+def _column_getter(header, *fields):
+    """ Build a function returning the given fields of a row as a tuple.
+
+    Each field is a tuple of candidate column names, the first one present in
+    header is used. Missing columns read as an empty string. Indices are worked
+    out once per header, so reading a row is a single itemgetter call.
+    """
+    width = len(header)
+    indices = []
+    for names in fields:
+        indices.append(next((header.index(name) for name in names if name in header), width))
+    getter = operator.itemgetter(*indices)
+
+    def get(row):
+        if len(row) <= width:
+            row = row + [""] * (width + 1 - len(row))
+        return getter(row)
+    return get
+
+
+def read_activity_csv(path):
+    """ Yield the trades of an Activity statement exported as CSV.
+
+    Activity statements are made of sections: each line starts with the section
+    name and the row kind (Header, Data, SubTotal, Total), and each section has
+    its own header line.
+    """
+    account = ""
+    get = None
+    with open(path, newline="", encoding="utf-8-sig") as f:
+        for row in csv.reader(f):
+            if len(row) < 3:
+                continue
+            section, kind = row[0], row[1]
+            if section == "Account Information" and kind == "Data" and row[2] == "Account":
+                account = row[3]
+            elif section == "Trades" and kind == "Header":
+                get = _column_getter(row, ("DataDiscriminator",), ("Symbol",), ("Description",), ("Asset Category",),
+                                     ("Currency",), ("Exchange",), ("Date/Time",), ("Quantity",), ("T. Price",),
+                                     ("TradeID",))
+            elif section == "Trades" and kind == "Data" and get is not None:
+                discriminator, symbol, description, category, currency, exchange, timestamp, quantity, price, trade_id = get(row)
+                # SubTotal and Total lines aside, trades may also be listed per closed lot
+                if discriminator not in ("Order", ""):
+                    continue
+                yield IBTrade(account, symbol, description, category, currency, exchange, timestamp,
+                              _number(quantity), _number(price), trade_id)
+
+
+def read_flex_csv(path):
+    """ Yield the trades of a Flex Query exported as CSV.
+
+    A Flex CSV may hold several sections, each starting with its own header
+    line; only rows of sections that look like trades are read.
+    """
+    get = None
+    with open(path, newline="", encoding="utf-8-sig") as f:
+        for row in csv.reader(f):
+            if not row or row[0] in ("BOF", "BOA", "BOS", "EOS", "EOA", "EOF"):
+                continue
+            if "Symbol" in row and ("TradePrice" in row or "Price" in row):
+                get = _column_getter(row, ("ClientAccountID", "AccountId"), ("Symbol",), ("Description",),
+                                     ("AssetClass",), ("CurrencyPrimary", "Currency"), ("ListingExchange", "Exchange"),
+                                     ("DateTime", "TradeDate", "Date/Time"), ("Quantity",), ("TradePrice", "Price"),
+                                     ("TransactionID", "TradeID"))
+                continue
+            if get is None:
+                continue
+            account, symbol, description, category, currency, exchange, timestamp, quantity, price, trade_id = get(row)
+            yield IBTrade(account, symbol, description, category, currency, exchange, timestamp,
+                          _number(quantity), _number(price), trade_id)
+
+
+def read_flex_xml(path):
+    """ Yield the trades of a Flex Query exported as XML.
+
+    The document is parsed incrementally and every processed element is dropped
+    from the tree, so memory use stays flat however many trades there are.
+    """
+    account = ""
+    parent = None
+    for event, elem in ET.iterparse(path, events=("start", "end")):
+        if event == "start":
+            if elem.tag == "FlexStatement":
+                account = elem.get("accountId", "")
+            elif elem.tag == "Trades":
+                parent = elem
+            continue
+        if elem.tag == "Trade":
+            get = elem.get
+            if get("levelOfDetail", "EXECUTION") == "EXECUTION":
+                yield IBTrade(get("accountId", account), get("symbol", ""), get("description", ""),
+                              get("assetCategory", ""), get("currency", ""), get("listingExchange", ""),
+                              get("dateTime") or get("tradeDate", ""),
+                              _number(get("quantity", "")), _number(get("tradePrice", "")),
+                              get("transactionID") or get("tradeID", ""))
+            elem.clear()
+            if parent is not None:
+                parent.clear()
+        elif elem.tag in ("Trades", "FlexStatement"):
+            elem.clear()
+
+
+def read_statement(path):
+    """ Pick the reader matching the format of the file """
+    if path.lower().endswith(".xml"):
+        return read_flex_xml(path)
+    with open(path, newline="", encoding="utf-8-sig") as f:
+        first_line = f.readline()
+    if first_line.startswith("Statement,") or ",Header," in first_line:
+        return read_activity_csv(path)
+    return read_flex_csv(path)
+
+
+class ReferenceResolver:
+    """ Map IB names and codes to ids, creating the missing rows on the way.
+
+    All the lookup tables are read once into dictionaries, so resolving a trade
+    costs a few dictionary hits and the database is only touched for new rows.
+    """
+
+    def __init__(self, db_file, location_name=DEFAULT_LOCATION):
+        self.db_file = db_file
+        self.location_name = location_name
+        self.locations = {name: location_id for location_id, name in db.get_locations(db_file)}
+        self.currencies = {code: currency_id for currency_id, code, name in db.get_currencies(db_file)}
+        self.markets = {name: market_id for market_id, name, description in db.get_markets(db_file)}
+        self.assets = {symbol: asset_id for asset_id, symbol, name, description, is_harmonised in db.get_assets(db_file)}
+        self.asset_markets = {(asset_id, market_id, location_id, currency_id): asset_market_id
+                              for asset_market_id, asset_id, market_id, location_id, currency_id in db.get_all_asset_markets(db_file)}
+        self.location_currencies = set()
+        # (account, symbol, exchange, currency) -> (asset_market_id, location_id)
+        self.resolved = {}
+
+    def location(self, account):
+        name = f"{self.location_name} {account}" if account else self.location_name
+        if name not in self.locations:
+            self.locations[name] = db.add_location(self.db_file, name, "Imported from Interactive Brokers")
+        return self.locations[name]
+
+    def currency(self, code):
+        if code not in self.currencies:
+            self.currencies[code] = db.add_currency(self.db_file, code, code)
+        return self.currencies[code]
+
+    def market(self, name):
+        if name not in self.markets:
+            self.markets[name] = db.add_market(self.db_file, name)
+        return self.markets[name]
+
+    def asset(self, trade):
+        if trade.symbol not in self.assets:
+            asset_type = ASSET_TYPES.get(trade.asset_category.lower(), trade.asset_category.lower() or "stock")
+            # Whether an asset is harmonised is not in the statement, so it is left unknown
+            self.assets[trade.symbol] = db.add_asset(self.db_file, trade.description or trade.symbol, trade.symbol,
+                                                     asset_type, trade.description, None)
+        return self.assets[trade.symbol]
+
+    def resolve(self, trade):
+        """ Return (asset_market_id, location_id) for a trade """
+        key = (trade.account, trade.symbol, trade.exchange, trade.currency)
+        resolved = self.resolved.get(key)
+        if resolved is None:
+            resolved = self.resolved[key] = self._resolve(trade)
+        return resolved
+
+    def _resolve(self, trade):
+        location_id = self.location(trade.account)
+        currency_id = self.currency(trade.currency)
+        exchange = trade.exchange or "IB"
+        key = (self.asset(trade), self.market(exchange), location_id, currency_id)
+        if key not in self.asset_markets:
+            self.asset_markets[key] = db.add_asset_market(self.db_file, location_id, f"{trade.symbol}@{exchange}", "", *key[:2], currency_id)
+        if (location_id, currency_id) not in self.location_currencies:
+            db.add_location_currency(self.db_file, location_id, currency_id)
+            self.location_currencies.add((location_id, currency_id))
+        return self.asset_markets[key], location_id
+
+
+def transaction_rows(trades, resolver):
+    """ Turn trades into rows for db.add_imported_transactions """
+    for trade in trades:
+        if trade.asset_category.lower() in SKIPPED_CATEGORIES or not trade.quantity:
+            continue
+        asset_market_id, location_id = resolver.resolve(trade)
+        yield (asset_market_id, trade.quantity, trade.price, _iso_date(trade.timestamp), location_id, fingerprint(trade))
+
+
+def import_statement(db_file, path, location_name=DEFAULT_LOCATION, chunk_size=IMPORT_CHUNK_SIZE):
+    """ Import an Interactive Brokers statement into db_file.
+
+    Returns a dict with the number of trades read, inserted and skipped as duplicates.
+    """
+    resolver = ReferenceResolver(db_file, location_name)
+    rows = transaction_rows(read_statement(path), resolver)
+    read = inserted = 0
+    while True:
+        chunk = list(itertools.islice(rows, chunk_size))
+        if not chunk:
+            break
+        read += len(chunk)
+        inserted += db.add_imported_transactions(db_file, chunk)
+    return {"read": read, "inserted": inserted, "duplicates": read - inserted}
@@ -0,0 +1,321 @@
+"""
+Last-In-First-Out lot matching.
+
+Every transaction that opens (or adds to) a position creates a lot; every
+transaction going the other way closes the most recent open lots first, and
+each of those matches realizes a gain or a loss. Lots are kept per stack, that
+is per (asset, location): the same asset bought on two exchanges of the same
+broker is one position. A lot keeps the currency it was opened in; closed in
+another one, its price is converted at the exchange rate of the day it was
+opened (or, if none is known then, of the day it is closed), so that the gain
+is in the closing currency. Exchange rates added later for those days only
+count once the lots are rebuilt.
+
+The results are persisted in the lots and lot_matches tables, and each stack's
+open lots are also kept in memory. New transactions dated after the last one
+of their stack are simply pushed on the in-memory stack. A back-dated
+transaction rewinds only its own stack, and only to its own date: the matches
+made from that date on are undone and the transactions from that date on are
+replayed. Edits, deletions, undos and redos come from the change journal
+(see db.dirty_since): each rewinds the stacks it touched to the first date it
+touched, the same way.
+
+Several processes may match the same database (the GUI, cli.py,
+aggregate.py). Every write to the lots moves a counter in user_settings on,
+under the write lock; an engine finding it moved by someone else drops its
+in-memory stacks and reloads them from the lots, rather than going on from
+stacks that no longer match the tables.
+"""
+import threading
+from collections import defaultdict
+from contextlib import contextmanager
+
+import db
+
+# Quantities smaller than this are rounding noise, and the lot is closed
+EPSILON = 1e-9
+# user_settings key holding the id of the last transaction matched
+SYNCED_SETTING = "lifo_synced_transaction_id"
+# user_settings key holding the id of the last entry of the change journal applied
+JOURNAL_SETTING = "lifo_synced_change_id"
+# user_settings key counting the writes to the lots, by any process
+LOTS_VERSION_SETTING = "lifo_lots_version"
+
+# Positions in the lists used as in-memory lots
+LOT_ID, LOT_DATE, LOT_QUANTITY, LOT_REMAINING, LOT_PRICE, LOT_CURRENCY = range(6)
+
+STACK_TRANSACTIONS_SQL = '''SELECT t.id, t.date, t.quantity, t.price, am.currency_id
+                            FROM transactions t
+                            JOIN asset_markets am ON t.asset_market_id = am.id
+                            WHERE am.asset_id = ? AND am.location_id IS ? AND t.date >= ?
+                            ORDER BY t.date, t.id'''
+
+UPSERT_LOT_SQL = '''INSERT INTO lots (transaction_id, asset_id, location_id, date, quantity, remaining, price, currency_id)
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                    ON CONFLICT (transaction_id) DO UPDATE SET remaining = excluded.remaining'''
+
+INSERT_MATCH_SQL = '''INSERT INTO lot_matches (lot_transaction_id, transaction_id, asset_id, location_id, currency_id,
+                                               date, quantity, open_price, close_price, gain)
+                      VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)'''
+
+
+class Converter:
+    """ The opening price of a lot in the currency it is closed in, from the exchange rates of the database.
+    They are loaded on first use, so that stacks in a single currency never load them (nor NumPy)
+    """
+
+    def __init__(self, db_file, service=None):
+        self.db_file = db_file
+        self.service = service
+
+    def __call__(self, price, from_id, to_id, open_date, close_date):
+        if self.service is None:
+            import fx
+            self.service = fx.FxService.load(self.db_file)
+        rate = self.service.rate(from_id, to_id, open_date)
+        if rate is None:
+            rate = self.service.rate(from_id, to_id, close_date)
+        if rate is None:
+            print(f"No exchange rate from currency {from_id} to {to_id}: a lot of {open_date} is matched at its own price")
+            return price
+        return price * rate
+
+
+def match(stack, transaction_id, date, quantity, price, currency_id, key, touched, matches, convert):
+    """ Apply one transaction to a stack of open lots.
+
+    Lots going the other way are closed from the top of the stack, and whatever
+    quantity is left opens a new lot. Closed quantities are signed like the lot
+    they close, so a short lot covered at a lower price is a gain too. A lot in
+    another currency than the transaction's is matched at its price converted
+    with convert, a Converter. Lots that change are collected in touched (by id),
+    realized matches in matches.
+    """
+    asset_id, location_id = key
+    while stack and abs(quantity) > EPSILON and (stack[-1][LOT_REMAINING] > 0) != (quantity > 0):
+        lot = stack[-1]
+        remaining = lot[LOT_REMAINING]
+        closed = min(abs(quantity), abs(remaining))
+        if remaining < 0:
+            closed = -closed
+        open_price = lot[LOT_PRICE]
+        if lot[LOT_CURRENCY] != currency_id and lot[LOT_CURRENCY] is not None and currency_id is not None:
+            open_price = convert(open_price, lot[LOT_CURRENCY], currency_id, lot[LOT_DATE], date)
+        matches.append((lot[LOT_ID], transaction_id, asset_id, location_id, currency_id, date,
+                        closed, open_price, price, (price - open_price) * closed))
+        lot[LOT_REMAINING] = remaining - closed
+        quantity += closed
+        touched[lot[LOT_ID]] = lot
+        if abs(lot[LOT_REMAINING]) <= EPSILON:
+            lot[LOT_REMAINING] = 0.0
+            stack.pop()
+    if abs(quantity) > EPSILON:
+        lot = [transaction_id, date, quantity, quantity, price, currency_id]
+        stack.append(lot)
+        touched[transaction_id] = lot
+
+
+class LifoEngine:
+    """ Incremental LIFO matching for one database file """
+
+    def __init__(self, db_file):
+        self.db_file = db_file
+        self._lock = threading.RLock()
+        # (asset_id, location_id) -> open lots, oldest first
+        self.stacks = {}
+        # (asset_id, location_id) -> (date, transaction_id) of the last transaction applied
+        self.last = {}
+        # The LOTS_VERSION_SETTING this engine wrote last: the stacks match the lots as long as it is still there
+        self.lots_version = None
+        # The exchange rates of the current transaction, read again for each one
+        self.convert = Converter(db_file)
+
+    @contextmanager
+    def _transaction(self):
+        """ A database transaction holding the write lock. The in-memory stacks are dropped, to be reloaded from
+        the tables, if another engine wrote to the lots since this one did, or if the transaction fails
+        """
+        with self._lock:
+            try:
+                with db.get_db(self.db_file).transaction() as conn:
+                    if not conn.in_transaction:
+                        conn.execute("BEGIN IMMEDIATE")
+                    row = conn.execute("SELECT setting_value FROM user_settings WHERE setting_key = ?",
+                                       (LOTS_VERSION_SETTING,)).fetchone()
+                    version = int(row[0]) if row else 0
+                    if version != self.lots_version:
+                        self.stacks, self.last = {}, {}
+                    self.convert = Converter(self.db_file)
+                    changes = conn.total_changes
+                    yield conn
+                    if conn.total_changes != changes:
+                        version += 1
+                        conn.execute("INSERT INTO user_settings (setting_key, setting_value) VALUES (?, ?) "
+                                     "ON CONFLICT (setting_key) DO UPDATE SET setting_value = excluded.setting_value",
+                                     (LOTS_VERSION_SETTING, str(version)))
+                self.lots_version = version
+            except BaseException:
+                self.stacks, self.last = {}, {}
+                self.lots_version = None
+                raise
+
+    def _write(self, conn, key, touched, matches):
+        asset_id, location_id = key
+        conn.executemany(UPSERT_LOT_SQL, ((lot[LOT_ID], asset_id, location_id, lot[LOT_DATE], lot[LOT_QUANTITY],
+                                           lot[LOT_REMAINING], lot[LOT_PRICE], lot[LOT_CURRENCY])
+                                          for lot in touched.values()))
+        conn.executemany(INSERT_MATCH_SQL, matches)
+
+    def rebuild(self):
+        """ Recompute every lot and match from the whole history """
+        with self._transaction() as conn:
+            conn.execute("DELETE FROM lot_matches")
+            conn.execute("DELETE FROM lots")
+            self.stacks, self.last = {}, {}
+            rows = conn.execute('''SELECT am.asset_id, am.location_id, t.id, t.date, t.quantity, t.price, am.currency_id
+                                   FROM transactions t
+                                   JOIN asset_markets am ON t.asset_market_id = am.id
+                                   ORDER BY am.asset_id, am.location_id, t.date, t.id''')
+            lots, matches = [], []
+            key = stack = touched = None
+            for asset_id, location_id, transaction_id, date, quantity, price, currency_id in rows:
+                if (asset_id, location_id) != key:
+                    if key is not None:
+                        lots.extend((lot[LOT_ID], *key, lot[LOT_DATE], lot[LOT_QUANTITY], lot[LOT_REMAINING], lot[LOT_PRICE],
+                                     lot[LOT_CURRENCY]) for lot in touched.values())
+                        self.last[key] = last
+                    key = (asset_id, location_id)
+                    stack = self.stacks[key] = []
+                    touched = {}
+                match(stack, transaction_id, date, quantity, price, currency_id, key, touched, matches, self.convert)
+                last = (date, transaction_id)
+            if key is not None:
+                lots.extend((lot[LOT_ID], *key, lot[LOT_DATE], lot[LOT_QUANTITY], lot[LOT_REMAINING], lot[LOT_PRICE],
+                             lot[LOT_CURRENCY]) for lot in touched.values())
+                self.last[key] = last
+            # The tables are empty: plain inserts in primary key order are much cheaper than upserts
+            lots.sort()
+            conn.executemany("INSERT INTO lots (transaction_id, asset_id, location_id, date, quantity, remaining, price, "
+                             "currency_id) VALUES (?, ?, ?, ?, ?, ?, ?, ?)", lots)
+            conn.executemany(INSERT_MATCH_SQL, matches)
+            self._set_synced(conn, conn.execute("SELECT COALESCE(MAX(id), 0) FROM transactions").fetchone()[0],
+                             conn.execute("SELECT COALESCE(MAX(id), 0) FROM changes").fetchone()[0])
+
+    def replay(self, asset_id, location_id, from_date):
+        """ Rewind one stack to from_date and re-match its transactions from that date on """
+        with self._transaction() as conn:
+            self._replay(conn, (asset_id, location_id), from_date)
+
+    def _replay(self, conn, key, from_date):
+        asset_id, location_id = key
+        stack_filter = "asset_id = ? AND location_id IS ? AND date >= ?"
+        params = (asset_id, location_id, from_date)
+        # Give back to the surviving lots what the undone matches took from them
+        undone = conn.execute(f"SELECT lot_transaction_id, SUM(quantity) FROM lot_matches WHERE {stack_filter} "
+                              "GROUP BY lot_transaction_id", params).fetchall()
+        conn.executemany("UPDATE lots SET remaining = remaining + ? WHERE transaction_id = ?",
+                         [(quantity, lot_id) for lot_id, quantity in undone])
+        conn.execute(f"DELETE FROM lot_matches WHERE {stack_filter}", params)
+        conn.execute(f"DELETE FROM lots WHERE {stack_filter}", params)
+
+        self.stacks[key] = [list(row) for row in conn.execute(
+            "SELECT transaction_id, date, quantity, remaining, price, currency_id FROM lots "
+            "WHERE asset_id = ? AND location_id IS ? AND ABS(remaining) > ? ORDER BY date, transaction_id",
+            (asset_id, location_id, EPSILON))]
+        self.last.pop(key, None)
+        self._apply(conn, key, conn.execute(STACK_TRANSACTIONS_SQL, params).fetchall())
+
+    def _apply(self, conn, key, transactions):
+        stack = self.stacks.setdefault(key, [])
+        touched, matches = {}, []
+        for transaction_id, date, quantity, price, currency_id in transactions:
+            match(stack, transaction_id, date, quantity, price, currency_id, key, touched, matches, self.convert)
+            self.last[key] = (date, transaction_id)
+        self._write(conn, key, touched, matches)
+
+    def _set_synced(self, conn, transaction_id, change_id=None):
+        settings = [(SYNCED_SETTING, str(transaction_id))]
+        if change_id is not None:
+            settings.append((JOURNAL_SETTING, str(change_id)))
+        conn.executemany("INSERT INTO user_settings (setting_key, setting_value) VALUES (?, ?) "
+                         "ON CONFLICT (setting_key) DO UPDATE SET setting_value = excluded.setting_value", settings)
+
+    def _changed_stacks(self, changed):
+        """ {(asset_id, location_id): first date} of the stacks of the asset markets in changed """
+        stacks = {}
+        database = db.get_db(self.db_file)
+        for asset_market_id, date in changed.items():
+            row = database.fetchone("SELECT asset_id, location_id FROM asset_markets WHERE id = ?", (asset_market_id,))
+            if row is not None:
+                stacks[row] = min(date, stacks.get(row, date))
+        return stacks
+
+    def sync(self):
+        """ Match the transactions added since the last sync, and match again from the first date changed the
+        stacks whose transactions were edited or deleted since. Returns how many transactions were added
+        """
+        # Read under the write lock too, so that another process cannot match the same transactions meanwhile
+        with self._transaction() as conn:
+            synced = int(db.get_setting(self.db_file, SYNCED_SETTING, 0))
+            # Only the changes to transactions matched already: the others are read below as they are now
+            dirty = db.dirty_since(self.db_file, int(db.get_setting(self.db_file, JOURNAL_SETTING, 0)), synced)
+            new = conn.execute('''SELECT am.asset_id, am.location_id, t.id, t.date, t.quantity, t.price, am.currency_id
+                                  FROM transactions t
+                                  JOIN asset_markets am ON t.asset_market_id = am.id
+                                  WHERE t.id > ?
+                                  ORDER BY t.date, t.id''', (synced,)).fetchall()
+            changed = self._changed_stacks(dirty.changed)
+            if not new and not changed:
+                return 0
+            by_stack = defaultdict(list)
+            for asset_id, location_id, *transaction in new:
+                by_stack[(asset_id, location_id)].append(transaction)
+
+            for key in by_stack.keys() | changed.keys():
+                transactions = by_stack.get(key)
+                if key in changed:
+                    # Rewound to the first date changed, or to the first new transaction if that is earlier
+                    self._replay(conn, key, min(changed[key], transactions[0][1]) if transactions else changed[key])
+                elif key in self.last and (transactions[0][1], transactions[0][0]) > self.last[key]:
+                    # Dated after everything else in the stack: push onto the in-memory stack
+                    self._apply(conn, key, transactions)
+                else:
+                    # Back-dated, or a stack not loaded in memory yet: rewind it to that date
+                    self._replay(conn, key, transactions[0][1])
+            self._set_synced(conn, max([synced] + [transaction[2] for transaction in new]), dirty.journal_id)
+            return len(new)
+
+
+_engines = {}
+_engines_lock = threading.Lock()
+
+
+def get_engine(db_file):
+    """ Return the shared LifoEngine for db_file """
+    # Keyed as db.get_db() pools connections: two engines on one file would keep reloading each other's stacks
+    key = db.database_key(db_file)
+    with _engines_lock:
+        engine = _engines.get(key)
+        if engine is None:
+            engine = _engines[key] = LifoEngine(db_file)
+    return engine
+
+
+def realized_gains(db_file, start_date=None, end_date=None):
+    """ Realized gains between two dates (both included, None for no limit).
+
+    Returns {"harmonised": {currency_code: gain}, "non_harmonised": {currency_code: gain}}.
+    Gains are in the currency of the closing transaction's asset market, lots opened in another one converted. Assets whose
+    harmonised status is unknown are counted as harmonised, as ordinary stocks are.
+    """
+    gains = {"harmonised": defaultdict(float), "non_harmonised": defaultdict(float)}
+    rows = db.get_db(db_file).fetchall('''SELECT COALESCE(a.is_harmonised, 1), cu.code, SUM(m.gain)
+                                          FROM lot_matches m
+                                          JOIN assets a ON m.asset_id = a.id
+                                          LEFT JOIN currencies cu ON m.currency_id = cu.id
+                                          WHERE m.date >= ? AND m.date <= ?
+                                          GROUP BY 1, 2''',
+                                       (start_date or "0000-00-00", end_date or "9999-99-99"))
+    for is_harmonised, currency_code, gain in rows:
+        gains["harmonised" if is_harmonised else "non_harmonised"][currency_code] += gain
+    return {bucket: dict(totals) for bucket, totals in gains.items()}
@@ -1,5 +1,6 @@
 import sys
 import db
+import profiling
 import ui 
 
 def main(db_file=None):
@@ -10,6 +11,7 @@ def main(db_file=None):
             if db_file is None or db_file == "":
                 print("No database file selected or created. Exiting application.")
                 return
+    profiling.enable_from_environment()  # opt-in, with PORTFOLIO_PROFILE set
     db.create_tables(db_file)
     app = ui.PortfolioTrackerApp(db_file)  # Start the GUI application
     app.mainloop()  # This will run the tkinter event loop
@@ -0,0 +1,304 @@
+"""
+Domain model.
+
+Records of the reference tables (locations, markets, currencies, assets, asset
+markets) are slotted dataclasses, loaded through an IdentityMap: one per
+database file, in which each row is materialized once and the same object is
+handed to every caller. A table is read whole on first use, after which
+lookups are dictionary hits, and read again once a write through db.py has
+moved its generation on, or within EXTERNAL_CHECK_SECONDS of a commit by
+another process. Transactions and lots are slotted dataclasses too, but the bulk paths
+keep transactions columnar, in a TransactionBatch of typed arrays.
+"""
+import sqlite3
+import threading
+from array import array
+from dataclasses import dataclass
+
+import db
+from dates import from_day, to_day
+
+
+@dataclass(slots=True)
+class Location:
+    id: int
+    name: str
+    description: str = None
+
+
+@dataclass(slots=True)
+class Market:
+    id: int
+    name: str
+    description: str = None
+
+
+@dataclass(slots=True)
+class Currency:
+    id: int
+    code: str
+    name: str
+
+
+@dataclass(slots=True)
+class Asset:
+    id: int
+    type: str
+    name: str
+    symbol: str = None
+    description: str = None
+    data_source_id: int = None
+    is_harmonised: bool = None
+
+
+@dataclass(slots=True)
+class AssetMarket:
+    id: int
+    name: str
+    description: str = None
+    asset_id: int = None
+    market_id: int = None
+    location_id: int = None
+    currency_id: int = None
+    data_source_id: int = None
+
+
+@dataclass(slots=True)
+class Transaction:
+    id: int
+    asset_market_id: int
+    quantity: float
+    price: float
+    date: str
+    location_id: int = None
+
+
+@dataclass(slots=True)
+class Lot:
+    transaction_id: int
+    asset_id: int
+    location_id: int
+    date: str
+    quantity: float
+    remaining: float
+    price: float
+    currency_id: int = None
+
+
+# The table of each record class, and the query reading it, its columns in the order of the dataclass fields
+TABLES = {Location: "locations", Market: "markets", Currency: "currencies", Asset: "assets", AssetMarket: "asset_markets"}
+LOOKUP_QUERIES = {
+    Location: "SELECT id, name, description FROM locations",
+    Market: "SELECT id, name, description FROM markets",
+    Currency: "SELECT id, code, name FROM currencies",
+    Asset: "SELECT id, type, name, symbol, description, data_source_id, is_harmonised FROM assets",
+    AssetMarket: "SELECT id, name, description, asset_id, market_id, location_id, currency_id, data_source_id FROM asset_markets",
+}
+
+
+# How often a lookup looks for writes made by other processes: they show within this many seconds
+EXTERNAL_CHECK_SECONDS = 0.1
+
+
+class IdentityMap:
+    """ The reference-table records of one database, each row materialized once and shared """
+
+    def __init__(self, db_file):
+        self.db_file = db_file
+        self._lock = threading.Lock()
+        self._records = {cls: {} for cls in LOOKUP_QUERIES}
+        # Generation of each table when it was last read, see db.PortfolioDB.generation
+        self._generations = {}
+        self._database = None
+        self.hits = self.misses = 0
+
+    def _load(self, cls):
+        """ Make sure the records of cls are current, reading the table if needed. Call with the lock held """
+        database = self._database
+        if database is None or database.closed:
+            # After close_db() the file has a new PortfolioDB, with generations of its own
+            database = self._database = db.get_db(self.db_file)
+        # Another process (a CLI import while the GUI is open) does not move the generations of this one
+        database.check_external_writes(EXTERNAL_CHECK_SECONDS)
+        generation = database.generation(TABLES[cls])
+        if self._generations.get(cls) == generation:
+            self.hits += 1
+            return self._records[cls]
+        self.misses += 1
+        records = self._records[cls]
+        try:
+            rows = database.execute(LOOKUP_QUERIES[cls]).fetchall()
+        except sqlite3.Error as e:
+            # Keep the records as they were, and read the table again next time
+            print(e)
+            return records
+        seen = set()
+        for row in rows:
+            record = records.get(row[0])
+            if record is None:
+                records[row[0]] = cls(*row)
+            else:
+                # Update in place, so that whoever holds the record sees the change
+                for field, value in zip(cls.__slots__, row):
+                    setattr(record, field, value)
+            seen.add(row[0])
+        for record_id in records.keys() - seen:
+            del records[record_id]
+        self._generations[cls] = generation
+        return records
+
+    def get(self, cls, record_id):
+        """ The record of class cls with id record_id, or None if there is no such row """
+        with self._lock:
+            return self._load(cls).get(record_id)
+
+    def all(self, cls):
+        """ Every record of class cls, in id order """
+        with self._lock:
+            return sorted(self._load(cls).values(), key=lambda record: record.id)
+
+    def invalidate(self, cls=None):
+        """ Read the table of cls (default: every table) again on next use """
+        with self._lock:
+            for each in ([cls] if cls else list(self._records)):
+                self._generations.pop(each, None)
+
+    def stats(self):
+        """ {"hits", "misses", "hit_rate"}: lookups served from memory, and those that read a table """
+        with self._lock:
+            total = self.hits + self.misses
+            return {"hits": self.hits, "misses": self.misses, "hit_rate": self.hits / total if total else 0.0}
+
+
+_identity_maps = {}
+_identity_maps_lock = threading.Lock()
+
+
+def get_identity_map(db_file):
+    """ Return the shared IdentityMap for db_file """
+    # Keyed as db.get_db() pools connections, so that two spellings of one file share a map. An absolute path is
+    # its own key, and found without normalizing it, which costs more than the lookup it is for
+    identity_map = _identity_maps.get(db_file)
+    if identity_map is not None:
+        return identity_map
+    key = db.database_key(db_file)
+    with _identity_maps_lock:
+        identity_map = _identity_maps.get(key)
+        if identity_map is None:
+            identity_map = _identity_maps[key] = IdentityMap(db_file)
+    return identity_map
+
+
+def currency_code(db_file, currency_id):
+    """ The code of a currency, or None """
+    currency = get_identity_map(db_file).get(Currency, currency_id)
+    return currency.code if currency else None
+
+
+def asset_name(db_file, asset_id):
+    """ The name of an asset, or None """
+    asset = get_identity_map(db_file).get(Asset, asset_id)
+    return asset.name if asset else None
+
+
+def asset_market_currency(db_file, asset_market_id):
+    """ The currency id of an asset market, or None """
+    asset_market = get_identity_map(db_file).get(AssetMarket, asset_market_id)
+    return asset_market.currency_id if asset_market else None
+
+
+class TransactionBatch:
+    """ Transactions as parallel typed arrays, a few dozen bytes each instead of a tuple or object per row.
+
+    Dates are stored as days since 1970-01-01, and a missing location as 0.
+    Rows are materialized as Transaction objects only when indexed.
+    """
+    __slots__ = ("ids", "asset_market_ids", "quantities", "prices", "days", "location_ids")
+
+    def __init__(self):
+        self.ids = array("q")
+        self.asset_market_ids = array("q")
+        self.quantities = array("d")
+        self.prices = array("d")
+        self.days = array("i")
+        self.location_ids = array("q")
+
+    def append(self, transaction_id, asset_market_id, quantity, price, date, location_id=None):
+        self.ids.append(transaction_id)
+        self.asset_market_ids.append(asset_market_id)
+        self.quantities.append(quantity)
+        self.prices.append(price)
+        self.days.append(to_day(date))
+        self.location_ids.append(location_id or 0)
+
+    def extend(self, rows, day_cache=None):
+        """ Append (id, asset_market_id, quantity, price, date, location_id) rows, a column at a time.
+
+        day_cache, a dict, remembers the dates already converted across calls.
+        """
+        if not rows:
+            return
+        day_cache = {} if day_cache is None else day_cache
+        ids, asset_market_ids, quantities, prices, dates, location_ids = zip(*rows)
+        self.ids.extend(ids)
+        self.asset_market_ids.extend(asset_market_ids)
+        self.quantities.extend(quantities)
+        self.prices.extend(prices)
+        for date in set(dates) - day_cache.keys():
+            day_cache[date] = to_day(date)
+        self.days.extend(map(day_cache.__getitem__, dates))
+        self.location_ids.extend(location_id or 0 for location_id in location_ids)
+
+    @classmethod
+    def from_rows(cls, rows):
+        """ A batch of (id, asset_market_id, quantity, price, date, location_id) rows """
+        batch = cls()
+        batch.extend(list(rows))
+        return batch
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __getitem__(self, i):
+        return Transaction(self.ids[i], self.asset_market_ids[i], self.quantities[i], self.prices[i],
+                           from_day(self.days[i]), self.location_ids[i] or None)
+
+    def __iter__(self):
+        return (self[i] for i in range(len(self)))
+
+    def rows(self):
+        """ Yield (asset_market_id, quantity, price, date, location_id) tuples, as db.add_transactions_bulk takes them """
+        for asset_market_id, quantity, price, day, location_id in zip(self.asset_market_ids, self.quantities, self.prices,
+                                                                      self.days, self.location_ids):
+            yield asset_market_id, quantity, price, from_day(day), location_id or None
+
+    def nbytes(self):
+        """ Memory held by the arrays """
+        return sum(column.itemsize * len(column) for column in
+                   (self.ids, self.asset_market_ids, self.quantities, self.prices, self.days, self.location_ids))
+
+
+TRANSACTIONS_SQL = "SELECT id, asset_market_id, quantity, price, date, location_id FROM transactions"
+
+
+def load_transactions(db_file, chunk_size=db.BULK_CHUNK_SIZE):
+    """ Every transaction of db_file, in (date, id) order, as a TransactionBatch """
+    batch = TransactionBatch()
+    day_cache = {}
+    cursor = db.get_db(db_file).execute(TRANSACTIONS_SQL + " ORDER BY date, id")
+    while True:
+        rows = cursor.fetchmany(chunk_size)
+        if not rows:
+            return batch
+        batch.extend(rows, day_cache)
+
+
+def load_open_lots(db_file, asset_id=None, location_id=None):
+    """ The lots still open, oldest first, optionally for one (asset, location) stack """
+    sql = ("SELECT transaction_id, asset_id, location_id, date, quantity, remaining, price, currency_id FROM lots "
+           "WHERE remaining != 0")
+    params = ()
+    if asset_id is not None:
+        sql += " AND asset_id = ? AND location_id IS ?"
+        params = (asset_id, location_id)
+    return [Lot(*row) for row in db.get_db(db_file).fetchall(sql + " ORDER BY date, transaction_id", params)]
@@ -0,0 +1,276 @@
+"""
+Historical net worth.
+
+Transactions, cached prices (see prices.py) and exchange rates are read once
+into NumPy arrays, and the whole daily series is computed in a single
+vectorized pass: holdings are the cumulative sum of the quantities traded per
+asset market, prices and rates are forward-filled day by day (an as-of join),
+and the value of every position is converted into the primary currency before
+summing.
+
+get_arrays() keeps the arrays of each database in memory, and reads each of
+the three tables again only once a write to it has moved db.data_version()
+on, so the net worth and the analytics (see analytics.py) do not read the
+tables every time. Not even the transactions are read again in full: the
+change journal (see db.dirty_since) tells the first date changed since they
+were read, and only the transactions from that date on are.
+"""
+import datetime
+import threading
+from collections import namedtuple
+
+import numpy as np
+import pandas as pd
+
+import db
+import fx
+from utils import EPOCH, to_day
+
+# user_settings key of the currency the net worth is expressed in
+PRIMARY_CURRENCY_SETTING = "primary_currency"
+DEFAULT_PRIMARY_CURRENCY = "EUR"
+# Rows turned into arrays at a time: no step holds the GIL for long, so reading on the database worker (see
+# worker.py) leaves the Tk main loop free, and the rows never all sit in memory as tuples
+READ_CHUNK_ROWS = 2000
+
+
+def _days_sql(column):
+    """ SQL for the days since EPOCH of a YYYY-MM-DD column, which SQLite computes quicker than NumPy parses them """
+    return f"CAST(julianday({column}) - julianday('{EPOCH}') AS INTEGER)"
+
+# Everything the computation needs, as arrays. Dates are days since EPOCH.
+PortfolioArrays = namedtuple("PortfolioArrays", [
+    "asset_market_ids",     # sorted ids of the asset markets with transactions; column order of every matrix
+    "currency_ids",         # currency of each of those asset markets
+    "location_ids",         # and location
+    "trade_columns", "trade_days", "trade_quantities", "trade_prices",
+    "price_columns", "price_days", "price_values",
+    "rate_from", "rate_to", "rate_days", "rate_values",
+])
+
+
+def _read_columns(db_file, sql, params, dtypes):
+    """ The columns of the rows of a query, as arrays of dtypes.
+
+    A query that fails (or is interrupted, see worker.py) raises sqlite3.Error, rather than handing back
+    empty arrays that get_arrays() would keep as the contents of the tables
+    """
+    chunks = []
+    cursor = db.get_db(db_file).execute(sql, params)
+    while rows := cursor.fetchmany(READ_CHUNK_ROWS):
+        chunks.append([np.array(column, dtype=dtype) for column, dtype in zip(zip(*rows), dtypes)])
+    return [np.concatenate([chunk[i] for chunk in chunks]) if chunks else np.array([], dtype=dtype)
+            for i, dtype in enumerate(dtypes)]
+
+
+def read_trades(db_file, from_date=None):
+    """ The transactions (from from_date on, if given), in date order, as
+    (asset_market_ids, days, quantities, prices, currency_ids, location_ids) arrays
+    """
+    where, params = ("WHERE t.date >= ?", (from_date,)) if from_date else ("", ())
+    # -1 for an asset market without a location
+    trade_asset_markets, trade_days, quantities, trade_prices, trade_currencies, trade_locations = _read_columns(
+        db_file, f'''SELECT t.asset_market_id, {_days_sql("t.date")}, t.quantity, t.price, am.currency_id, COALESCE(am.location_id, -1)
+                     FROM transactions t
+                     JOIN asset_markets am ON t.asset_market_id = am.id
+                     {where}
+                     ORDER BY t.date, t.id''', params,
+        (np.int64, np.int64, np.float64, np.float64, np.int64, np.int64))
+    return trade_asset_markets, trade_days, quantities, trade_prices, trade_currencies, trade_locations
+
+
+def read_trades_since(db_file, trades=None, marks=None):
+    """ (trades, marks): the output of read_trades, and where the change journal stood when it was read.
+    Given the trades and marks of an earlier call, only the transactions from the first date changed
+    since then are read again
+    """
+    if trades is None:
+        # Taken before reading, so that a change made meanwhile is read again next time rather than missed
+        marks = (db.last_change_id(db_file), db.get_last_transaction_id(db_file))
+        return read_trades(db_file), marks
+    dirty = db.dirty_since(db_file, *marks)
+    dates = [*dirty.changed.values(), *dirty.added.values()]
+    if dates:
+        from_date = min(dates)
+        cut = np.searchsorted(trades[1], to_day(from_date))
+        trades = tuple(np.concatenate([old[:cut], new]) for old, new in zip(trades, read_trades(db_file, from_date)))
+    return trades, (dirty.journal_id, dirty.transaction_id)
+
+
+def read_prices(db_file):
+    """ The cached closes, as (asset_market_ids, days, closes) arrays """
+    return tuple(_read_columns(db_file, f"SELECT asset_market_id, {_days_sql('date')}, close FROM prices", (),
+                               (np.int64, np.int64, np.float64)))
+
+
+def read_rates(db_file):
+    """ The exchange rates, in date order, as (from ids, to ids, days, rates) arrays """
+    return tuple(_read_columns(db_file, f"SELECT currency_from_id, currency_to_id, {_days_sql('date')}, rate "
+                                        f"FROM exchange_rates ORDER BY date", (), (np.int64, np.int64, np.int64, np.float64)))
+
+
+def build_arrays(trades, prices, rates):
+    """ The PortfolioArrays of the output of read_trades, read_prices and read_rates """
+    trade_asset_markets, trade_days, quantities, trade_prices, trade_currencies, trade_locations = trades
+    asset_market_ids, first = np.unique(trade_asset_markets, return_index=True)
+    trade_columns = np.searchsorted(asset_market_ids, trade_asset_markets)
+
+    # Positions are valued at the cached close of the day, or else at the price of their last trade
+    cached_asset_markets, cached_days, closes = prices
+    known = np.isin(cached_asset_markets, asset_market_ids)
+    price_columns = np.concatenate([trade_columns, np.searchsorted(asset_market_ids, cached_asset_markets[known])])
+    price_days = np.concatenate([trade_days, cached_days[known]])
+    price_values = np.concatenate([trade_prices, closes[known]])
+    # Sort by day, closes after trades, so that on the same day the close wins
+    order = np.lexsort((np.repeat([0, 1], [len(trade_days), int(known.sum())]), price_days))
+    price_columns, price_days, price_values = price_columns[order], price_days[order], price_values[order]
+
+    return PortfolioArrays(asset_market_ids, trade_currencies[first], trade_locations[first],
+                           trade_columns, trade_days, quantities, trade_prices,
+                           price_columns, price_days, price_values, *rates)
+
+
+def load_arrays(db_file):
+    """ Read transactions, prices and exchange rates into arrays """
+    return build_arrays(read_trades(db_file), read_prices(db_file), read_rates(db_file))
+
+
+# What each part of the arrays is read by, and the tables it is read from
+ARRAY_PARTS = {
+    "trades": (read_trades, ("transactions", "asset_markets")),
+    "prices": (read_prices, ("prices",)),
+    "rates": (read_rates, ("exchange_rates",)),
+}
+_arrays = {}
+_arrays_lock = threading.Lock()
+
+
+def get_arrays(db_file):
+    """ The arrays of db_file. Each part is read again only when the tables it comes from have been written to,
+    so a new transaction does not read all the prices again
+    """
+    # Keyed as db.get_db() pools connections, so that two spellings of one file share the arrays
+    key = db.database_key(db_file)
+    with _arrays_lock:
+        cached = _arrays.get(key, {})
+    parts, versions, stale = {}, {}, False
+    marks = cached.get("marks")
+    for part, (read, tables) in ARRAY_PARTS.items():
+        # The version is taken before reading, so that a write made meanwhile is not hidden under it
+        versions[part] = db.data_version(db_file, tables)
+        if part in cached and cached[part][0] == versions[part]:
+            parts[part] = cached[part][1]
+        elif part == "trades":
+            # With the asset markets as they were, the journal tells which transactions to read again
+            same_asset_markets = part in cached and cached[part][0][1:] == versions[part][1:]
+            parts[part], marks = read_trades_since(db_file, *((cached[part][1], marks) if same_asset_markets else ()))
+            stale = True
+        else:
+            parts[part], stale = read(db_file), True
+    if not stale and "arrays" in cached:
+        return cached["arrays"]
+    arrays = build_arrays(parts["trades"], parts["prices"], parts["rates"])
+    entry = {part: (versions[part], parts[part]) for part in ARRAY_PARTS}
+    entry["marks"] = marks
+    entry["arrays"] = arrays
+    with _arrays_lock:
+        _arrays[key] = entry
+    return arrays
+
+
+def forward_fill(matrix):
+    """ Replace every NaN by the last non-NaN value above it in the same column """
+    rows = np.arange(matrix.shape[0])[:, None]
+    last_valid = np.maximum.accumulate(np.where(np.isnan(matrix), 0, rows), axis=0)
+    return matrix[last_valid, np.arange(matrix.shape[1])]
+
+
+def daily_holdings(arrays, first_day, n_days):
+    """ Quantity held of each asset market at the end of each day, as a (n_days, n_asset_markets) matrix """
+    holdings = np.zeros((n_days, len(arrays.asset_market_ids)))
+    inside = arrays.trade_days < first_day + n_days
+    days = np.maximum(arrays.trade_days[inside] - first_day, 0)
+    np.add.at(holdings, (days, arrays.trade_columns[inside]), arrays.trade_quantities[inside])
+    return np.cumsum(holdings, axis=0)
+
+
+def daily_prices(arrays, first_day, n_days):
+    """ Last known price of each asset market on each day, NaN before the first observation """
+    n_columns = len(arrays.asset_market_ids)
+    prices = np.full((n_days, n_columns), np.nan)
+    inside = arrays.price_days < first_day + n_days
+    days, columns, values = arrays.price_days[inside], arrays.price_columns[inside], arrays.price_values[inside]
+    # Everything before first_day lands on row 0: keep the latest observation of each cell, since NumPy leaves
+    # unspecified which of repeated indices an assignment writes last
+    rows = np.maximum(days - first_day, 0)
+    cells = rows * n_columns + columns
+    order = np.lexsort((days, cells))
+    latest = order[np.r_[cells[order][1:] != cells[order][:-1], True]] if len(order) else order
+    prices[rows[latest], columns[latest]] = values[latest]
+    return forward_fill(prices)
+
+
+def daily_rates(arrays, currency_ids, to_currency_id, first_day, n_days, pivots=()):
+    """ Last known rate from each of currency_ids to to_currency_id on each day, as a (n_days, len(currency_ids)) matrix.
+
+    Pairs are resolved by fx.FxService: a missing pair is inverted, or crossed
+    through one of pivots. Days before the first known rate are NaN.
+    """
+    service = fx.FxService(arrays.rate_from, arrays.rate_to, arrays.rate_days, arrays.rate_values, pivots)
+    days = np.arange(first_day, first_day + n_days)
+    rates = np.empty((n_days, len(currency_ids)))
+    for column, currency_id in enumerate(currency_ids):
+        rates[:, column] = fx.as_of(service.series(int(currency_id), to_currency_id), days)
+    return rates
+
+
+def day_range(arrays, end_date=None):
+    """ (first day, number of days) from the first transaction to end_date (default today) """
+    end_day = int((np.datetime64(end_date or datetime.date.today(), "D") - EPOCH).astype(np.int64))
+    first_day = int(arrays.trade_days.min())
+    return first_day, max(end_day - first_day + 1, 1)
+
+
+def daily_values(arrays, currency_id, first_day, n_days, pivots=()):
+    """ (values, holdings, rates): the value of each asset market on each day in currency_id, the quantity
+    held and the rate its own currency converts at, as (n_days, n_asset_markets) matrices.
+    Values are NaN where there is no price or rate yet
+    """
+    holdings = daily_holdings(arrays, first_day, n_days)
+    currencies, currency_columns = np.unique(arrays.currency_ids, return_inverse=True)
+    rates = daily_rates(arrays, currencies, currency_id, first_day, n_days, pivots)[:, currency_columns]
+    values = holdings * daily_prices(arrays, first_day, n_days)
+    values *= rates
+    return values, holdings, rates
+
+
+def date_index(first_day, n_days):
+    """ The dates of n_days days from first_day, for the rows of the daily matrices """
+    return pd.date_range(EPOCH + np.timedelta64(first_day, "D"), periods=n_days, freq="D")
+
+
+def compute_series(arrays, currency_id, end_date=None, pivots=()):
+    """ The daily net worth, in currency_id, from the first transaction to end_date (default today) """
+    if not len(arrays.trade_days):
+        return pd.Series(dtype=np.float64, name="net_worth")
+    first_day, n_days = day_range(arrays, end_date)
+    values, holdings, rates = daily_values(arrays, currency_id, first_day, n_days, pivots)
+
+    # Positions that cannot be valued yet (no price or no rate so far) are left out
+    return pd.Series(np.nansum(values, axis=1), index=date_index(first_day, n_days), name="net_worth")
+
+
+def primary_currency_id(db_file):
+    """ The id of the currency chosen for the net worth, from user_settings """
+    code = db.get_setting(db_file, PRIMARY_CURRENCY_SETTING, DEFAULT_PRIMARY_CURRENCY)
+    for currency_id, currency_code, name in db.get_currencies(db_file):
+        if currency_code == code:
+            return currency_id
+    return None
+
+
+def net_worth_series(db_file, currency_id=None, end_date=None):
+    """ The daily net worth of the whole portfolio, in currency_id (default: the primary currency) """
+    if currency_id is None:
+        currency_id = primary_currency_id(db_file)
+    return compute_series(get_arrays(db_file), currency_id, end_date, fx.pivot_ids(db_file))
@@ -0,0 +1,174 @@
+"""
+Lazily paged transactions list.
+
+TransactionWindow holds a bounded slice of the transactions, in (date, id)
+order, read from the database a page at a time with keyset queries (see
+db.fetch_transactions_page). Moving forward appends a page and drops rows from
+the start once the window is full; moving backward does the opposite. New
+transactions are merged in where they belong, without reloading the window.
+
+It knows nothing of Tk: the TransactionsPage treeview mirrors it, using the
+changes each method returns. Transactions edited, deleted or brought back by
+an undo (see db.Change) are put right with refresh().
+
+A window can be restricted by a where condition (see search.TransactionFilter):
+then only the matching transactions are paged, and counted no further than
+COUNT_LIMIT, so that a broad filter does not have to count the whole table.
+"""
+import bisect
+
+import db
+
+# Rows kept in memory (and in the treeview) at most
+DEFAULT_MAX_ROWS = 2000
+# Keys beyond any date, to page from the end
+MAX_KEY = ("9999-99-99", 0)
+# Matches counted at most in a filtered window
+COUNT_LIMIT = 10000
+
+
+def row_key(row):
+    """ The (date, id) key of a row of db.fetch_transactions_page """
+    return row[1], row[0]
+
+
+class TransactionWindow:
+    """ A sliding window over the transactions of one database """
+
+    def __init__(self, db_file, page_size=db.TRANSACTIONS_PAGE_SIZE, max_rows=DEFAULT_MAX_ROWS, where=None, start_key=None,
+                 count_where=None):
+        self.db_file = db_file
+        self.where = where
+        # The same condition, written to be counted quickly rather than read in order, if that differs
+        self.count_where = count_where or where
+        # The key the first page follows, when where excludes everything before it
+        self.start_key = start_key
+        self.page_size = page_size
+        self.max_rows = max(max_rows, 2 * page_size)
+        self.rows = []
+        self.keys = []
+        # Position of rows[0] among all the transactions, and how many there are
+        self.offset = 0
+        self.total = 0
+        # Whether total stopped at COUNT_LIMIT, and there are more
+        self.total_capped = False
+        self.at_start = self.at_end = True
+        self.last_id = 0
+
+    def load(self, from_end=False):
+        """ Replace the window with the first page, or the last one. Returns the rows """
+        last_id = db.get_last_transaction_id(self.db_file)
+        if self.where is None:
+            total = db.count_transactions(self.db_file)
+        else:
+            total = db.count_transactions(self.db_file, self.count_where, COUNT_LIMIT + 1)
+        if from_end:
+            rows = db.fetch_transactions_page(self.db_file, before=MAX_KEY, limit=self.page_size, where=self.where)
+        else:
+            rows = db.fetch_transactions_page(self.db_file, after=self.start_key, limit=self.page_size, where=self.where)
+        return self.reset(rows, total, last_id, from_end)
+
+    def reset(self, rows, total, last_id, from_end=False):
+        """ Replace the window with a page read elsewhere (see search.SearchWorker). Returns the rows """
+        self.last_id = last_id
+        self.total_capped = self.where is not None and total > COUNT_LIMIT
+        self.total = min(total, COUNT_LIMIT) if self.total_capped else total
+        self.rows = rows
+        self.keys = [row_key(row) for row in self.rows]
+        # From the end of a capped count the position is unknown; it is counted from the start
+        self.offset = max(self.total - len(self.rows), 0) if from_end and not self.total_capped else 0
+        if self.total_capped:
+            self.at_start = not from_end or len(rows) < self.page_size
+            self.at_end = from_end or len(rows) < self.page_size
+        else:
+            self.at_start = self.offset == 0
+            self.at_end = self.offset + len(self.rows) >= self.total
+        return self.rows
+
+    def forward(self):
+        """ Append the next page. Returns (rows appended, number of rows dropped from the start) """
+        if self.at_end or not self.rows:
+            return [], 0
+        page = db.fetch_transactions_page(self.db_file, after=self.keys[-1], limit=self.page_size, where=self.where)
+        self.at_end = len(page) < self.page_size
+        self.rows.extend(page)
+        self.keys.extend(row_key(row) for row in page)
+        dropped = max(len(self.rows) - self.max_rows, 0)
+        if dropped:
+            del self.rows[:dropped], self.keys[:dropped]
+            self.offset += dropped
+            self.at_start = False
+        return page, dropped
+
+    def backward(self):
+        """ Prepend the previous page. Returns (rows prepended, number of rows dropped from the end) """
+        if self.at_start or not self.rows:
+            return [], 0
+        page = db.fetch_transactions_page(self.db_file, before=self.keys[0], limit=self.page_size, where=self.where)
+        self.at_start = len(page) < self.page_size
+        self.rows[:0] = page
+        self.keys[:0] = [row_key(row) for row in page]
+        self.offset = 0 if self.at_start else self.offset - len(page)
+        dropped = max(len(self.rows) - self.max_rows, 0)
+        if dropped:
+            del self.rows[-dropped:], self.keys[-dropped:]
+            self.at_end = False
+        return page, dropped
+
+    def sync(self):
+        """ Merge the transactions added since the last load or sync.
+
+        Returns [(position in the window, row)] for the rows that fall inside the
+        window, in insertion order; the others only move offset and total.
+        """
+        new = db.fetch_transactions_since(self.db_file, self.last_id, self.where)
+        inserted = []
+        for row in new:
+            self.last_id = max(self.last_id, row[0])
+            if not self.total_capped:
+                self.total += 1
+            key = row_key(row)
+            position = bisect.bisect(self.keys, key)
+            if position == 0 and not self.at_start:
+                self.offset += 1
+            elif position == len(self.keys) and not self.at_end:
+                continue
+            else:
+                self.rows.insert(position, row)
+                self.keys.insert(position, key)
+                inserted.append((position, row))
+        return inserted
+
+    def refresh(self, transaction_ids):
+        """ Put right the rows of transaction_ids, edited, deleted or brought back since they were read.
+
+        Returns (ids of the rows taken out of the window, [(position, row)] of the rows put in), in that order.
+        """
+        ids = set(transaction_ids)
+        removed = [row[0] for row in self.rows if row[0] in ids]
+        if removed:
+            kept = [position for position, row in enumerate(self.rows) if row[0] not in ids]
+            self.rows = [self.rows[position] for position in kept]
+            self.keys = [self.keys[position] for position in kept]
+        inserted = []
+        for row in db.fetch_transactions_by_id(self.db_file, ids, self.where):
+            # Brought back with its old id, which sync() must not merge in a second time
+            self.last_id = max(self.last_id, row[0])
+            key = row_key(row)
+            position = bisect.bisect(self.keys, key)
+            if self.rows and ((position == 0 and not self.at_start) or (position == len(self.keys) and not self.at_end)):
+                continue
+            self.rows.insert(position, row)
+            self.keys.insert(position, key)
+            inserted.append((position, row))
+        # The transactions before the window, and all of them, are counted again
+        limit = None if self.where is None else COUNT_LIMIT + 1
+        total = db.count_transactions(self.db_file, self.count_where, limit)
+        self.total_capped = self.where is not None and total > COUNT_LIMIT
+        self.total = min(total, COUNT_LIMIT) if self.total_capped else total
+        self.offset = 0
+        if self.rows and not self.at_start:
+            condition, params = self.count_where or ("1", ())
+            self.offset = db.count_transactions(self.db_file, (f"(t.date, t.id) < (?, ?) AND ({condition})",
+                                                               (*self.keys[0], *params)), limit)
+        return removed, inserted
@@ -0,0 +1,249 @@
+"""
+Local price-history cache.
+
+Daily closes are downloaded once and stored in the prices table. For every
+asset market, price_ranges records the date spans that have already been
+downloaded, so a later request only fetches the gaps. Today is never recorded
+as downloaded, since its close is not final yet.
+
+Where the prices come from is decided by the data source linked to the asset
+market, or to its asset. Fetchers are looked up by data source name in
+FETCHERS, and register_fetcher() can replace them, for instance with a
+DictFetcher standing in for yfinance in tests.
+"""
+import datetime
+import json
+import urllib.parse
+import urllib.request
+
+import db
+
+
+class PriceFetcher:
+    """ Downloads daily closes for one data source """
+
+    def fetch(self, symbol, start_date, end_date):
+        """ Return (YYYY-MM-DD, close) pairs for the days between start_date and end_date, both included """
+        raise NotImplementedError
+
+
+class ManualEntryFetcher(PriceFetcher):
+    """ Prices typed in by the user with add_price(): there is nothing to download """
+
+    def fetch(self, symbol, start_date, end_date):
+        return []
+
+
+class YFinanceFetcher(PriceFetcher):
+    """ Daily closes from Yahoo Finance, through the optional yfinance package """
+
+    def fetch(self, symbol, start_date, end_date):
+        try:
+            import yfinance
+        except ImportError:
+            raise ImportError("yfinance is needed to download prices: conda install -c conda-forge yfinance")
+        # yfinance's end date is exclusive
+        end = datetime.date.fromisoformat(end_date) + datetime.timedelta(days=1)
+        history = yfinance.Ticker(symbol).history(start=start_date, end=end.isoformat(), auto_adjust=False)
+        return [(day.strftime("%Y-%m-%d"), float(close)) for day, close in history["Close"].items()]
+
+
+class DictFetcher(PriceFetcher):
+    """ Serves prices from a {symbol: {date: close}} dictionary, for tests and offline use """
+
+    def __init__(self, prices):
+        self.prices = prices
+        self.calls = []
+
+    def fetch(self, symbol, start_date, end_date):
+        self.calls.append((symbol, start_date, end_date))
+        return sorted((date, close) for date, close in self.prices.get(symbol, {}).items()
+                      if start_date <= date <= end_date)
+
+
+class HttpJsonFetcher(PriceFetcher):
+    """ Reads closes from an HTTP endpoint answering GET {base_url}/{symbol}?start=...&end=...
+    with a JSON list of [date, close] pairs. Handy for a local stub server in tests.
+    """
+
+    def __init__(self, base_url, timeout=30):
+        self.base_url = base_url.rstrip("/")
+        self.timeout = timeout
+
+    def fetch(self, symbol, start_date, end_date):
+        query = urllib.parse.urlencode({"start": start_date, "end": end_date})
+        url = f"{self.base_url}/{urllib.parse.quote(symbol)}?{query}"
+        with urllib.request.urlopen(url, timeout=self.timeout) as response:
+            return [(date, float(close)) for date, close in json.load(response)]
+
+
+FETCHERS = {
+    "yfinance": YFinanceFetcher(),
+    "manual_entry": ManualEntryFetcher(),
+}
+
+
+def register_fetcher(source, fetcher):
+    """ Use fetcher for the data source named source """
+    FETCHERS[source] = fetcher
+
+
+# user_settings key naming the data source exchange rates are downloaded from
+FX_SOURCE_SETTING = "fx_data_source"
+DEFAULT_FX_SOURCE = "yfinance"
+
+
+def fx_symbol(from_code, to_code):
+    """ The symbol of a currency pair, as Yahoo Finance spells it """
+    return f"{from_code}{to_code}=X"
+
+
+def _day(date, days):
+    return (datetime.date.fromisoformat(date) + datetime.timedelta(days=days)).isoformat()
+
+
+def missing_ranges(cached, start_date, end_date):
+    """ The spans of [start_date, end_date] not covered by the sorted (start, end) spans in cached """
+    gaps = []
+    cursor = start_date
+    for start, end in cached:
+        if end < cursor:
+            continue
+        if start > end_date:
+            break
+        if start > cursor:
+            gaps.append((cursor, _day(start, -1)))
+        cursor = max(cursor, _day(end, 1))
+    if cursor <= end_date:
+        gaps.append((cursor, end_date))
+    return gaps
+
+
+def merge_ranges(ranges):
+    """ Merge overlapping or adjacent (start, end) spans """
+    merged = []
+    for start, end in sorted(ranges):
+        if merged and start <= _day(merged[-1][1], 1):
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+    return merged
+
+
+def get_cached_ranges(db_file, asset_market_id):
+    return db.get_db(db_file).fetchall("SELECT start_date, end_date FROM price_ranges WHERE asset_market_id = ? ORDER BY start_date",
+                                       (asset_market_id,))
+
+
+def get_price_source(db_file, asset_market_id):
+    """ Return (data source name, symbol) for an asset market, or (None, symbol) if it has no data source.
+
+    The data source linked to the asset market wins; -1 or nothing there means
+    the one linked to the asset is used. A data source is stored either as the
+    id of a data_sources row or directly by name.
+    """
+    row = db.get_db(db_file).fetchone('''SELECT am.data_source_id, dam.source, a.data_source_id, da.source, a.symbol
+                                         FROM asset_markets am
+                                         JOIN assets a ON am.asset_id = a.id
+                                         LEFT JOIN data_sources dam ON dam.id = am.data_source_id
+                                         LEFT JOIN data_sources da ON da.id = a.data_source_id
+                                         WHERE am.id = ?''', (asset_market_id,))
+    if row is None:
+        return None, None
+    market_source, market_source_name, asset_source, asset_source_name, symbol = row
+    if market_source not in (None, -1, "-1"):
+        return market_source_name or str(market_source), symbol
+    if asset_source not in (None, -1, "-1"):
+        return asset_source_name or str(asset_source), symbol
+    return None, symbol
+
+
+def _store(conn, asset_market_id, closes, start_date=None, end_date=None):
+    conn.executemany("INSERT OR REPLACE INTO prices (asset_market_id, date, close) VALUES (?, ?, ?)",
+                     ((asset_market_id, date, close) for date, close in closes))
+    if start_date is None:
+        return
+    ranges = conn.execute("SELECT start_date, end_date FROM price_ranges WHERE asset_market_id = ?",
+                          (asset_market_id,)).fetchall()
+    conn.execute("DELETE FROM price_ranges WHERE asset_market_id = ?", (asset_market_id,))
+    conn.executemany("INSERT INTO price_ranges (asset_market_id, start_date, end_date) VALUES (?, ?, ?)",
+                     ((asset_market_id, start, end) for start, end in merge_ranges(ranges + [(start_date, end_date)])))
+
+
+def store_prices(db_file, asset_market_id, closes, start_date=None, end_date=None):
+    """ Store downloaded closes and, if given, record [start_date, end_date] as downloaded """
+    database = db.get_db(db_file)
+    try:
+        with database.transaction() as conn:
+            _store(conn, asset_market_id, closes, start_date, end_date)
+    finally:
+        database.bump_generation("prices")
+
+
+def store_downloads(db_file, downloads, rates=()):
+    """ Store in one transaction the output of several download() calls, {asset_market_id: [(closes, start, end), ...]},
+    and (date, currency_from_id, currency_to_id, rate) exchange rates
+    """
+    database = db.get_db(db_file)
+    try:
+        with database.transaction() as conn:
+            for asset_market_id, chunks in downloads.items():
+                for closes, start_date, end_date in chunks:
+                    _store(conn, asset_market_id, closes, start_date, end_date)
+            conn.executemany("INSERT OR REPLACE INTO exchange_rates (date, currency_from_id, currency_to_id, rate) VALUES (?, ?, ?, ?)", rates)
+    finally:
+        database.bump_generation("prices", "exchange_rates")
+
+
+def add_price(db_file, asset_market_id, date, close):
+    """ Store a manually entered close """
+    database = db.get_db(db_file)
+    database.write("INSERT OR REPLACE INTO prices (asset_market_id, date, close) VALUES (?, ?, ?)",
+                   (asset_market_id, date, close))
+    database.bump_generation("prices")
+
+
+def download(fetcher, symbol, gaps):
+    """ Fetch every gap and return [(closes, start_date, end_date)], ready for storing.
+
+    The recorded span stops at yesterday: today's close may still change, so
+    today is fetched again next time. The span is None when there is nothing to record.
+    """
+    yesterday = (datetime.date.today() - datetime.timedelta(days=1)).isoformat()
+    chunks = []
+    for gap_start, gap_end in gaps:
+        closes = fetcher.fetch(symbol, gap_start, gap_end)
+        recorded_end = min(gap_end, yesterday)
+        if recorded_end >= gap_start:
+            chunks.append((closes, gap_start, recorded_end))
+        else:
+            chunks.append((closes, None, None))
+    return chunks
+
+
+def find_gaps(db_file, asset_market_id, start_date, end_date=None):
+    """ The spans of [start_date, end_date] (end_date at most today) that are not cached yet """
+    today = datetime.date.today().isoformat()
+    return missing_ranges(get_cached_ranges(db_file, asset_market_id), start_date, min(end_date or today, today))
+
+
+def fetch_missing(db_file, asset_market_id, start_date, end_date=None, fetcher=None):
+    """ Download the closes of [start_date, end_date] that are not cached yet.
+
+    fetcher defaults to the one registered for the asset market's data source.
+    Returns the number of closes downloaded.
+    """
+    source, symbol = get_price_source(db_file, asset_market_id)
+    fetcher = fetcher or FETCHERS.get(source)
+    if fetcher is None:
+        return 0
+    chunks = download(fetcher, symbol, find_gaps(db_file, asset_market_id, start_date, end_date))
+    store_downloads(db_file, {asset_market_id: chunks})
+    return sum(len(closes) for closes, start, end in chunks)
+
+
+def get_prices(db_file, asset_market_id, start_date, end_date=None, fetcher=None):
+    """ The cached (date, close) pairs of [start_date, end_date], downloading the missing ones first """
+    fetch_missing(db_file, asset_market_id, start_date, end_date, fetcher)
+    return db.get_db(db_file).fetchall("SELECT date, close FROM prices WHERE asset_market_id = ? AND date >= ? AND date <= ? ORDER BY date",
+                                       (asset_market_id, start_date, end_date or datetime.date.today().isoformat()))
@@ -0,0 +1,329 @@
+"""
+Opt-in instrumentation of the database layer.
+
+Nothing here runs unless enable() is called, from the PORTFOLIO_PROFILE
+environment variable (see enable_from_environment) or cli.py --profile. Once
+enabled, the Profiler records:
+
+- for every db.py function taking a db_file: the calls, a latency histogram,
+  the rows returned and the SQL it ran, as seen by the sqlite3 trace callback
+  (with the values bound, a few samples per function);
+- for every statement run through PortfolioDB (fetchall, fetchone, write,
+  execute): the calls, a latency histogram, the rows returned and the errors,
+  which db.py otherwise only prints;
+- every function or statement slower than slow_ms, in a slow log that is also
+  printed as it happens.
+
+It works by wrapping the db functions and PortfolioDB methods in place, so
+disabled it costs nothing; disable() puts the originals back. The report is
+shown by the Tk debug panel (ui.ProfilePanel) and dumped by cli.py.
+"""
+import collections
+import functools
+import json
+import os
+import re
+import sys
+import threading
+import time
+
+import db
+
+# Upper bounds of the latency histogram buckets, in milliseconds; one more bucket holds the rest
+HISTOGRAM_BOUNDS_MS = (0.1, 0.3, 1, 3, 10, 30, 100, 300, 1000, 3000)
+DEFAULT_SLOW_MS = 100.0
+SLOW_LOG_SIZE = 200
+SQL_SAMPLES = 5
+# db.py functions left alone: they are called around every other one
+NOT_INSTRUMENTED = ("get_db", "close_db")
+ENVIRONMENT_VARIABLE = "PORTFOLIO_PROFILE"
+
+
+def normalize_sql(sql):
+    """ sql on one line, with runs of whitespace collapsed """
+    return re.sub(r"\s+", " ", sql).strip()
+
+
+class Stats:
+    """ Calls, latency histogram, rows and errors of one function or statement """
+    __slots__ = ("calls", "seconds", "max_seconds", "histogram", "rows", "errors")
+
+    def __init__(self):
+        self.calls = 0
+        self.seconds = self.max_seconds = 0.0
+        self.histogram = [0] * (len(HISTOGRAM_BOUNDS_MS) + 1)
+        self.rows = 0
+        self.errors = 0
+
+    def add(self, seconds, rows=0):
+        self.calls += 1
+        self.seconds += seconds
+        self.max_seconds = max(self.max_seconds, seconds)
+        milliseconds = seconds * 1000
+        bucket = 0
+        while bucket < len(HISTOGRAM_BOUNDS_MS) and milliseconds > HISTOGRAM_BOUNDS_MS[bucket]:
+            bucket += 1
+        self.histogram[bucket] += 1
+        self.rows += rows
+
+    def percentile_ms(self, fraction):
+        """ Upper bound, in milliseconds, of the bucket holding the given fraction of the calls """
+        target = fraction * self.calls
+        seen = 0
+        for bound, count in zip(HISTOGRAM_BOUNDS_MS + (self.max_seconds * 1000,), self.histogram):
+            seen += count
+            if count and seen >= target:
+                return min(bound, self.max_seconds * 1000)
+        return self.max_seconds * 1000
+
+    def as_dict(self):
+        return {"calls": self.calls, "total_ms": self.seconds * 1000,
+                "mean_ms": self.seconds * 1000 / self.calls if self.calls else 0.0,
+                "p50_ms": self.percentile_ms(0.5), "p95_ms": self.percentile_ms(0.95),
+                "max_ms": self.max_seconds * 1000, "rows": self.rows, "errors": self.errors,
+                "histogram": dict(zip([f"<={bound}ms" for bound in HISTOGRAM_BOUNDS_MS] + ["more"], self.histogram))}
+
+
+def _row_count(result):
+    if isinstance(result, list):
+        return len(result)
+    return 1 if isinstance(result, tuple) else 0
+
+
+class Profiler:
+    """ What the instrumented database layer did, since it was enabled or reset """
+
+    def __init__(self, slow_ms=DEFAULT_SLOW_MS, log_file=None):
+        self.slow_ms = slow_ms
+        self.log_file = log_file
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.functions = collections.defaultdict(Stats)
+            self.statements = collections.defaultdict(Stats)
+            self.function_sql = collections.defaultdict(dict)
+            self.function_statements = collections.Counter()
+            self.slow = collections.deque(maxlen=SLOW_LOG_SIZE)
+            self.started = time.time()
+
+    def _stack(self):
+        stack = getattr(self._local, "stack", None)
+        if stack is None:
+            stack = self._local.stack = []
+        return stack
+
+    def record_function(self, name, seconds, rows):
+        with self._lock:
+            self.functions[name].add(seconds, rows)
+        self._check_slow("function", name, seconds)
+
+    def record_statement(self, sql, seconds, rows):
+        with self._lock:
+            self.statements[sql].add(seconds, rows)
+        self._check_slow("statement", sql, seconds)
+
+    def record_error(self, sql, error):
+        with self._lock:
+            self.statements[sql].errors += 1
+            for name in self._stack()[-1:]:
+                self.functions[name].errors += 1
+        self._log(f"query error in {self.current_function() or '?'}: {error} [{sql}]")
+
+    def trace(self, sql):
+        """ sqlite3 trace callback: count the statement against the function running on this thread """
+        name = self.current_function() or "(outside db.py)"
+        with self._lock:
+            self.function_statements[name] += 1
+            samples = self.function_sql[name]
+            if len(samples) < SQL_SAMPLES:
+                samples[normalize_sql(sql)[:500]] = None
+
+    def current_function(self):
+        stack = self._stack()
+        return stack[-1] if stack else None
+
+    def _check_slow(self, kind, name, seconds):
+        if seconds * 1000 < self.slow_ms:
+            return
+        entry = {"time": time.time(), "kind": kind, "name": name, "ms": seconds * 1000,
+                 "function": self.current_function()}
+        with self._lock:
+            self.slow.append(entry)
+        where = f" in {entry['function']}" if kind == "statement" and entry["function"] else ""
+        self._log(f"slow {kind}{where}: {entry['ms']:.1f} ms [{name}]")
+
+    def _log(self, message):
+        print(message, file=self.log_file or sys.stderr)
+
+    def report(self):
+        """ Everything recorded, as plain data: {"functions", "statements", "slow", "seconds"} """
+        with self._lock:
+            functions = {}
+            for name, stats in self.functions.items():
+                functions[name] = stats.as_dict()
+                functions[name]["statements"] = self.function_statements.get(name, 0)
+                functions[name]["sql"] = list(self.function_sql.get(name, ()))
+            for name in self.function_statements.keys() - self.functions.keys():
+                functions[name] = {"statements": self.function_statements[name], "sql": list(self.function_sql[name])}
+            return {"seconds": time.time() - self.started,
+                    "functions": functions,
+                    "statements": {sql: stats.as_dict() for sql, stats in self.statements.items()},
+                    "slow": list(self.slow)}
+
+
+_profiler = None
+_originals = {}
+
+
+def _instrument_function(profiler, name, func):
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        stack = profiler._stack()
+        stack.append(name)
+        start = time.perf_counter()
+        try:
+            result = func(*args, **kwargs)
+        finally:
+            seconds = time.perf_counter() - start
+            stack.pop()
+        profiler.record_function(name, seconds, _row_count(result))
+        return result
+    return wrapper
+
+
+def _instrument_method(profiler, method):
+    """ Time a PortfolioDB method taking (sql, params); only the outermost one, fetchall runs execute too """
+    @functools.wraps(method)
+    def wrapper(self, sql, params=()):
+        local = profiler._local
+        depth = getattr(local, "depth", 0)
+        local.depth = depth + 1
+        start = time.perf_counter()
+        try:
+            result = method(self, sql, params)
+        except db.sqlite3.Error as e:
+            profiler.record_error(normalize_sql(sql), e)
+            raise
+        finally:
+            local.depth = depth
+        if not depth:
+            rows = _row_count(result) if method.__name__ in ("fetchall", "fetchone") else 0
+            profiler.record_statement(normalize_sql(sql), time.perf_counter() - start, rows)
+        return result
+    return wrapper
+
+
+def _traced_connection(profiler, prop):
+    def connection(self):
+        conn = prop.fget(self)
+        # Connections are per thread, and so is the note that this one is traced
+        if getattr(self._local, "profiler", None) is not profiler:
+            conn.set_trace_callback(profiler.trace)
+            self._local.profiler = profiler
+        return conn
+    return property(connection)
+
+
+def _db_functions():
+    """ The db.py functions to instrument: those defined there whose first parameter is db_file """
+    import inspect  # only once profiling is enabled: it is slow to import, and main.py imports this module
+    for name, func in vars(db).items():
+        if inspect.isfunction(func) and func.__module__ == db.__name__ and name not in NOT_INSTRUMENTED:
+            parameters = list(inspect.signature(func).parameters)
+            if parameters[:1] == ["db_file"]:
+                yield name, func
+
+
+def enable(slow_ms=DEFAULT_SLOW_MS, log_file=None):
+    """ Start recording, and return the Profiler. Calling it again only changes the slow threshold """
+    global _profiler
+    if _profiler is not None:
+        _profiler.slow_ms = slow_ms
+        return _profiler
+    profiler = Profiler(slow_ms, log_file)
+    for name, func in list(_db_functions()):
+        _originals[(db, name)] = func
+        setattr(db, name, _instrument_function(profiler, name, func))
+    for name in ("execute", "fetchall", "fetchone", "write"):
+        method = vars(db.PortfolioDB)[name]
+        _originals[(db.PortfolioDB, name)] = method
+        setattr(db.PortfolioDB, name, _instrument_method(profiler, method))
+    prop = vars(db.PortfolioDB)["connection"]
+    _originals[(db.PortfolioDB, "connection")] = prop
+    db.PortfolioDB.connection = _traced_connection(profiler, prop)
+    _profiler = profiler
+    return profiler
+
+
+def disable():
+    """ Stop recording and put the original functions back. Returns the last report, or None """
+    global _profiler
+    if _profiler is None:
+        return None
+    report = _profiler.report()
+    for (owner, name), original in _originals.items():
+        setattr(owner, name, original)
+    _originals.clear()
+    with db._databases_lock:
+        databases = list(db._databases.values())
+    for database in databases:
+        with database._lock:
+            connections = list(database._connections)
+        for conn in connections:
+            conn.set_trace_callback(None)
+    _profiler = None
+    return report
+
+
+def get_profiler():
+    """ The running Profiler, or None when profiling is off """
+    return _profiler
+
+
+def enable_from_environment():
+    """ Enable profiling if PORTFOLIO_PROFILE is set: to 1, or to the slow query threshold in milliseconds """
+    value = os.environ.get(ENVIRONMENT_VARIABLE, "")
+    if value in ("", "0"):
+        return None
+    try:
+        slow_ms = float(value)
+    except ValueError:
+        slow_ms = DEFAULT_SLOW_MS
+    return enable(slow_ms if slow_ms > 1 else DEFAULT_SLOW_MS)
+
+
+def format_report(report, top=20):
+    """ The report as text: the functions and statements taking the most time, and the slow log """
+    lines = [f"{'function':<36} {'calls':>7} {'total ms':>10} {'p50 ms':>8} {'p95 ms':>8} {'max ms':>9} "
+             f"{'rows':>9} {'sql':>6} {'errors':>6}"]
+    functions = sorted(report["functions"].items(), key=lambda item: -item[1].get("total_ms", 0))
+    for name, stats in functions[:top]:
+        if "calls" not in stats:
+            lines.append(f"{name:<36} {'':>7} {'':>10} {'':>8} {'':>8} {'':>9} {'':>9} {stats['statements']:>6}")
+            continue
+        lines.append(f"{name:<36} {stats['calls']:>7} {stats['total_ms']:>10.1f} {stats['p50_ms']:>8.2f} "
+                     f"{stats['p95_ms']:>8.2f} {stats['max_ms']:>9.2f} {stats['rows']:>9} {stats['statements']:>6} "
+                     f"{stats['errors']:>6}")
+    lines.append("")
+    lines.append(f"{'statement':<60} {'calls':>7} {'total ms':>10} {'p95 ms':>8} {'rows':>9} {'errors':>6}")
+    statements = sorted(report["statements"].items(), key=lambda item: -item[1]["total_ms"])
+    for sql, stats in statements[:top]:
+        text = sql if len(sql) <= 60 else sql[:57] + "..."
+        lines.append(f"{text:<60} {stats['calls']:>7} {stats['total_ms']:>10.1f} {stats['p95_ms']:>8.2f} "
+                     f"{stats['rows']:>9} {stats['errors']:>6}")
+    if report["slow"]:
+        lines.append("")
+        lines.append(f"{len(report['slow'])} slow operation(s), the latest:")
+        for entry in report["slow"][-top:]:
+            lines.append(f"    {entry['ms']:9.1f} ms  {entry['kind']:<9} {entry['name'][:100]}")
+    return "\n".join(lines)
+
+
+def dump(path, report=None):
+    """ Write the report (default: the running profiler's) to a JSON file """
+    report = report if report is not None else _profiler.report()
+    with open(path, "w") as f:
+        json.dump(report, f, indent=1)
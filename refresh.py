@@ -0,0 +1,186 @@
+"""
+Background refresh of prices and exchange rates.
+
+RefreshScheduler downloads, on a pool of worker threads, the missing closes of
+every asset market that has a data source, and the missing exchange rates
+between the currencies in use and the primary currency. Each data source has
+its own rate limit. Nothing is written until every download is done; then the
+results are stored in a single transaction.
+
+The refresh runs on its own thread, so the Tk main loop is never blocked:
+start() it, then poll() it from the Tk thread, which checks for the result
+with after() and hands it to a callback once it is there.
+"""
+import datetime
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import db
+import models
+import networth
+import prices
+
+DEFAULT_MAX_WORKERS = 8
+# Requests per second allowed for each data source; sources not listed are not limited
+DEFAULT_RATE_LIMITS = {"yfinance": 2.0}
+
+
+class RateLimiter:
+    """ Spaces out calls, shared between threads, so that at most rate of them start per second """
+
+    def __init__(self, rate):
+        self.interval = 1.0 / rate if rate else 0.0
+        self._lock = threading.Lock()
+        self._next = 0.0
+
+    def wait(self):
+        with self._lock:
+            now = time.monotonic()
+            start = max(now, self._next)
+            self._next = start + self.interval
+        if start > now:
+            time.sleep(start - now)
+
+
+class RateLimitedFetcher(prices.PriceFetcher):
+    """ A fetcher that waits for its turn on a RateLimiter before every request """
+
+    def __init__(self, fetcher, limiter):
+        self.fetcher = fetcher
+        self.limiter = limiter
+
+    def fetch(self, symbol, start_date, end_date):
+        self.limiter.wait()
+        return self.fetcher.fetch(symbol, start_date, end_date)
+
+
+def price_targets(db_file):
+    """ (asset_market_id, data source, symbol, first transaction date) for every traded asset market with a data source """
+    rows = db.get_db(db_file).fetchall('''SELECT am.id, MIN(t.date)
+                                          FROM asset_markets am
+                                          JOIN transactions t ON t.asset_market_id = am.id
+                                          GROUP BY am.id''')
+    targets = []
+    for asset_market_id, first_date in rows:
+        source, symbol = prices.get_price_source(db_file, asset_market_id)
+        if source in prices.FETCHERS and symbol:
+            targets.append((asset_market_id, source, symbol, first_date))
+    return targets
+
+
+def rate_targets(db_file):
+    """ (currency_from_id, from code, currency_to_id, to code, first missing date) for every currency in use """
+    to_currency_id = networth.primary_currency_id(db_file)
+    if to_currency_id is None:
+        return []
+    to_code = models.currency_code(db_file, to_currency_id)
+    rows = db.get_db(db_file).fetchall('''SELECT am.currency_id, cu.code, MIN(t.date),
+                                                 (SELECT MAX(date) FROM exchange_rates
+                                                  WHERE currency_from_id = am.currency_id AND currency_to_id = ?)
+                                          FROM transactions t
+                                          JOIN asset_markets am ON t.asset_market_id = am.id
+                                          JOIN currencies cu ON am.currency_id = cu.id
+                                          WHERE am.currency_id != ?
+                                          GROUP BY am.currency_id''', (to_currency_id, to_currency_id))
+    targets = []
+    for currency_id, code, first_date, last_rate_date in rows:
+        # The last stored day is fetched again, in case it was today and its rate has moved since
+        start = max(first_date, last_rate_date or first_date)
+        targets.append((currency_id, code, to_currency_id, to_code, start))
+    return targets
+
+
+class RefreshScheduler:
+    """ Refreshes every price and exchange rate of one database on a bounded pool of worker threads """
+
+    def __init__(self, db_file, max_workers=DEFAULT_MAX_WORKERS, rate_limits=None):
+        self.db_file = db_file
+        self.max_workers = max_workers
+        self.limiters = {source: RateLimiter(rate) for source, rate in (DEFAULT_RATE_LIMITS if rate_limits is None else rate_limits).items()}
+        self.results = queue.Queue()
+        self._cancelled = threading.Event()
+        self._thread = None
+
+    def _fetcher(self, source):
+        fetcher = prices.FETCHERS[source]
+        if source in self.limiters:
+            fetcher = RateLimitedFetcher(fetcher, self.limiters[source])
+        return fetcher
+
+    def _download_prices(self, asset_market_id, source, symbol, first_date):
+        if self._cancelled.is_set():
+            return []
+        return prices.download(self._fetcher(source), symbol, prices.find_gaps(self.db_file, asset_market_id, first_date))
+
+    def _download_rates(self, source, from_id, from_code, to_id, to_code, start_date):
+        today = datetime.date.today().isoformat()
+        if self._cancelled.is_set() or start_date > today:
+            return []
+        closes = self._fetcher(source).fetch(prices.fx_symbol(from_code, to_code), start_date, today)
+        return [(date, from_id, to_id, rate) for date, rate in closes]
+
+    def refresh(self):
+        """ Download everything that is missing and store it. Runs in the calling thread; returns a summary dict """
+        started = time.perf_counter()
+        fx_source = db.get_setting(self.db_file, prices.FX_SOURCE_SETTING, prices.DEFAULT_FX_SOURCE)
+        downloads, rates, errors = {}, [], []
+        with ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="refresh") as pool:
+            futures = {}
+            for asset_market_id, source, symbol, first_date in price_targets(self.db_file):
+                futures[pool.submit(self._download_prices, asset_market_id, source, symbol, first_date)] = ("price", asset_market_id)
+            if fx_source in prices.FETCHERS:
+                for target in rate_targets(self.db_file):
+                    futures[pool.submit(self._download_rates, fx_source, *target)] = ("rate", target[1])
+            for future in as_completed(futures):
+                kind, key = futures[future]
+                try:
+                    result = future.result()
+                except Exception as e:
+                    errors.append(f"{kind} {key}: {e}")
+                    continue
+                if kind == "price":
+                    downloads[key] = result
+                else:
+                    rates.extend(result)
+
+        if self._cancelled.is_set():
+            return {"prices": 0, "rates": 0, "errors": errors, "cancelled": True,
+                    "seconds": time.perf_counter() - started}
+        prices.store_downloads(self.db_file, downloads, rates)
+        return {"prices": sum(len(closes) for chunks in downloads.values() for closes, start, end in chunks),
+                "rates": len(rates), "errors": errors, "cancelled": False,
+                "seconds": time.perf_counter() - started}
+
+    def _run(self):
+        try:
+            result = self.refresh()
+        except Exception as e:
+            result = {"prices": 0, "rates": 0, "errors": [str(e)], "cancelled": False}
+        self.results.put(result)
+
+    @property
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self):
+        """ Run refresh() on a background thread; its summary is put on self.results """
+        if not self.running:
+            self._cancelled.clear()
+            self._thread = threading.Thread(target=self._run, name="refresh-scheduler", daemon=True)
+            self._thread.start()
+        return self
+
+    def cancel(self):
+        """ Skip the downloads not started yet, and store nothing """
+        self._cancelled.set()
+
+    def poll(self, widget, on_done, interval_ms=100):
+        """ From the Tk thread: call on_done(summary) once the refresh is over, checking every interval_ms """
+        try:
+            result = self.results.get_nowait()
+        except queue.Empty:
+            widget.after(interval_ms, self.poll, widget, on_done, interval_ms)
+            return
+        on_done(result)
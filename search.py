@@ -0,0 +1,209 @@
+"""
+Transaction search, for the filter bar of the Transactions view.
+
+A TransactionFilter combines free text, matched with the asset_market_search
+full-text index (symbol, asset name and asset market name, by word prefix),
+with a location and ranges of date and price. It turns into a condition on
+the transactions that db.fetch_transactions_page pages through, so a filtered
+list scrolls like the full one.
+
+The text only looks up asset markets, a few hundred rows. How many
+transactions they hold is known from the positions table, and decides how the
+transactions are read: few of them through idx_transactions_asset_market_date,
+then sorted by date; many of them in date order through idx_transactions_date,
+stopping once a page is full, which is quicker than sorting them all. A date
+range starts the pages at its first day, and a price range can use
+idx_transactions_price.
+
+SearchWorker runs searches on a thread of its own, one at a time: a search
+submitted while another is running interrupts it, and only the result of the
+latest search is handed back, so typing never waits on a query it has
+already made obsolete.
+"""
+import datetime
+import queue
+import re
+import threading
+import time
+from dataclasses import dataclass
+
+import db
+import paging
+
+
+def fts_query(text):
+    """ The FTS5 MATCH expression for text: every word, as a prefix. None if text has no word """
+    words = re.findall(r"\w+", text)
+    if not words:
+        return None
+    return " ".join(f'"{word}"*' for word in words)
+
+
+@dataclass(slots=True)
+class TransactionFilter:
+    text: str = ""
+    location_id: int = None
+    date_from: str = None
+    date_to: str = None
+    price_min: float = None
+    price_max: float = None
+
+    @classmethod
+    def parse(cls, text="", location_id=None, date_from="", date_to="", price_min="", price_max=""):
+        """ A filter from the strings of the filter bar. Raises ValueError on a malformed date or price """
+        def date(value):
+            return datetime.date.fromisoformat(value.strip()).isoformat() if value and value.strip() else None
+
+        def price(value):
+            return float(value.replace(",", "")) if value and value.strip() else None
+
+        return cls(text.strip(), location_id, date(date_from), date(date_to), price(price_min), price(price_max))
+
+    def where(self, db_file=None, page_size=db.TRANSACTIONS_PAGE_SIZE, database=None):
+        """ The (condition, params) on the transactions t, or None when the filter lets everything through.
+
+        With db_file, a text matching many transactions gets a condition that keeps SQLite from
+        reading them all through idx_transactions_asset_market_date, see matched_transactions.
+        That is quicker to page through, but not to count: count with the condition without db_file.
+        With database too, the positions are read through it and its errors raised, see matched_transactions.
+        """
+        conditions, params = [], []
+        match = fts_query(self.text)
+        if match is not None:
+            column = "t.asset_market_id"
+            if db_file is not None:
+                matched, total = matched_transactions(db_file, match, database)
+                if matched * matched > page_size * total:
+                    # The unary + makes the column unusable for an index, so the rows are read in date order
+                    column = "+t.asset_market_id"
+            conditions.append(f"{column} IN (SELECT rowid FROM asset_market_search WHERE asset_market_search MATCH ?)")
+            params.append(match)
+        for condition, value in (("t.location_id = ?", self.location_id),
+                                 ("t.date >= ?", self.date_from), ("t.date <= ?", self.date_to),
+                                 ("t.price >= ?", self.price_min), ("t.price <= ?", self.price_max)):
+            if value is not None:
+                conditions.append(condition)
+                params.append(value)
+        if not conditions:
+            return None
+        return " AND ".join(conditions), tuple(params)
+
+    def start_key(self):
+        """ The (date, id) key the matching transactions come after. Starting pages there rather than
+        at the first transaction lets SQLite begin its index range at date_from
+        """
+        return (self.date_from, 0) if self.date_from else None
+
+
+MATCHED_TRANSACTIONS_SQL = '''SELECT (SELECT TOTAL(transaction_count) FROM positions WHERE asset_market_id IN
+                                         (SELECT rowid FROM asset_market_search WHERE asset_market_search MATCH ?)),
+                                    (SELECT TOTAL(transaction_count) FROM positions)'''
+
+
+def matched_transactions(db_file, match, database=None):
+    """ (transactions of the asset markets matching the FTS5 expression match, all transactions), from the positions.
+
+    Through database.execute when database is given, which raises an error, an interruption by SearchWorker
+    included, instead of printing it and counting (0, 0)
+    """
+    if database is not None:
+        return database.execute(MATCHED_TRANSACTIONS_SQL, (match,)).fetchone()
+    row = db.get_db(db_file).fetchone(MATCHED_TRANSACTIONS_SQL, (match,))
+    return row if row else (0, 0)
+
+
+def search(db_file, transaction_filter, page_size=db.TRANSACTIONS_PAGE_SIZE):
+    """ A TransactionWindow over the transactions matching transaction_filter, loaded with the first page """
+    window = paging.TransactionWindow(db_file, page_size, where=transaction_filter.where(db_file, page_size),
+                                      start_key=transaction_filter.start_key(), count_where=transaction_filter.where())
+    window.load()
+    return window
+
+
+class SearchWorker:
+    """ Runs searches on a thread of its own, interrupting the one running when a new one comes """
+
+    def __init__(self, db_file, page_size=db.TRANSACTIONS_PAGE_SIZE):
+        self.db_file = db_file
+        self.page_size = page_size
+        self.results = queue.Queue()
+        self._condition = threading.Condition()
+        self._pending = None
+        self._generation = 0
+        self._connection = None
+        self._polling = False
+        self._thread = threading.Thread(target=self._run, name="search", daemon=True)
+        self._thread.start()
+
+    def submit(self, transaction_filter):
+        """ Search for transaction_filter, superseding any earlier search. Returns its generation number """
+        with self._condition:
+            self._generation += 1
+            self._pending = (self._generation, transaction_filter)
+            if self._connection is not None:
+                # Makes the statement running, if any, fail with "interrupted"
+                self._connection.interrupt()
+            self._condition.notify()
+            return self._generation
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while self._pending is None:
+                    self._condition.wait()
+                generation, transaction_filter = self._pending
+                self._pending = None
+                database = db.get_db(self.db_file)
+                self._connection = database.connection
+            start = time.perf_counter()
+            try:
+                window = self._search(database, transaction_filter)
+                error = None
+            except Exception as e:
+                # Not only sqlite3.Error: anything else would end the thread, and poll() would wait for it forever
+                window, error = None, e
+            with self._condition:
+                self._connection = None
+                current = generation == self._generation
+            if current:
+                # An interrupted search always has a newer one behind it, so it never gets here with the error
+                self.results.put((generation, window, error, time.perf_counter() - start))
+
+    def _search(self, database, transaction_filter):
+        # Through execute rather than db.fetch_transactions_page, which would print the interruptions as errors
+        where = transaction_filter.where(self.db_file, self.page_size, database)
+        count_where = transaction_filter.where()
+        start_key = transaction_filter.start_key()
+        rows = database.execute(*db.transactions_page_query(start_key, limit=self.page_size, where=where)).fetchall()
+        count_limit = None if where is None else paging.COUNT_LIMIT + 1
+        total = database.execute(*db.count_transactions_query(count_where, count_limit)).fetchone()[0]
+        last_id = database.execute("SELECT COALESCE(MAX(id), 0) FROM transactions").fetchone()[0]
+        window = paging.TransactionWindow(self.db_file, self.page_size, where=where, start_key=start_key,
+                                          count_where=count_where)
+        window.reset(rows, total, last_id)
+        return window
+
+    def poll(self, widget, on_result, interval_ms=20):
+        """ From the Tk thread: call on_result(generation, window, error, seconds) for each finished search,
+        checking every interval_ms until the latest one submitted is in. Calling it again while it is
+        already checking does nothing
+        """
+        if not self._polling:
+            self._polling = True
+            self._poll(widget, on_result, interval_ms)
+
+    def _poll(self, widget, on_result, interval_ms):
+        delivered = None
+        while True:
+            try:
+                result = self.results.get_nowait()
+            except queue.Empty:
+                break
+            on_result(*result)
+            delivered = result[0]
+        with self._condition:
+            waiting = delivered != self._generation
+        if waiting:
+            widget.after(interval_ms, self._poll, widget, on_result, interval_ms)
+        else:
+            self._polling = False
@@ -0,0 +1,210 @@
+"""
+Columnar snapshots of the portfolio database, for analysis jobs.
+
+snapshot() copies the transactions, prices, exchange_rates, lots and
+lot_matches tables into a directory of Arrow IPC (or Parquet) files, one
+subdirectory per table and one part file per snapshot run:
+
+    snapshot_dir/manifest.json
+    snapshot_dir/transactions/part-00000.arrow
+    snapshot_dir/transactions/part-00001.arrow
+    ...
+
+Runs after the first one are incremental. Tables with an increasing key
+(transactions, exchange_rates, lot_matches) only get a new part with the rows
+past the last exported key, provided the rows already exported are unchanged:
+that is checked with a cheap signature (row count and column totals, weighted
+by the key), and a table whose old rows did change is written again
+from scratch. Tables without such a key (prices, lots) are written again
+whenever their signature changes.
+
+load_table() maps the Arrow files back into memory without copying them
+(Parquet files are read through a memory map too, but decoded).
+
+pyarrow is an optional dependency: conda install -c conda-forge pyarrow
+"""
+import json
+import os
+
+import db
+
+MANIFEST = "manifest.json"
+FORMATS = {"arrow": ".arrow", "parquet": ".parquet"}
+SNAPSHOT_CHUNK_SIZE = 100000
+
+# Per table: the increasing key rows are appended by (None when there is none),
+# and the exported columns with their Arrow type names
+SNAPSHOT_TABLES = {
+    "transactions": ("id", [("id", "int64"), ("asset_market_id", "int64"), ("quantity", "float64"),
+                            ("price", "float64"), ("date", "date32"), ("location_id", "int64")]),
+    "prices": (None, [("asset_market_id", "int64"), ("date", "date32"), ("close", "float64")]),
+    "exchange_rates": ("rowid", [("date", "date32"), ("currency_from_id", "int64"), ("currency_to_id", "int64"),
+                                 ("rate", "float64")]),
+    "lots": (None, [("transaction_id", "int64"), ("asset_id", "int64"), ("location_id", "int64"), ("date", "date32"),
+                    ("quantity", "float64"), ("remaining", "float64"), ("price", "float64"), ("currency_id", "int64")]),
+    "lot_matches": ("rowid", [("lot_transaction_id", "int64"), ("transaction_id", "int64"), ("asset_id", "int64"),
+                              ("location_id", "int64"), ("currency_id", "int64"), ("date", "date32"),
+                              ("quantity", "float64"), ("open_price", "float64"), ("close_price", "float64"),
+                              ("gain", "float64")]),
+}
+
+
+def _pyarrow():
+    try:
+        import pyarrow
+        import pyarrow.ipc
+        import pyarrow.parquet
+    except ImportError:
+        raise ImportError("pyarrow is needed for snapshots: conda install -c conda-forge pyarrow")
+    return pyarrow
+
+
+def _schema(pa, columns):
+    return pa.schema([(name, getattr(pa, type_name)()) for name, type_name in columns])
+
+
+def read_manifest(snapshot_dir):
+    """ The manifest of a snapshot directory: {table: {"watermark", "signature", "parts"}}, {} if there is none """
+    try:
+        with open(os.path.join(snapshot_dir, MANIFEST)) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+
+def _write_manifest(snapshot_dir, manifest):
+    path = os.path.join(snapshot_dir, MANIFEST)
+    with open(path + ".tmp", "w") as f:
+        json.dump(manifest, f, indent=1)
+    os.replace(path + ".tmp", path)
+
+
+def _signature(conn, table, key, columns, upto=None):
+    """ Row count and column totals of table (up to key upto), to tell cheaply whether rows changed.
+
+    Each value is weighted by the key of its row (by its day, for the tables without a key), so that values
+    swapped between rows, or a row moved to another day, change the totals too
+    """
+    weight = key or "julianday(date)"
+    values = [f"julianday({name})" if type_name == "date32" else name for name, type_name in columns]
+    totals = ", ".join(f"TOTAL({value} * {weight})" for value in values)
+    where = f" WHERE {key} <= {int(upto)}" if key and upto is not None else ""
+    return list(conn.execute(f"SELECT COUNT(*), {totals} FROM {table}{where}").fetchone())
+
+
+def _write_part(pa, conn, table, key, columns, path, after, file_format):
+    """ Write the rows of table past key value after (all rows if key is None) to path.
+    Returns (rows written, last key written)
+    """
+    schema = _schema(pa, columns)
+    names = ", ".join(name for name, type_name in columns)
+    if key:
+        cursor = conn.execute(f"SELECT {key}, {names} FROM {table} WHERE {key} > ? ORDER BY {key}", (after or 0,))
+    else:
+        cursor = conn.execute(f"SELECT NULL, {names} FROM {table}")
+    if file_format == "parquet":
+        writer = pa.parquet.ParquetWriter(path, schema)
+    else:
+        writer = pa.ipc.new_file(path, schema)
+    written, last = 0, after
+    try:
+        while True:
+            rows = cursor.fetchmany(SNAPSHOT_CHUNK_SIZE)
+            if not rows:
+                break
+            keys, *values = zip(*rows)
+            arrays = []
+            for (name, type_name), column in zip(columns, values):
+                if type_name == "date32":
+                    arrays.append(pa.array(column, pa.string()).cast(pa.date32()))
+                else:
+                    arrays.append(pa.array(column, schema.field(name).type))
+            batch = pa.RecordBatch.from_arrays(arrays, schema=schema)
+            if file_format == "parquet":
+                writer.write_batch(batch)
+            else:
+                writer.write(batch)
+            written += len(rows)
+            last = keys[-1]
+    finally:
+        writer.close()
+    return written, last
+
+
+def snapshot(db_file, snapshot_dir, file_format="arrow", full=False, tables=None):
+    """ Bring the snapshot in snapshot_dir up to date with db_file.
+
+    Returns {table: rows written}; a table left untouched writes 0 rows.
+    """
+    pa = _pyarrow()
+    if file_format not in FORMATS:
+        raise ValueError(f"Unknown snapshot format {file_format!r}, expected one of {sorted(FORMATS)}")
+    os.makedirs(snapshot_dir, exist_ok=True)
+    manifest = read_manifest(snapshot_dir)
+    written = {}
+    conn = db.get_db(db_file).connection
+    for table in tables or SNAPSHOT_TABLES:
+        key, columns = SNAPSHOT_TABLES[table]
+        # The parts written before, in any format, are removed once the table is written again from scratch
+        previous = manifest.get(table)
+        entry = None if full or (previous and previous.get("format") != file_format) else previous
+        # A read transaction, so the signature and the rows exported agree
+        conn.execute("BEGIN")
+        try:
+            if entry and _signature(conn, table, key, columns, entry["watermark"]) == entry["signature"]:
+                if not key:
+                    written[table] = 0
+                    continue
+                append = True
+            else:
+                append = False
+            table_dir = os.path.join(snapshot_dir, table)
+            os.makedirs(table_dir, exist_ok=True)
+            old_parts = previous["parts"] if previous else []
+            number = previous["next_part"] if previous else 0
+            part = f"part-{number:05d}{FORMATS[file_format]}"
+            count, last = _write_part(pa, conn, table, key, columns, os.path.join(table_dir, part),
+                                      entry["watermark"] if append else None, file_format)
+            if append and not count:
+                os.remove(os.path.join(table_dir, part))
+                written[table] = 0
+                continue
+            manifest[table] = {
+                "format": file_format,
+                "watermark": last,
+                "signature": _signature(conn, table, key, columns, last),
+                "parts": (old_parts if append else []) + [part],
+                "next_part": number + 1,
+            }
+        finally:
+            conn.execute("COMMIT")
+        _write_manifest(snapshot_dir, manifest)
+        if not append:
+            for stale in old_parts:
+                try:
+                    os.remove(os.path.join(table_dir, stale))
+                except FileNotFoundError:
+                    pass
+        written[table] = count
+    return written
+
+
+def load_table(snapshot_dir, table):
+    """ A table of the snapshot as a pyarrow Table. Arrow parts are memory-mapped, not copied """
+    pa = _pyarrow()
+    entry = read_manifest(snapshot_dir).get(table)
+    if entry is None:
+        return _schema(pa, SNAPSHOT_TABLES[table][1]).empty_table()
+    pieces = []
+    for part in entry["parts"]:
+        path = os.path.join(snapshot_dir, table, part)
+        if part.endswith(".parquet"):
+            pieces.append(pa.parquet.read_table(path, memory_map=True))
+        else:
+            pieces.append(pa.ipc.open_file(pa.memory_map(path, "r")).read_all())
+    return pa.concat_tables(pieces)
+
+
+def load_frame(snapshot_dir, table):
+    """ A table of the snapshot as a pandas DataFrame """
+    return load_table(snapshot_dir, table).to_pandas()
@@ -0,0 +1,236 @@
+"""
+Italian capital gains tax estimate.
+
+A rough estimate, in euro, built on the realized LIFO gains (see lifo.py).
+Each closing transaction's gain is converted to euro at the rate of its day
+and then:
+
+- gains and losses of harmonised assets (and of assets whose status is not
+  known), together with the losses of non-harmonised ETFs, are netted within
+  the year ("redditi diversi"); a net gain is first reduced by the losses
+  carried forward from the four previous years, oldest first, and a net loss
+  is carried forward;
+- gains of non-harmonised ETFs ("redditi di capitale") are taxed in full and
+  cannot be offset by any loss.
+
+Both are taxed at TAX_RATE. Each year's result is cached in the tax_years
+table together with a checksum of what it was computed from (a hash of the
+year's LIFO matches with the harmonised status of their assets, the exchange
+rates up to the end of the year and the losses carried in), so only the years
+touched by new or back-dated transactions, and those after them whose carried
+losses change, are computed again.
+
+what_if_sell() estimates the tax of a sale that has not happened, without
+writing anything, from the lots as they were last matched.
+"""
+import datetime
+import hashlib
+import json
+from collections import defaultdict
+
+import db
+import fx
+import lifo
+from utils import to_days
+
+TAX_RATE = 0.26
+LOSS_CARRY_YEARS = 4
+TAX_CURRENCY = "EUR"
+
+# Net gain of each closing transaction of a year, in the currency of its asset market
+YEAR_SALES_SQL = '''SELECT m.transaction_id, m.date, m.currency_id, COALESCE(a.is_harmonised, 1), SUM(m.gain)
+                    FROM lot_matches m
+                    JOIN assets a ON m.asset_id = a.id
+                    WHERE m.date >= ? AND m.date <= ?
+                    GROUP BY m.transaction_id'''
+
+# Everything of a year's matches its estimate depends on, as one string built by SQLite, along idx_lot_matches_date
+YEAR_MATCHES_SQL = '''SELECT group_concat(printf('%d %s %d %d %!.17g', m.transaction_id, m.date, m.currency_id,
+                                           COALESCE(a.is_harmonised, 1), m.gain), ';')
+                      FROM lot_matches m
+                      JOIN assets a ON m.asset_id = a.id
+                      WHERE m.date >= ? AND m.date <= ?'''
+
+
+def _year_bounds(year):
+    return f"{year}-01-01", f"{year}-12-31"
+
+
+def year_signatures(db_file):
+    """ {year: signature} of what each year's estimate depends on: a hash of the year's LIFO matches,
+    together with the currency and harmonised status of each, and the exchange rates up to its end
+    """
+    database = db.get_db(db_file)
+    first, last = database.fetchone("SELECT MIN(date), MAX(date) FROM lot_matches")
+    if first is None:
+        return {}
+    rates_by_year = database.fetchall("SELECT substr(date, 1, 4), COUNT(*), TOTAL(rate), MAX(date) "
+                                      "FROM exchange_rates GROUP BY 1 ORDER BY 1")
+    signatures = {}
+    rates = [0, 0.0, None]
+    for year in range(int(first[:4]), int(last[:4]) + 1):
+        # The rows themselves: sums of them stay the same for edits that offset each other. Rows of the same day
+        # come in rowid order, so matching a day again may change the hash but never leaves it the same for new rows
+        matches = database.fetchone(YEAR_MATCHES_SQL, _year_bounds(year))
+        digest = hashlib.blake2b(((matches and matches[0]) or "").encode(), digest_size=16).hexdigest()
+        while rates_by_year and int(rates_by_year[0][0]) <= year:
+            year_rates = rates_by_year.pop(0)
+            rates = [rates[0] + year_rates[1], rates[1] + year_rates[2], year_rates[3]]
+        signatures[year] = [digest, rates]
+    return signatures
+
+
+def checksum(signature, carry_in):
+    """ The checksum a year's cached estimate is stored with """
+    payload = json.dumps([signature, sorted(carry_in.items())])
+    return hashlib.blake2b(payload.encode(), digest_size=16).hexdigest()
+
+
+def year_sales(db_file, year):
+    """ [(closing transaction id, date, currency_id, is_harmonised, gain)] realized in year """
+    return db.get_db(db_file).fetchall(YEAR_SALES_SQL, _year_bounds(year))
+
+
+def to_tax_currency(service, sales, tax_currency_id):
+    """ The gains of sales converted to the tax currency on their day, as a list; None where no rate is known """
+    if not sales:
+        return []
+    if tax_currency_id is None:
+        return [None] * len(sales)
+    transaction_ids, dates, currency_ids, flags, gains = zip(*sales)
+    currency_ids = [-1 if currency_id is None else currency_id for currency_id in currency_ids]
+    converted = service.convert(gains, currency_ids, to_days(dates), tax_currency_id)
+    return [None if value != value else float(value) for value in converted]
+
+
+def compute_year(year, sales, converted, carry_in):
+    """ The estimate of one year, from its sales, their gains in euro and the losses carried in {origin year: amount} """
+    diversi = capital = unconverted = 0.0
+    for (transaction_id, date, currency_id, is_harmonised, gain), gain_eur in zip(sales, converted):
+        if gain_eur is None:
+            unconverted += gain
+        elif is_harmonised or gain_eur < 0:
+            diversi += gain_eur
+        else:
+            capital += gain_eur
+
+    # Losses older than LOSS_CARRY_YEARS have expired
+    carry = {origin: amount for origin, amount in carry_in.items() if int(origin) >= year - LOSS_CARRY_YEARS}
+    losses_used = 0.0
+    if diversi > 0:
+        for origin in sorted(carry, key=int):
+            used = min(carry[origin], diversi - losses_used)
+            carry[origin] -= used
+            losses_used += used
+        carry = {origin: amount for origin, amount in carry.items() if amount > 1e-9}
+    elif diversi < 0:
+        carry[str(year)] = -diversi
+    taxable = max(diversi - losses_used, 0.0) + capital
+    return {
+        "year": year,
+        "redditi_diversi": diversi,
+        "redditi_di_capitale": capital,
+        "losses_used": losses_used,
+        "taxable": taxable,
+        "tax": taxable * TAX_RATE,
+        "unconverted_gains": unconverted,
+        "carry_out": carry,
+    }
+
+
+def _tax_currency_id(db_file):
+    return next((currency_id for currency_id, code, name in db.get_currencies(db_file) if code == TAX_CURRENCY), None)
+
+
+def estimate_years(db_file, last_year=None, persist=True):
+    """ The estimate of every year from the first realized gain to last_year (default: this year).
+
+    Years whose checksum matches the cached one are not computed again. With persist False, nothing is
+    written: the lots are not brought up to date, and the years computed are not cached.
+    """
+    if persist:
+        lifo.get_engine(db_file).sync()
+    last_year = last_year or datetime.date.today().year
+    signatures = year_signatures(db_file)
+    if not signatures:
+        return []
+    database = db.get_db(db_file)
+    cached = {year: (stored, result) for year, stored, result in
+              database.fetchall("SELECT year, checksum, result FROM tax_years")}
+    service = tax_currency_id = None
+    results, carry = [], {}
+    for year in range(min(signatures), last_year + 1):
+        # Years past the last match still depend on the losses carried into them
+        year_checksum = checksum(signatures.get(year), carry)
+        if year in cached and cached[year][0] == year_checksum:
+            result = json.loads(cached[year][1])
+        else:
+            if service is None:
+                service, tax_currency_id = fx.FxService.load(db_file), _tax_currency_id(db_file)
+            sales = year_sales(db_file, year)
+            result = compute_year(year, sales, to_tax_currency(service, sales, tax_currency_id), carry)
+            if persist:
+                database.write("INSERT OR REPLACE INTO tax_years (year, checksum, result) VALUES (?, ?, ?)",
+                               (year, year_checksum, json.dumps(result)))
+        results.append(result)
+        carry = result["carry_out"]
+    return results
+
+
+def estimate(db_file, year=None):
+    """ The estimate of one year (default: this year) """
+    year = year or datetime.date.today().year
+    results = estimate_years(db_file, year)
+    return results[-1] if results else compute_year(year, [], [], {})
+
+
+def what_if_sell(db_file, asset_market_id, quantity, price, date):
+    """ Estimate the tax of selling quantity of an asset market at price on date, without writing anything:
+    the other sales are those of the lots as last matched, and the years are estimated without being cached.
+
+    The sale's stack is matched again in memory with the sale added, so a
+    back-dated sale changes the later matches too. Returns the sale's gain and,
+    for every year from the sale's on, the tax before and after. Raises ValueError for an unknown asset market
+    """
+    database = db.get_db(db_file)
+    row = database.fetchone('''SELECT am.asset_id, am.location_id, am.currency_id, COALESCE(a.is_harmonised, 1)
+                               FROM asset_markets am JOIN assets a ON am.asset_id = a.id WHERE am.id = ?''',
+                            (asset_market_id,))
+    if row is None:
+        raise ValueError(f"Unknown asset_market_id: {asset_market_id}")
+    asset_id, location_id, currency_id, is_harmonised = row
+    baseline = {result["year"]: result for result in
+                estimate_years(db_file, max(int(date[:4]), datetime.date.today().year), persist=False)}
+    key = (asset_id, location_id)
+
+    # The whole stack, with the sale after whatever else happened on its day
+    transactions = [(row[1], 0, row[0], row[2], row[3], row[4]) for row in
+                    database.fetchall(lifo.STACK_TRANSACTIONS_SQL, (asset_id, location_id, ""))]
+    transactions.append((date, 1, 0, -abs(quantity), price, currency_id))
+    service = fx.FxService.load(db_file)
+    convert = lifo.Converter(db_file, service)
+    stack, matches = [], []
+    for day, order, transaction_id, amount, trade_price, trade_currency_id in sorted(transactions):
+        lifo.match(stack, transaction_id, day, amount, trade_price, trade_currency_id, key, {}, matches, convert)
+    simulated = defaultdict(float)
+    for lot_id, transaction_id, asset, location, match_currency_id, day, closed, open_price, close_price, gain in matches:
+        simulated[(transaction_id, day, match_currency_id)] += gain
+    sale_gain = sum(gain for (transaction_id, day, match_currency_id), gain in simulated.items() if transaction_id == 0)
+
+    stack_transactions = {row[2] for row in transactions}
+    tax_currency_id = _tax_currency_id(db_file)
+    sale_year = int(date[:4])
+    carry = baseline[sale_year - 1]["carry_out"] if sale_year - 1 in baseline else {}
+    years = []
+    # From the sale's year on, even if it comes before the first year with gains
+    for year in range(sale_year, max(max(baseline, default=sale_year), sale_year) + 1):
+        start, end = _year_bounds(year)
+        sales = [sale for sale in year_sales(db_file, year) if sale[0] not in stack_transactions]
+        sales += [(transaction_id, day, match_currency_id, is_harmonised, gain)
+                  for (transaction_id, day, match_currency_id), gain in simulated.items() if start <= day <= end]
+        result = compute_year(year, sales, to_tax_currency(service, sales, tax_currency_id), carry)
+        before = baseline[year]["tax"] if year in baseline else 0.0
+        years.append({"year": year, "tax_before": before, "tax_after": result["tax"], "delta": result["tax"] - before})
+        carry = result["carry_out"]
+    return {"gain": sale_gain, "currency_id": currency_id, "years": years,
+            "tax_delta": sum(year["delta"] for year in years)}
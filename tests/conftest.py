@@ -0,0 +1,70 @@
+import datetime
+import random
+
+import pytest
+
+import db
+
+
+@pytest.fixture
+def db_file(tmp_path):
+    """ A new database with every table, closed again after the test """
+    db_file = str(tmp_path / "portfolio.db")
+    db.create_tables(db_file)
+    yield db_file
+    db.close_db(db_file)
+
+
+@pytest.fixture
+def asset_markets(db_file):
+    """ Two asset markets in EUR at one location, as [(asset_market_id, location_id)] """
+    currency_id = db.add_currency(db_file, "EUR", "Euro")
+    market_id = db.add_market(db_file, "TEST", "Test market")
+    location_id = db.add_location(db_file, "Broker", "")
+    pairs = []
+    for i in range(2):
+        asset_id = db.add_asset(db_file, f"Asset {i}", f"SYM{i}", "stock", "", True)
+        pairs.append((db.add_asset_market(db_file, location_id, f"SYM{i}@TEST", "", asset_id, market_id, currency_id),
+                      location_id))
+    return pairs
+
+
+def _synthetic_transactions(pairs, n, seed=0, start=datetime.date(2014, 1, 1), days=3650):
+    """ n random transaction tuples over pairs, in date order, in the order expected by db.add_transaction """
+    rng = random.Random(seed)
+    rows = []
+    for i in range(n):
+        asset_market_id, location_id = rng.choice(pairs)
+        quantity = rng.randint(1, 100)
+        if rng.random() < 0.3:
+            quantity = -quantity
+        date = (start + datetime.timedelta(days=i * days // n)).isoformat()
+        rows.append((asset_market_id, quantity, round(rng.uniform(1, 500), 2), date, location_id))
+    return rows
+
+
+def _write_flex_csv(path, n, n_symbols=20, seed=0):
+    """ Write a Flex Query trades CSV of n random trades, with TransactionIDs from 1000000 on """
+    rng = random.Random(seed)
+    start = datetime.date(2014, 1, 1)
+    with open(path, "w", newline="") as f:
+        f.write("ClientAccountID,AssetClass,Symbol,Description,CurrencyPrimary,ListingExchange,DateTime,Quantity,"
+                "TradePrice,TransactionID\n")
+        for i in range(n):
+            symbol = rng.randrange(n_symbols)
+            date = start + datetime.timedelta(days=i * 3650 // n)
+            f.write(f"U1234567,STK,SYM{symbol},Synthetic {symbol},{'USD' if symbol % 3 else 'EUR'},NASDAQ,"
+                    f"{date:%Y%m%d};101500,{rng.randint(-50, 100) or 1},{rng.uniform(1, 500):.2f},{1000000 + i}\n")
+    return path
+
+
+@pytest.fixture
+def synthetic_transactions():
+    """ The generator of random transactions: synthetic_transactions(pairs, n, seed=0) """
+    return _synthetic_transactions
+
+
+@pytest.fixture
+def write_flex_csv():
+    """ The writer of random Flex Query statements: write_flex_csv(path, n, n_symbols=20, seed=0) """
+    return _write_flex_csv
@@ -0,0 +1,70 @@
+import os
+
+import numpy as np
+import pytest
+
+import analytics
+import db
+
+
+def xirr(flows):
+    """ The XIRR of each list of (years, amount) flows, solved together """
+    series = np.concatenate([np.full(len(each), i) for i, each in enumerate(flows)])
+    years = np.array([year for each in flows for year, amount in each], dtype=float)
+    amounts = np.array([amount for each in flows for year, amount in each], dtype=float)
+    return analytics.xirr(series, years, amounts, len(flows))
+
+
+def test_xirr_converges_for_many_series_at_once():
+    flows = [
+        [(0, -100.0), (1, 110.0)],
+        [(0, -1000.0), (0.5, -1000.0), (1, 2200.0)],
+        # Far from the first guess of 10%
+        [(0, -100.0), (1, 1000.0)],
+        [(0, -100.0), (2, 50.0)],
+    ]
+    rates = xirr(flows)
+    assert rates[0] == pytest.approx(0.10)
+    assert rates[2] == pytest.approx(9.0)
+    for rate, each in zip(rates, flows):
+        # Compounded yearly, the flows discount to zero at the rate found
+        assert sum(amount / (1 + rate) ** year for year, amount in each) == pytest.approx(0, abs=1e-6)
+
+
+def test_xirr_is_nan_without_a_rate():
+    rates = xirr([[(0, -100.0), (1, -10.0)], [(0, 100.0), (1, 10.0)], [(0, -100.0), (1, 105.0)]])
+    assert np.isnan(rates[:2]).all()
+    assert rates[2] == pytest.approx(0.05)
+
+
+@pytest.fixture
+def priced_asset_market(db_file, asset_markets):
+    """ An asset market closing at 10, then 11 and 12.1 on the days after """
+    (asset_market_id, location_id), _ = asset_markets
+    for date, close in (("2024-01-01", 10.0), ("2024-01-02", 11.0), ("2024-01-03", 12.1)):
+        db.get_db(db_file).write("INSERT INTO prices (asset_market_id, date, close) VALUES (?, ?, ?)",
+                                 (asset_market_id, date, close))
+    return asset_market_id, location_id
+
+
+def test_time_weighted_return_leaves_out_the_money_added(db_file, priced_asset_market):
+    asset_market_id, location_id = priced_asset_market
+    db.add_transaction(db_file, asset_market_id, 10, 10.0, "2024-01-01", location_id)
+    # Ten times as much bought after the first 10% gain: the second 10% is made on far more money
+    db.add_transaction(db_file, asset_market_id, 100, 11.0, "2024-01-02", location_id)
+    summary = analytics.analyze(db_file, end_date="2024-01-03").summary
+    row = summary.loc[("asset_market", asset_market_id)]
+    assert row["twr"] == pytest.approx(0.21)
+    assert row["invested"] == pytest.approx(1200.0)
+    assert row["value"] == pytest.approx(110 * 12.1)
+    assert summary.loc[("portfolio", 0), "twr"] == pytest.approx(0.21)
+
+
+def test_results_are_cached_per_file_however_it_is_spelled(db_file, priced_asset_market, monkeypatch):
+    asset_market_id, location_id = priced_asset_market
+    db.add_transaction(db_file, asset_market_id, 10, 10.0, "2024-01-01", location_id)
+    monkeypatch.chdir(os.path.dirname(db_file))
+    first = analytics.analyze(db_file, end_date="2024-01-03")
+    assert analytics.analyze(os.path.join(".", os.path.basename(db_file)), end_date="2024-01-03") is first
+    db.add_transaction(db_file, asset_market_id, 10, 11.0, "2024-01-02", location_id)
+    assert analytics.analyze(db_file, end_date="2024-01-03") is not first
@@ -0,0 +1,101 @@
+import pytest
+
+import cash
+import db
+
+
+def full_scan(db_file, location_id, currency_id, date):
+    """ The balance at the end of date, adding up every movement up to it """
+    return sum(amount for _, _, amount, _, _ in cash.get_movements(db_file, location_id, currency_id, date_to=date))
+
+
+@pytest.fixture
+def ledger(db_file, asset_markets, synthetic_transactions, monkeypatch):
+    """ db_file with 400 transactions and a few deposits at one location, checkpointed every 20 movements """
+    monkeypatch.setattr(cash, "CHECKPOINT_EVERY", 20)
+    (_, location_id), _ = asset_markets
+    currency_id = db.get_db(db_file).fetchone("SELECT id FROM currencies WHERE code = 'EUR'")[0]
+    db.add_transactions_bulk(db_file, synthetic_transactions(asset_markets, 400))
+    for year in range(2014, 2024, 2):
+        cash.add_movement(db_file, location_id, currency_id, 10000.0, f"{year}-06-30", "Deposit")
+    return db_file, location_id, currency_id
+
+
+def test_trades_book_their_cash_leg(db_file, asset_markets):
+    (asset_market_id, location_id), _ = asset_markets
+    db.add_transaction(db_file, asset_market_id, 10, 5.0, "2020-01-01", location_id)
+    db.add_transaction(db_file, asset_market_id, -4, 7.5, "2020-02-01", location_id)
+    (_, _, currency_id, code, amount), = cash.balances(db_file)
+    assert (code, amount) == ("EUR", pytest.approx(-20.0))
+    assert cash.balance_at(db_file, location_id, currency_id, "2020-01-15") == pytest.approx(-50.0)
+    assert cash.balance_at(db_file, location_id + 1, currency_id, "2020-01-15") == 0.0
+
+
+def test_balance_at_agrees_with_a_full_scan(ledger):
+    db_file, location_id, currency_id = ledger
+    assert cash.checkpoint(db_file) > 0
+    assert cash.verify(db_file) == []
+    for date in ("2013-12-31", "2014-01-01", "2016-06-30", "2018-03-15", "2023-12-31", "2030-01-01"):
+        assert cash.balance_at(db_file, location_id, currency_id, date) == \
+            pytest.approx(full_scan(db_file, location_id, currency_id, date)), date
+    (_, _, _, _, current), = cash.balances(db_file)
+    assert current == pytest.approx(full_scan(db_file, location_id, currency_id, "9999-12-31"))
+
+
+def test_back_dated_changes_correct_the_checkpoints(ledger, asset_markets):
+    db_file, location_id, currency_id = ledger
+    (asset_market_id, _), _ = asset_markets
+    cash.checkpoint(db_file)
+    cash.add_movement(db_file, location_id, currency_id, -123.0, "2014-02-01", "Fee")
+    transaction_id = db.add_transaction(db_file, asset_market_id, 3, 50.0, "2014-03-01", location_id)
+    db.update_transaction(db_file, transaction_id, price=60.0)
+    db.delete_transactions(db_file, [5])
+    assert cash.verify(db_file) == []
+    for date in ("2014-02-01", "2015-01-01", "2020-01-01"):
+        assert cash.balance_at(db_file, location_id, currency_id, date) == \
+            pytest.approx(full_scan(db_file, location_id, currency_id, date))
+
+
+def test_verify_finds_a_wrong_checkpoint_and_rebuild_fixes_it(ledger):
+    db_file, location_id, currency_id = ledger
+    cash.checkpoint(db_file)
+    db.get_db(db_file).write("UPDATE cash_snapshots SET balance = balance + 1 "
+                             "WHERE date = (SELECT date FROM cash_snapshots ORDER BY date LIMIT 1 OFFSET 2)")
+    (account_id, mismatch_currency_id, date, stored, expected), = cash.verify(db_file)
+    assert (mismatch_currency_id, stored) == (currency_id, pytest.approx(expected + 1))
+    assert cash.rebuild(db_file) > 0
+    assert cash.verify(db_file) == []
+    assert cash.balance_at(db_file, location_id, currency_id, date) == pytest.approx(expected)
+
+
+def test_a_long_replay_writes_checkpoints(ledger):
+    db_file, location_id, currency_id = ledger
+    database = db.get_db(db_file)
+    assert database.fetchone("SELECT COUNT(*) FROM cash_snapshots")[0] == 0
+    cash.balance_at(db_file, location_id, currency_id, "2030-01-01")
+    assert database.fetchone("SELECT COUNT(*) FROM cash_snapshots")[0] == 405 // 20
+    assert cash.verify(db_file) == []
+
+
+def test_migration_keeps_the_balances_stored_before(tmp_path, asset_markets, monkeypatch):
+    db_file = str(tmp_path / "old.db")
+    migrations = db.MIGRATIONS
+    cash_ledger = migrations.index(db._migration_cash_ledger)
+    monkeypatch.setattr(db, "MIGRATIONS", migrations[:cash_ledger])
+    monkeypatch.setattr(db, "SCHEMA_VERSION", cash_ledger)
+    db.create_tables(db_file)
+    try:
+        database = db.get_db(db_file)
+        eur = db.add_currency(db_file, "EUR", "Euro")
+        database.write("INSERT INTO accounts (name, type) VALUES ('Savings', 'bank')")
+        database.write("INSERT INTO account_balances (account_id, currency_id, amount) VALUES (1, ?, 1234.5)", (eur,))
+
+        monkeypatch.setattr(db, "MIGRATIONS", migrations)
+        monkeypatch.setattr(db, "SCHEMA_VERSION", len(migrations))
+        assert db.migrate(db_file) == len(migrations)
+        assert database.fetchall("SELECT account_id, currency_id, amount FROM account_balances") == [(1, eur, 1234.5)]
+        assert cash.verify(db_file) == []
+        cash.rebuild(db_file)
+        assert database.fetchall("SELECT account_id, currency_id, amount FROM account_balances") == [(1, eur, 1234.5)]
+    finally:
+        db.close_db(db_file)
@@ -0,0 +1,57 @@
+import pytest
+
+import db
+
+
+@pytest.fixture
+def old_schema(monkeypatch):
+    """ old_schema(n) makes create_tables() stop at schema version n, old_schema(None) lets migrate() go on to the
+    current one
+    """
+    migrations = db.MIGRATIONS
+
+    def at_version(n):
+        monkeypatch.setattr(db, "MIGRATIONS", migrations[:n])
+        monkeypatch.setattr(db, "SCHEMA_VERSION", len(db.MIGRATIONS))
+
+    return at_version
+
+
+def test_hot_queries_use_indexes(db_file, asset_markets, synthetic_transactions):
+    # Without ANALYZE, which the app never runs
+    db.add_transactions_bulk(db_file, synthetic_transactions(asset_markets, 500))
+    for name, (sql, params, allowed) in db.HOT_QUERIES.items():
+        assert db.explain_query_plan(db_file, sql, params), name
+    assert db.find_table_scans(db_file) == {}
+
+
+def test_a_table_scan_is_reported(db_file):
+    plan = db.explain_query_plan(db_file, "SELECT * FROM transactions WHERE quantity * price > ?", (1.0,))
+    assert any(detail.startswith("SCAN") for detail in plan)
+
+
+def test_new_database_is_at_the_current_version(db_file):
+    assert db.get_schema_version(db_file) == db.SCHEMA_VERSION
+    assert db.migrate(db_file) == db.SCHEMA_VERSION
+    db.create_tables(db_file)
+    assert db.get_schema_version(db_file) == db.SCHEMA_VERSION
+
+
+def test_migration_drops_duplicates_before_the_unique_indexes(tmp_path, old_schema):
+    db_file = str(tmp_path / "old.db")
+    old_schema(2)
+    db.create_tables(db_file)
+    database = db.get_db(db_file)
+    eur, usd = db.add_currency(db_file, "EUR", "Euro"), db.add_currency(db_file, "USD", "Dollar")
+    for rate in (1.1, 1.2):
+        database.write("INSERT INTO exchange_rates (date, currency_from_id, currency_to_id, rate) VALUES (?, ?, ?, ?)",
+                       ("2024-01-02", usd, eur, rate))
+    assert db.get_schema_version(db_file) == 2
+
+    old_schema(None)
+    try:
+        assert db.migrate(db_file) == db.SCHEMA_VERSION
+        assert database.fetchone("SELECT COUNT(*) FROM exchange_rates")[0] == 1
+        assert "SEARCH" in db.explain_query_plan(db_file, db.EXCHANGE_RATE_AS_OF_SQL, (usd, eur, "2024-01-05"))[0]
+    finally:
+        db.close_db(db_file)
@@ -0,0 +1,62 @@
+import numpy as np
+import pytest
+
+import db
+import fx
+from utils import to_day
+
+EUR, USD, GBP, CHF, JPY = 1, 2, 3, 4, 5
+
+
+@pytest.fixture
+def service():
+    """ USD->EUR and GBP->EUR, CHF->USD and JPY->GBP quotes, with EUR then USD as pivots """
+    quotes = [(USD, EUR, "2024-01-01", 0.9), (USD, EUR, "2024-01-11", 0.8),
+              (GBP, EUR, "2024-01-06", 1.2),
+              (CHF, USD, "2024-01-01", 1.1),
+              (JPY, GBP, "2024-01-01", 0.005)]
+    rate_from, rate_to, dates, rates = zip(*quotes)
+    return fx.FxService(rate_from, rate_to, [to_day(date) for date in dates], rates, pivots=(EUR, USD))
+
+
+def test_quoted_rates_are_looked_up_as_of_the_day(service):
+    assert service.rate(USD, EUR, "2023-12-31") is None
+    assert service.rate(USD, EUR, "2024-01-01") == 0.9
+    assert service.rate(USD, EUR, "2024-01-10") == 0.9
+    assert service.rate(USD, EUR, "2024-06-01") == 0.8
+    assert service.rate(EUR, EUR, "1900-01-01") == 1.0
+
+
+def test_a_pair_quoted_the_other_way_is_inverted(service):
+    assert service.rate(EUR, USD, "2024-01-05") == pytest.approx(1 / 0.9)
+    assert service.rate(EUR, USD, "2024-01-11") == pytest.approx(1 / 0.8)
+    assert service.rate(EUR, GBP, "2024-01-05") is None
+
+
+def test_other_pairs_are_crossed_through_a_pivot(service):
+    # GBP -> EUR -> USD, from the day both legs are known, on the days either moves
+    assert service.rate(GBP, USD, "2024-01-05") is None
+    assert service.rate(GBP, USD, "2024-01-06") == pytest.approx(1.2 / 0.9)
+    assert service.rate(GBP, USD, "2024-02-01") == pytest.approx(1.2 / 0.8)
+    # CHF is not quoted against EUR, so through the second pivot: CHF -> USD -> EUR
+    assert service.rate(CHF, EUR, "2024-01-02") == pytest.approx(1.1 * 0.9)
+    assert service.rate(EUR, CHF, "2024-01-02") == pytest.approx(1 / (1.1 * 0.9))
+    # Two steps from any pivot: not crossed
+    assert service.rate(JPY, USD, "2024-02-01") is None
+
+
+def test_convert_groups_by_currency(service):
+    days = [to_day(date) for date in ("2024-01-02", "2024-01-12", "2024-01-12", "2024-01-02", "2023-01-01")]
+    converted = service.convert([10, 10, 5, 7, 3], [USD, USD, GBP, EUR, USD], days, EUR)
+    np.testing.assert_allclose(converted[:4], [9.0, 8.0, 6.0, 7.0])
+    assert np.isnan(converted[4])
+
+
+def test_load_reads_the_rates_and_pivots_of_a_database(db_file):
+    eur, usd, gbp = (db.add_currency(db_file, code, code) for code in ("EUR", "USD", "GBP"))
+    db.add_exchange_rates(db_file, [("2024-01-01", usd, eur, 0.9), ("2024-01-01", gbp, eur, 1.2),
+                                    ("2024-01-01", usd, eur, 0.91)])
+    assert fx.pivot_ids(db_file) == [eur, usd]
+    service = fx.FxService.load(db_file)
+    assert service.rate(usd, eur, "2024-01-02") == 0.91
+    assert service.rate(gbp, usd, "2024-01-02") == pytest.approx(1.2 / 0.91)
@@ -0,0 +1,114 @@
+import pytest
+
+import db
+import importer
+
+ACTIVITY_CSV = """\
+Statement,Header,Field Name,Field Value
+Statement,Data,Title,Activity Statement
+Account Information,Header,Field Name,Field Value
+Account Information,Data,Account,U1234567
+Trades,Header,DataDiscriminator,Asset Category,Currency,Symbol,Description,Exchange,Date/Time,Quantity,T. Price,TradeID
+Trades,Data,Order,Stocks,USD,AAPL,APPLE INC,NASDAQ,"2024-03-01, 10:15:00","1,000",180.5,501
+Trades,Data,ClosedLot,Stocks,USD,AAPL,APPLE INC,NASDAQ,2024-01-02,-10,150,
+Trades,Data,Order,Stocks,EUR,VWCE,VANGUARD FTSE ALL-WORLD,IBIS2,"2024-03-04, 09:00:00",-5,110.25,502
+Trades,SubTotal,,Stocks,USD,AAPL,,,,,,
+Trades,Data,Order,Forex,USD,EUR.USD,,IDEALFX,"2024-03-04, 09:01:00",100,1.08,503
+"""
+
+FLEX_CSV = """\
+"BOF","U1234567","Trades"
+"ClientAccountID","AssetClass","CurrencyPrimary","Symbol","Description","ListingExchange","DateTime","Quantity","TradePrice","TransactionID"
+"U1234567","STK","USD","AAPL","APPLE INC","NASDAQ","20240301;101500","1000","180.5","501"
+"U1234567","STK","EUR","VWCE","VANGUARD FTSE ALL-WORLD","IBIS2","20240304;090000","-5","110.25","502"
+"U1234567","CASH","USD","EUR.USD","","IDEALFX","20240304;090100","100","1.08","503"
+"EOF"
+"""
+
+FLEX_XML = """\
+<FlexQueryResponse queryName="Trades" type="AF">
+  <FlexStatements count="1">
+    <FlexStatement accountId="U1234567" fromDate="20240101" toDate="20241231">
+      <Trades>
+        <Trade assetCategory="STK" currency="USD" symbol="AAPL" description="APPLE INC" listingExchange="NASDAQ"
+               dateTime="20240301;101500" quantity="1000" tradePrice="180.5" transactionID="501"
+               levelOfDetail="EXECUTION"/>
+        <Trade assetCategory="STK" currency="USD" symbol="AAPL" description="APPLE INC" listingExchange="NASDAQ"
+               dateTime="20240102" quantity="-10" tradePrice="150" levelOfDetail="CLOSED_LOT"/>
+        <Trade assetCategory="STK" currency="EUR" symbol="VWCE" description="VANGUARD FTSE ALL-WORLD"
+               listingExchange="IBIS2" dateTime="20240304;090000" quantity="-5" tradePrice="110.25"
+               transactionID="502" levelOfDetail="EXECUTION"/>
+        <Trade assetCategory="CASH" currency="USD" symbol="EUR.USD" listingExchange="IDEALFX"
+               dateTime="20240304;090100" quantity="100" tradePrice="1.08" transactionID="503"/>
+      </Trades>
+    </FlexStatement>
+  </FlexStatements>
+</FlexQueryResponse>
+"""
+
+STATEMENTS = {"activity.csv": ACTIVITY_CSV, "flex.csv": FLEX_CSV, "flex.xml": FLEX_XML}
+
+
+@pytest.fixture
+def statement(tmp_path):
+    """ statement(name) writes the statement of STATEMENTS called name and returns its path """
+    def write(name):
+        path = tmp_path / name
+        path.write_text(STATEMENTS[name])
+        return str(path)
+    return write
+
+
+def imported(db_file):
+    """ (symbol, market, currency, location, quantity, price, date) of every transaction, in id order """
+    return db.get_db(db_file).fetchall(
+        '''SELECT a.symbol, m.name, cu.code, l.name, t.quantity, t.price, t.date FROM transactions t
+           JOIN asset_markets am ON t.asset_market_id = am.id JOIN assets a ON am.asset_id = a.id
+           JOIN markets m ON am.market_id = m.id JOIN currencies cu ON am.currency_id = cu.id
+           JOIN locations l ON t.location_id = l.id ORDER BY t.id''')
+
+
+@pytest.mark.parametrize("name", list(STATEMENTS))
+def test_every_format_reads_the_same_trades(statement, name):
+    trades = [trade for trade in importer.read_statement(statement(name))
+              if trade.asset_category.lower() not in importer.SKIPPED_CATEGORIES]
+    assert [(trade.account, trade.symbol, trade.currency, trade.exchange, trade.quantity, trade.price, trade.trade_id,
+             importer._iso_date(trade.timestamp)) for trade in trades] == [
+        ("U1234567", "AAPL", "USD", "NASDAQ", 1000.0, 180.5, "501", "2024-03-01"),
+        ("U1234567", "VWCE", "EUR", "IBIS2", -5.0, 110.25, "502", "2024-03-04"),
+    ]
+
+
+@pytest.mark.parametrize("name", list(STATEMENTS))
+def test_import_creates_the_reference_rows(db_file, statement, name):
+    assert importer.import_statement(db_file, statement(name)) == {"read": 2, "inserted": 2, "duplicates": 0}
+    assert imported(db_file) == [
+        ("AAPL", "NASDAQ", "USD", "Interactive Brokers U1234567", 1000.0, 180.5, "2024-03-01"),
+        ("VWCE", "IBIS2", "EUR", "Interactive Brokers U1234567", -5.0, 110.25, "2024-03-04"),
+    ]
+    assert db.verify_positions(db_file) == []
+
+
+def test_the_same_trades_in_another_format_are_duplicates(db_file, statement):
+    importer.import_statement(db_file, statement("flex.xml"))
+    for name in STATEMENTS:
+        assert importer.import_statement(db_file, statement(name)) == {"read": 2, "inserted": 0, "duplicates": 2}
+    assert len(imported(db_file)) == 2
+
+
+def test_fingerprint_without_a_trade_id_uses_the_whole_trade():
+    trade = importer.IBTrade("U1", "AAPL", "", "STK", "USD", "NASDAQ", "20240301;101500", 10.0, 180.5, "")
+    assert importer.fingerprint(trade) == importer.fingerprint(trade._replace(description="Apple"))
+    assert importer.fingerprint(trade) != importer.fingerprint(trade._replace(quantity=11.0))
+    assert importer.fingerprint(trade) != importer.fingerprint(trade._replace(timestamp="20240301;101501"))
+    assert importer.fingerprint(trade) != importer.fingerprint(trade._replace(account="U2"))
+    # The trade id, when there is one, is the whole key
+    assert (importer.fingerprint(trade._replace(trade_id="7")) ==
+            importer.fingerprint(trade._replace(trade_id="7", quantity=11.0, price=1.0)))
+
+
+def test_a_generated_statement_imports_in_chunks(db_file, tmp_path, write_flex_csv):
+    path = write_flex_csv(str(tmp_path / "big.csv"), 1000)
+    assert importer.import_statement(db_file, path, chunk_size=128)["inserted"] == 1000
+    assert importer.import_statement(db_file, path, chunk_size=300)["duplicates"] == 1000
+    assert db.verify_positions(db_file) == []
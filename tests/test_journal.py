@@ -0,0 +1,62 @@
+import cash
+import db
+
+
+def transactions(db_file):
+    return db.get_db(db_file).fetchall("SELECT id, asset_market_id, quantity, price, date, location_id FROM transactions ORDER BY id")
+
+
+def assert_consistent(db_file):
+    assert db.verify_positions(db_file) == []
+    assert cash.verify(db_file) == []
+
+
+def test_undo_redo_round_trip(db_file, asset_markets):
+    (first, location_id), (second, _) = asset_markets
+    ids = [db.add_transaction(db_file, first, 10, 10.0, "2020-01-01", location_id),
+           db.add_transaction(db_file, second, 5, 20.0, "2020-02-01", location_id)]
+    original = transactions(db_file)
+
+    db.update_transaction(db_file, ids[0], quantity=12, price=11.0)
+    db.delete_transactions(db_file, [ids[1]])
+    edited = transactions(db_file)
+    assert edited != original
+    assert db.undo_redo_state(db_file)[1] is None
+
+    assert db.undo(db_file) is not None
+    assert db.undo(db_file) is not None
+    assert transactions(db_file) == original
+    assert_consistent(db_file)
+
+    assert db.redo(db_file) is not None
+    assert db.redo(db_file) is not None
+    assert db.redo(db_file) is None
+    assert transactions(db_file) == edited
+    assert_consistent(db_file)
+
+
+def test_change_after_undo_cannot_be_redone(db_file, asset_markets):
+    (asset_market_id, location_id), _ = asset_markets
+    transaction_id = db.add_transaction(db_file, asset_market_id, 10, 10.0, "2020-01-01", location_id)
+    db.update_transaction(db_file, transaction_id, price=12.0)
+    db.undo(db_file)
+    db.update_transaction(db_file, transaction_id, price=13.0)
+    assert db.redo(db_file) is None
+    assert transactions(db_file)[0][3] == 13.0
+
+
+def test_dirty_since_reports_where_the_changes_start(db_file, asset_markets, synthetic_transactions):
+    (first, location_id), (second, _) = asset_markets
+    db.add_transactions_bulk(db_file, synthetic_transactions(asset_markets, 100))
+    start = db.dirty_since(db_file, transaction_id=0)
+    assert start.changed == {}
+    assert set(start.added) == {first, second}
+
+    _, moved_asset_market_id, _, _, moved_date, _ = transactions(db_file)[0]
+    db.update_transaction(db_file, 1, date="2030-01-01")
+    db.add_transaction(db_file, second, 1, 10.0, "2029-01-01", location_id)
+    dirty = db.dirty_since(db_file, start.journal_id, start.transaction_id)
+    # The edit counts from the earlier of its dates, the transaction added is not a change
+    assert dirty.changed == {moved_asset_market_id: moved_date}
+    assert dirty.added == {second: "2029-01-01"}
+    assert db.dirty_since(db_file, dirty.journal_id, dirty.transaction_id) == (dirty.journal_id, dirty.transaction_id, {}, {})
@@ -0,0 +1,91 @@
+import os
+
+import pytest
+
+import db
+import lifo
+
+
+def lot_state(db_file):
+    database = db.get_db(db_file)
+    return (database.fetchall("SELECT transaction_id, remaining FROM lots ORDER BY transaction_id"),
+            database.fetchall("SELECT lot_transaction_id, transaction_id, quantity, gain FROM lot_matches "
+                              "ORDER BY lot_transaction_id, transaction_id"))
+
+
+def rebuilt_state(db_file):
+    lifo.LifoEngine(db_file).rebuild()
+    return lot_state(db_file)
+
+
+def test_back_dated_sale_is_matched_against_the_lots_of_its_day(db_file, asset_markets):
+    (asset_market_id, location_id), _ = asset_markets
+    engine = lifo.LifoEngine(db_file)
+    first = db.add_transaction(db_file, asset_market_id, 10, 10.0, "2020-01-01", location_id)
+    second = db.add_transaction(db_file, asset_market_id, 10, 20.0, "2020-01-10", location_id)
+    later_sale = db.add_transaction(db_file, asset_market_id, -5, 25.0, "2020-02-01", location_id)
+    engine.sync()
+
+    # Before the second purchase: only the first lot was open then
+    sale = db.add_transaction(db_file, asset_market_id, -4, 30.0, "2020-01-05", location_id)
+    engine.sync()
+    lots, matches = lot_state(db_file)
+    assert (first, sale, 4.0, 80.0) in matches
+    assert (second, later_sale, 5.0, 25.0) in matches
+    assert dict(lots) == {first: 6.0, second: 5.0}
+    assert (lots, matches) == rebuilt_state(db_file)
+
+
+def test_edits_and_undo_replay_the_stack(db_file, asset_markets):
+    (asset_market_id, location_id), _ = asset_markets
+    engine = lifo.LifoEngine(db_file)
+    buy = db.add_transaction(db_file, asset_market_id, 10, 10.0, "2020-01-01", location_id)
+    sale = db.add_transaction(db_file, asset_market_id, -10, 15.0, "2020-03-01", location_id)
+    engine.sync()
+    db.update_transaction(db_file, buy, date="2020-04-01")
+    engine.sync()
+    assert lot_state(db_file) == rebuilt_state(db_file)
+    db.undo(db_file)
+    engine = lifo.LifoEngine(db_file)
+    engine.sync()
+    assert lot_state(db_file)[1] == [(buy, sale, 10.0, 50.0)]
+
+
+def test_engines_in_other_processes_are_seen(db_file, asset_markets):
+    (asset_market_id, location_id), _ = asset_markets
+    # Two engines on one file stand for two processes: each must match against the lots the other wrote
+    one, other = lifo.LifoEngine(db_file), lifo.LifoEngine(db_file)
+    db.add_transaction(db_file, asset_market_id, 10, 10.0, "2020-01-01", location_id)
+    db.add_transaction(db_file, asset_market_id, 10, 20.0, "2020-01-02", location_id)
+    one.sync()
+    db.add_transaction(db_file, asset_market_id, -10, 30.0, "2020-01-03", location_id)
+    other.sync()
+    db.add_transaction(db_file, asset_market_id, -5, 40.0, "2020-01-04", location_id)
+    one.sync()
+    assert lot_state(db_file) == rebuilt_state(db_file)
+
+
+def test_lot_closed_in_another_currency_is_converted(db_file):
+    # One ETF, bought on XETRA in EUR and sold on the LSE in GBP at the same broker: a single stack
+    eur, gbp = db.add_currency(db_file, "EUR", "Euro"), db.add_currency(db_file, "GBP", "Pound")
+    location_id = db.add_location(db_file, "Broker", "")
+    asset_id = db.add_asset(db_file, "Vanguard FTSE All-World", "VWCE", "etf", "", True)
+    xetra = db.add_asset_market(db_file, location_id, "VWCE@XETRA", "", asset_id, db.add_market(db_file, "XETRA", ""), eur)
+    lse = db.add_asset_market(db_file, location_id, "VWCE@LSE", "", asset_id, db.add_market(db_file, "LSE", ""), gbp)
+    db.get_db(db_file).write("INSERT INTO exchange_rates (date, currency_from_id, currency_to_id, rate) VALUES (?, ?, ?, ?)",
+                             ("2024-01-02", gbp, eur, 1 / 0.85))
+    buy = db.add_transaction(db_file, xetra, 10, 100.0, "2024-01-02", location_id)
+    sale = db.add_transaction(db_file, lse, -10, 86.0, "2024-03-01", location_id)
+
+    lifo.LifoEngine(db_file).sync()
+    # 100 EUR at 0.85 GBP to the euro, on the day of the purchase
+    assert lifo.realized_gains(db_file) == {"harmonised": {"GBP": pytest.approx(10.0)}, "non_harmonised": {}}
+    [(lot_id, transaction_id, quantity, gain)] = lot_state(db_file)[1]
+    assert (lot_id, transaction_id, quantity) == (buy, sale, 10.0)
+    assert lot_state(db_file) == rebuilt_state(db_file)
+
+
+def test_one_engine_per_file(db_file, monkeypatch):
+    monkeypatch.chdir(os.path.dirname(db_file))
+    assert lifo.get_engine(db_file) is lifo.get_engine(os.path.basename(db_file))
+    assert lifo.get_engine(db_file) is lifo.get_engine(os.path.join(".", os.path.basename(db_file)))
@@ -0,0 +1,51 @@
+import os
+import sqlite3
+import threading
+
+import db
+import models
+
+
+def test_identity_map_is_shared_by_every_spelling_of_a_file(db_file, monkeypatch, tmp_path):
+    monkeypatch.chdir(tmp_path)
+    assert models.get_identity_map(db_file) is models.get_identity_map(os.path.basename(db_file))
+
+
+def test_identity_map_sees_writes_of_other_processes(db_file, monkeypatch):
+    monkeypatch.setattr(models, "EXTERNAL_CHECK_SECONDS", 0)
+    currency_id = db.add_currency(db_file, "EUR", "Euro")
+    assert models.currency_code(db_file, currency_id) == "EUR"
+
+    # A connection of its own, as another process would have
+    conn = sqlite3.connect(db_file)
+    with conn:
+        conn.execute("UPDATE currencies SET code = 'USD' WHERE id = ?", (currency_id,))
+    conn.close()
+    assert models.currency_code(db_file, currency_id) == "USD"
+
+
+def run_on_a_thread(func, *args):
+    thread = threading.Thread(target=func, args=args)
+    thread.start()
+    thread.join()
+
+
+def test_writes_of_other_threads_only_move_their_own_tables(db_file):
+    version = db.data_version(db_file)
+    # A look from another thread, as DBWorker and SearchWorker take, changes nothing
+    run_on_a_thread(db.data_version, db_file)
+    assert db.data_version(db_file) == version
+
+    data = db.data_version(db_file, db.DATA_TABLES)
+    run_on_a_thread(db.add_currency, db_file, "EUR", "Euro")
+    assert db.data_version(db_file, db.DATA_TABLES) == data
+    assert db.data_version(db_file) != version
+
+
+def test_data_version_moves_with_writes_of_other_processes(db_file):
+    version = db.data_version(db_file)
+    conn = sqlite3.connect(db_file)
+    with conn:
+        conn.execute("INSERT INTO currencies (code, name) VALUES ('USD', 'Dollar')")
+    conn.close()
+    assert db.data_version(db_file) != version
@@ -0,0 +1,33 @@
+import os
+
+import numpy as np
+
+import db
+import networth
+
+
+def arrays_with_prices(columns, days, values):
+    empty = np.empty(0)
+    return networth.PortfolioArrays(np.array([1, 2]), np.array([1, 1]), np.array([1, 1]), empty, empty, empty, empty,
+                                    np.array(columns, dtype=np.int64), np.array(days, dtype=np.int64), np.array(values, dtype=float),
+                                    empty, empty, empty, empty)
+
+
+def test_daily_prices_keep_the_latest_observation_before_the_first_day():
+    # Out of date order, and several days before the first one, all of which fall on row 0
+    arrays = arrays_with_prices([0, 0, 0, 1, 0], [8, 5, 9, 11, 12], [8.0, 5.0, 9.0, 11.0, 12.0])
+    prices = networth.daily_prices(arrays, 10, 4)
+    assert prices[:, 0].tolist() == [9.0, 9.0, 12.0, 12.0]
+    assert np.isnan(prices[0, 1]) and prices[1:, 1].tolist() == [11.0, 11.0, 11.0]
+
+
+def test_daily_prices_without_observations():
+    prices = networth.daily_prices(arrays_with_prices([], [], []), 10, 2)
+    assert prices.shape == (2, 2) and np.isnan(prices).all()
+
+
+def test_arrays_are_shared_by_every_spelling_of_a_file(db_file, asset_markets, monkeypatch):
+    (asset_market_id, location_id), _ = asset_markets
+    db.add_transaction(db_file, asset_market_id, 10, 10.0, "2020-01-01", location_id)
+    monkeypatch.chdir(os.path.dirname(db_file))
+    assert networth.get_arrays(db_file) is networth.get_arrays(os.path.join(".", os.path.basename(db_file)))
@@ -0,0 +1,98 @@
+import db
+import paging
+
+
+def all_keys(db_file):
+    return db.get_db(db_file).fetchall("SELECT date, id FROM transactions ORDER BY date, id")
+
+
+def assert_window_in_place(window, keys):
+    assert window.keys == keys[window.offset:window.offset + len(window.rows)]
+    assert window.keys == [paging.row_key(row) for row in window.rows]
+    assert len(window.rows) <= window.max_rows
+    # A full last page is only known to be the last once the next one comes back empty
+    assert not window.at_start or window.offset == 0
+    assert not window.at_end or window.offset + len(window.rows) == len(keys)
+
+
+def test_pages_follow_one_another_both_ways(db_file, asset_markets, synthetic_transactions):
+    # Five transactions a day, so pages end in the middle of a day
+    db.add_transactions_bulk(db_file, synthetic_transactions(asset_markets, 500, days=100))
+    keys = all_keys(db_file)
+
+    forward, after = [], None
+    while page := db.fetch_transactions_page(db_file, after=after, limit=30):
+        forward.extend(paging.row_key(row) for row in page)
+        after = forward[-1]
+    backward, before = [], paging.MAX_KEY
+    while page := db.fetch_transactions_page(db_file, before=before, limit=30):
+        backward[:0] = [paging.row_key(row) for row in page]
+        before = backward[0]
+    assert forward == backward == keys
+
+
+def test_window_slides_forward_and_back(db_file, asset_markets, synthetic_transactions):
+    db.add_transactions_bulk(db_file, synthetic_transactions(asset_markets, 500, days=100))
+    keys = all_keys(db_file)
+    window = paging.TransactionWindow(db_file, page_size=20, max_rows=50)
+    window.load()
+    assert (window.total, window.offset, len(window.rows)) == (500, 0, 20)
+    assert_window_in_place(window, keys)
+
+    while not window.at_end:
+        window.forward()
+        assert_window_in_place(window, keys)
+    assert window.offset + len(window.rows) == 500
+    assert window.forward() == ([], 0)
+    while not window.at_start:
+        window.backward()
+        assert_window_in_place(window, keys)
+    assert window.offset == 0
+
+    window.load(from_end=True)
+    assert window.offset == 480
+    assert_window_in_place(window, keys)
+
+
+def test_window_takes_in_changes(db_file, asset_markets, synthetic_transactions):
+    (asset_market_id, location_id), _ = asset_markets
+    db.add_transactions_bulk(db_file, synthetic_transactions(asset_markets, 500, days=100))
+    window = paging.TransactionWindow(db_file, page_size=20, max_rows=50)
+    window.load()
+    window.forward()
+
+    inside = window.rows[10][1]
+    new_id = db.add_transaction(db_file, asset_market_id, 1, 1.0, inside, location_id)
+    db.add_transaction(db_file, asset_market_id, 1, 1.0, "2099-01-01", location_id)
+    inserted = window.sync()
+    assert [row[0] for position, row in inserted] == [new_id]
+    assert window.total == 502
+    assert_window_in_place(window, all_keys(db_file))
+
+    moved, deleted = window.rows[3][0], window.rows[5][0]
+    db.update_transaction(db_file, moved, date="2000-01-01")
+    db.delete_transactions(db_file, [deleted])
+    removed, inserted = window.refresh([moved, deleted])
+    assert sorted(removed) == sorted([moved, deleted])
+    # Moved before the first row of the window, which is at the start: it comes back first
+    assert [(position, row[0]) for position, row in inserted] == [(0, moved)]
+    assert window.total == 501
+    assert_window_in_place(window, all_keys(db_file))
+
+
+def test_filtered_window_counts_up_to_the_limit(db_file, asset_markets, synthetic_transactions, monkeypatch):
+    monkeypatch.setattr(paging, "COUNT_LIMIT", 100)
+    (asset_market_id, _), _ = asset_markets
+    db.add_transactions_bulk(db_file, synthetic_transactions(asset_markets, 500, days=100))
+    where = ("t.asset_market_id = ?", (asset_market_id,))
+    matching = db.count_transactions(db_file, where)
+    assert matching > 100
+
+    window = paging.TransactionWindow(db_file, page_size=20, where=where)
+    window.load()
+    assert (window.total, window.total_capped, window.at_start, window.at_end) == (100, True, True, False)
+    assert {row[4] for row in window.rows} == {"SYM0@TEST"}
+    seen = len(window.rows)
+    while not window.at_end:
+        seen += len(window.forward()[0])
+    assert seen == matching
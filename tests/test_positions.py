@@ -0,0 +1,56 @@
+import pytest
+
+import cash
+import db
+import importer
+
+
+def transaction_rows(db_file):
+    return db.get_db(db_file).fetchall("SELECT id, asset_market_id, location_id FROM transactions ORDER BY id")
+
+
+def assert_consistent(db_file):
+    assert db.verify_positions(db_file) == []
+    assert cash.verify(db_file) == []
+
+
+def test_positions_and_cash_after_import_and_edits(db_file, tmp_path, write_flex_csv):
+    statement = write_flex_csv(str(tmp_path / "statement.csv"), 300, n_symbols=20)
+    assert importer.import_statement(db_file, statement)["inserted"] == 300
+    assert_consistent(db_file)
+    assert importer.import_statement(db_file, statement)["inserted"] == 0
+
+    ids = [row[0] for row in transaction_rows(db_file)]
+    db.update_transaction(db_file, ids[10], quantity=-7, price=123.0, date="2014-01-02")
+    db.delete_transactions(db_file, ids[20:40])
+    db.undo(db_file)
+    cash.checkpoint(db_file)
+    _, asset_market_id, location_id = transaction_rows(db_file)[0]
+    db.add_transaction(db_file, asset_market_id, 3, 50.0, "2015-06-01", location_id)
+    assert_consistent(db_file)
+
+
+def test_position_follows_a_transaction_to_another_asset_market(db_file, asset_markets):
+    (first, location_id), (second, _) = asset_markets
+    transaction_id = db.add_transaction(db_file, first, 10, 10.0, "2020-01-01", location_id)
+    db.add_transaction(db_file, second, 5, 20.0, "2020-02-01", location_id)
+    db.update_transaction(db_file, transaction_id, asset_market_id=second)
+    positions = {row[0]: row for row in db.fetch_positions(db_file)}
+    # A position left without transactions is dropped
+    assert list(positions) == [second]
+    assert positions[second][3:] == pytest.approx((15, 200.0, 2))
+    assert_consistent(db_file)
+
+
+def test_verify_reports_and_rebuild_repairs(db_file, asset_markets, synthetic_transactions):
+    db.add_transactions_bulk(db_file, synthetic_transactions(asset_markets, 200))
+    (first, _), (second, _) = asset_markets
+    database = db.get_db(db_file)
+    database.write("UPDATE positions SET quantity = quantity + 1 WHERE asset_market_id = ?", (first,))
+    database.write("DELETE FROM positions WHERE asset_market_id = ?", (second,))
+    mismatches = {asset_market_id: stored for asset_market_id, stored, expected in db.verify_positions(db_file)}
+    assert set(mismatches) == {first, second}
+    assert mismatches[second] is None
+
+    assert db.rebuild_positions(db_file) == 2
+    assert db.verify_positions(db_file) == []
@@ -0,0 +1,100 @@
+import sqlite3
+
+import pytest
+
+import db
+import search
+
+
+@pytest.fixture
+def searched(db_file, asset_markets, synthetic_transactions):
+    """ db_file with 600 transactions, and the transactions as {id: (asset_market_id, location_id, date, price)} """
+    db.add_transactions_bulk(db_file, synthetic_transactions(asset_markets, 600))
+    rows = db.get_db(db_file).fetchall("SELECT id, asset_market_id, location_id, date, price FROM transactions")
+    return db_file, {row[0]: row[1:] for row in rows}
+
+
+def paged_ids(db_file, where, start_key=None, page_size=50):
+    """ The ids of every transaction meeting where, paged through as the Transactions view does """
+    ids, after = [], start_key
+    while True:
+        page = db.fetch_transactions_page(db_file, after=after, limit=page_size, where=where)
+        ids.extend(row[0] for row in page)
+        if len(page) < page_size:
+            return ids
+        after = (page[-1][1], page[-1][0])
+
+
+def test_parse_reads_the_filter_bar():
+    transaction_filter = search.TransactionFilter.parse(" sym1 ", 3, " 2015-01-02", "", "1,000.5", " ")
+    assert transaction_filter == search.TransactionFilter("sym1", 3, "2015-01-02", None, 1000.5, None)
+    assert search.TransactionFilter.parse().where() is None
+    with pytest.raises(ValueError):
+        search.TransactionFilter.parse(date_from="2015-13-01")
+    with pytest.raises(ValueError):
+        search.TransactionFilter.parse(price_max="cheap")
+
+
+def test_fts_query_matches_every_word_as_a_prefix():
+    assert search.fts_query("SYM1 asset-") == '"SYM1"* "asset"*'
+    assert search.fts_query(" -- ") is None
+
+
+@pytest.mark.parametrize("transaction_filter, keep", [
+    (search.TransactionFilter("sym1"), lambda am, loc, date, price, first: am == first + 1),
+    (search.TransactionFilter("asset"), lambda am, loc, date, price, first: True),
+    (search.TransactionFilter("nothing"), lambda am, loc, date, price, first: False),
+    (search.TransactionFilter(date_from="2016-01-01", date_to="2016-12-31"),
+     lambda am, loc, date, price, first: "2016-01-01" <= date <= "2016-12-31"),
+    (search.TransactionFilter(price_min=100, price_max=200), lambda am, loc, date, price, first: 100 <= price <= 200),
+    (search.TransactionFilter("sym0", date_from="2020-06-01", price_max=250),
+     lambda am, loc, date, price, first: am == first and date >= "2020-06-01" and price <= 250),
+])
+def test_conditions_keep_the_matching_transactions(searched, asset_markets, transaction_filter, keep):
+    db_file, transactions = searched
+    first = asset_markets[0][0]
+    expected = sorted(i for i, row in transactions.items() if keep(*row, first))
+    start_key = transaction_filter.start_key()
+    # Both the condition that reads in date order and the one that reads by asset market
+    for where in (transaction_filter.where(db_file, page_size=1), transaction_filter.where()):
+        assert sorted(paged_ids(db_file, where, start_key)) == expected
+    if transaction_filter.where() is not None:
+        assert db.count_transactions(db_file, transaction_filter.where()) == len(expected)
+
+
+def test_location_condition(searched, asset_markets):
+    db_file, transactions = searched
+    location_id = asset_markets[0][1]
+    assert len(paged_ids(db_file, search.TransactionFilter(location_id=location_id).where())) == len(transactions)
+    assert paged_ids(db_file, search.TransactionFilter(location_id=location_id + 1).where()) == []
+
+
+def test_search_loads_the_first_page(searched):
+    db_file, transactions = searched
+    window = search.search(db_file, search.TransactionFilter("sym", date_from="2019-01-01"), page_size=20)
+    assert len(window.rows) == 20
+    assert window.rows[0][1] >= "2019-01-01"
+    assert window.total == sum(date >= "2019-01-01" for _, _, date, _ in transactions.values())
+
+
+def test_matched_transactions_raises_through_the_database(searched, capsys):
+    db_file, _ = searched
+    assert search.matched_transactions(db_file, '"') == (0, 0)
+    assert capsys.readouterr().out
+    with pytest.raises(sqlite3.Error):
+        search.matched_transactions(db_file, '"', db.get_db(db_file))
+
+
+def test_worker_hands_back_every_error_and_goes_on(searched):
+    db_file, transactions = searched
+    worker = search.SearchWorker(db_file)
+    # Not a sqlite3.Error: the text is no string
+    generation = worker.submit(search.TransactionFilter(text=5))
+    result_generation, window, error, _ = worker.results.get(timeout=10)
+    assert (result_generation, window) == (generation, None)
+    assert isinstance(error, TypeError)
+
+    generation = worker.submit(search.TransactionFilter("asset"))
+    result_generation, window, error, _ = worker.results.get(timeout=10)
+    assert (result_generation, error) == (generation, None)
+    assert window.total == len(transactions)
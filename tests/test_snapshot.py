@@ -0,0 +1,93 @@
+import os
+
+import pytest
+
+import db
+import snapshot
+
+pa = pytest.importorskip("pyarrow")
+
+
+def exported_ids(snapshot_dir):
+    return snapshot.load_table(snapshot_dir, "transactions").column("id").to_pylist()
+
+
+def stored_ids(db_file):
+    return [row[0] for row in db.get_db(db_file).fetchall("SELECT id FROM transactions ORDER BY id")]
+
+
+@pytest.fixture
+def exported(db_file, asset_markets, synthetic_transactions, tmp_path):
+    """ db_file with 300 transactions, and a snapshot directory holding them """
+    db.add_transactions_bulk(db_file, synthetic_transactions(asset_markets, 300))
+    snapshot_dir = str(tmp_path / "snapshot")
+    assert snapshot.snapshot(db_file, snapshot_dir, tables=["transactions"]) == {"transactions": 300}
+    return db_file, snapshot_dir
+
+
+def test_new_rows_are_appended_as_a_part(exported, asset_markets, synthetic_transactions):
+    db_file, snapshot_dir = exported
+    assert snapshot.snapshot(db_file, snapshot_dir, tables=["transactions"]) == {"transactions": 0}
+    db.add_transactions_bulk(db_file, synthetic_transactions(asset_markets, 50, seed=1))
+    assert snapshot.snapshot(db_file, snapshot_dir, tables=["transactions"]) == {"transactions": 50}
+    entry = snapshot.read_manifest(snapshot_dir)["transactions"]
+    assert entry["parts"] == ["part-00000.arrow", "part-00001.arrow"]
+    assert entry["watermark"] == 350
+    assert exported_ids(snapshot_dir) == stored_ids(db_file)
+
+
+def swap_transactions(db_file, first_id, second_id):
+    """ Give each of two transactions the quantity and price of the other: the column totals stay the same """
+    rows = {transaction_id: (quantity, price) for transaction_id, quantity, price in db.get_db(db_file).fetchall(
+        "SELECT id, quantity, price FROM transactions WHERE id IN (?, ?)", (first_id, second_id))}
+    db.update_transaction(db_file, first_id, quantity=rows[second_id][0], price=rows[second_id][1])
+    db.update_transaction(db_file, second_id, quantity=rows[first_id][0], price=rows[first_id][1])
+
+
+@pytest.mark.parametrize("change", [
+    lambda db_file: db.update_transaction(db_file, 7, date="2030-01-01"),
+    lambda db_file: db.delete_transactions(db_file, [7]),
+    lambda db_file: swap_transactions(db_file, 7, 8),
+], ids=["moved", "deleted", "swapped"])
+def test_changed_rows_are_written_again(exported, change):
+    db_file, snapshot_dir = exported
+    change(db_file)
+    db.add_transactions_bulk(db_file, [(1, 1, 1.0, "2030-01-02", 1)])
+    written = snapshot.snapshot(db_file, snapshot_dir, tables=["transactions"])["transactions"]
+    assert written == len(stored_ids(db_file))
+    assert snapshot.read_manifest(snapshot_dir)["transactions"]["parts"] == ["part-00001.arrow"]
+    assert os.listdir(os.path.join(snapshot_dir, "transactions")) == ["part-00001.arrow"]
+    table = snapshot.load_table(snapshot_dir, "transactions")
+    rows = db.get_db(db_file).fetchall("SELECT id, quantity, price, date FROM transactions ORDER BY id")
+    assert list(zip(*[table.column(name).to_pylist() for name in ("id", "quantity", "price")])) == \
+        [row[:3] for row in rows]
+    assert [date.isoformat() for date in table.column("date").to_pylist()] == [row[3] for row in rows]
+
+
+def test_swapped_prices_are_written_again(db_file, asset_markets, tmp_path):
+    (asset_market_id, _), _ = asset_markets
+    database = db.get_db(db_file)
+    for date, close in (("2024-01-01", 10.0), ("2024-01-02", 20.0)):
+        database.write("INSERT INTO prices (asset_market_id, date, close) VALUES (?, ?, ?)", (asset_market_id, date, close))
+    snapshot_dir = str(tmp_path / "snapshot")
+    snapshot.snapshot(db_file, snapshot_dir, tables=["prices"])
+    assert snapshot.snapshot(db_file, snapshot_dir, tables=["prices"]) == {"prices": 0}
+    database.write("UPDATE prices SET close = 30.0 - close")
+    assert snapshot.snapshot(db_file, snapshot_dir, tables=["prices"]) == {"prices": 2}
+    assert snapshot.load_table(snapshot_dir, "prices").column("close").to_pylist() == [20.0, 10.0]
+
+
+def test_full_and_format_change_rewrite(exported, asset_markets, synthetic_transactions):
+    db_file, snapshot_dir = exported
+    db.add_transactions_bulk(db_file, synthetic_transactions(asset_markets, 50, seed=1))
+    snapshot.snapshot(db_file, snapshot_dir)
+    assert snapshot.snapshot(db_file, snapshot_dir, tables=["transactions"], full=True) == {"transactions": 350}
+    assert os.listdir(os.path.join(snapshot_dir, "transactions")) == ["part-00002.arrow"]
+    # The other tables are still in the manifest
+    assert set(snapshot.read_manifest(snapshot_dir)) == set(snapshot.SNAPSHOT_TABLES)
+
+    assert snapshot.snapshot(db_file, snapshot_dir, file_format="parquet", tables=["transactions"]) == {"transactions": 350}
+    assert os.listdir(os.path.join(snapshot_dir, "transactions")) == ["part-00003.parquet"]
+    assert exported_ids(snapshot_dir) == stored_ids(db_file)
+    with pytest.raises(ValueError):
+        snapshot.snapshot(db_file, snapshot_dir, file_format="csv")
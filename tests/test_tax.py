@@ -0,0 +1,90 @@
+import sqlite3
+
+import pytest
+
+import db
+import tax
+
+
+def test_what_if_sale_before_the_first_year_with_gains(db_file, asset_markets):
+    (held, location_id), (traded, _) = asset_markets
+    db.add_transaction(db_file, held, 10, 10.0, "2017-03-01", location_id)
+    db.add_transaction(db_file, traded, 10, 10.0, "2019-03-01", location_id)
+    db.add_transaction(db_file, traded, -10, 15.0, "2020-03-01", location_id)
+    assert [result["year"] for result in tax.estimate_years(db_file, 2021) if result["tax"]] == [2020]
+
+    result = tax.what_if_sell(db_file, held, 10, 20.0, "2018-06-01")
+    assert result["gain"] == 100.0
+    years = {year["year"]: year for year in result["years"]}
+    assert min(years) == 2018
+    assert years[2018]["tax_before"] == 0.0 and years[2018]["delta"] > 0
+    assert years[2020]["delta"] == 0.0
+    assert result["tax_delta"] == years[2018]["delta"]
+    # Nothing was recorded
+    assert db.get_db(db_file).fetchone("SELECT COUNT(*) FROM transactions")[0] == 3
+
+
+def test_what_if_unknown_asset_market(db_file, asset_markets):
+    with pytest.raises(ValueError):
+        tax.what_if_sell(db_file, 999, 1, 1.0, "2020-01-01")
+
+
+@pytest.fixture
+def three_assets(db_file):
+    """ Three asset markets in EUR at one location, of assets 1 and 2 not harmonised and 3 harmonised """
+    currency_id = db.add_currency(db_file, "EUR", "Euro")
+    market_id = db.add_market(db_file, "TEST", "")
+    location_id = db.add_location(db_file, "Broker", "")
+    asset_markets = []
+    for i, is_harmonised in enumerate((False, False, True)):
+        asset_id = db.add_asset(db_file, f"ETF {i}", f"ETF{i}", "etf", "", is_harmonised)
+        asset_markets.append(db.add_asset_market(db_file, location_id, f"ETF{i}@TEST", "", asset_id, market_id,
+                                                 currency_id))
+    return asset_markets, location_id
+
+
+def recomputed(db_file, year):
+    db.get_db(db_file).write("DELETE FROM tax_years")
+    return tax.estimate(db_file, year)
+
+
+def test_cached_year_follows_the_harmonised_status(db_file, three_assets):
+    asset_markets, location_id = three_assets
+    for asset_market_id, gain in zip(asset_markets, (-100.0, -50.0, 30.0)):
+        db.add_transaction(db_file, asset_market_id, 1, 100.0, "2023-01-02", location_id)
+        db.add_transaction(db_file, asset_market_id, -1, 100.0 + gain, "2023-06-01", location_id)
+    before = tax.estimate(db_file, 2023)
+    # Assets 1 and 2 become harmonised and asset 3 not: a sum of the flags weighted by id stays 3
+    database = db.get_db(db_file)
+    database.write("UPDATE assets SET is_harmonised = id != 3")
+    after = tax.estimate(db_file, 2023)
+    assert after != before
+    assert after == recomputed(db_file, 2023)
+
+
+def test_cached_year_follows_edits_that_offset_each_other(db_file, three_assets):
+    asset_markets, location_id = three_assets
+    sales = []
+    for asset_market_id in asset_markets[1:]:
+        db.add_transaction(db_file, asset_market_id, 1, 100.0, "2023-01-02", location_id)
+        sales.append(db.add_transaction(db_file, asset_market_id, -1, 110.0, "2023-06-01", location_id))
+    before = tax.estimate(db_file, 2023)
+    # 10 less gain on the non-harmonised ETF and 10 more on the harmonised one: the total gain is the same
+    db.update_transaction(db_file, sales[0], price=100.0)
+    db.update_transaction(db_file, sales[1], price=120.0)
+    after = tax.estimate(db_file, 2023)
+    assert after != before
+    assert after == recomputed(db_file, 2023)
+
+
+def test_what_if_writes_nothing(db_file, asset_markets):
+    (asset_market_id, location_id), _ = asset_markets
+    db.add_transaction(db_file, asset_market_id, 10, 10.0, "2020-01-02", location_id)
+    tax.estimate_years(db_file, 2021)
+    # Not matched yet either
+    db.add_transaction(db_file, asset_market_id, -5, 12.0, "2021-03-01", location_id)
+    observer = sqlite3.connect(db_file)
+    version = observer.execute("PRAGMA data_version").fetchone()[0]
+    tax.what_if_sell(db_file, asset_market_id, 5, 20.0, "2021-06-01")
+    assert observer.execute("PRAGMA data_version").fetchone()[0] == version
+    observer.close()
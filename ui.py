@@ -1,19 +1,37 @@
 import tkinter as tk
 from tkinter import filedialog, simpledialog, ttk
-from tkcalendar import DateEntry
 
 import datetime
 
+import cash
 import db
+import models
+import paging
+import profiling
+import search
+import worker
+
+# networth (with NumPy and pandas), refresh and tkcalendar are imported where they
+# are first needed, so that the main window opens without waiting for them
 
 class AssetOverviewPage(tk.Frame):
     def __init__(self, parent, controller, db_file):
         tk.Frame.__init__(self, parent)
         self.controller = controller
         self.db_file = db_file
+        self.worker = controller.worker
         label = tk.Label(self, text="Asset Overview")
         label.pack(pady=10, padx=10)
 
+        # The cash of every location, in each currency, from the running balances of the cash ledger
+        columns = ("Location", "Currency", "Cash")
+        self.cash_tree = ttk.Treeview(self, columns=columns, show="headings", height=5)
+        for col in columns:
+            self.cash_tree.heading(col, text=col)
+            self.cash_tree.column(col, width=100)
+        self.cash_tree.column("Cash", anchor="e")
+        self.cash_tree.pack(side="top", fill="x")
+
         # Set up the Treeview
         columns = ("Asset Name", "Location", "Quantity Owned")
         self.tree = ttk.Treeview(self, columns=columns, show="headings", height=25)
@@ -27,19 +45,6 @@ class AssetOverviewPage(tk.Frame):
         scrollbar.pack(side="right", fill="y")
         self.tree.configure(yscrollcommand=scrollbar.set)
 
-        self.populate_assets()
-
-    def populate_assets(self):
-        """ Fetch data from the database and insert into the treeview """
-        # Clear the treeview
-        for i in self.tree.get_children():
-            self.tree.delete(i)
-
-        # Fetch data from the database
-        asset_data = db.fetch_asset_overview(self.db_file)
-        for asset in asset_data:
-            self.tree.insert("", "end", values=asset)
-
         # Navigation buttons
         transactions_button = tk.Button(self, text="Transactions",
                                         command=lambda: self.controller.show_frame(TransactionsPage))
@@ -49,7 +54,28 @@ class AssetOverviewPage(tk.Frame):
                                      command=lambda: self.controller.show_frame(NetValuePage))
         net_value_button.pack()
 
+        self.populate_assets()
+
+    def populate_assets(self):
+        """ Read the positions and the cash balances on the database worker, and show them once read """
+        def read(db_file):
+            return db.fetch_asset_overview(db_file), cash.balances(db_file)
+        self.worker.then(self.worker.submit_query(read, self.db_file), self.show_assets)
+
+    def show_assets(self, data):
+        asset_data, balances = data
+        self.tree.delete(*self.tree.get_children())
+        for asset in asset_data:
+            self.tree.insert("", "end", values=asset)
+
+        self.cash_tree.delete(*self.cash_tree.get_children())
+        for location_id, location, currency_id, currency, amount in balances:
+            self.cash_tree.insert("", "end", values=(location, currency, f"{amount:,.2f}"))
+
 class PortfolioTrackerApp(tk.Tk):
+    # Quick work ends before the loading indicator would show, so that it does not flicker
+    LOADING_DELAY_MS = 200
+
     def __init__(self, db_file,*args, **kwargs):
         super().__init__(*args, **kwargs)
         self.db_file = db_file
@@ -59,32 +85,99 @@ class PortfolioTrackerApp(tk.Tk):
         container = ttk.Frame(self)
         container.pack(side="top", fill="both", expand=True)
 
-        # A dictionary to hold the pages
+        # A dictionary to hold the pages, each one built the first time it is shown
+        self.container = container
         self.frames = {}
 
-        for F in (TransactionsPage, NetValuePage, AssetOverviewPage):
-            frame = F(container, self, self.db_file)
-            self.frames[F] = frame
-            frame.grid(row=0, column=0, sticky="nsew")
-
         # Add a button to navigate to the Asset Overview page
         asset_overview_button = tk.Button(self, text="Asset Overview",
                                           command=lambda: self.show_frame(AssetOverviewPage))
         asset_overview_button.pack()
 
+        # Prices and exchange rates are downloaded in the background
+        self.refresh_scheduler = None
+        self.refresh_button = tk.Button(self, text="Refresh Prices", command=self.refresh_prices)
+        self.refresh_button.pack()
+        self.status = tk.Label(self, text="")
+        self.status.pack()
+
+        # The pages read and write through the database worker, see worker.py, so the window never hangs on a query
+        self.worker = worker.DBWorker(self, db_file, on_busy=self.on_worker_busy)
+        self.loading_after_id = None
+        self.loading = tk.Frame(self)
+        self.loading_bar = ttk.Progressbar(self.loading, mode="indeterminate", length=120)
+        self.loading_bar.pack(side="left", padx=5)
+        tk.Label(self.loading, text="Loading...").pack(side="left")
+        tk.Button(self.loading, text="Cancel", command=self.worker.cancel).pack(side="left", padx=5)
+
+        # With PORTFOLIO_PROFILE set, the queries run so far can be inspected
+        self.profile_panel = None
+        if profiling.get_profiler() is not None:
+            tk.Button(self, text="Query Profile", command=self.show_profile_panel).pack()
+
         self.show_frame(TransactionsPage)
 
+    def on_worker_busy(self, busy):
+        """ Show the loading indicator while the database worker has work, once it has had it for a moment """
+        if busy:
+            self.loading_after_id = self.after(self.LOADING_DELAY_MS, self.show_loading)
+            return
+        if self.loading_after_id is not None:
+            self.after_cancel(self.loading_after_id)
+            self.loading_after_id = None
+        self.loading_bar.stop()
+        self.loading.pack_forget()
+
+    def show_loading(self):
+        self.loading_after_id = None
+        self.loading.pack(before=self.container)
+        self.loading_bar.start(20)
+
+    def show_profile_panel(self):
+        if self.profile_panel is None or not self.profile_panel.winfo_exists():
+            self.profile_panel = ProfilePanel(self)
+        self.profile_panel.lift()
+
+    def refresh_prices(self):
+        if self.refresh_scheduler is None:
+            import refresh
+            self.refresh_scheduler = refresh.RefreshScheduler(self.db_file)
+        self.refresh_button.config(state="disabled")
+        self.status.config(text="Refreshing prices...")
+        self.refresh_scheduler.start().poll(self, self.on_prices_refreshed)
+
+    def on_prices_refreshed(self, summary):
+        self.refresh_button.config(state="normal")
+        text = f"Downloaded {summary['prices']} prices and {summary['rates']} exchange rates"
+        if summary["errors"]:
+            text += f" ({len(summary['errors'])} errors, the first: {summary['errors'][0]})"
+        self.status.config(text=text)
+
     def show_frame(self, cont):
-        frame = self.frames[cont]
+        frame = self.frames.get(cont)
+        if frame is None:
+            # Pages run their queries when built, so a page nobody opens costs nothing
+            frame = self.frames[cont] = cont(self.container, self, self.db_file)
+            frame.grid(row=0, column=0, sticky="nsew")
         frame.tkraise()  # Brings the selected frame to the top
 
 class TransactionsPage(tk.Frame):
+    # Wait this long after the last keystroke in the filter bar before searching
+    SEARCH_DEBOUNCE_MS = 150
+
     def __init__(self, parent, controller, db_file):
         tk.Frame.__init__(self, parent)
         self.db_file = db_file
+        self.worker = controller.worker
         label = tk.Label(self, text="Transactions List")
         label.pack(pady=10, padx=10)
 
+        # Filter bar: searched on a worker thread as the user types, see search.py
+        self.search_worker = None
+        self.search_generation = 0
+        self.search_after_id = None
+        self.build_filter_bar()
+
         # Set up the Treeview
         columns = ("Date", "Symbol", "Asset Name", "Asset-Market", "Price", "Quantity", "Total", "Location", "Currency")  # Update with actual column names
         columns_width={"Date": 85, "Symbol": 50, "Asset Name": 200, "Asset-Market": 90, "Price": 50, "Quantity": 70, "Total": 80, "Location": 50, "Currency": 50}
@@ -103,9 +196,13 @@ class TransactionsPage(tk.Frame):
         scrollbar.pack(side="right", fill="y")
         self.tree.configure(yscrollcommand=scrollbar.set)
 
-        # TODO: Fetch data from the database and insert into the treeview
-        # for transaction in transactions:
-        #     self.tree.insert("", "end", values=(data1, data2, data3, data4))
+        # Only a window of the transactions is loaded; more are read as the list is scrolled
+        self.window = paging.TransactionWindow(db_file)
+        self.scrollbar = scrollbar
+        self.shift_pending = False
+        self.tree.configure(yscrollcommand=self.on_tree_scrolled)
+        self.position_label = tk.Label(self, text="")
+        self.position_label.pack()
 
         self.populate_transactions()
 
@@ -115,24 +212,239 @@ class TransactionsPage(tk.Frame):
         net_value_button.pack()
 
         def add_and_refresh(self, db_file):
-            add_transaction_wizard(db_file)
-            self.populate_transactions()
+            add_transaction_wizard(db_file, self.worker)
+            self.add_new_transactions()
+            self.update_undo_buttons()
 
-        # Add transaction button with wizard then reload page to show new transaction
+        # Add transaction button with wizard then show the new transaction
         add_transaction_button = tk.Button(self, text="Add Transaction", command=lambda: add_and_refresh(self, db_file))
         add_transaction_button.pack()
 
+        # Edits and deletions go through the change journal, so they can be undone, see db.undo
+        edit_bar = tk.Frame(self)
+        edit_bar.pack()
+        tk.Button(edit_bar, text="Edit", command=self.edit_selected).pack(side="left")
+        tk.Button(edit_bar, text="Delete", command=self.delete_selected).pack(side="left")
+        self.undo_button = tk.Button(edit_bar, text="Undo", command=self.undo)
+        self.undo_button.pack(side="left")
+        self.redo_button = tk.Button(edit_bar, text="Redo", command=self.redo)
+        self.redo_button.pack(side="left")
+        self.tree.bind("<Delete>", lambda event: self.delete_selected())
+        self.tree.bind("<Double-1>", lambda event: self.edit_selected())
+        self.tree.bind("<Control-z>", lambda event: self.undo())
+        self.tree.bind("<Control-y>", lambda event: self.redo())
+        self.update_undo_buttons()
+
+
+    def build_filter_bar(self):
+        bar = tk.Frame(self)
+        bar.pack(side="top", fill="x", padx=10)
+        self.filter_vars = {}
+        for key, text, width in (("text", "Search", 20), ("date_from", "From", 10), ("date_to", "To", 10),
+                                 ("price_min", "Price from", 8), ("price_max", "to", 8)):
+            tk.Label(bar, text=text).pack(side="left")
+            var = self.filter_vars[key] = tk.StringVar()
+            entry = tk.Entry(bar, textvariable=var, width=width)
+            entry.pack(side="left", padx=(2, 8))
+            entry.bind("<KeyRelease>", self.schedule_search)
+        tk.Label(bar, text="Location").pack(side="left")
+        self.locations = {"All": None}
+        self.location_box = ttk.Combobox(bar, values=list(self.locations), state="readonly", width=15)
+        self.location_box.set("All")
+        self.location_box.pack(side="left", padx=(2, 8))
+        self.location_box.bind("<<ComboboxSelected>>", self.schedule_search)
+        # Not a query: it fills the reference-data cache, which cancel() must not leave half read
+        self.worker.then(self.worker.submit(lambda: models.get_identity_map(self.db_file).all(models.Location)),
+                         self.show_locations)
+        tk.Button(bar, text="Clear", command=self.clear_filter).pack(side="left")
+        self.filter_status = tk.Label(bar, text="")
+        self.filter_status.pack(side="left", padx=8)
+
+    def show_locations(self, locations):
+        self.locations.update((location.name, location.id) for location in locations)
+        self.location_box.config(values=list(self.locations))
+
+    def schedule_search(self, event=None):
+        """ Search once the typing pauses: each keystroke postpones the search already scheduled """
+        if self.search_after_id is not None:
+            self.after_cancel(self.search_after_id)
+        self.search_after_id = self.after(self.SEARCH_DEBOUNCE_MS, self.run_search)
+
+    def run_search(self):
+        self.search_after_id = None
+        values = {key: var.get() for key, var in self.filter_vars.items()}
+        try:
+            transaction_filter = search.TransactionFilter.parse(location_id=self.locations.get(self.location_box.get()),
+                                                                **values)
+        except ValueError:
+            self.filter_status.config(text="Dates are YYYY-MM-DD, prices numbers")
+            return
+        if self.search_worker is None:
+            self.search_worker = search.SearchWorker(self.db_file, self.window.page_size)
+        # A newer search interrupts the one still running, and only the latest result is shown
+        self.search_generation = self.search_worker.submit(transaction_filter)
+        self.search_worker.poll(self, self.on_search_result)
+
+    def on_search_result(self, generation, window, error, seconds):
+        if generation != self.search_generation:
+            return
+        if error is not None:
+            self.filter_status.config(text=f"Search failed: {error}")
+            return
+        self.window = window
+        self.tree.delete(*self.tree.get_children())
+        for row in window.rows:
+            self.tree.insert("", "end", iid=row[0], values=row[1:])
+        self.tree.yview_moveto(0)
+        self.filter_status.config(text=f"{seconds * 1000:.0f} ms" if window.where is not None else "")
+        self.update_position_label()
+
+    def clear_filter(self):
+        for var in self.filter_vars.values():
+            var.set("")
+        self.location_box.set("All")
+        self.run_search()
 
     def populate_transactions(self):
-        """ Fetch data from the database and insert into the treeview """
-        # Clear the treeview
-        for i in self.tree.get_children():
-            self.tree.delete(i)
-
-        # Fetch data from the database
-        transactions = db.fetch_all_transactions(self.db_file )
-        for transaction in transactions:
-            self.tree.insert("", "end", values=transaction)
+        """ Load the first page of transactions into the treeview """
+        window = self.window
+        self.worker.then(self.worker.submit(window.load), lambda rows: self.show_transactions(window, rows))
+
+    def show_transactions(self, window, rows):
+        if window is not self.window:
+            return
+        self.tree.delete(*self.tree.get_children())
+        for row in rows:
+            self.tree.insert("", "end", iid=row[0], values=row[1:])
+        self.update_position_label()
+
+    def add_new_transactions(self):
+        """ Insert the transactions added since the last load where they belong, without reloading the list """
+        window = self.window
+        self.worker.then(self.worker.submit(window.sync), lambda inserted: self.insert_rows(window, inserted))
+
+    def insert_rows(self, window, inserted):
+        """ Insert [(position, row)] read by window, unless a search has replaced it since """
+        if window is not self.window:
+            return
+        for position, row in inserted:
+            self.tree.insert("", position, iid=row[0], values=row[1:])
+        self.update_position_label()
+
+    def on_tree_scrolled(self, first, last):
+        """ Keep the scrollbar in step, and read the next (or previous) page when close to an edge of the window """
+        self.scrollbar.set(first, last)
+        first, last = float(first), float(last)
+        if self.shift_pending:
+            return
+        if last > 0.9 and not self.window.at_end:
+            self.shift_pending = True
+            self.after_idle(self.shift_window, True)
+        elif first < 0.1 and not self.window.at_start:
+            self.shift_pending = True
+            self.after_idle(self.shift_window, False)
+
+    def shift_window(self, forward):
+        """ Read the next (or previous) page on the database worker, then move the list by it """
+        window = self.window
+        future = self.worker.submit(window.forward if forward else window.backward)
+        self.worker.then(future, lambda shift: self.show_shift(window, forward, *shift), self.on_shift_error)
+
+    def show_shift(self, window, forward, page, dropped):
+        """ Move the list by one page, keeping the row at the top of the list where it is on screen """
+        self.shift_pending = False
+        if window is not self.window:
+            return
+        children = self.tree.get_children()
+        top = self.tree.identify_row(0) or (children[0] if children else "")
+        if forward:
+            for row in page:
+                self.tree.insert("", "end", iid=row[0], values=row[1:])
+            if dropped:
+                self.tree.delete(*children[:dropped])
+        else:
+            if dropped:
+                self.tree.delete(*children[-dropped:])
+            for row in reversed(page):
+                self.tree.insert("", 0, iid=row[0], values=row[1:])
+        if top and self.tree.exists(top):
+            self.tree.yview_moveto(self.tree.index(top) / max(len(self.window.rows), 1))
+        self.update_position_label()
+
+    def on_shift_error(self, error):
+        self.shift_pending = False
+        print(error)
+
+    def edit_selected(self):
+        """ Ask for the new date, quantity and price of the selected transaction, and change it """
+        selected = self.tree.selection()
+        if len(selected) != 1:
+            return
+        row = next(row for row in self.window.rows if str(row[0]) == selected[0])
+        date = simpledialog.askstring("Edit Transaction", "Date (YYYY-MM-DD):", initialvalue=row[1], parent=self)
+        if date is None:
+            return
+        quantity = simpledialog.askfloat("Edit Transaction", "Quantity:", initialvalue=row[6], parent=self)
+        if quantity is None:
+            return
+        price = simpledialog.askfloat("Edit Transaction", "Price:", initialvalue=row[5], parent=self)
+        if price is None:
+            return
+        try:
+            date = datetime.date.fromisoformat(date.strip()).isoformat()
+        except ValueError:
+            self.filter_status.config(text="Dates are YYYY-MM-DD")
+            return
+        self.apply_change(self.worker.submit(db.update_transaction, self.db_file, row[0], quantity=quantity, price=price,
+                                             date=date))
+
+    def delete_selected(self):
+        selected = self.tree.selection()
+        if selected:
+            self.apply_change(self.worker.submit(db.delete_transactions, self.db_file, [int(iid) for iid in selected]))
+
+    def undo(self):
+        self.apply_change(self.worker.submit(db.undo, self.db_file))
+
+    def redo(self):
+        self.apply_change(self.worker.submit(db.redo, self.db_file))
+
+    def apply_change(self, future):
+        """ Once the change written by future is in, a db.Change, refresh its rows in the window and show them
+        in the list, without reloading it
+        """
+        def refresh(change):
+            if change is not None:
+                window = self.window
+                future = self.worker.submit(window.refresh, change.transaction_ids)
+                self.worker.then(future, lambda refreshed: self.show_refresh(window, *refreshed))
+            self.update_undo_buttons()
+        self.worker.then(future, refresh)
+
+    def show_refresh(self, window, removed, inserted):
+        if window is not self.window:
+            return
+        self.tree.delete(*[iid for iid in removed if self.tree.exists(iid)])
+        self.insert_rows(window, inserted)
+
+    def update_undo_buttons(self):
+        self.worker.then(self.worker.submit_query(db.undo_redo_state, self.db_file), self.show_undo_state)
+
+    def show_undo_state(self, state):
+        undo_description, redo_description = state
+        self.undo_button.config(text=f"Undo {undo_description}" if undo_description else "Undo",
+                                state="normal" if undo_description else "disabled")
+        self.redo_button.config(text=f"Redo {redo_description}" if redo_description else "Redo",
+                                state="normal" if redo_description else "disabled")
+
+    def update_position_label(self):
+        window = self.window
+        if window.rows:
+            text = (f"Transactions {window.offset + 1}-{window.offset + len(window.rows)} of {window.total}"
+                    f"{'+' if window.total_capped else ''}")
+        else:
+            text = "No transactions" if window.where is None else "No matching transactions"
+        self.position_label.config(text=text)
 
 
 
@@ -141,16 +453,140 @@ class NetValuePage(tk.Frame):
     def __init__(self, parent, controller, db_file):
         tk.Frame.__init__(self, parent)
         self.db_file = db_file
+        self.worker = controller.worker
 
-        label = tk.Label(self, text="Net Value of Investments (Under Construction)")
+        label = tk.Label(self, text="Net Value of Investments")
         label.pack(pady=10, padx=10)
 
+        self.summary = tk.Label(self, text="")
+        self.summary.pack()
+
+        # The daily net worth, drawn as a line
+        self.canvas = tk.Canvas(self, width=800, height=400, background="white")
+        self.canvas.pack(fill="both", expand=True, padx=10, pady=10)
+
         # Navigation buttons
         transactions_button = tk.Button(self, text="Transactions",
                                         command=lambda: controller.show_frame(TransactionsPage))
         transactions_button.pack()
 
-        # Here you will add code to display net value when it's implemented
+        refresh_button = tk.Button(self, text="Refresh", command=self.populate_net_value)
+        refresh_button.pack()
+
+        self.populate_net_value()
+
+    def populate_net_value(self):
+        """ Compute the net worth series on the database worker, and draw it once computed """
+        def compute(db_file):
+            import networth
+            return (networth.net_worth_series(db_file),
+                    db.get_setting(db_file, networth.PRIMARY_CURRENCY_SETTING, networth.DEFAULT_PRIMARY_CURRENCY))
+        self.summary.config(text="Computing the net worth...")
+        self.worker.then(self.worker.submit_query(compute, self.db_file), self.draw_net_value, self.on_net_value_error)
+
+    def on_net_value_error(self, error):
+        self.summary.config(text="Cancelled" if isinstance(error, worker.CancelledError) else f"Failed: {error}")
+
+    def draw_net_value(self, result):
+        series, currency = result
+        self.canvas.delete("all")
+        if series.empty:
+            self.summary.config(text="No transactions yet")
+            return
+        self.summary.config(text=f"Net worth on {series.index[-1]:%Y-%m-%d}: {series.iloc[-1]:,.2f} {currency}")
+
+        width, height, margin = int(self.canvas["width"]), int(self.canvas["height"]), 20
+        low, high = float(series.min()), float(series.max())
+        span = (high - low) or 1.0
+        # One point per pixel column is all the canvas can show
+        step = max(len(series) // (width - 2 * margin), 1)
+        values = series.to_numpy()[::step]
+        points = []
+        for i, value in enumerate(values):
+            points.append(margin + i * (width - 2 * margin) / max(len(values) - 1, 1))
+            points.append(height - margin - (value - low) * (height - 2 * margin) / span)
+        if len(points) >= 4:
+            self.canvas.create_line(*points, fill="blue")
+        self.canvas.create_text(margin, margin, anchor="nw", text=f"{high:,.0f}")
+        self.canvas.create_text(margin, height - margin, anchor="sw", text=f"{low:,.0f}")
+
+
+class ProfilePanel(tk.Toplevel):
+    """ The functions and statements recorded by the running profiler, refreshed while the window is open """
+    REFRESH_MS = 1000
+
+    def __init__(self, parent):
+        super().__init__(parent)
+        self.title("Query Profile")
+        self.geometry("1000x600")
+
+        columns = ("calls", "total ms", "p50 ms", "p95 ms", "max ms", "rows", "sql", "errors")
+        self.functions = self.make_tree("Functions", "function", columns, 220)
+        self.statements = self.make_tree("Statements", "statement", columns[:6] + ("errors",), 500)
+        tk.Label(self, text="Slow operations").pack(anchor="w", padx=5)
+        self.slow = tk.Listbox(self, height=6)
+        self.slow.pack(fill="x", padx=5)
+
+        buttons = tk.Frame(self)
+        buttons.pack(fill="x", pady=5)
+        tk.Button(buttons, text="Reset", command=self.reset).pack(side="left", padx=5)
+        tk.Button(buttons, text="Save as JSON...", command=self.save).pack(side="left")
+        self.summary = tk.Label(buttons, text="")
+        self.summary.pack(side="right", padx=5)
+        self.populate()
+
+    def make_tree(self, title, first_column, columns, first_width):
+        tk.Label(self, text=title).pack(anchor="w", padx=5)
+        frame = tk.Frame(self)
+        frame.pack(fill="both", expand=True, padx=5)
+        tree = ttk.Treeview(frame, columns=columns, height=8)
+        tree.heading("#0", text=first_column)
+        tree.column("#0", width=first_width)
+        for column in columns:
+            tree.heading(column, text=column)
+            tree.column(column, width=70, anchor="e")
+        tree.pack(side="left", fill="both", expand=True)
+        scrollbar = ttk.Scrollbar(frame, command=tree.yview)
+        scrollbar.pack(side="right", fill="y")
+        tree.configure(yscrollcommand=scrollbar.set)
+        return tree
+
+    def populate(self):
+        profiler = profiling.get_profiler()
+        if profiler is None or not self.winfo_exists():
+            return
+        report = profiler.report()
+        self.functions.delete(*self.functions.get_children())
+        for name, stats in sorted(report["functions"].items(), key=lambda item: -item[1].get("total_ms", 0)):
+            if "calls" in stats:
+                values = (stats["calls"], f"{stats['total_ms']:.1f}", f"{stats['p50_ms']:.2f}", f"{stats['p95_ms']:.2f}",
+                          f"{stats['max_ms']:.2f}", stats["rows"], stats["statements"], stats["errors"])
+            else:
+                values = ("", "", "", "", "", "", stats["statements"], "")
+            item = self.functions.insert("", "end", text=name, values=values)
+            for sql in stats["sql"]:
+                self.functions.insert(item, "end", text=sql)
+        self.statements.delete(*self.statements.get_children())
+        for sql, stats in sorted(report["statements"].items(), key=lambda item: -item[1]["total_ms"]):
+            self.statements.insert("", "end", text=sql, values=(
+                stats["calls"], f"{stats['total_ms']:.1f}", f"{stats['p50_ms']:.2f}", f"{stats['p95_ms']:.2f}",
+                f"{stats['max_ms']:.2f}", stats["rows"], stats["errors"]))
+        self.slow.delete(0, "end")
+        for entry in reversed(report["slow"]):
+            self.slow.insert("end", f"{entry['ms']:9.1f} ms  {entry['kind']:<9}  {entry['name']}")
+        self.summary.config(text=f"{len(report['statements'])} statements over {report['seconds']:.0f}s, "
+                                 f"slow above {profiler.slow_ms:g} ms")
+        self.after(self.REFRESH_MS, self.populate)
+
+    def reset(self):
+        profiler = profiling.get_profiler()
+        if profiler is not None:
+            profiler.reset()
+
+    def save(self):
+        path = filedialog.asksaveasfilename(parent=self, defaultextension=".json", filetypes=[("JSON", "*.json")])
+        if path:
+            profiling.dump(path)
 
 
 if __name__ == "__main__":
@@ -185,7 +621,14 @@ def ask_for_new_db_name():
         return None
     
 
-def get_location(db_file):
+def run_db(db_worker, func, *args):
+    """ func(*args) on the database worker, with the main loop running meanwhile, or right here without a worker """
+    if db_worker is None:
+        return func(*args)
+    return db_worker.wait(db_worker.submit(func, *args))
+
+
+def get_location(db_file, db_worker=None):
     """
     Prompts the user to select a location from a dropdown or add a new one.
     """
@@ -198,9 +641,9 @@ def get_location(db_file):
     root = tk.Tk()
     root.title("Select Location")
 
-    # Fetch locations as (id, name) tuples
-    location_tuples = db.get_locations(db_file)
-    location_names = [location[1] for location in location_tuples] + ["New one"]
+    # Locations come from the reference-data cache
+    locations = run_db(db_worker, lambda: models.get_identity_map(db_file).all(models.Location))
+    location_names = [location.name for location in locations] + ["New one"]
 
     # Create a combobox
     combo = ttk.Combobox(root, values=location_names)
@@ -220,12 +663,12 @@ def get_location(db_file):
     if user_input == "New one":
         new_location_name = simpledialog.askstring("New Location Name", "Enter new location name:", parent=None)
         new_location_description = simpledialog.askstring("New Location Description", "Enter new location description:", parent=None)
-        location_id=db.add_location(db_file, new_location_name, new_location_description)
+        location_id=run_db(db_worker, db.add_location, db_file, new_location_name, new_location_description)
         return location_id
     else:
-        return location_tuples[location_names.index(user_input)][0]
+        return locations[location_names.index(user_input)].id
 
-def get_market(db_file):
+def get_market(db_file, db_worker=None):
     """Prompts the user to select a market or add a new one"""
     def on_confirm():
         nonlocal user_input
@@ -236,9 +679,9 @@ def get_market(db_file):
     root = tk.Tk()
     root.title("Select Market")
 
-    # Fetch markets as (id, name) tuples
-    market_tuples = db.get_markets(db_file)
-    market_names = [market[1] for market in market_tuples] + ["New one"]
+    # Markets come from the reference-data cache
+    markets = run_db(db_worker, lambda: models.get_identity_map(db_file).all(models.Market))
+    market_names = [market.name for market in markets] + ["New one"]
 
     # Create a combobox
     combo = ttk.Combobox(root, values=market_names)
@@ -258,12 +701,12 @@ def get_market(db_file):
     if user_input == "New one":
         new_market_name = simpledialog.askstring("New Market Name", "Enter new market name:", parent=None)
         new_market_description = simpledialog.askstring("New Market Description", "Enter new market description:", parent=None)
-        market_id=db.add_market(db_file, new_market_name, new_market_description)
+        market_id=run_db(db_worker, db.add_market, db_file, new_market_name, new_market_description)
         return market_id
     else:
-        return market_tuples[market_names.index(user_input)][0]
+        return markets[market_names.index(user_input)].id
 
-def get_asset(db_file):
+def get_asset(db_file, db_worker=None):
     """Prompts the user to select an asset or add a new one"""
     def on_confirm():
         nonlocal user_input
@@ -274,9 +717,9 @@ def get_asset(db_file):
     root = tk.Tk()
     root.title("Select Asset")
 
-    # Fetch asset markets as (id, name) tuples
-    asset_tuples = db.get_assets(db_file)
-    asset_names = [asset[1] for asset in asset_tuples] + ["New one"]
+    # Assets come from the reference-data cache, listed by symbol
+    assets = run_db(db_worker, lambda: models.get_identity_map(db_file).all(models.Asset))
+    asset_names = [asset.symbol for asset in assets] + ["New one"]
 
     # Create a combobox
     combo = ttk.Combobox(root, values=asset_names)
@@ -301,12 +744,12 @@ def get_asset(db_file):
         new_asset_is_harmonised = simpledialog.askstring("New Asset Is Harmonised", "Enter new asset is harmonised (True/False):", parent=None)
         new_asset_is_harmonised = True if   new_asset_is_harmonised == "True" or new_asset_is_harmonised == "true" or new_asset_is_harmonised == "TRUE" or new_asset_is_harmonised == "1" or new_asset_is_harmonised == "T" else False
         
-        asset_id=db.add_asset(db_file, new_asset_name, new_asset_symbol, new_asset_type, new_asset_description, new_asset_is_harmonised)
+        asset_id=run_db(db_worker, db.add_asset, db_file, new_asset_name, new_asset_symbol, new_asset_type, new_asset_description, new_asset_is_harmonised)
         return asset_id
     else:
-        return asset_tuples[asset_names.index(user_input)][0]
+        return assets[asset_names.index(user_input)].id
 
-def get_currency(db_file):
+def get_currency(db_file, db_worker=None):
     """Prompts the user to select a currency or add a new one"""
     def on_confirm():
         nonlocal user_input
@@ -317,9 +760,9 @@ def get_currency(db_file):
     root = tk.Tk()
     root.title("Select Currency")
 
-    # Fetch currencies as (id, code, name) tuples
-    currency_tuples = db.get_currencies(db_file)
-    currency_codes = [currency[1] for currency in currency_tuples] + ["New one"]
+    # Currencies come from the reference-data cache
+    currencies = run_db(db_worker, lambda: models.get_identity_map(db_file).all(models.Currency))
+    currency_codes = [currency.code for currency in currencies] + ["New one"]
 
     # Create a combobox
     combo = ttk.Combobox(root, values=currency_codes)
@@ -340,13 +783,13 @@ def get_currency(db_file):
         new_currency_code = simpledialog.askstring("New Currency Code", "Enter new currency code:", parent=None)
         new_currency_name = simpledialog.askstring("New Currency Name", "Enter new currency name:", parent=None)
 
-        currency_id=db.add_currency(db_file, new_currency_code, new_currency_name)
+        currency_id=run_db(db_worker, db.add_currency, db_file, new_currency_code, new_currency_name)
         return currency_id
     else:
-        return currency_tuples[currency_codes.index(user_input)][0]
+        return currencies[currency_codes.index(user_input)].id
 
 
-def get_asset_market(db_file, location_id):
+def get_asset_market(db_file, location_id, db_worker=None):
     """Prompts the user to select an asset market or add a new one for a given location and market."""
     def on_confirm():
         nonlocal user_input
@@ -357,9 +800,11 @@ def get_asset_market(db_file, location_id):
     root = tk.Tk()
     root.title("Select Asset Market")
 
-    # Fetch asset markets as (id, name) tuples
-    asset_market_tuples = db.get_asset_markets(db_file, location_id)
-    asset_market_names = [asset_market[1] for asset_market in asset_market_tuples] + ["New one"]
+    # The location's asset markets, from the reference-data cache
+    asset_markets = [asset_market for asset_market in
+                     run_db(db_worker, lambda: models.get_identity_map(db_file).all(models.AssetMarket))
+                     if asset_market.location_id == location_id]
+    asset_market_names = [asset_market.name for asset_market in asset_markets] + ["New one"]
 
     # Create a combobox
     combo = ttk.Combobox(root, values=asset_market_names)
@@ -380,24 +825,24 @@ def get_asset_market(db_file, location_id):
         new_asset_market_name = simpledialog.askstring("New Asset Market Name", "Enter new asset market name:", parent=None)
         new_asset_market_description = simpledialog.askstring("New Asset Market Description", "Enter new asset market description:", parent=None)
         #getting the asset, the market, the currency
-        asset_id=get_asset(db_file)
-        market_id=get_market(db_file)
-        currency_id=get_currency(db_file)
-        asset_market_id=db.add_asset_market(db_file, location_id, new_asset_market_name, new_asset_market_description, asset_id, market_id, currency_id)
-        db.add_location_currency(db_file, location_id, currency_id)
+        asset_id=get_asset(db_file, db_worker)
+        market_id=get_market(db_file, db_worker)
+        currency_id=get_currency(db_file, db_worker)
+        asset_market_id=run_db(db_worker, db.add_asset_market, db_file, location_id, new_asset_market_name, new_asset_market_description, asset_id, market_id, currency_id)
+        run_db(db_worker, db.add_location_currency, db_file, location_id, currency_id)
 
         # Check if asset has a linked data source and add it if it doesn't
-        if not db.has_data_source(db_file, asset_id):
+        if not run_db(db_worker, db.has_data_source, db_file, asset_id):
             # Prompt user to select or define a data source
             data_source_id = define_data_source()
-            asset_name=db.get_asset_name(db_file, asset_id)
+            asset_name=run_db(db_worker, models.asset_name, db_file, asset_id)
             # Prompt user to define what should actually be connected to the data source
             data_source_connected_to = ask_what_to_link_to(new_asset_market_name, asset_name)
-            db.add_data_source_to_asset(db_file, asset_id, asset_market_id, data_source_id, data_source_connected_to)
+            run_db(db_worker, db.add_data_source_to_asset, db_file, asset_id, asset_market_id, data_source_id, data_source_connected_to)
 
         return asset_market_id
     else:
-        return asset_market_tuples[asset_market_names.index(user_input)][0]
+        return asset_markets[asset_market_names.index(user_input)].id
 
 
 #offers the user to select or define a data source from a dropdown menu
@@ -453,14 +898,14 @@ def ask_what_to_link_to(new_asset_market_name, asset_name):
     return "asset"
 
 
-def get_asset_symbol(db_file, location, market):
+def get_asset_symbol(db_file, location, market, db_worker=None):
     """
     Prompts the user to select an asset symbol or add a new one for a given location.
     """
     root = tk.Tk()
     root.withdraw()
 
-    asset_symbols = db.get_asset_symbols(db_file, location, market) + ["New one"]
+    asset_symbols = run_db(db_worker, db.get_asset_symbols, db_file, location, market) + ["New one"]
     
     asset_symbol = simpledialog.askstring("Transaction - Asset Symbol", 
                                           "Choose asset symbol:", parent=root, 
@@ -495,6 +940,7 @@ def get_transaction_date():
     root.title("Select Transaction Date")
 
     # Create a DateEntry widget
+    from tkcalendar import DateEntry
     cal = DateEntry(root, selectmode='day', year=datetime.datetime.now().year, 
                     month=datetime.datetime.now().month, day=datetime.datetime.now().day)
 
@@ -511,20 +957,21 @@ def get_transaction_date():
     return selected_date if selected_date else datetime.date.today().isoformat()
 
 
-def add_transaction_wizard(db_file):
+def add_transaction_wizard(db_file, db_worker=None):
     """
     Guides the user through the process of adding a transaction.
+    With db_worker (a worker.DBWorker), the database is read and written on its thread.
     """
-    location_id = get_location(db_file)
-    asset_market_id=get_asset_market(db_file,location_id)
+    location_id = get_location(db_file, db_worker)
+    asset_market_id=get_asset_market(db_file,location_id, db_worker)
     quantity = get_quantity()
-    currency_id = db.get_asset_market_currency(db_file, asset_market_id)
-    currency_code = db.get_currency_code(db_file, currency_id)
+    currency_id = run_db(db_worker, models.asset_market_currency, db_file, asset_market_id)
+    currency_code = run_db(db_worker, models.currency_code, db_file, currency_id)
     price = get_price(currency_code)
     date = get_transaction_date()
 
     # Add the transaction to the database
-    db.add_transaction(db_file,asset_market_id, quantity, price, date, location_id)
+    run_db(db_worker, db.add_transaction, db_file,asset_market_id, quantity, price, date, location_id)
 
 
     print(f"Adding transaction: {quantity} of {asset_market_id} at {location_id} on {date} for {price} ")
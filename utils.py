@@ -0,0 +1,20 @@
+import datetime
+
+import numpy as np
+
+import dates
+
+# Dates are handled as whole days since EPOCH in the array code
+EPOCH = np.datetime64("1970-01-01", "D")
+
+
+def to_days(iso_dates):
+    """ Convert a sequence of YYYY-MM-DD strings (or dates) to days since EPOCH """
+    return (np.array(iso_dates, dtype="datetime64[D]") - EPOCH).astype(np.int64)
+
+
+def to_day(date):
+    """ Convert one YYYY-MM-DD string, date or datetime64 to days since EPOCH """
+    if isinstance(date, (str, datetime.date)):
+        return dates.to_day(date)
+    return int((np.datetime64(date, "D") - EPOCH).astype(np.int64))
@@ -0,0 +1,192 @@
+"""
+Database work off the Tk main thread.
+
+DBWorker runs the reads and writes of the GUI on a thread of its own, one at
+a time and in the order they were submitted, so that a read submitted after
+a write sees it. submit() returns a concurrent.futures.Future at once, and
+then() hands the result to a callback on the Tk thread: finished work is
+picked up with after(), so the main loop keeps drawing while a long query
+runs (sqlite3 lets go of the GIL while SQLite steps through a statement).
+
+Queries, submitted with submit_query(), can be given up: cancel() drops
+the ones not started yet and interrupts the one running, with
+Connection.interrupt() as search.SearchWorker does. Everything else is never
+interrupted, since the functions of db.py take an interruption for an error
+and carry on with their sentinel: a write always commits or rolls back whole,
+and a TransactionWindow never moves on a page that was not read. After an
+interruption every cache keyed on db.data_version() is read again, so none
+keeps what a query cut short returned.
+
+wait() is for code that needs a result before it can go on, such as the
+steps of a wizard: the main loop keeps running while it waits.
+
+on_busy(busy) is called on the Tk thread when the worker starts and stops
+having work to do, for a loading indicator.
+
+Everything but the worker thread itself is meant to be called from the Tk
+thread.
+"""
+import queue
+import threading
+from concurrent.futures import CancelledError, Future
+
+import db
+
+# How often finished work is looked for while some is outstanding
+POLL_MS = 15
+
+
+class DBWorker:
+    """ Runs database functions on a thread of its own, and hands their results back to the Tk thread """
+
+    def __init__(self, widget, db_file, on_busy=None, poll_ms=POLL_MS):
+        self.widget = widget
+        self.db_file = db_file
+        self.on_busy = on_busy
+        self.poll_ms = poll_ms
+        self._work = queue.Queue()
+        self._lock = threading.Lock()
+        self._running = None        # the query running, which cancel() may interrupt
+        self._connection = None
+        self._interrupted = False
+        self._outstanding = {}      # future: [(callback, on_error)], until its callbacks have run
+        self._queries = set()
+        self._polling = False
+        self._busy = False
+        self._thread = threading.Thread(target=self._run, name="db-worker", daemon=True)
+        self._thread.start()
+
+    def submit(self, func, *args, **kwargs):
+        """ Run func(*args, **kwargs) on the worker thread, to the end. Returns its Future """
+        return self._submit(func, args, kwargs, False)
+
+    def submit_query(self, func, *args, **kwargs):
+        """ As submit(), for a function that only reads, which cancel() may interrupt """
+        return self._submit(func, args, kwargs, True)
+
+    def _submit(self, func, args, kwargs, query):
+        future = Future()
+        self._outstanding[future] = []
+        if query:
+            self._queries.add(future)
+        self._work.put((future, func, args, kwargs, query))
+        self._set_busy(True)
+        self._start_polling()
+        return future
+
+    def then(self, future, callback, on_error=None):
+        """ Call callback(result) on the Tk thread once future is done, or on_error(exception) if it raised
+        or was cancelled (a CancelledError). Without on_error, the exception is printed and the cancellation
+        ignored. Returns future
+        """
+        if future in self._outstanding:
+            self._outstanding[future].append((callback, on_error))
+        else:
+            # Already handed back: deliver it on the next turn of the main loop, as for any other
+            self._outstanding[future] = [(callback, on_error)]
+            self._start_polling()
+        return future
+
+    def wait(self, future):
+        """ The result of future, waiting for it with the main loop running. Raises its exception """
+        # A Tcl variable set by the callback, since wait_variable() runs the main loop until then
+        name = f"dbworker{id(future)}"
+        self.widget.setvar(name, 0)
+        self.then(future, lambda result: self.widget.setvar(name, 1), lambda error: self.widget.setvar(name, 1))
+        self.widget.wait_variable(name)
+        return future.result()
+
+    def cancel(self, future=None):
+        """ Cancel future (default: every query outstanding), interrupting it if it is running.
+        Returns True if anything was cancelled
+        """
+        futures = [future] if future is not None else list(self._outstanding)
+        cancelled = False
+        for future in futures:
+            if future not in self._queries or future.done():
+                continue
+            if future.cancel():
+                cancelled = True
+                continue
+            with self._lock:
+                if self._running is future:
+                    # Makes the statement running, if any, fail with "interrupted"
+                    self._interrupted = True
+                    self._connection.interrupt()
+                    cancelled = True
+        return cancelled
+
+    def busy(self):
+        """ Whether some work submitted has not been handed back yet """
+        return bool(self._outstanding)
+
+    def close(self):
+        """ Cancel the queries outstanding, and stop the thread once the rest of the work submitted is done """
+        self.cancel()
+        self._work.put(None)
+
+    def _run(self):
+        while True:
+            item = self._work.get()
+            if item is None:
+                return
+            future, func, args, kwargs, query = item
+            if not future.set_running_or_notify_cancel():
+                continue
+            with self._lock:
+                self._running = future if query else None
+                self._connection = db.get_db(self.db_file).connection
+                self._interrupted = False
+            try:
+                result, error = func(*args, **kwargs), None
+            except BaseException as e:
+                result, error = None, e
+            with self._lock:
+                interrupted = self._interrupted
+                self._running = None
+            if interrupted:
+                # The functions of db.py print the interruption and return their sentinel: drop it, and anything
+                # a cache may have kept of it (the net worth arrays, the analytics, the reference records)
+                db.get_db(self.db_file).invalidate()
+                future.set_exception(CancelledError())
+            elif error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(result)
+
+    def _start_polling(self):
+        if not self._polling:
+            self._polling = True
+            self.widget.after(self.poll_ms, self._poll)
+
+    def _poll(self):
+        try:
+            for future in [future for future in self._outstanding if future.done()]:
+                self._queries.discard(future)
+                self._deliver(future, self._outstanding.pop(future))
+        finally:
+            # Even if a callback raised, so that the rest are still delivered
+            if self._outstanding:
+                self.widget.after(self.poll_ms, self._poll)
+            else:
+                self._polling = False
+                self._set_busy(False)
+
+    def _deliver(self, future, callbacks):
+        try:
+            result = future.result()
+        except Exception as e:
+            for callback, on_error in callbacks:
+                if on_error is not None:
+                    on_error(e)
+                elif not isinstance(e, CancelledError):
+                    print(e)
+            return
+        for callback, on_error in callbacks:
+            callback(result)
+
+    def _set_busy(self, busy):
+        if busy != self._busy:
+            self._busy = busy
+            if self.on_busy is not None:
+                self.on_busy(busy)